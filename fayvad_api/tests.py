@@ -0,0 +1,443 @@
+import hashlib
+from unittest import mock, skipUnless
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from organizations.models import Organization
+from mail.models import (
+    Contact, Domain, EmailAccount, EmailFolder, EmailMessage, EmailTemplate, FolderSyncState, MailboxPushState,
+    MailMergeJob, MessageLocation, OutboxMessage,
+)
+from mail.services import IMAPFolderError, credentials, idle_watcher
+from mail.services.message_cache import message_cache
+from mail.services.message_search import update_search_vectors
+from mail.testing import FakeFolder, FakeIMAP, FakeMessage, with_credential_key
+
+User = get_user_model()
+
+
+@with_credential_key
+class EmailAPITestCase(TestCase):
+    """Logged-in API client of an account, with the IMAP password in the session"""
+
+    def setUp(self):
+        organization = Organization.objects.create(name='Example', domain_name='example.com')
+        domain = Domain.objects.create(name='example.com', organization=organization)
+        self.user = User.objects.create(username='ada', organization=organization)
+        self.account = EmailAccount.objects.create(user=self.user, domain=domain, email='ada@example.com',
+                                                   first_name='Ada', last_name='L')
+        self.client = APIClient()
+        self.client.force_login(self.user)
+        session = self.client.session
+        session['email_password'] = 'secret'
+        session.save()
+
+        patcher = mock.patch('fayvad_api.views.email.imap_pool')
+        self.pool = patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class EmailEventsTests(EmailAPITestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('fayvad_api.views.email.imap_idle_hub')
+        self.hub = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.hub.subscribe.return_value = True
+        self.hub.wait_for_events.return_value = {
+            'version': 4, 'folder': 'INBOX', 'unread_count': 1, 'total_count': 9, 'events': [], 'error': None}
+
+    def get(self, **params):
+        return self.client.get('/fayvad_api/email/events/', params)
+
+    def test_poll(self):
+        response = self.get(since=3, timeout=5)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'version': 4, 'folder': 'INBOX', 'unread_count': 1, 'total_count': 9,
+                                           'events': [], 'retry_after': 15})
+        self.hub.subscribe.assert_called_once_with('ada@example.com', 'secret')
+        self.hub.wait_for_events.assert_called_once_with('ada@example.com', since=3, timeout=0)
+
+    @override_settings(EMAIL_IDLE_LONGPOLL_TIMEOUT=25)
+    def test_long_poll(self):
+        response = self.get(since=3, timeout=5)
+        self.assertEqual(response.json()['retry_after'], 0)
+        self.hub.wait_for_events.assert_called_once_with('ada@example.com', since=3, timeout=5.0)
+
+    @override_settings(EMAIL_IDLE_LONGPOLL_TIMEOUT=10)
+    def test_timeout_is_capped(self):
+        self.get(timeout=600)
+        self.assertEqual(self.hub.wait_for_events.call_args.kwargs, {'since': None, 'timeout': 10})
+
+    def test_invalid_since(self):
+        self.assertEqual(self.get(since='x').status_code, 400)
+
+    def test_unavailable(self):
+        self.hub.subscribe.return_value = False
+        self.assertEqual(self.get().status_code, 503)
+        self.hub.subscribe.return_value = True
+        self.hub.wait_for_events.return_value['error'] = 'Authentication failed'
+        response = self.get()
+        self.assertEqual((response.status_code, response.json()), (503, {'error': 'Authentication failed'}))
+
+    def test_password_required(self):
+        session = self.client.session
+        del session['email_password']
+        session.save()
+        self.assertEqual(self.get().status_code, 401)
+        self.hub.subscribe.assert_not_called()
+
+
+class EmailEventsHubTests(EmailAPITestCase):
+    """email/events/ answered by a real hub; watcher threads are not started"""
+
+    def setUp(self):
+        super().setUp()
+        for name in ('start', 'is_alive'):
+            patcher = mock.patch.object(idle_watcher.MailboxWatcher, name, return_value=True)
+            setattr(self, name, patcher.start())
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch('fayvad_api.views.email.imap_idle_hub', idle_watcher.IdleHub())
+        self.hub = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, **params):
+        return self.client.get('/fayvad_api/email/events/', params)
+
+    def test_events_since_last_poll(self):
+        first = self.get().json()
+        self.assertEqual((first['version'], first['events'], first['retry_after']), (0, [], 15))
+        self.hub.publish('ada@example.com', 'new_mail', 3, 1, new_count=1)
+        second = self.get(since=first['version']).json()
+        self.assertEqual([(event['type'], event['new_count']) for event in second['events']], [('new_mail', 1)])
+        self.assertEqual((second['version'], second['unread_count']), (1, 1))
+        self.assertEqual(self.start.call_count, 1)
+
+    def test_watcher_of_another_process(self):
+        MailboxPushState.objects.create(email='ada@example.com', version=5, watcher='mx2:42',
+                                        watcher_heartbeat=timezone.now())
+        self.assertEqual(self.get().json()['version'], 5)
+        self.start.assert_not_called()
+
+    def test_refused_password(self):
+        MailboxPushState.objects.create(email='ada@example.com', error='Authentication failed',
+                                        failed_digest=hashlib.sha256(b'secret').hexdigest(), failed_at=timezone.now())
+        response = self.get()
+        self.assertEqual((response.status_code, response.json()), (503, {'error': 'Authentication failed'}))
+        self.start.assert_not_called()
+
+
+class MessagePartTests(EmailAPITestCase):
+    PAYLOAD = bytes(range(256)) * 4
+
+    def setUp(self):
+        super().setUp()
+        self.conn = FakeIMAP(folders={'INBOX': FakeFolder({5: FakeMessage(parts={'2': self.PAYLOAD})})})
+        self.conn.select('INBOX')
+        self.conn.uidvalidity = 7
+        self.pool.acquire.return_value = self.conn
+        patcher = mock.patch('fayvad_api.views.email.fetch_part_info', return_value={
+            'part': '2', 'content_type': 'application/pdf', 'encoding': 'binary', 'size': len(self.PAYLOAD),
+            'content_id': None, 'disposition': 'attachment', 'filename': 'report.pdf'})
+        self.part_info = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, ref='7:5', folder='INBOX', **headers):
+        return self.client.get(f'/fayvad_api/email/messages/{ref}/parts/2/', {'folder': folder}, **headers)
+
+    def test_whole_part(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.PAYLOAD)
+        self.assertEqual(response['Content-Length'], str(len(self.PAYLOAD)))
+        self.assertEqual(response['ETag'], '"7-5-2"')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="report.pdf"')
+        self.pool.acquire.assert_called_once_with('ada@example.com', 'secret', folder='INBOX')
+        self.pool.release.assert_called_once_with(self.conn)
+
+    def test_range(self):
+        response = self.get(HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.PAYLOAD[100:200])
+        self.assertEqual(response['Content-Range'], f'bytes 100-199/{len(self.PAYLOAD)}')
+        self.assertEqual(response['Content-Length'], '100')
+
+    def test_range_ignored_for_other_if_range(self):
+        response = self.get(HTTP_RANGE='bytes=100-199', HTTP_IF_RANGE='"7-5-3"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.PAYLOAD)
+
+    def test_unsatisfiable_range(self):
+        response = self.get(HTTP_RANGE=f'bytes={len(self.PAYLOAD)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.PAYLOAD)}')
+        self.pool.release.assert_called_once_with(self.conn)
+
+    def test_stale_ref(self):
+        response = self.get(ref='6:5')
+        self.assertEqual(response.status_code, 409)
+        self.pool.release.assert_called_once_with(self.conn)
+
+    def test_unknown_part(self):
+        self.part_info.return_value = None
+        response = self.get()
+        self.assertEqual(response.status_code, 404)
+        self.pool.release.assert_called_once_with(self.conn)
+
+    def test_unknown_folder(self):
+        self.pool.acquire.side_effect = IMAPFolderError('Cannot select folder Missing')
+        response = self.get(folder='Missing')
+        self.assertEqual((response.status_code, response.json()), (404, {'error': 'Folder not found: Missing'}))
+        self.part_info.assert_not_called()
+
+    def test_password_required(self):
+        session = self.client.session
+        del session['email_password']
+        session.save()
+        self.assertEqual(self.get().status_code, 401)
+        self.pool.acquire.assert_not_called()
+
+
+class EmailActionTests(EmailAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.conn = mock.Mock(uidvalidity=7)
+        self.pool.session.return_value.__enter__.return_value = self.conn
+        patcher = mock.patch('fayvad_api.views.email.apply_action')
+        self.apply_action = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, **data):
+        return self.client.post('/fayvad_api/email/actions/', data, format='json')
+
+    def test_one_call_for_all_refs(self):
+        self.apply_action.return_value = {5: {'status': 'ok'}, 6: {'status': 'not_found'}}
+        response = self.post(action='mark_read', ids=['7:5', '7:6', '3:9', 'junk'], folder='Archive')
+        self.assertEqual(response.status_code, 200)
+        self.pool.session.assert_called_once_with('ada@example.com', 'secret', folder='Archive')
+        self.apply_action.assert_called_once()
+        conn, action, uids, target = self.apply_action.call_args.args
+        self.assertEqual((conn, action, list(uids), target), (self.conn, 'mark_read', [5, 6], None))
+        statuses = {result['id']: result['status'] for result in response.json()['results']}
+        self.assertEqual(statuses, {'7:5': 'ok', '7:6': 'not_found', '3:9': 'stale', 'junk': 'invalid'})
+        self.assertFalse(response.json()['success'])
+
+    def test_stored_messages_and_counters_follow_the_action(self):
+        inbox = EmailFolder.objects.create(account=self.account, name='INBOX', display_name='Inbox')
+        archive = EmailFolder.objects.create(account=self.account, name='Archive', display_name='Archive')
+        now = timezone.now()
+        for uid in (5, 6):
+            EmailMessage.objects.create(folder=inbox, message_id=f'<{uid}@example.org>', uid=str(uid), subject='Hi',
+                                        sender='bob@example.org', to_recipients=['ada@example.com'],
+                                        date_sent=now, date_received=now)
+        EmailFolder.reconcile_counts()
+
+        def counts():
+            return [tuple(EmailFolder.objects.filter(pk=folder.pk).values_list('total_count', 'unread_count')[0])
+                    for folder in (inbox, archive)]
+
+        self.apply_action.return_value = {5: {'status': 'ok'}}
+        self.post(action='mark_read', ids=['7:5'])
+        self.assertEqual(counts(), [(2, 1), (0, 0)])
+        self.apply_action.return_value = {5: {'status': 'ok'}, 6: {'status': 'ok'}}
+        self.post(action='mark_unread', ids=['7:5', '7:6'])
+        self.assertEqual(counts(), [(2, 2), (0, 0)])
+        self.apply_action.return_value = {5: {'status': 'ok', 'id': '9:1'}}
+        self.post(action='move', ids=['7:5'], target_folder='Archive')
+        self.assertEqual(counts(), [(1, 1), (1, 1)])
+        self.assertEqual(EmailMessage.objects.get(message_id='<5@example.org>').uid, '1')
+        self.apply_action.return_value = {6: {'status': 'ok'}}
+        self.post(action='delete', ids=['7:6'])
+        self.assertEqual(counts(), [(0, 0), (1, 1)])
+        self.assertEqual(EmailMessage.objects.count(), 1)
+
+    def test_validation(self):
+        self.assertEqual(self.post(ids=['7:5']).status_code, 400)
+        self.assertEqual(self.post(action='explode', ids=['7:5']).status_code, 400)
+        self.assertEqual(self.post(action='move', ids=['7:5']).status_code, 400)
+        self.pool.session.assert_not_called()
+
+    def test_default_folder(self):
+        self.apply_action.return_value = {5: {'status': 'ok'}}
+        self.post(action='mark_read', ids=['7:5'])
+        self.pool.session.assert_called_once_with('ada@example.com', 'secret', folder='INBOX')
+
+    def test_unknown_folder(self):
+        self.pool.session.return_value.__enter__.side_effect = IMAPFolderError('Cannot select folder Missing')
+        response = self.post(action='mark_read', ids=['7:5'], folder='Missing')
+        self.assertEqual((response.status_code, response.json()), (404, {'error': 'Folder not found: Missing'}))
+        self.apply_action.assert_not_called()
+
+    def test_password_required(self):
+        session = self.client.session
+        del session['email_password']
+        session.save()
+        self.assertEqual(self.post(action='mark_read', ids=['7:5']).status_code, 401)
+        self.pool.session.assert_not_called()
+
+
+@skipUnless(connection.vendor == 'postgresql', 'full-text search needs PostgreSQL')
+class SearchMessagesTests(EmailAPITestCase):
+    def setUp(self):
+        super().setUp()
+        folder = EmailFolder.objects.create(account=self.account, name='INBOX', display_name='Inbox')
+        now = timezone.now()
+        for uid in range(1, 4):
+            EmailMessage.objects.create(folder=folder, message_id=f'<{uid}@example.org>', uid=str(uid),
+                                        subject=f'Invoice {uid}', sender='bob@example.org',
+                                        to_recipients=['ada@example.com'], date_sent=now, date_received=now)
+        update_search_vectors({pk: '' for pk in EmailMessage.objects.values_list('pk', flat=True)})
+
+    def get(self, **params):
+        return self.client.get('/fayvad_api/email/search/', params)
+
+    def test_search(self):
+        response = self.get(query='invoice', limit=2, page=2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), 1)
+        self.pool.acquire.assert_not_called()
+
+    def test_query_required(self):
+        self.assertEqual(self.get(query=' ').status_code, 400)
+        self.assertEqual(self.get(query='invoice', page='x').status_code, 400)
+
+
+class MessageDetailLocationTests(EmailAPITestCase):
+    def setUp(self):
+        super().setUp()
+        archive = EmailFolder.objects.create(account=self.account, name='Archive', display_name='Archive')
+        FolderSyncState.objects.create(folder=archive, mailbox='Archive', uidvalidity=9)
+        MessageLocation.objects.create(folder=archive, uidvalidity=9, uid=5, message_id='<5@example.org>')
+        self.conn = mock.Mock(uidvalidity=9)
+        self.conn.select.return_value = ('OK', [b'1'])
+        self.pool.acquire.return_value = self.conn
+        patcher = mock.patch('fayvad_api.views.email.fetch_message_structure', return_value=None)
+        self.fetch_structure = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_selects_only_the_indexed_folder(self):
+        response = self.client.get('/fayvad_api/email/messages/9:5/', {'folder': 'INBOX'})
+        self.conn.select.assert_called_once_with('Archive')
+        self.fetch_structure.assert_called_once_with(self.conn, '5')
+        # Gone from the server: 404 and the stale location is dropped
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json(), {'error': 'Message 9:5 not found in Archive'})
+        self.assertFalse(MessageLocation.objects.exists())
+
+    def test_lookup_by_message_id(self):
+        self.client.get('/fayvad_api/email/messages/lookup/', {'message_id': '<5@example.org>'})
+        self.conn.select.assert_called_once_with('Archive')
+        self.fetch_structure.assert_called_once_with(self.conn, '5')
+
+    def test_opening_marks_the_stored_message_read(self):
+        archive = EmailFolder.objects.get(name='Archive')
+        now = timezone.now()
+        EmailMessage.objects.create(folder=archive, message_id='<5@example.org>', uid='5', subject='Hi',
+                                    sender='bob@example.org', to_recipients=['ada@example.com'],
+                                    date_sent=now, date_received=now)
+        EmailFolder.reconcile_counts()
+        self.addCleanup(message_cache.clear)
+        self.fetch_structure.return_value = {b'FLAGS': (), b'BODY[HEADER]': b'Subject: Hi\r\n\r\n'}
+        with mock.patch('fayvad_api.views.email.display_parts', return_value=(None, None)), \
+                mock.patch('fayvad_api.views.email.attachment_manifest', return_value=[]):
+            response = self.client.get('/fayvad_api/email/messages/9:5/')
+        self.assertEqual((response.status_code, response.json()['is_read']), (200, False))
+        self.assertTrue(EmailMessage.objects.get().is_read)
+        archive.refresh_from_db()
+        self.assertEqual((archive.total_count, archive.unread_count), (1, 0))
+
+
+class SendEmailTests(EmailAPITestCase):
+    """Sending queues the message for the outbox worker and answers 202"""
+
+    def send(self, **data):
+        payload = {'to_emails': ['bob@example.org'], 'subject': 'Hello', 'body': 'Hi Bob'}
+        payload.update(data)
+        return self.client.post('/fayvad_api/email/send/', payload, format='json')
+
+    def test_send_queues_message(self):
+        response = self.send(bcc_emails=['cy@example.org'])
+        self.assertEqual(response.status_code, 202)
+        entry = OutboxMessage.objects.get()
+        self.assertEqual(response.json(), {'success': True, 'id': entry.pk, 'message_id': entry.message_id,
+                                           'status': 'queued'})
+        self.assertEqual((entry.account, credentials.unseal(entry.smtp_password)), (self.account, 'secret'))
+        self.assertEqual(entry.recipients, ['bob@example.org', 'cy@example.org'])
+        self.assertIn(b'Subject: Hello', bytes(entry.raw))
+
+    def test_missing_fields(self):
+        self.assertEqual(self.send(subject='').status_code, 400)
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_outbox_status(self):
+        entry_id = self.send().json()['id']
+        OutboxMessage.objects.filter(pk=entry_id).update(attempts=1, last_error='451 Try again later')
+        response = self.client.get(f'/fayvad_api/email/outbox/{entry_id}/')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual((data['status'], data['attempts'], data['last_error'], data['sent_at']),
+                         ('queued', 1, '451 Try again later', None))
+        self.assertIsNotNone(data['next_attempt_at'])
+
+    def test_outbox_status_of_another_user(self):
+        entry_id = self.send().json()['id']
+        other = User.objects.create(username='eve', organization=self.user.organization)
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(f'/fayvad_api/email/outbox/{entry_id}/').status_code, 404)
+
+
+class MailMergeAPITests(EmailAPITestCase):
+    """Queueing a merge job and reading its progress"""
+
+    def setUp(self):
+        super().setUp()
+        Contact.objects.create(user=self.user, first_name='Bob', last_name='B', email='bob@example.org', tags=['vip'])
+        Contact.objects.create(user=self.user, first_name='Cy', last_name='C', email='cy@example.org')
+        self.template = EmailTemplate.objects.create(user=self.user, name='News', subject_template='News',
+                                                     body_template='Hi {{ first_name }}')
+
+    def create(self, **data):
+        return self.client.post('/fayvad_api/email/merge/', {'template_id': self.template.pk, **data}, format='json')
+
+    def test_create(self):
+        response = self.create(tag='vip')
+        self.assertEqual(response.status_code, 202)
+        job = MailMergeJob.objects.get()
+        self.assertEqual(response.json(), {'id': job.pk, 'status': 'pending', 'total': 1})
+        self.assertEqual((job.tag, credentials.unseal(job.smtp_password)), ('vip', 'secret'))
+
+    def test_invalid_template(self):
+        self.template.body_template = '{% for %}'
+        self.template.save()
+        self.assertEqual(self.create().status_code, 400)
+        self.assertEqual(self.create(context='x').status_code, 400)
+
+    def test_template_of_another_user(self):
+        other = User.objects.create(username='eve')
+        template = EmailTemplate.objects.create(user=other, name='Mine', subject_template='S', body_template='B')
+        self.assertEqual(self.create(template_id=template.pk).status_code, 404)
+
+    def test_progress(self):
+        job_id = self.create().json()['id']
+        MailMergeJob.objects.filter(pk=job_id).update(status=MailMergeJob.STATUS_RUNNING, sent_count=1)
+        response = self.client.get(f'/fayvad_api/email/merge/{job_id}/')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual((data['status'], data['total'], data['sent'], data['failed']), ('running', 2, 1, 0))
+        self.assertEqual(self.client.get('/fayvad_api/email/merge/999999/').status_code, 404)
+
+
+class OrgDashboardTests(EmailAPITestCase):
+    def test_rate_limits(self):
+        Domain.objects.filter(pk=self.account.domain_id).update(message_limit=360)
+        self.user.role = 'org_admin'
+        self.user.save()
+        response = self.client.get('/fayvad_api/org/dashboard/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['rate_limits'], [{
+            'domain': 'example.com', 'message_limit': 360, 'capacity': 30.0, 'available': 30.0, 'accounts': [],
+        }])
@@ -1,9 +1,10 @@
 from django.urls import path
 from .views.auth import api_login, api_logout, api_me, api_update_me, api_refresh_token
 from .views.email import (
-    email_auth, get_folders, get_messages, get_message_detail, send_email,
+    email_auth, get_folders, get_messages, get_message_detail, get_message_part, send_email,
     perform_email_actions, search_messages, upload_attachment, download_attachment,
-    get_drafts, save_draft, delete_draft, check_new_emails
+    get_drafts, save_draft, delete_draft, check_new_emails, email_events, get_outbox_status,
+    create_mail_merge, get_mail_merge
 )
 from .views.admin import (
     get_organizations, create_organization, get_organization_detail,
@@ -32,10 +33,15 @@ urlpatterns = [
     path('email/folders/', get_folders, name='get_folders'),
     path('email/messages/', get_messages, name='get_messages'),
     path('email/messages/<str:message_id>/', get_message_detail, name='get_message_detail'),
+    path('email/messages/<str:message_id>/parts/<str:part>/', get_message_part, name='get_message_part'),
     path('email/send/', send_email, name='send_email'),
+    path('email/outbox/<int:outbox_id>/', get_outbox_status, name='get_outbox_status'),
+    path('email/merge/', create_mail_merge, name='create_mail_merge'),
+    path('email/merge/<int:job_id>/', get_mail_merge, name='get_mail_merge'),
     path('email/actions/', perform_email_actions, name='perform_email_actions'),
     path('email/search/', search_messages, name='search_messages'),
     path('email/check-new/', check_new_emails, name='check_new_emails'),
+    path('email/events/', email_events, name='email_events'),
 
     # Attachment operations
     path('email/attachments/upload/', upload_attachment, name='upload_attachment'),
@@ -1,15 +1,35 @@
 from django.shortcuts import get_object_or_404
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.views.decorators.http import require_http_methods, require_GET, require_POST
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.decorators import login_required
 from django.core.paginator import Paginator
 from django.db.models import Q
+from django.template import TemplateSyntaxError
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
-from mail.models import EmailAccount, EmailMessage, EmailFolder, EmailAttachment, Draft
+from mail.models import (
+    EmailAccount, EmailMessage, EmailFolder, EmailAttachment, Draft, EmailTemplate, MailMergeJob, OutboxMessage
+)
+from mail.services import imap_pool, IMAPConnectionError, IMAPFolderError
+from mail.services.imap_fetch import (
+    fetch_summaries, make_message_ref, parse_message_ref, resolve_uid, StaleMessageRef,
+    fetch_message_structure, display_parts, fetch_body_parts, attachment_manifest, fetch_part_info
+)
+from mail.services.imap_actions import ACTIONS, apply_action
+from mail.services.imap_stream import PartReader, SessionStream, parse_range_header
+from mail.services.folder_status import (
+    get_cached_folder_status, get_folder_status, invalidate_folder_status, list_folder_status,
+    set_cached_folder_status, update_cached_folder
+)
+from mail.services.idle_watcher import imap_idle_hub
+from mail.services.message_cache import message_cache
+from mail.services.message_locations import apply_action_results, forget_ref, locate
+from mail.services.message_search import search_messages as search_stored_messages
+from mail.services.mail_merge import create_job as create_merge_job
+from mail.services.outbox import enqueue as enqueue_message
 from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
 import os
@@ -19,6 +39,7 @@ import logging
 import requests
 from django.conf import settings
 import email.utils
+from urllib.parse import urlencode
 
 logger = logging.getLogger(__name__)
 
@@ -39,105 +60,36 @@ def get_folders(request):
         if not password:
             return Response({'error': 'Email password required. Please login again.'}, status=status.HTTP_401_UNAUTHORIZED)
         
-        # Import IMAP functions
-        import imaplib
-        import socket
-        import os
-        
-        # IMAP Configuration
-        if os.path.exists('/.dockerenv'):
-            IMAP_HOST = getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
-        else:
-            IMAP_HOST = getattr(settings, 'EMAIL_IMAP_HOST', 'mail.fayvad.com')
-            try:
-                socket.gethostbyname(IMAP_HOST)
-            except socket.gaierror:
-                IMAP_HOST = getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
-        
-        IMAP_PORT = 993
-        IMAP_USE_SSL = True
+        # Serve counters from the per-account cache when fresh
+        folders_list = get_cached_folder_status(email_account.email)
+        if folders_list is not None:
+            return Response({'folders': folders_list})
         
-        # Connect to IMAP
+        # Borrow a pooled IMAP session
         try:
-            if IMAP_USE_SSL:
-                mail = imaplib.IMAP4_SSL(IMAP_HOST, IMAP_PORT, timeout=10)
-            else:
-                mail = imaplib.IMAP4(IMAP_HOST, IMAP_PORT, timeout=10)
-            
-            mail.login(email_account.email, password)
-        except Exception as e:
+            mail = imap_pool.acquire(email_account.email, password)
+        except IMAPConnectionError as e:
             logger.error(f"IMAP connection failed: {e}")
             return Response({'error': f'IMAP connection failed: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         
         try:
-            # List all folders
-            status_code, folders_data = mail.list()
-            if status_code != 'OK':
-                mail.logout()
+            # One LIST-STATUS round trip (or LIST + STATUS per folder) covers all folders
+            try:
+                folders_list = list_folder_status(mail)
+            except mail.abort:
+                raise
+            except mail.error as e:
+                imap_pool.release(mail)
+                logger.error(f"Failed to list folders: {e}")
                 return Response({'error': 'Failed to list folders'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
             
-            # Default folders to check
-            default_folders = ['INBOX', 'Sent', 'Drafts', 'Trash', 'Spam']
-            folders_list = []
-            
-            for folder_name in default_folders:
-                try:
-                    # Try to select folder to check if it exists
-                    status_code, messages = mail.select(folder_name)
-                    if status_code == 'OK':
-                        # Get message count
-                        status_code, message_ids = mail.search(None, 'ALL')
-                        total = len(message_ids[0].split()) if message_ids[0] else 0
-                        
-                        # Get unread count
-                        status_code, unread_ids = mail.search(None, 'UNSEEN')
-                        unseen = len(unread_ids[0].split()) if unread_ids[0] else 0
-                        
-                        folder_type_map = {
-                            'INBOX': 'inbox',
-                            'Sent': 'sent',
-                            'Drafts': 'drafts',
-                            'Trash': 'trash',
-                            'Spam': 'spam'
-                        }
-                        
-                        folders_list.append({
-                            'name': folder_name,
-                            'type': folder_type_map.get(folder_name, 'other'),
-                            'total': total,
-                            'unseen': unseen
-                        })
-                    else:
-                        # Folder doesn't exist, create it or add with 0 count
-                        folders_list.append({
-                            'name': folder_name,
-                            'type': folder_type_map.get(folder_name, 'other'),
-                            'total': 0,
-                            'unseen': 0
-                        })
-                except Exception as e:
-                    logger.warning(f"Error checking folder {folder_name}: {e}")
-                    # Add folder with 0 count if error
-                    folder_type_map = {
-                        'INBOX': 'inbox',
-                        'Sent': 'sent',
-                        'Drafts': 'drafts',
-                        'Trash': 'trash',
-                        'Spam': 'spam'
-                    }
-                    folders_list.append({
-                        'name': folder_name,
-                        'type': folder_type_map.get(folder_name, 'other'),
-                        'total': 0,
-                        'unseen': 0
-                    })
-            
-            mail.logout()
+            imap_pool.release(mail)
             
+            set_cached_folder_status(email_account.email, folders_list)
             return Response({'folders': folders_list})
             
         except Exception as e:
-            mail.logout()
+            imap_pool.discard(mail)
             logger.error(f"Error retrieving folders: {e}")
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -168,43 +120,10 @@ def get_messages(request):
         limit = min(int(request.GET.get('limit', 50)), 100)  # Max 100 per page
         offset = (page - 1) * limit
 
-        # Import IMAP functions
-        import imaplib
-        import email
-        from email.header import decode_header
-        from django.conf import settings
-        
-        # IMAP Configuration
-        # In Docker, use IP directly or check if hostname resolves
-        import socket
-        import os
-        
-        # Check if we're in Docker
-        if os.path.exists('/.dockerenv'):
-            # In Docker, prefer IP address for IMAP
-            IMAP_HOST = getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
-        else:
-            IMAP_HOST = getattr(settings, 'EMAIL_IMAP_HOST', 'mail.fayvad.com')
-            # Try to resolve, fallback to IP if fails
-            try:
-                socket.gethostbyname(IMAP_HOST)
-            except socket.gaierror:
-                IMAP_HOST = getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
-                logger.info(f"Using IP address {IMAP_HOST} instead of hostname")
-        
-        # Use port 993 (SSL) for IMAP - override settings if needed
-        IMAP_PORT = 993  # Always use SSL port for secure connection
-        IMAP_USE_SSL = True  # Always use SSL for IMAP
-        
-        # Connect to IMAP
+        # Borrow a pooled IMAP session
         try:
-            if IMAP_USE_SSL:
-                mail = imaplib.IMAP4_SSL(IMAP_HOST, IMAP_PORT, timeout=10)
-            else:
-                mail = imaplib.IMAP4(IMAP_HOST, IMAP_PORT, timeout=10)
-            
-            mail.login(email_account.email, password)
-        except Exception as e:
+            mail = imap_pool.acquire(email_account.email, password)
+        except IMAPConnectionError as e:
             logger.error(f"IMAP connection failed: {e}")
             return Response({'error': f'IMAP connection failed: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         
@@ -227,164 +146,42 @@ def get_messages(request):
                         mail.create(imap_folder)
                         status_code, messages = mail.select(imap_folder)
                         if status_code != 'OK':
-                            mail.logout()
+                            imap_pool.release(mail)
                             return Response({'error': f'Folder not found and could not be created: {folder_name}'}, status=status.HTTP_404_NOT_FOUND)
                     except Exception as e:
                         logger.warning(f"Could not create folder {folder_name}: {e}")
                         # Try selecting again - folder might exist but selection failed
                         status_code, messages = mail.select(imap_folder)
                         if status_code != 'OK':
-                            mail.logout()
+                            imap_pool.release(mail)
                             return Response({'error': f'Folder not accessible: {folder_name}'}, status=status.HTTP_404_NOT_FOUND)
                 else:
-                    mail.logout()
+                    imap_pool.release(mail)
                     return Response({'error': f'Folder not found: {folder_name}'}, status=status.HTTP_404_NOT_FOUND)
             
-            # Search for messages
-            status_code, message_ids = mail.search(None, 'ALL')
-            if status_code != 'OK':
-                mail.logout()
-                return Response({'error': 'Failed to search messages'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            # Message count comes straight from the SELECT response (EXISTS)
+            total = int(messages[0]) if messages and messages[0] else 0
             
-            # Get message IDs
-            message_id_list = message_ids[0].split()
-            total = len(message_id_list)
+            # Paginate by sequence number (most recent first)
+            end = total - offset
+            start = max(1, end - limit + 1)
             
-            # Paginate (most recent first)
-            start = max(0, total - offset - limit)
-            end = max(0, total - offset)
-            message_ids_to_fetch = message_id_list[start:end]
-            
-            # Fetch messages
+            # One FETCH for the whole page: flags, envelope, size, structure and a snippet peek
             messages_list = []
-            for msg_id in reversed(message_ids_to_fetch):  # Most recent first
-                try:
-                    status_code, msg_data = mail.fetch(msg_id, '(RFC822 FLAGS)')
-                    if status_code == 'OK' and msg_data and msg_data[0]:
-                        # Parse email - msg_data format: [(b'1 (FLAGS (\\Seen) RFC822 {...}', b'...email content...')]
-                        # Find the RFC822 part
-                        email_body = None
-                        flags_str = ''
-                        
-                        if isinstance(msg_data[0], tuple):
-                            # Standard format: (flags_string, email_body)
-                            if len(msg_data[0]) >= 2:
-                                flags_str = msg_data[0][0].decode('utf-8') if isinstance(msg_data[0][0], bytes) else str(msg_data[0][0])
-                                email_body = msg_data[0][1]
-                            elif len(msg_data[0]) == 1:
-                                email_body = msg_data[0][0]
-                        else:
-                            # Fallback: try to find email body
-                            for item in msg_data[0]:
-                                if isinstance(item, bytes) and len(item) > 100:
-                                    email_body = item
-                                    break
-                        
-                        if not email_body:
-                            continue
-                            
-                        email_message = email.message_from_bytes(email_body)
-                        
-                        # Decode subject
-                        subject, encoding = decode_header(email_message['Subject'])[0] if email_message['Subject'] else (None, None)
-                        if isinstance(subject, bytes):
-                            subject = subject.decode(encoding or 'utf-8', errors='ignore') if subject else '(no subject)'
-                        else:
-                            subject = subject or '(no subject)'
-                        
-                        # Decode sender
-                        sender_header = email_message.get('From', 'Unknown')
-                        sender, encoding = decode_header(sender_header)[0] if sender_header else (None, None)
-                        if isinstance(sender, bytes):
-                            sender = sender.decode(encoding or 'utf-8', errors='ignore') if sender else 'Unknown'
-                        else:
-                            sender = sender or 'Unknown'
-                        
-                        # Extract email address from sender
-                        sender_email = email.utils.parseaddr(sender)[1] or sender
-                        
-                        # Get body
-                        body_text = ''
-                        body_html = ''
-                        if email_message.is_multipart():
-                            for part in email_message.walk():
-                                content_type = part.get_content_type()
-                                content_disposition = str(part.get('Content-Disposition', ''))
-                                
-                                if 'attachment' not in content_disposition:
-                                    if content_type == 'text/plain':
-                                        try:
-                                            body_text = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                                        except:
-                                            pass
-                                    elif content_type == 'text/html':
-                                        try:
-                                            body_html = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                                        except:
-                                            pass
-                        else:
-                            content_type = email_message.get_content_type()
-                            if content_type == 'text/plain':
-                                try:
-                                    body_text = email_message.get_payload(decode=True).decode('utf-8', errors='ignore')
-                                except:
-                                    pass
-                            elif content_type == 'text/html':
-                                try:
-                                    body_html = email_message.get_payload(decode=True).decode('utf-8', errors='ignore')
-                                except:
-                                    pass
-                        
-                        # Get recipients
-                        to_recipients = email_message.get('To', '')
-                        cc_recipients = email_message.get('Cc', '')
-                        
-                        # Get date and parse it properly
-                        date_str = email_message.get('Date', '')
-                        date_received = None
-                        if date_str:
-                            try:
-                                # Parse RFC 2822 date format using email.utils
-                                from email.utils import parsedate_to_datetime
-                                parsed_date = parsedate_to_datetime(date_str)
-                                if parsed_date:
-                                    date_received = parsed_date.isoformat()  # Convert to ISO format for JSON
-                                else:
-                                    date_received = date_str  # Fallback to string if parsing fails
-                            except Exception as e:
-                                logger.warning(f"Failed to parse date '{date_str}': {e}")
-                                date_received = date_str  # Fallback to string if parsing fails
-                        else:
-                            date_received = None
-                        
-                        # Get message ID
-                        message_id = email_message.get('Message-ID', msg_id.decode('utf-8'))
-                        
-                        # Check flags for read status
-                        is_read = '\\Seen' in flags_str or 'Seen' in flags_str
-                        
-                        # Create message dict
-                        msg_dict = {
-                            'id': msg_id.decode('utf-8'),
-                            'message_id': message_id,
-                            'subject': subject,
-                            'sender': sender_email,
-                            'from_display': sender,
-                            'to_recipients': [to_recipients] if to_recipients else [],
-                            'cc_recipients': [cc_recipients] if cc_recipients else [],
-                            'body_text': body_text,
-                            'body_html': body_html,
-                            'date_received': date_received,
-                            'is_read': is_read,
-                            'has_attachments': False,  # TODO: Check for attachments
-                            'snippet': (body_text or body_html or '')[:100].replace('\n', ' '),
-                        }
-                        messages_list.append(msg_dict)
-                except Exception as e:
-                    logger.error(f"Error fetching message {msg_id}: {e}")
-                    continue
+            if end >= 1:
+                summaries = fetch_summaries(mail, f'{start}:{end}')
+                for seq in sorted(summaries, reverse=True):  # Most recent first
+                    summary = summaries[seq]
+                    # (uidvalidity, uid) identity - stable across expunges, safe to cache
+                    ref = make_message_ref(mail.uidvalidity, summary['uid'])
+                    messages_list.append({
+                        'id': ref,
+                        'uidvalidity': mail.uidvalidity,
+                        **summary,
+                        'message_id': summary['message_id'] or ref,
+                    })
             
-            mail.logout()
+            imap_pool.release(mail)
             
             # Calculate pagination metadata
             total_pages = (total + limit - 1) // limit if total > 0 else 1  # Ceiling division
@@ -402,7 +199,7 @@ def get_messages(request):
             })
             
         except Exception as e:
-            mail.logout()
+            imap_pool.discard(mail)
             logger.error(f"Error retrieving messages: {e}")
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -455,35 +252,30 @@ def get_message_detail(request, message_id):
         # Get folder from query params (default to INBOX)
         folder_name = request.GET.get('folder', 'INBOX')
         
-        # Import IMAP functions
-        import imaplib
-        import email
-        from email.header import decode_header
-        import socket
-        import os
+        # The location index knows the message's current folder (and, for a Message-ID
+        # lookup, its UID), so only that folder is selected
+        location = locate(email_account, ref=message_id, message_id=request.GET.get('message_id'))
+        if location is not None:
+            folder_name = location.mailbox
+            message_id = location.ref
         
-        # IMAP Configuration
-        if os.path.exists('/.dockerenv'):
-            IMAP_HOST = getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
-        else:
-            IMAP_HOST = getattr(settings, 'EMAIL_IMAP_HOST', 'mail.fayvad.com')
-            try:
-                socket.gethostbyname(IMAP_HOST)
-            except socket.gaierror:
-                IMAP_HOST = getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
+        # Repeat views are served from the parsed message cache without touching IMAP
+        try:
+            ref_validity, ref_uid = parse_message_ref(message_id)
+        except ValueError:
+            ref_validity = ref_uid = None
+        cached_message = message_cache.get(email_account.email, folder_name, ref_validity, ref_uid) if ref_validity else None
+        if cached_message is not None:
+            return Response(cached_message)
         
-        IMAP_PORT = 993
-        IMAP_USE_SSL = True
+        # Import email parsing functions
+        import email
+        from email.header import decode_header
         
-        # Connect to IMAP
+        # Borrow a pooled IMAP session
         try:
-            if IMAP_USE_SSL:
-                mail = imaplib.IMAP4_SSL(IMAP_HOST, IMAP_PORT, timeout=10)
-            else:
-                mail = imaplib.IMAP4(IMAP_HOST, IMAP_PORT, timeout=10)
-            
-            mail.login(email_account.email, password)
-        except Exception as e:
+            mail = imap_pool.acquire(email_account.email, password)
+        except IMAPConnectionError as e:
             logger.error(f"IMAP connection failed: {e}")
             return Response({'error': f'IMAP connection failed: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         
@@ -500,58 +292,34 @@ def get_message_detail(request, message_id):
             
             status_code, messages = mail.select(imap_folder)
             if status_code != 'OK':
-                mail.logout()
+                imap_pool.release(mail)
                 return Response({'error': f'Folder not found: {folder_name}'}, status=status.HTTP_404_NOT_FOUND)
             
-            # Fetch the specific message by ID
+            # Fetch the specific message by UID
             try:
-                # message_id is the IMAP UID (as string)
-                msg_id_str = str(message_id)
-                status_code, msg_data = mail.fetch(msg_id_str, '(RFC822 FLAGS)')
-                
-                if status_code != 'OK' or not msg_data or not msg_data[0]:
-                    # Try searching all folders
-                    folders_to_check = ['INBOX', 'Sent', 'Drafts', 'Trash']
-                    message_found = False
-                    
-                    for folder in folders_to_check:
-                        if folder == imap_folder:
-                            continue
-                        try:
-                            mail.select(folder)
-                            status_code, msg_data = mail.fetch(msg_id_str, '(RFC822 FLAGS)')
-                            if status_code == 'OK' and msg_data and msg_data[0]:
-                                message_found = True
-                                break
-                        except Exception as e:
-                            logger.warning(f"Failed to search folder {folder}: {e}")
-                            continue
-                    
-                    if not message_found:
-                        mail.logout()
-                        return Response({'error': f'Message {message_id} not found in any folder'}, status=status.HTTP_404_NOT_FOUND)
-                
-                # Parse email
-                email_body = None
-                flags_str = ''
+                try:
+                    uid = resolve_uid(mail, message_id)
+                except ValueError:
+                    imap_pool.release(mail)
+                    return Response({'error': f'Invalid message ID: {message_id}'}, status=status.HTTP_400_BAD_REQUEST)
+                except StaleMessageRef as e:
+                    imap_pool.release(mail)
+                    return Response({'error': str(e)}, status=status.HTTP_409_CONFLICT)
                 
-                if isinstance(msg_data[0], tuple):
-                    if len(msg_data[0]) >= 2:
-                        flags_str = msg_data[0][0].decode('utf-8') if isinstance(msg_data[0][0], bytes) else str(msg_data[0][0])
-                        email_body = msg_data[0][1]
-                    elif len(msg_data[0]) == 1:
-                        email_body = msg_data[0][0]
-                else:
-                    for item in msg_data[0]:
-                        if isinstance(item, bytes) and len(item) > 100:
-                            email_body = item
-                            break
+                # BODYSTRUCTURE + headers first; body bytes are fetched only for the parts shown
+                fetched = fetch_message_structure(mail, uid)
                 
-                if not email_body:
-                    mail.logout()
-                    return Response({'error': 'Failed to parse email'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+                if fetched is None:
+                    # Expunged or moved by another client; the next sync records where it went
+                    if location is not None:
+                        forget_ref(email_account, mail.uidvalidity, uid)
+                    imap_pool.release(mail)
+                    return Response({'error': f'Message {message_id} not found in {imap_folder}'}, status=status.HTTP_404_NOT_FOUND)
                 
-                email_message = email.message_from_bytes(email_body)
+                structure = fetched.get(b'BODYSTRUCTURE')
+                email_message = email.message_from_bytes(fetched.get(b'BODY[HEADER]') or b'')
+                flags = [flag.decode('utf-8', errors='ignore') if isinstance(flag, bytes) else str(flag)
+                         for flag in fetched.get(b'FLAGS', ())]
                 
                 # Decode subject
                 subject, encoding = decode_header(email_message['Subject'])[0] if email_message['Subject'] else (None, None)
@@ -570,38 +338,6 @@ def get_message_detail(request, message_id):
                 
                 sender_email = email.utils.parseaddr(sender)[1] or sender
                 
-                # Get body
-                body_text = ''
-                body_html = ''
-                if email_message.is_multipart():
-                    for part in email_message.walk():
-                        content_type = part.get_content_type()
-                        content_disposition = str(part.get('Content-Disposition', ''))
-                        
-                        if 'attachment' not in content_disposition:
-                            if content_type == 'text/plain':
-                                try:
-                                    body_text = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                                except:
-                                    pass
-                            elif content_type == 'text/html':
-                                try:
-                                    body_html = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                                except:
-                                    pass
-                else:
-                    content_type = email_message.get_content_type()
-                    if content_type == 'text/plain':
-                        try:
-                            body_text = email_message.get_payload(decode=True).decode('utf-8', errors='ignore')
-                        except:
-                            pass
-                    elif content_type == 'text/html':
-                        try:
-                            body_html = email_message.get_payload(decode=True).decode('utf-8', errors='ignore')
-                        except:
-                            pass
-                
                 # Get recipients
                 to_recipients_str = email_message.get('To', '')
                 cc_recipients_str = email_message.get('Cc', '')
@@ -645,26 +381,39 @@ def get_message_detail(request, message_id):
                 msg_message_id = email_message.get('Message-ID', message_id)
                 
                 # Check flags
-                is_read = '\\Seen' in flags_str or 'Seen' in flags_str
+                is_read = '\\Seen' in flags
                 
-                # Get attachments
-                attachments = []
-                if email_message.is_multipart():
-                    for part in email_message.walk():
-                        content_disposition = str(part.get('Content-Disposition', ''))
-                        if 'attachment' in content_disposition:
-                            filename = part.get_filename()
-                            if filename:
-                                attachments.append({
-                                    'filename': filename,
-                                    'content_type': part.get_content_type(),
-                                    'size': len(part.get_payload(decode=True)) if part.get_payload(decode=True) else 0
-                                })
+                # Fetch only the displayable text parts (BODY[n] marks the message \\Seen like opening it did)
+                text_part, html_part = display_parts(structure)
+                shown_parts = [part for part in (text_part, html_part) if part]
+                texts = fetch_body_parts(mail, uid, shown_parts)
+                body_text = texts.get(text_part['part'], '') if text_part else ''
+                body_html = texts.get(html_part['part'], '') if html_part else ''
+                if not shown_parts and not is_read:
+                    mail.uid('STORE', uid, '+FLAGS.SILENT', '(\\Seen)')
                 
-                mail.logout()
+                # Attachments and inline images are described, not downloaded
+                attachments = attachment_manifest(structure)
+                message_ref = make_message_ref(mail.uidvalidity, uid)
+                for attachment in attachments:
+                    attachment['url'] = f"/fayvad_api/email/messages/{message_ref}/parts/{attachment['part']}/?{urlencode({'folder': imap_folder})}"
+                    if attachment['content_id'] and body_html:
+                        # Inline images load on demand from the part endpoint
+                        body_html = body_html.replace(f"cid:{attachment['content_id']}", attachment['url'])
+                
+                uidvalidity = mail.uidvalidity
+                imap_pool.release(mail)
+                
+                # Fetching the body parts sets \\Seen, so the unread counters may have changed
+                if not is_read:
+                    apply_action_results(email_account, imap_folder, uidvalidity, 'mark_read', {int(uid): {'status': 'ok'}})
+                invalidate_folder_status(email_account.email)
                 
                 formatted_message = {
-                    'id': message_id,
+                    'id': make_message_ref(uidvalidity, uid),
+                    'uid': int(uid),
+                    'uidvalidity': uidvalidity,
+                    'folder': imap_folder,
                     'message_id': msg_message_id,
                     'subject': subject,
                     'sender': sender_email,
@@ -679,15 +428,18 @@ def get_message_detail(request, message_id):
                     'attachments': attachments,
                 }
                 
+                # The fetch above set \\Seen, so later views see the message as read
+                message_cache.set(email_account.email, imap_folder, uidvalidity, uid, {**formatted_message, 'is_read': True})
+                
                 return Response(formatted_message)
                 
             except Exception as e:
-                mail.logout()
+                imap_pool.discard(mail)
                 logger.error(f"Error fetching message {message_id}: {e}")
                 return Response({'error': f'Failed to fetch message: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
             
         except Exception as e:
-            mail.logout()
+            imap_pool.discard(mail)
             logger.error(f"Error retrieving message detail: {e}")
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -695,6 +447,89 @@ def get_message_detail(request, message_id):
         logger.error(f"Error in get_message_detail: {e}")
         return Response({'error': 'Failed to retrieve message'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_message_part(request, message_id, part):
+    """Stream a single MIME part (attachment or inline image) from IMAP, with HTTP Range support"""
+    try:
+        # Get user's email account
+        try:
+            email_account = EmailAccount.objects.get(user=request.user, is_active=True)
+        except EmailAccount.DoesNotExist:
+            return Response({'error': 'No email account found'}, status=status.HTTP_404_NOT_FOUND)
+        
+        # Get password from session
+        password = request.session.get('email_password')
+        if not password:
+            return Response({'error': 'Email password required. Please login again.'}, status=status.HTTP_401_UNAUTHORIZED)
+        
+        folder_name = request.GET.get('folder', 'INBOX')
+        
+        # Borrow a pooled IMAP session; the streamed response hands it back when finished
+        try:
+            mail = imap_pool.acquire(email_account.email, password, folder=folder_name)
+        except IMAPFolderError:
+            return Response({'error': f'Folder not found: {folder_name}'}, status=status.HTTP_404_NOT_FOUND)
+        except IMAPConnectionError as e:
+            logger.error(f"IMAP connection failed: {e}")
+            return Response({'error': f'IMAP connection failed: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        
+        try:
+            try:
+                uid = resolve_uid(mail, message_id)
+            except ValueError:
+                imap_pool.release(mail)
+                return Response({'error': f'Invalid message ID: {message_id}'}, status=status.HTTP_400_BAD_REQUEST)
+            except StaleMessageRef as e:
+                imap_pool.release(mail)
+                return Response({'error': str(e)}, status=status.HTTP_409_CONFLICT)
+            
+            # Look the part up in BODYSTRUCTURE so only that part's bytes are fetched
+            described = fetch_part_info(mail, uid, part)
+            if described is None:
+                imap_pool.release(mail)
+                return Response({'error': 'Message part not found'}, status=status.HTTP_404_NOT_FOUND)
+            
+            reader = PartReader(mail, uid, described)
+            size = reader.size
+            
+            # A (uidvalidity, uid, part) triple never changes content, so it makes a strong ETag
+            etag = f'"{mail.uidvalidity}-{uid}-{part}"'
+            byte_range = parse_range_header(request.META.get('HTTP_RANGE'), size)
+            if_range = request.META.get('HTTP_IF_RANGE')
+            if if_range and if_range != etag:
+                byte_range = None
+            if byte_range == 'invalid':
+                imap_pool.release(mail)
+                response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+                response['Content-Range'] = f'bytes */{size}'
+                return response
+        except Exception:
+            imap_pool.discard(mail)
+            raise
+        
+        start, end = byte_range if byte_range else (0, None)
+        response = StreamingHttpResponse(
+            SessionStream(reader.iter_range(start, end), imap_pool, mail),
+            content_type=described['content_type'],
+            status=status.HTTP_206_PARTIAL_CONTENT if byte_range else status.HTTP_200_OK
+        )
+        if byte_range:
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+            response['Content-Length'] = str(end - start + 1)
+        elif size is not None:
+            response['Content-Length'] = str(size)
+        response['Accept-Ranges'] = 'bytes' if size is not None else 'none'
+        response['ETag'] = etag
+        disposition = 'inline' if described['content_id'] and described['disposition'] != 'attachment' else 'attachment'
+        filename = (described['filename'] or f'part-{part}').replace('"', '')
+        response['Content-Disposition'] = f'{disposition}; filename="{filename}"'
+        return response
+        
+    except Exception as e:
+        logger.error(f"Error downloading message part: {e}")
+        return Response({'error': 'Failed to download message part'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def send_email(request):
@@ -721,15 +556,6 @@ def send_email(request):
         if not to_emails or not subject:
             return Response({'error': 'Missing required fields'}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Use Django email service
-        from mail.services import DjangoEmailService
-        email_service = DjangoEmailService(email_account)
-        
-        # Set password for IMAP operations (for saving to Sent folder)
-        password = request.session.get('email_password')
-        if password:
-            email_service._password = password
-        
         # Extract text/html from body if it's a dict, otherwise treat as plain text
         body_text = body
         body_html = None
@@ -740,24 +566,113 @@ def send_email(request):
             body_html = body
             body_text = ''  # Will extract text from HTML if needed
 
-        result = email_service.send_email(
+        # Queue for the outbox worker; SMTP delivery and the Sent copy happen off the request
+        entry = enqueue_message(
+            email_account,
             to_emails=to_emails,
             subject=subject,
             body_text=body_text,
             body_html=body_html,
             cc_emails=cc_emails,
-            bcc_emails=bcc_emails
+            bcc_emails=bcc_emails,
+            password=request.session.get('email_password'),
         )
 
-        if result['success']:
-            return Response({'success': True, 'message_id': result.get('message_id')})
-        else:
-            return Response({'error': result.get('error', 'Failed to send email')}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return Response({
+            'success': True,
+            'id': entry.pk,
+            'message_id': entry.message_id,
+            'status': entry.status,
+        }, status=status.HTTP_202_ACCEPTED)
 
     except Exception as e:
         logger.error(f"Error sending email: {e}")
         return Response({'error': 'Failed to send email'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_outbox_status(request, outbox_id):
+    """Delivery status of a message queued by send_email"""
+    try:
+        entry = OutboxMessage.objects.defer('raw').get(pk=outbox_id, account__user=request.user)
+    except OutboxMessage.DoesNotExist:
+        return Response({'error': 'Message not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    return Response({
+        'id': entry.pk,
+        'message_id': entry.message_id,
+        'status': entry.status,
+        'attempts': entry.attempts,
+        'next_attempt_at': entry.next_attempt_at.isoformat() if entry.status == OutboxMessage.STATUS_QUEUED else None,
+        'last_error': entry.last_error or None,
+        'created_at': entry.created_at.isoformat(),
+        'sent_at': entry.sent_at.isoformat() if entry.sent_at else None,
+    })
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def create_mail_merge(request):
+    """Queue a mail merge of a template to the user's contacts (sent by run_mail_merge)"""
+    try:
+        user = request.user
+        try:
+            email_account = EmailAccount.objects.get(user=user, is_active=True)
+        except EmailAccount.DoesNotExist:
+            return Response({'error': 'No email account found'}, status=status.HTTP_404_NOT_FOUND)
+
+        template_id = request.data.get('template_id')
+        if not template_id:
+            return Response({'error': 'Missing template_id'}, status=status.HTTP_400_BAD_REQUEST)
+        context = request.data.get('context') or {}
+        if not isinstance(context, dict):
+            return Response({'error': 'context must be an object'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Own templates, or public ones shared within the organization
+        templates = EmailTemplate.objects.filter(
+            Q(user=user) | Q(is_public=True, user__email_accounts__domain__organization=email_account.domain.organization),
+            is_active=True,
+        ).distinct()
+        try:
+            template = templates.get(pk=template_id)
+        except (EmailTemplate.DoesNotExist, ValueError):
+            return Response({'error': 'Template not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            job = create_merge_job(email_account, template, tag=request.data.get('tag', ''), context=context,
+                                   password=request.session.get('email_password'))
+        except TemplateSyntaxError as e:
+            return Response({'error': f'Invalid template: {e}'}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({'id': job.pk, 'status': job.status, 'total': job.total}, status=status.HTTP_202_ACCEPTED)
+
+    except Exception as e:
+        logger.error(f"Error creating mail merge: {e}")
+        return Response({'error': 'Failed to create mail merge'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_mail_merge(request, job_id):
+    """Progress of a mail merge job"""
+    try:
+        job = MailMergeJob.objects.get(pk=job_id, account__user=request.user)
+    except MailMergeJob.DoesNotExist:
+        return Response({'error': 'Mail merge not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    return Response({
+        'id': job.pk,
+        'template_id': job.template_id,
+        'tag': job.tag,
+        'status': job.status,
+        'total': job.total,
+        'sent': job.sent_count,
+        'failed': job.failed_count,
+        'failures': job.failures,
+        'last_error': job.last_error or None,
+        'created_at': job.created_at.isoformat(),
+        'updated_at': job.updated_at.isoformat(),
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    })
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def perform_email_actions(request):
@@ -772,7 +687,7 @@ def perform_email_actions(request):
 
         action = request.data.get('action')
         message_ids = request.data.get('ids', [])
-        folder_name = request.data.get('folder')
+        folder_name = request.data.get('folder') or 'INBOX'
 
         if not action or not message_ids:
             return Response({'error': 'Missing action or message IDs'}, status=status.HTTP_400_BAD_REQUEST)
@@ -782,56 +697,45 @@ def perform_email_actions(request):
         if not password:
             return Response({'error': 'Email password required. Please login again.'}, status=status.HTTP_401_UNAUTHORIZED)
 
-        # Perform actions via IMAP
-        import imaplib
-        import socket
-        import os
-        
-        # IMAP Configuration
-        if os.path.exists('/.dockerenv'):
-            IMAP_HOST = getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
-        else:
-            IMAP_HOST = getattr(settings, 'EMAIL_IMAP_HOST', 'mail.fayvad.com')
-            try:
-                socket.gethostbyname(IMAP_HOST)
-            except socket.gaierror:
-                IMAP_HOST = getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
-        
-        IMAP_PORT = 993
-        IMAP_USE_SSL = True
+        if action not in ACTIONS:
+            return Response({'error': f'Unknown action: {action}'}, status=status.HTTP_400_BAD_REQUEST)
+        target_folder = request.data.get('target_folder')
+        if action == 'move' and not target_folder:
+            return Response({'error': 'Target folder required for move'}, status=status.HTTP_400_BAD_REQUEST)
 
+        # Perform actions via a pooled IMAP session
         try:
-            if IMAP_USE_SSL:
-                mail = imaplib.IMAP4_SSL(IMAP_HOST, IMAP_PORT, timeout=10)
-            else:
-                mail = imaplib.IMAP4(IMAP_HOST, IMAP_PORT, timeout=10)
-            
-            mail.login(email_account.email, password)
-            
-            # Select folder
-            if folder_name:
-                mail.select(folder_name)
-            
-            # Perform actions
-            for msg_id in message_ids:
-                if action == 'mark_read':
-                    mail.store(msg_id, '+FLAGS', '\\Seen')
-                elif action == 'mark_unread':
-                    mail.store(msg_id, '-FLAGS', '\\Seen')
-                elif action == 'delete':
-                    mail.store(msg_id, '+FLAGS', '\\Deleted')
-                elif action == 'move' and folder_name:
-                    # Move to target folder
-                    target_folder = request.data.get('target_folder')
-                    if target_folder:
-                        mail.copy(msg_id, target_folder)
-                        mail.store(msg_id, '+FLAGS', '\\Deleted')
-            
-            mail.expunge()
-            mail.logout()
+            with imap_pool.session(email_account.email, password, folder=folder_name) as mail:
+                # Resolve (uidvalidity, uid) references against the selected folder
+                results = {}
+                uids = {}
+                for msg_id in message_ids:
+                    try:
+                        uids[msg_id] = int(resolve_uid(mail, msg_id))
+                    except ValueError:
+                        results[msg_id] = {'status': 'invalid'}
+                    except StaleMessageRef as e:
+                        results[msg_id] = {'status': 'stale', 'error': str(e)}
+                
+                for uid in uids.values():
+                    message_cache.invalidate(email_account.email, folder_name, mail.uidvalidity, uid)
+                
+                # One command per UID set instead of one per message
+                by_uid = apply_action(mail, action, uids.values(), target_folder) if uids else {}
+                apply_action_results(email_account, folder_name, mail.uidvalidity, action, by_uid, target_folder)
+                results.update({msg_id: {'uid': uid, **by_uid[uid]} for msg_id, uid in uids.items()})
             
-            return Response({'success': True, 'message': f'Action {action} completed'})
+            if by_uid:
+                invalidate_folder_status(email_account.email)
+            succeeded = sum(1 for result in results.values() if result['status'] == 'ok')
+            return Response({
+                'success': succeeded == len(results),
+                'message': f'Action {action} completed for {succeeded} of {len(results)} messages',
+                'results': [{'id': msg_id, **result} for msg_id, result in results.items()],
+            })
             
+        except IMAPFolderError:
+            return Response({'error': f'Folder not found: {folder_name}'}, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
             logger.error(f"IMAP action failed: {e}")
             return Response({'error': f'Failed to perform action: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -843,7 +747,7 @@ def perform_email_actions(request):
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def search_messages(request):
-    """Advanced email search"""
+    """Ranked full-text search across the account's synced messages"""
     try:
         # Get user's email account
         user = request.user
@@ -853,62 +757,27 @@ def search_messages(request):
             return Response({'error': 'No email account found'}, status=status.HTTP_404_NOT_FOUND)
 
         query = request.GET.get('query', '').strip()
-        folder_name = request.GET.get('folder', 'INBOX')
-
+        folder_name = request.GET.get('folder') or None  # All folders unless given
+        
         if not query:
             return Response({'error': 'Query parameter required'}, status=status.HTTP_400_BAD_REQUEST)
-
-        # Get password from session for IMAP operations
-        password = request.session.get('email_password')
-        if not password:
-            return Response({'error': 'Email password required. Please login again.'}, status=status.HTTP_401_UNAUTHORIZED)
-
-        # Search via IMAP
-        import imaplib
-        import socket
-        import os
         
-        # IMAP Configuration
-        if os.path.exists('/.dockerenv'):
-            IMAP_HOST = getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
-        else:
-            IMAP_HOST = getattr(settings, 'EMAIL_IMAP_HOST', 'mail.fayvad.com')
-            try:
-                socket.gethostbyname(IMAP_HOST)
-            except socket.gaierror:
-                IMAP_HOST = getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
-        
-        IMAP_PORT = 993
-        IMAP_USE_SSL = True
-
         try:
-            if IMAP_USE_SSL:
-                mail = imaplib.IMAP4_SSL(IMAP_HOST, IMAP_PORT, timeout=10)
-            else:
-                mail = imaplib.IMAP4(IMAP_HOST, IMAP_PORT, timeout=10)
-            
-            mail.login(email_account.email, password)
-            mail.select(folder_name)
-            
-            # Search for query in subject, from, or body
-            search_criteria = f'(OR SUBJECT "{query}" FROM "{query}" BODY "{query}")'
-            status_code, message_ids = mail.search(None, search_criteria)
-            
-            if status_code != 'OK':
-                mail.logout()
-                return Response({'error': 'Search failed'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-            
-            message_id_list = message_ids[0].split() if message_ids[0] else []
-            mail.logout()
-            
-            return Response({
-                'results': [{'id': msg_id.decode('utf-8')} for msg_id in message_id_list],
-                'count': len(message_id_list)
-            })
-            
-        except Exception as e:
-            logger.error(f"IMAP search failed: {e}")
-            return Response({'error': f'Search failed: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            page = max(int(request.GET.get('page', 1)), 1)
+            limit = min(max(int(request.GET.get('limit', 25)), 1), 100)  # Max 100 per page
+        except ValueError:
+            return Response({'error': 'Invalid page or limit'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        # One query over the GIN-indexed search_vector instead of an IMAP SEARCH per folder
+        results = search_stored_messages(email_account, query, folder=folder_name,
+                                         limit=limit, offset=(page - 1) * limit)
+        
+        return Response({
+            'results': results,
+            'count': len(results),
+            'page': page,
+            'has_more': len(results) == limit,
+        })
 
     except Exception as e:
         logger.error(f"Error searching messages: {e}")
@@ -998,34 +867,10 @@ def check_new_emails(request):
         # Get last check timestamp (optional)
         last_check = request.GET.get('since')
         
-        # Import IMAP functions
-        import imaplib
-        import socket
-        import os
-        from django.conf import settings
-        
-        # IMAP Configuration
-        if os.path.exists('/.dockerenv'):
-            IMAP_HOST = getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
-        else:
-            IMAP_HOST = getattr(settings, 'EMAIL_IMAP_HOST', 'mail.fayvad.com')
-            try:
-                socket.gethostbyname(IMAP_HOST)
-            except socket.gaierror:
-                IMAP_HOST = getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
-        
-        IMAP_PORT = 993
-        IMAP_USE_SSL = True
-        
-        # Connect to IMAP
+        # Borrow a pooled IMAP session
         try:
-            if IMAP_USE_SSL:
-                mail = imaplib.IMAP4_SSL(IMAP_HOST, IMAP_PORT, timeout=10)
-            else:
-                mail = imaplib.IMAP4(IMAP_HOST, IMAP_PORT, timeout=10)
-            
-            mail.login(email_account.email, password)
-        except Exception as e:
+            mail = imap_pool.acquire(email_account.email, password)
+        except IMAPConnectionError as e:
             logger.error(f"IMAP connection failed: {e}")
             return Response({'error': f'IMAP connection failed: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
         
@@ -1040,24 +885,17 @@ def check_new_emails(request):
             }
             imap_folder = folder_map.get(folder_name, folder_name)
             
-            status_code, messages = mail.select(imap_folder)
-            if status_code != 'OK':
-                mail.logout()
+            # STATUS returns both counters without selecting the folder or listing message IDs
+            folder_status = get_folder_status(mail, imap_folder)
+            imap_pool.release(mail)
+            if folder_status is None:
                 return Response({'error': f'Folder not found: {folder_name}'}, status=status.HTTP_404_NOT_FOUND)
             
-            # Search for unread messages (lightweight check)
-            status_code, unread_ids = mail.search(None, 'UNSEEN')
-            if status_code != 'OK':
-                mail.logout()
-                return Response({'error': 'Failed to search messages'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-            
-            unread_count = len(unread_ids[0].split()) if unread_ids[0] else 0
+            unread_count = folder_status['unseen']
+            total_count = folder_status['total']
             
-            # Get total count
-            status_code, message_ids = mail.search(None, 'ALL')
-            total_count = len(message_ids[0].split()) if message_ids[0] and message_ids[0] else 0
-            
-            mail.logout()
+            # Keep the sidebar cache in step with what the poll just saw
+            update_cached_folder(email_account.email, folder_status)
             
             return Response({
                 'has_new': unread_count > 0,
@@ -1067,7 +905,7 @@ def check_new_emails(request):
             })
             
         except Exception as e:
-            mail.logout()
+            imap_pool.discard(mail)
             logger.error(f"Error checking new emails: {e}")
             return Response({'error': f'Failed to check emails: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
             
@@ -1075,6 +913,54 @@ def check_new_emails(request):
         logger.error(f"Error in check_new_emails: {e}")
         return Response({'error': 'Failed to check for new emails'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def email_events(request):
+    """
+    Poll for INBOX push events (new mail, flag changes) from the server-side IDLE watcher
+
+    Answers at once unless EMAIL_IDLE_LONGPOLL_TIMEOUT allows waiting (only with worker
+    classes that don't tie up a process per request); retry_after tells the client how
+    long to pause before the next poll.
+    """
+    try:
+        # Get user's email account
+        try:
+            email_account = EmailAccount.objects.get(user=request.user, is_active=True)
+        except EmailAccount.DoesNotExist:
+            return Response({'error': 'No email account found'}, status=status.HTTP_404_NOT_FOUND)
+        
+        # Get password from session
+        password = request.session.get('email_password')
+        if not password:
+            return Response({'error': 'Email password required. Please login again.'}, status=status.HTTP_401_UNAUTHORIZED)
+        
+        # Last event version the client has seen (omitted on the first call)
+        since = request.GET.get('since')
+        try:
+            since = int(since) if since not in (None, '') else None
+            max_timeout = getattr(settings, 'EMAIL_IDLE_LONGPOLL_TIMEOUT', 0)
+            timeout = max(min(float(request.GET.get('timeout', max_timeout)), max_timeout), 0)
+        except ValueError:
+            return Response({'error': 'Invalid since/timeout'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        if not imap_idle_hub.subscribe(email_account.email, password):
+            # Watcher limit reached: the client falls back to check-new polling
+            return Response({'error': 'Push channel unavailable'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        
+        result = imap_idle_hub.wait_for_events(email_account.email, since=since, timeout=timeout)
+        if result is None or result.get('error'):
+            error = result.get('error') if result else 'Push channel unavailable'
+            return Response({'error': error}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        
+        result.pop('error', None)
+        result['retry_after'] = 0 if timeout > 0 else getattr(settings, 'EMAIL_IDLE_POLL_INTERVAL', 15)
+        return Response(result)
+        
+    except Exception as e:
+        logger.error(f"Error in email_events: {e}")
+        return Response({'error': 'Failed to wait for email events'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_drafts(request):
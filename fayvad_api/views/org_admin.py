@@ -8,6 +8,7 @@ from rest_framework.response import Response
 from rest_framework import status
 from organizations.models import Organization
 from mail.models import Domain, EmailAccount
+from mail.services import rate_limit
 from accounts.models import User
 import logging
 
@@ -162,6 +163,7 @@ def get_org_dashboard(request):
             'storage_used_mb': org.storage_used_mb,
             'storage_limit_gb': org.max_storage_gb,
             'user_limit': org.max_users,
+            'rate_limits': rate_limit.levels(Domain.objects.filter(organization=org).order_by('name')),
         })
 
     except Exception as e:
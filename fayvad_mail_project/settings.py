@@ -300,12 +300,71 @@ EMAIL_HOST_USER = os.getenv('EMAIL_HOST_USER', '')  # SMTP auth username (email
 EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD', '')  # SMTP auth password
 DEFAULT_FROM_EMAIL = os.getenv('DEFAULT_FROM_EMAIL', 'noreply@fayvad.com')
 
+# SMTP connection pool (reused authenticated submission connections, keyed by sender)
+EMAIL_SMTP_POOL_MAX_SIZE = int(os.getenv('EMAIL_SMTP_POOL_MAX_SIZE', '20'))  # Max open pooled connections per process
+EMAIL_SMTP_POOL_MAX_PER_ACCOUNT = int(os.getenv('EMAIL_SMTP_POOL_MAX_PER_ACCOUNT', '2'))  # Max connections per sender, idle or in use
+EMAIL_SMTP_POOL_IDLE_TIMEOUT = int(os.getenv('EMAIL_SMTP_POOL_IDLE_TIMEOUT', '60'))  # Seconds before an idle connection is closed (below Postfix smtpd_timeout)
+EMAIL_SMTP_POOL_NOOP_INTERVAL = int(os.getenv('EMAIL_SMTP_POOL_NOOP_INTERVAL', '15'))  # Idle seconds before NOOP health check
+EMAIL_SMTP_POOL_ACQUIRE_TIMEOUT = int(os.getenv('EMAIL_SMTP_POOL_ACQUIRE_TIMEOUT', '30'))  # Seconds to wait for a free connection when the pool is full
+
+# Outbox (queued sending, delivered by the run_outbox_worker command)
+EMAIL_OUTBOX_WORKERS = int(os.getenv('EMAIL_OUTBOX_WORKERS', '4'))  # Messages delivered in parallel per worker process
+EMAIL_OUTBOX_MAX_PER_DOMAIN = int(os.getenv('EMAIL_OUTBOX_MAX_PER_DOMAIN', '2'))  # Parallel deliveries per sender domain
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.getenv('EMAIL_OUTBOX_MAX_ATTEMPTS', '8'))  # Attempts before a message is marked failed
+EMAIL_OUTBOX_RETRY_BASE = int(os.getenv('EMAIL_OUTBOX_RETRY_BASE', '60'))  # Seconds before the first retry (doubles per attempt)
+EMAIL_OUTBOX_RETRY_MAX = int(os.getenv('EMAIL_OUTBOX_RETRY_MAX', '3600'))  # Ceiling for the retry delay
+EMAIL_OUTBOX_LEASE = int(os.getenv('EMAIL_OUTBOX_LEASE', '600'))  # Seconds before a claimed message of a dead worker is requeued
+EMAIL_OUTBOX_POLL_INTERVAL = int(os.getenv('EMAIL_OUTBOX_POLL_INTERVAL', '2'))  # Seconds between queue polls when idle
+
+# Sender passwords kept with queued messages and merge jobs (encrypted, see mail/services/credentials.py)
+EMAIL_CREDENTIAL_KEY = os.getenv('EMAIL_CREDENTIAL_KEY', '')  # Fernet key, kept out of the database; required to queue mail (no SECRET_KEY fallback)
+EMAIL_CREDENTIAL_MAX_AGE = int(os.getenv('EMAIL_CREDENTIAL_MAX_AGE', '86400'))  # Seconds a stored password stays usable
+
+# Outbound rate limits (token buckets enforcing Domain.message_limit across processes)
+EMAIL_RATE_LIMIT_BURST_SECONDS = int(os.getenv('EMAIL_RATE_LIMIT_BURST_SECONDS', '300'))  # Seconds of a domain's hourly allowance that can go out at once
+EMAIL_RATE_LIMIT_ACCOUNT_PERCENT = int(os.getenv('EMAIL_RATE_LIMIT_ACCOUNT_PERCENT', '50'))  # Share of the domain limit one account may use (100 disables per-account buckets)
+
+# Mail merge (bulk sends of an EmailTemplate, run by the run_mail_merge command)
+EMAIL_MERGE_PIPELINING = os.getenv('EMAIL_MERGE_PIPELINING', 'True').lower() in ('true', '1', 'yes', 'on')  # Use SMTP PIPELINING when the server offers it
+EMAIL_MERGE_CHECKPOINT_EVERY = int(os.getenv('EMAIL_MERGE_CHECKPOINT_EVERY', '20'))  # Messages between progress saves (at most this many resent after a crash)
+EMAIL_MERGE_LEASE = int(os.getenv('EMAIL_MERGE_LEASE', '600'))  # Seconds without a checkpoint before a running job counts as abandoned
+
 # Dovecot IMAP Configuration (for receiving emails)
 # Use host.docker.internal when running in Docker, localhost otherwise
 EMAIL_IMAP_HOST = os.getenv('EMAIL_IMAP_HOST', 'host.docker.internal' if os.path.exists('/.dockerenv') else 'localhost')  # Dovecot IMAP server
 EMAIL_IMAP_PORT = int(os.getenv('EMAIL_IMAP_PORT', '143'))  # Dovecot default port (993 for SSL, 143 for plain)
 EMAIL_IMAP_USE_SSL = os.getenv('EMAIL_IMAP_USE_SSL', 'False').lower() in ('true', '1', 'yes', 'on')  # True for port 993, False for 143
 
+# IMAP session pool (reused authenticated connections for the API/mail views)
+EMAIL_IMAP_POOL_MAX_SIZE = int(os.getenv('EMAIL_IMAP_POOL_MAX_SIZE', '50'))  # Max open pooled sessions per process
+EMAIL_IMAP_POOL_MAX_PER_ACCOUNT = int(os.getenv('EMAIL_IMAP_POOL_MAX_PER_ACCOUNT', '4'))  # Max sessions per account, idle or in use (below Dovecot mail_max_userip_connections)
+EMAIL_IMAP_POOL_IDLE_TIMEOUT = int(os.getenv('EMAIL_IMAP_POOL_IDLE_TIMEOUT', '300'))  # Seconds before an idle session is closed
+EMAIL_IMAP_POOL_NOOP_INTERVAL = int(os.getenv('EMAIL_IMAP_POOL_NOOP_INTERVAL', '30'))  # Idle seconds before NOOP health check
+EMAIL_IMAP_POOL_ACQUIRE_TIMEOUT = int(os.getenv('EMAIL_IMAP_POOL_ACQUIRE_TIMEOUT', '10'))  # Seconds to wait for a free session when the pool is full
+EMAIL_FOLDER_STATUS_CACHE_TTL = int(os.getenv('EMAIL_FOLDER_STATUS_CACHE_TTL', '30'))  # Seconds folder counters are cached per account
+EMAIL_IDLE_MAX_WATCHERS = int(os.getenv('EMAIL_IDLE_MAX_WATCHERS', '100'))  # Max IDLE connections per process
+EMAIL_IDLE_LINGER = int(os.getenv('EMAIL_IDLE_LINGER', '120'))  # Seconds a watcher survives without polling clients
+EMAIL_IDLE_RENEW_INTERVAL = int(os.getenv('EMAIL_IDLE_RENEW_INTERVAL', '600'))  # Seconds before IDLE is re-issued
+EMAIL_IDLE_LONGPOLL_TIMEOUT = int(os.getenv('EMAIL_IDLE_LONGPOLL_TIMEOUT', '0'))  # Max long-poll wait; 0 answers at once, keep it 0 with sync workers (below proxy_read_timeout otherwise)
+EMAIL_IDLE_POLL_INTERVAL = int(os.getenv('EMAIL_IDLE_POLL_INTERVAL', '15'))  # Seconds clients wait between push channel polls when long-polling is off
+EMAIL_IDLE_WATCHER_LEASE = int(os.getenv('EMAIL_IDLE_WATCHER_LEASE', '90'))  # Seconds without heartbeat before another process takes over an account's watcher
+EMAIL_IDLE_LOGIN_BACKOFF = int(os.getenv('EMAIL_IDLE_LOGIN_BACKOFF', '300'))  # Seconds before a password refused at IDLE login is tried again
+EMAIL_MESSAGE_CACHE_MAX_BYTES = int(os.getenv('EMAIL_MESSAGE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))  # In-memory parsed message cache budget (0 disables)
+EMAIL_MESSAGE_CACHE_DIR = os.getenv('EMAIL_MESSAGE_CACHE_DIR', '')  # Optional disk tier for evicted messages
+EMAIL_MESSAGE_CACHE_DISK_MAX_BYTES = int(os.getenv('EMAIL_MESSAGE_CACHE_DISK_MAX_BYTES', str(512 * 1024 * 1024)))  # Disk tier budget
+EMAIL_MESSAGE_CACHE_TTL = int(os.getenv('EMAIL_MESSAGE_CACHE_TTL', '300'))  # Seconds a cached message is served (caps staleness when CACHES is not shared between processes)
+EMAIL_ATTACHMENT_CHUNK_BYTES = int(os.getenv('EMAIL_ATTACHMENT_CHUNK_BYTES', str(1024 * 1024)))  # Encoded bytes per IMAP FETCH when streaming parts
+EMAIL_SYNC_WORKERS = int(os.getenv('EMAIL_SYNC_WORKERS', '8'))  # Accounts synced in parallel by sync_emails
+EMAIL_SYNC_MAX_PER_HOST = int(os.getenv('EMAIL_SYNC_MAX_PER_HOST', '4'))  # Concurrent sync sessions per IMAP host
+EMAIL_SYNC_BATCH_SIZE = int(os.getenv('EMAIL_SYNC_BATCH_SIZE', '100'))  # Messages fetched and inserted per batch
+EMAIL_RAW_STORE_DIR = os.getenv('EMAIL_RAW_STORE_DIR', '')  # Keep raw RFC822 of synced messages here, content-addressed (empty disables)
+EMAIL_SCHEDULER_MIN_INTERVAL = int(os.getenv('EMAIL_SCHEDULER_MIN_INTERVAL', '60'))  # Seconds between syncs of an account receiving mail
+EMAIL_SCHEDULER_MAX_INTERVAL = int(os.getenv('EMAIL_SCHEDULER_MAX_INTERVAL', '1800'))  # Ceiling for the sync interval of idle accounts
+EMAIL_SCHEDULER_MAX_BACKOFF = int(os.getenv('EMAIL_SCHEDULER_MAX_BACKOFF', '3600'))  # Ceiling for retry delay after sync failures
+EMAIL_INGEST_PARSE_PROCESSES = int(os.getenv('EMAIL_INGEST_PARSE_PROCESSES', '2'))  # Worker processes parsing fetched messages (0 parses in-thread)
+EMAIL_INGEST_QUEUE_SIZE = int(os.getenv('EMAIL_INGEST_QUEUE_SIZE', '2'))  # Batches buffered between ingest pipeline stages
+EMAIL_INGEST_HOOKS = [hook for hook in os.getenv('EMAIL_INGEST_HOOKS', '').split(',') if hook]  # Dotted paths of post-ingest hooks, e.g. mail.services.ingest_hooks.extract_contacts
+
 # Mail Server Configuration
 # Mail server hostname for DNS records (MX, SPF, etc.)
 MAIL_SERVER_HOSTNAME = os.getenv('MAIL_SERVER_HOSTNAME', 'mail.fayvad.com')
@@ -12,6 +12,31 @@ from django.conf import settings
 logger = logging.getLogger(__name__)
 
 
+def resolve_smtp_host(host=None):
+    """Resolve SMTP host with fallback to IP address if hostname fails"""
+    smtp_host = host or getattr(settings, 'EMAIL_HOST', 'localhost')
+    
+    # If already an IP address, use it directly
+    try:
+        socket.inet_aton(smtp_host)
+        return smtp_host
+    except socket.error:
+        pass
+    
+    # For host.docker.internal or Docker environment, use IP directly
+    if smtp_host == 'host.docker.internal' or os.path.exists('/.dockerenv'):
+        return getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
+    
+    # Try to resolve hostname, fallback to IP if it fails
+    try:
+        socket.gethostbyname(smtp_host)
+        return smtp_host
+    except socket.gaierror:
+        fallback_ip = getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
+        logger.warning(f"SMTP host '{smtp_host}' not resolvable, using IP: {fallback_ip}")
+        return fallback_ip
+
+
 class CustomSMTPBackend(EmailBackend):
     """Custom SMTP backend that skips SSL verification for self-signed certs (development)"""
     
@@ -28,27 +53,7 @@ class CustomSMTPBackend(EmailBackend):
     
     def _resolve_smtp_host(self):
         """Resolve SMTP host with fallback to IP address if hostname fails"""
-        smtp_host = self.host or getattr(settings, 'EMAIL_HOST', 'localhost')
-        
-        # If already an IP address, use it directly
-        try:
-            socket.inet_aton(smtp_host)
-            return smtp_host
-        except socket.error:
-            pass
-        
-        # For host.docker.internal or Docker environment, use IP directly
-        if smtp_host == 'host.docker.internal' or os.path.exists('/.dockerenv'):
-            return getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
-        
-        # Try to resolve hostname, fallback to IP if it fails
-        try:
-            socket.gethostbyname(smtp_host)
-            return smtp_host
-        except socket.gaierror:
-            fallback_ip = getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
-            logger.warning(f"SMTP host '{smtp_host}' not resolvable, using IP: {fallback_ip}")
-            return fallback_ip
+        return resolve_smtp_host(self.host)
     
     def open(self):
         if self.connection:
@@ -72,3 +77,35 @@ class CustomSMTPBackend(EmailBackend):
                 raise
             return False
 
+
+class PooledSMTPBackend(EmailBackend):
+    """
+    SMTP backend borrowing authenticated connections from the process-wide SMTP pool
+
+    Credentials are passed per instance (username/password), never through settings:
+        connection = get_connection('mail.backends.PooledSMTPBackend', username=..., password=...)
+    close() hands the connection back to the pool instead of sending QUIT.
+    """
+
+    def open(self):
+        if self.connection:
+            return False
+        from mail.services.smtp_pool import smtp_pool
+        try:
+            self.connection = smtp_pool.acquire(self.username, self.password)
+            return True
+        except (smtplib.SMTPException, socket.gaierror, OSError) as e:
+            if not self.fail_silently:
+                logger.error(f"SMTP connection error: {e}")
+                raise
+            return False
+
+    def close(self):
+        if self.connection is None:
+            return
+        from mail.services.smtp_pool import smtp_pool
+        try:
+            # RSET on release; a connection that fails it (e.g. after a dropped DATA) is closed
+            smtp_pool.release(self.connection)
+        finally:
+            self.connection = None
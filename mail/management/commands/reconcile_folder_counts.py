@@ -0,0 +1,33 @@
+"""
+Management command to fix drifted folder counters
+Run periodically (e.g. from cron): python manage.py reconcile_folder_counts
+"""
+from django.core.management.base import BaseCommand
+from mail.models import EmailFolder
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Recount total/unread counters of email folders and fix any drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--email',
+            type=str,
+            help='Reconcile folders of a specific email account only',
+        )
+
+    def handle(self, *args, **options):
+        email_address = options.get('email')
+
+        folders = EmailFolder.objects.all()
+        if email_address:
+            folders = folders.filter(account__email=email_address)
+
+        corrected = EmailFolder.reconcile_counts(folders)
+        if corrected:
+            self.stdout.write(self.style.WARNING(f'Corrected counters of {corrected} folder(s)'))
+        else:
+            self.stdout.write(self.style.SUCCESS('All folder counters are consistent'))
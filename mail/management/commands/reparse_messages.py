@@ -0,0 +1,88 @@
+"""
+Management command to rebuild stored messages from the local raw message store
+Re-runs the parser over kept RFC822 copies and refreshes headers, bodies and search
+vectors without contacting the IMAP server
+Run: python manage.py reparse_messages [--email user@domain]
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from mail.models import EmailMessage, EmailMessageBody
+from mail.services import DjangoEmailService
+from mail.services.message_search import update_search_vectors
+from mail.services.raw_store import raw_store
+import logging
+
+logger = logging.getLogger(__name__)
+
+REPARSED_FIELDS = [
+    'subject', 'sender', 'sender_name', 'to_recipients', 'cc_recipients', 'bcc_recipients',
+    'snippet', 'date_sent', 'date_received', 'size_bytes',
+]
+
+
+class Command(BaseCommand):
+    help = 'Reparse messages from their raw copies in EMAIL_RAW_STORE_DIR'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--email',
+            type=str,
+            help='Reparse messages of a specific email account only',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Messages updated per transaction (default: 500)',
+        )
+
+    def handle(self, *args, **options):
+        if not raw_store.enabled:
+            raise CommandError('EMAIL_RAW_STORE_DIR is not set; there are no raw copies to reparse')
+
+        messages = EmailMessage.objects.exclude(raw_digest=None).select_related('folder__account')
+        if options.get('email'):
+            messages = messages.filter(folder__account__email=options['email'])
+
+        batch_size = options['batch_size']
+        services = {}  # account id -> DjangoEmailService (only used for its parser)
+        reparsed = missing = 0
+        last_pk = 0
+        while True:
+            batch = list(messages.filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+
+            updated = []
+            bodies = []
+            texts = {}  # pk -> plain text for the search vector
+            for message in batch:
+                account = message.folder.account
+                service = services.setdefault(account.pk, DjangoEmailService(account))
+                try:
+                    email_data = service._parse_email(raw_store.parse(message.raw_digest))
+                except FileNotFoundError:
+                    missing += 1
+                    continue
+                except Exception as e:
+                    logger.error(f"Failed to reparse message {message.pk}: {e}")
+                    continue
+                for field in REPARSED_FIELDS:
+                    setattr(message, field, email_data[field])
+                updated.append(message)
+                bodies.append(EmailMessageBody(message_id=message.pk, text=email_data['body_text'],
+                                               html=email_data['body_html']))
+                texts[message.pk] = email_data['body_text']
+
+            with transaction.atomic():
+                EmailMessage.objects.bulk_update(updated, REPARSED_FIELDS)
+                EmailMessageBody.objects.bulk_create(
+                    bodies, update_conflicts=True, unique_fields=['message'], update_fields=['text_data', 'html_data'])
+                update_search_vectors(texts)
+            reparsed += len(updated)
+            self.stdout.write(f'  {reparsed} reparsed')
+
+        if missing:
+            self.stdout.write(self.style.WARNING(f'{missing} message(s) had no raw copy in the store'))
+        self.stdout.write(self.style.SUCCESS(f'Reparsed {reparsed} message(s)'))
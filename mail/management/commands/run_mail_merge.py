@@ -0,0 +1,72 @@
+"""
+Management command running mail merge jobs
+Run: python manage.py run_mail_merge (pending jobs and jobs abandoned by a dead runner)
+     python manage.py run_mail_merge --job 12 (run or resume one job, e.g. after it failed)
+"""
+from django.core.management.base import BaseCommand, CommandError
+from mail.models import MailMergeJob
+from mail.services.mail_merge import claim_job, claimable_jobs, run_job
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Send queued mail merge jobs, resuming interrupted ones from their checkpoint'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--job',
+            type=int,
+            help='Run or resume this job only',
+        )
+        parser.add_argument(
+            '--password',
+            type=str,
+            help='SMTP password for jobs queued without one',
+        )
+        parser.add_argument(
+            '--no-pipelining',
+            action='store_true',
+            help='Send one command at a time even when the server offers PIPELINING',
+        )
+
+    def handle(self, *args, **options):
+        if options.get('job'):
+            try:
+                jobs = [MailMergeJob.objects.get(pk=options['job'])]
+            except MailMergeJob.DoesNotExist:
+                raise CommandError(f"Mail merge job {options['job']} not found")
+            if jobs[0].status == MailMergeJob.STATUS_COMPLETED:
+                self.stdout.write(f'Job {jobs[0].pk} is already completed')
+                return
+        else:
+            jobs = list(claimable_jobs())
+
+        if not jobs:
+            self.stdout.write('No mail merge jobs to run')
+            return
+
+        for job in jobs:
+            if not claim_job(job):
+                self.stdout.write(self.style.WARNING(f'Job {job.pk} is being run elsewhere, skipping'))
+                continue
+            resumed = f' (resuming after {job.sent_count + job.failed_count})' if job.last_contact_id else ''
+            self.stdout.write(f'Job {job.pk}: "{job.template.name}" from {job.account.email} to {job.total} contact(s){resumed}')
+            job = run_job(
+                job,
+                password=options.get('password'),
+                pipelining=False if options.get('no_pipelining') else None,
+                progress=self.print_progress,
+            )
+            if job.status == MailMergeJob.STATUS_COMPLETED:
+                self.stdout.write(self.style.SUCCESS(
+                    f'✓ Job {job.pk}: {job.sent_count} sent, {job.failed_count} rejected'))
+            else:
+                self.stdout.write(self.style.ERROR(
+                    f'✗ Job {job.pk} stopped after {job.sent_count} sent: {job.last_error} '
+                    f'(resume with --job {job.pk} --password ...)'))
+
+    def print_progress(self, job):
+        done = job.sent_count + job.failed_count
+        self.stdout.write(f'  {done}/{job.total} ({job.failed_count} rejected)')
@@ -0,0 +1,76 @@
+"""
+Management command delivering queued outgoing mail
+Run: python manage.py run_outbox_worker (stop with SIGTERM or Ctrl-C)
+     python manage.py run_outbox_worker --once (deliver what is due, then exit)
+"""
+import signal
+from django.core.management.base import BaseCommand
+from mail.models import OutboxMessage
+from mail.services.outbox import THROTTLED, OutboxWorker
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Deliver queued outgoing email with retries'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Exit when no message is due instead of waiting for more',
+        )
+        parser.add_argument(
+            '--password',
+            type=str,
+            help='SMTP password for messages queued without one',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=None,
+            help='Messages delivered in parallel (default: EMAIL_OUTBOX_WORKERS)',
+        )
+        parser.add_argument(
+            '--max-per-domain',
+            type=int,
+            default=None,
+            help='Parallel deliveries per sender domain (default: EMAIL_OUTBOX_MAX_PER_DOMAIN)',
+        )
+
+    def handle(self, *args, **options):
+        worker = OutboxWorker(
+            workers=options.get('workers'),
+            max_per_domain=options.get('max_per_domain'),
+            password=options.get('password'),
+            progress=self.print_delivery,
+        )
+
+        def shutdown(signum, frame):
+            self.stdout.write(self.style.WARNING('Stopping after running deliveries finish...'))
+            worker.stop()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+        self.stdout.write(
+            f'Outbox worker started: {worker.workers} worker(s), {worker.max_per_domain} per domain'
+        )
+        totals = worker.run(once=options.get('once', False))
+        self.stdout.write(self.style.SUCCESS(
+            f'Outbox worker stopped: {totals[OutboxMessage.STATUS_SENT]} sent, '
+            f'{totals[OutboxMessage.STATUS_QUEUED]} to retry, {totals[OutboxMessage.STATUS_FAILED]} failed, '
+            f'{totals[THROTTLED]} held back by rate limits'
+        ))
+
+    def print_delivery(self, entry, result):
+        """One line per finished delivery attempt"""
+        if result == OutboxMessage.STATUS_SENT:
+            self.stdout.write(self.style.SUCCESS(f'✓ {entry.account.email}: {entry.message_id}'))
+        elif result == THROTTLED:
+            self.stdout.write(f'⏸ {entry.account.email}: {entry.message_id} (rate limited)')
+        elif result == OutboxMessage.STATUS_QUEUED:
+            self.stdout.write(self.style.WARNING(f'↻ {entry.account.email}: {entry.message_id} (attempt {entry.attempts})'))
+        else:
+            self.stdout.write(self.style.ERROR(f'✗ {entry.account.email}: {entry.message_id}'))
@@ -0,0 +1,106 @@
+"""
+Management command running the adaptive sync scheduler as a resident process
+Run: python manage.py run_sync_scheduler (stop with SIGTERM or Ctrl-C)
+"""
+import signal
+import time
+from django.core.management.base import BaseCommand
+from mail.models import EmailAccount
+from mail.services.sync_engine import SyncEngine, DEFAULT_SYNC_FOLDERS
+from mail.services.sync_scheduler import SyncScheduler
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Continuously sync active email accounts, more often for busy mailboxes'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--email',
+            type=str,
+            help='Schedule a specific email account only',
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=100,
+            help='Maximum number of emails per folder per sync (default: 100)',
+        )
+        parser.add_argument(
+            '--password',
+            type=str,
+            help='Email password used for every account',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=None,
+            help='Accounts synced in parallel (default: EMAIL_SYNC_WORKERS)',
+        )
+        parser.add_argument(
+            '--max-per-host',
+            type=int,
+            default=None,
+            help='Concurrent IMAP sessions per mail host (default: EMAIL_SYNC_MAX_PER_HOST)',
+        )
+        parser.add_argument(
+            '--min-interval',
+            type=int,
+            default=None,
+            help='Seconds between syncs of an active account (default: EMAIL_SCHEDULER_MIN_INTERVAL)',
+        )
+        parser.add_argument(
+            '--max-interval',
+            type=int,
+            default=None,
+            help='Longest interval for idle accounts (default: EMAIL_SCHEDULER_MAX_INTERVAL)',
+        )
+
+    def handle(self, *args, **options):
+        accounts = EmailAccount.objects.filter(is_active=True)
+        if options.get('email'):
+            accounts = accounts.filter(email=options['email'])
+
+        engine = SyncEngine(
+            workers=options.get('workers'),
+            max_per_host=options.get('max_per_host'),
+            folders=DEFAULT_SYNC_FOLDERS,
+            limit=options.get('limit', 100),
+            password=options.get('password'),
+        )
+        scheduler = SyncScheduler(
+            engine,
+            min_interval=options.get('min_interval'),
+            max_interval=options.get('max_interval'),
+            accounts=accounts,
+            progress=self.print_account,
+        )
+
+        def shutdown(signum, frame):
+            self.stdout.write(self.style.WARNING('Stopping after running syncs finish...'))
+            scheduler.stop()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+        self.stdout.write(
+            f'Sync scheduler started: {engine.workers} worker(s), '
+            f'interval {scheduler.min_interval}-{scheduler.max_interval}s'
+        )
+        scheduler.run()
+        self.stdout.write(self.style.SUCCESS('Sync scheduler stopped'))
+
+    def print_account(self, result, schedule):
+        """One line per finished sync with the account's next run"""
+        next_in = max(0, schedule.next_run - time.monotonic())
+        if result.error or result.failures:
+            error = result.error or ', '.join(f'{folder}: {error}' for folder, error in result.failures.items())
+            self.stdout.write(self.style.ERROR(
+                f'✗ {result.email_address}: {error} (failure {schedule.failures}, retry in {next_in:.0f}s)'))
+        elif result.messages:
+            self.stdout.write(self.style.SUCCESS(
+                f'✓ {result.email_address}: {result.messages} emails in {result.seconds:.1f}s (next in {next_in:.0f}s)'))
+        else:
+            self.stdout.write(f'- {result.email_address}: no new mail (next in {next_in:.0f}s)')
@@ -5,11 +5,7 @@ Run: python manage.py sync_emails
 from django.core.management.base import BaseCommand
 from django.contrib.auth import get_user_model
 from mail.models import EmailAccount
-# Import DjangoEmailService from services.py (not services package)
-import sys
-import os
-sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
-from mail.services import DjangoEmailService
+from mail.services.sync_engine import SyncEngine, DEFAULT_SYNC_FOLDERS
 import logging
 
 logger = logging.getLogger(__name__)
@@ -42,87 +38,88 @@ class Command(BaseCommand):
             type=str,
             help='Email password (if not provided, will prompt)',
         )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=None,
+            help='Accounts synced in parallel (default: EMAIL_SYNC_WORKERS)',
+        )
+        parser.add_argument(
+            '--max-per-host',
+            type=int,
+            default=None,
+            help='Concurrent IMAP sessions per mail host (default: EMAIL_SYNC_MAX_PER_HOST)',
+        )
 
     def handle(self, *args, **options):
         email_address = options.get('email')
         folder_name = options.get('folder')
-        limit = options.get('limit', 100)
-        password = options.get('password')
         
         if email_address:
             # Sync specific email account
-            try:
-                email_account = EmailAccount.objects.get(email=email_address)
-                self.sync_account(email_account, folder_name, limit, password)
-            except EmailAccount.DoesNotExist:
+            email_accounts = list(EmailAccount.objects.filter(email=email_address))
+            if not email_accounts:
                 self.stdout.write(self.style.ERROR(f'Email account {email_address} not found'))
+                return
         else:
             # Sync all active email accounts
-            email_accounts = EmailAccount.objects.filter(is_active=True)
-            if not email_accounts.exists():
+            email_accounts = list(EmailAccount.objects.filter(is_active=True))
+            if not email_accounts:
                 self.stdout.write(self.style.WARNING('No active email accounts found'))
                 return
-            
-            self.stdout.write(f'Syncing {email_accounts.count()} email account(s)...')
-            for account in email_accounts:
-                self.sync_account(account, folder_name, limit, password)
-    
-    def sync_account(self, email_account, folder_name, limit, password=None):
-        """Sync emails for a specific account"""
-        self.stdout.write(f'\nSyncing emails for {email_account.email}...')
         
-        # Standard folders to sync
-        folders_to_sync = ['INBOX', 'Sent', 'Drafts', 'Spam', 'Trash', 'Junk']
+        engine = SyncEngine(
+            workers=options.get('workers'),
+            max_per_host=options.get('max_per_host'),
+            folders=[folder_name] if folder_name else DEFAULT_SYNC_FOLDERS,
+            limit=options.get('limit', 100),
+            password=options.get('password'),
+            progress=self.print_account,
+        )
+        self.stdout.write(
+            f'Syncing {len(email_accounts)} email account(s) with {engine.workers} worker(s), '
+            f'max {engine.max_per_host} session(s) per host...'
+        )
+        report = engine.run(email_accounts)
+        self.print_summary(report)
+    
+    def print_account(self, result):
+        """Print one account's result as soon as it finishes"""
+        if result.error:
+            self.stdout.write(self.style.ERROR(f'✗ {result.email_address}: {result.error}'))
+            return
         
-        if folder_name:
-            folders_to_sync = [folder_name]
+        line = f'{result.email_address}: {result.messages} emails, {self.format_bytes(result.bytes)} in {result.seconds:.1f}s'
+        if result.failures:
+            self.stdout.write(self.style.WARNING(f'⚠ {line}'))
+            for folder, error in result.failures.items():
+                self.stdout.write(self.style.WARNING(f'    {folder}: {error}'))
+        elif result.messages:
+            self.stdout.write(self.style.SUCCESS(f'✓ {line}'))
+        else:
+            self.stdout.write(f'- {line}')
+    
+    def print_summary(self, report):
+        self.stdout.write('\nSummary')
+        self.stdout.write(f'  Accounts: {len(report.accounts)} ({len(report.failed_accounts)} with failures)')
+        self.stdout.write(f'  Emails:   {report.messages} ({report.rate(report.messages):.1f}/s)')
+        self.stdout.write(f'  Data:     {self.format_bytes(report.bytes)} ({self.format_bytes(report.rate(report.bytes))}/s)')
+        self.stdout.write(f'  Elapsed:  {report.seconds:.1f}s')
         
-        try:
-            email_service = DjangoEmailService(email_account)
-            
-            # Set password if provided
-            if password:
-                email_service._password = password
-            
-            total_synced = 0
-            for folder in folders_to_sync:
-                try:
-                    result = email_service.receive_emails(folder_name=folder, limit=limit)
-                    
-                    if result['success']:
-                        count = result['count']
-                        total_synced += count
-                        if count > 0:
-                            self.stdout.write(
-                                self.style.SUCCESS(
-                                    f'  ✓ {folder}: {count} emails synced'
-                                )
-                            )
-                        else:
-                            self.stdout.write(f'  - {folder}: No new emails')
-                    else:
-                        error = result.get("error", "Unknown error")
-                        # Don't error on folders that don't exist
-                        if "doesn't exist" not in error.lower() and "not found" not in error.lower():
-                            self.stdout.write(
-                                self.style.WARNING(f'  ⚠ {folder}: {error}')
-                            )
-                except Exception as e:
-                    # Skip folders that don't exist
-                    if "doesn't exist" not in str(e).lower():
-                        self.stdout.write(
-                            self.style.WARNING(f'  ⚠ {folder}: {str(e)}')
-                        )
-            
-            if total_synced > 0:
-                self.stdout.write(
-                    self.style.SUCCESS(f'\n✓ Total: {total_synced} emails synced')
-                )
-            else:
-                self.stdout.write('\n- No new emails to sync')
-                
-        except Exception as e:
-            self.stdout.write(
-                self.style.ERROR(f'✗ Error syncing {email_account.email}: {e}')
-            )
-
+        if report.failed_accounts:
+            self.stdout.write(self.style.WARNING('\nFailures per account:'))
+            for account in sorted(report.failed_accounts, key=lambda account: account.email_address):
+                failures = {'login': account.error} if account.error else account.failures
+                details = ', '.join(f'{folder}: {error}' for folder, error in failures.items())
+                self.stdout.write(self.style.WARNING(f'  {account.email_address}: {details}'))
+        elif report.messages:
+            self.stdout.write(self.style.SUCCESS(f'\n✓ Total: {report.messages} emails synced'))
+        else:
+            self.stdout.write('\n- No new emails to sync')
+    
+    @staticmethod
+    def format_bytes(size):
+        for unit in ('B', 'KB', 'MB', 'GB'):
+            if size < 1024 or unit == 'GB':
+                return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+            size /= 1024
@@ -0,0 +1,135 @@
+"""
+Message parsing stages
+Pure functions turning raw RFC822 bytes into the dict stored by sync. They use only
+the standard library (no settings, models or database), so the ingest pipeline can
+run them in worker processes; that is also why this lives outside mail.services,
+whose package import loads the models.
+"""
+import email
+import hashlib
+import re
+from datetime import datetime, timezone
+from email.utils import parseaddr, parsedate_to_datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Score at or above which X-Spam-* headers mark a message as spam (domains can lower it)
+SPAM_SCORE_THRESHOLD = 5.0
+
+
+def parse_headers(msg):
+    """Identity and address headers"""
+    from_name, from_addr = parseaddr(str(msg.get('From', '')))
+    return {
+        'message_id': str(msg.get('Message-ID', '')).strip(),
+        'subject': str(msg.get('Subject', 'No Subject')),
+        'sender': from_addr,
+        'sender_name': from_name,
+        'to_recipients': [parseaddr(str(addr))[1] for addr in msg.get_all('To', [])],
+        'cc_recipients': [parseaddr(str(addr))[1] for addr in msg.get_all('Cc', [])],
+        'bcc_recipients': [parseaddr(str(addr))[1] for addr in msg.get_all('Bcc', [])],
+    }
+
+
+def parse_spam_headers(msg):
+    """Verdict of upstream filters (SpamAssassin style X-Spam-* headers)"""
+    spam_score = None
+    spam_status = None
+    is_spam = False
+
+    spam_score_str = msg.get('X-Spam-Score') or msg.get('X-Spam-Level') or msg.get('X-Spam-Status')
+    if spam_score_str:
+        # e.g. "X-Spam-Score: 5.2" or "X-Spam-Status: Yes, score=5.2"
+        score_match = re.search(r'[\d.]+', str(spam_score_str))
+        if score_match:
+            try:
+                spam_score = float(score_match.group())
+            except ValueError as e:
+                logger.debug(f"Could not parse spam score '{spam_score_str}': {e}")
+            else:
+                spam_status = str(spam_score_str).lower()
+                if 'yes' in spam_status or spam_score >= SPAM_SCORE_THRESHOLD:
+                    is_spam = True
+
+    if str(msg.get('X-Spam-Flag', '')).lower() in ('yes', 'true', '1'):
+        is_spam = True
+
+    return {'spam_score': spam_score, 'spam_status': spam_status, 'is_spam': is_spam}
+
+
+def parse_dates(msg):
+    """Sent/received dates from the Date header (now when missing or unparseable)"""
+    date_str = msg.get('Date')
+    parsed_date = None
+    if date_str:
+        try:
+            parsed_date = parsedate_to_datetime(str(date_str))
+        except Exception as e:
+            logger.warning(f"Failed to parse date '{date_str}': {e}")
+    if parsed_date and parsed_date.tzinfo is None:
+        parsed_date = parsed_date.replace(tzinfo=timezone.utc)
+    date_sent = parsed_date or datetime.now(timezone.utc)
+    return {'date_sent': date_sent, 'date_received': date_sent}
+
+
+def extract_bodies(msg):
+    """First text/plain and text/html bodies plus the listing snippet"""
+    body_text = ''
+    body_html = ''
+
+    if msg.is_multipart():
+        for part in msg.walk():
+            content_type = part.get_content_type()
+            if content_type == 'text/plain' and not body_text:
+                body_text = (part.get_payload(decode=True) or b'').decode('utf-8', errors='ignore')
+            elif content_type == 'text/html' and not body_html:
+                body_html = (part.get_payload(decode=True) or b'').decode('utf-8', errors='ignore')
+    else:
+        payload = msg.get_payload(decode=True)
+        if payload:
+            decoded = payload.decode('utf-8', errors='ignore')
+            if msg.get_content_type() == 'text/html':
+                body_html = decoded
+            else:
+                body_text = decoded
+
+    return {
+        'body_text': body_text,
+        'body_html': body_html,
+        'snippet': (body_text or body_html or '')[:200],
+    }
+
+
+def parse_email(msg, size_bytes=None):
+    """
+    Parse an email.message.Message into structured data
+
+    Returns:
+        dict with header, date, body and spam fields plus size_bytes
+    """
+    email_data = {}
+    email_data.update(parse_headers(msg))
+    email_data.update(parse_spam_headers(msg))
+    email_data.update(parse_dates(msg))
+    email_data.update(extract_bodies(msg))
+    email_data['size_bytes'] = size_bytes if size_bytes is not None else len(msg.as_bytes())
+    return email_data
+
+
+def parse_message(raw):
+    """
+    Parse raw RFC822 bytes (the worker-process entry point)
+
+    Returns:
+        tuple: (email_data, None) or (None, error message); errors are returned rather
+        than raised so one broken message doesn't fail its whole batch
+    """
+    try:
+        email_data = parse_email(email.message_from_bytes(raw), size_bytes=len(raw))
+    except Exception as e:
+        return None, str(e)
+    if not email_data['message_id']:
+        # Stable stand-in so a message without Message-ID is recognised when seen again
+        email_data['message_id'] = f"<{hashlib.sha256(raw).hexdigest()}@no-message-id>"
+    return email_data, None
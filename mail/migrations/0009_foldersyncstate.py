@@ -0,0 +1,30 @@
+# Generated manually for CONDSTORE/QRESYNC incremental sync
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0008_update_date_received_field'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FolderSyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mailbox', models.CharField(max_length=255)),
+                ('uidvalidity', models.BigIntegerField(blank=True, null=True)),
+                ('last_uid', models.BigIntegerField(default=0)),
+                ('highest_modseq', models.BigIntegerField(blank=True, null=True)),
+                ('last_synced_at', models.DateTimeField(blank=True, null=True)),
+                ('folder', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='sync_state', to='mail.emailfolder')),
+            ],
+            options={
+                'verbose_name': 'Folder Sync State',
+                'verbose_name_plural': 'Folder Sync States',
+            },
+        ),
+    ]
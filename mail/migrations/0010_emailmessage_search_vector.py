@@ -0,0 +1,71 @@
+# Generated manually for PostgreSQL full-text search over stored messages
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations
+from django.db.models import TextField
+from django.db.models.functions import Cast, Substr
+
+BACKFILL_BATCH = 5000
+
+
+def backfill_search_vectors(apps, schema_editor):
+    """Index existing messages in pk batches (same expression as services.message_search)"""
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    EmailMessage = apps.get_model('mail', 'EmailMessage')
+    vector = (
+        SearchVector('subject', weight='A', config='english')
+        + SearchVector('sender_name', 'sender', weight='B', config='english')
+        + SearchVector(Cast('to_recipients', TextField()), Cast('cc_recipients', TextField()),
+                       weight='C', config='english')
+        + SearchVector(Substr('body_text', 1, 200000), weight='D', config='english')
+    )
+    last_pk = 0
+    while True:
+        pks = list(EmailMessage.objects.filter(pk__gt=last_pk).order_by('pk')
+                   .values_list('pk', flat=True)[:BACKFILL_BATCH])
+        if not pks:
+            break
+        EmailMessage.objects.filter(pk__in=pks).update(search_vector=vector)
+        last_pk = pks[-1]
+
+
+class AddSearchIndex(AddIndexConcurrently):
+    """
+    Build the GIN index CONCURRENTLY on PostgreSQL; other databases (e.g. SQLite in
+    development) have no tsvector search, so the index is only recorded in the state
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+
+    # Backfill commits per batch and the index is built CONCURRENTLY, so writes are never blocked
+    atomic = False
+
+    dependencies = [
+        ('mail', '0009_foldersyncstate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailmessage',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_search_vectors, migrations.RunPython.noop),
+        AddSearchIndex(
+            model_name='emailmessage',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='mail_message_search_gin'),
+        ),
+    ]
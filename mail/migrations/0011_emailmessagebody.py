@@ -0,0 +1,86 @@
+# Generated manually to move message bodies out of mail_emailmessage into a compressed 1:1 table
+
+import zlib
+import django.db.models.deletion
+from django.db import migrations, models
+
+COPY_BATCH = 2000
+
+
+def _compress(value):
+    # Same format as mail.models.compress_body: version byte 0 = raw UTF-8, 1 = zlib
+    if value is None:
+        return None
+    data = value.encode('utf-8')
+    if len(data) >= 256:
+        compressed = zlib.compress(data, 6)
+        if len(compressed) < len(data):
+            return bytes([1]) + compressed
+    return bytes([0]) + data
+
+
+def _decompress(data):
+    if data is None:
+        return None
+    data = bytes(data)
+    if not data:
+        return ''
+    return (zlib.decompress(data[1:]) if data[0] == 1 else data[1:]).decode('utf-8')
+
+
+def move_bodies(apps, schema_editor):
+    EmailMessage = apps.get_model('mail', 'EmailMessage')
+    EmailMessageBody = apps.get_model('mail', 'EmailMessageBody')
+    last_pk = 0
+    while True:
+        rows = list(EmailMessage.objects.filter(pk__gt=last_pk).order_by('pk')
+                    .values_list('pk', 'body_text', 'body_html')[:COPY_BATCH])
+        if not rows:
+            break
+        EmailMessageBody.objects.bulk_create([
+            EmailMessageBody(message_id=pk, text_data=_compress(text), html_data=_compress(html))
+            for pk, text, html in rows
+        ], ignore_conflicts=True)
+        last_pk = rows[-1][0]
+
+
+def restore_bodies(apps, schema_editor):
+    EmailMessage = apps.get_model('mail', 'EmailMessage')
+    EmailMessageBody = apps.get_model('mail', 'EmailMessageBody')
+    for body in EmailMessageBody.objects.iterator(chunk_size=COPY_BATCH):
+        EmailMessage.objects.filter(pk=body.message_id).update(
+            body_text=_decompress(body.text_data), body_html=_decompress(body.html_data))
+
+
+class Migration(migrations.Migration):
+
+    # Bodies are copied in committed batches instead of one long transaction
+    atomic = False
+
+    dependencies = [
+        ('mail', '0010_emailmessage_search_vector'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailMessageBody',
+            fields=[
+                ('message', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='body', serialize=False, to='mail.emailmessage')),
+                ('text_data', models.BinaryField(blank=True, null=True)),
+                ('html_data', models.BinaryField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Email Message Body',
+                'verbose_name_plural': 'Email Message Bodies',
+            },
+        ),
+        migrations.RunPython(move_bodies, restore_bodies),
+        migrations.RemoveField(
+            model_name='emailmessage',
+            name='body_text',
+        ),
+        migrations.RemoveField(
+            model_name='emailmessage',
+            name='body_html',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated manually for the content-addressed raw message store
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0011_emailmessagebody'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailmessage',
+            name='raw_digest',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated manually for resumable sync checkpoints and per-folder error tracking
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0012_emailmessage_raw_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='foldersyncstate',
+            name='last_full_scan',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='foldersyncstate',
+            name='error_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='foldersyncstate',
+            name='last_error',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='foldersyncstate',
+            name='last_error_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated manually for the message location index
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+BACKFILL_BATCH = 5000
+
+
+def backfill_locations(apps, schema_editor):
+    """Index stored messages whose folder has a sync checkpoint"""
+    EmailMessage = apps.get_model('mail', 'EmailMessage')
+    MessageLocation = apps.get_model('mail', 'MessageLocation')
+    last_pk = 0
+    while True:
+        rows = list(EmailMessage.objects.filter(pk__gt=last_pk, folder__sync_state__uidvalidity__isnull=False)
+                    .exclude(uid=None).order_by('pk')
+                    .values_list('pk', 'folder_id', 'folder__sync_state__uidvalidity', 'uid', 'message_id')[:BACKFILL_BATCH])
+        if not rows:
+            break
+        MessageLocation.objects.bulk_create([
+            MessageLocation(folder_id=folder_id, uidvalidity=uidvalidity, uid=int(uid), message_id=message_id[:255])
+            for _, folder_id, uidvalidity, uid, message_id in rows if uid.isdigit()
+        ], ignore_conflicts=True)
+        last_pk = rows[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0013_foldersyncstate_checkpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageLocation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uidvalidity', models.BigIntegerField()),
+                ('uid', models.BigIntegerField()),
+                ('message_id', models.CharField(blank=True, default='', max_length=255)),
+                ('folder', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='locations', to='mail.emailfolder')),
+            ],
+            options={
+                'verbose_name': 'Message Location',
+                'verbose_name_plural': 'Message Locations',
+                'constraints': [models.UniqueConstraint(fields=('folder', 'uidvalidity', 'uid'), name='mail_location_unique_uid')],
+                'indexes': [models.Index(fields=['uidvalidity', 'uid'], name='mail_location_uid_idx'), models.Index(fields=['message_id'], name='mail_location_msgid_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_locations, migrations.RunPython.noop),
+    ]
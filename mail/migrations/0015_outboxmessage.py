@@ -0,0 +1,45 @@
+# Generated manually for the outbox queue
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0014_messagelocation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed')], default='queued', max_length=10)),
+                ('message_id', models.CharField(max_length=255)),
+                ('subject', models.TextField(blank=True, default='')),
+                ('to_recipients', models.JSONField(default=list)),
+                ('cc_recipients', models.JSONField(default=list)),
+                ('bcc_recipients', models.JSONField(default=list)),
+                ('body_text', models.TextField(blank=True, default='')),
+                ('body_html', models.TextField(blank=True, null=True)),
+                ('raw', models.BinaryField()),
+                ('recipients', models.JSONField(default=list)),
+                ('smtp_password', models.CharField(blank=True, default='', max_length=255)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('locked_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='outbox', to='mail.emailaccount')),
+            ],
+            options={
+                'verbose_name': 'Outbox Message',
+                'verbose_name_plural': 'Outbox Messages',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['status', 'next_attempt_at'], name='mail_outbox_due_idx')],
+            },
+        ),
+    ]
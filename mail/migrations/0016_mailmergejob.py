@@ -0,0 +1,40 @@
+# Generated manually for mail merge jobs
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0015_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailMergeJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tag', models.CharField(blank=True, default='', max_length=50)),
+                ('context', models.JSONField(default=dict)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('failed', 'Failed'), ('completed', 'Completed')], default='pending', max_length=10)),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('sent_count', models.PositiveIntegerField(default=0)),
+                ('failed_count', models.PositiveIntegerField(default=0)),
+                ('last_contact_id', models.BigIntegerField(default=0)),
+                ('failures', models.JSONField(default=list)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('smtp_password', models.CharField(blank=True, default='', max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='merge_jobs', to='mail.emailaccount')),
+                ('template', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='merge_jobs', to='mail.emailtemplate')),
+            ],
+            options={
+                'verbose_name': 'Mail Merge Job',
+                'verbose_name_plural': 'Mail Merge Jobs',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated manually for the shared push channel state
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0017_ratelimitbucket'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailboxPushState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.EmailField(max_length=254, unique=True)),
+                ('folder', models.CharField(default='INBOX', max_length=255)),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('total_count', models.PositiveIntegerField(default=0)),
+                ('events', models.JSONField(default=list)),
+                ('error', models.CharField(blank=True, default='', max_length=255)),
+                ('watcher', models.CharField(blank=True, default='', max_length=100)),
+                ('watcher_heartbeat', models.DateTimeField(blank=True, null=True)),
+                ('last_polled', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Mailbox Push State',
+                'verbose_name_plural': 'Mailbox Push States',
+            },
+        ),
+    ]
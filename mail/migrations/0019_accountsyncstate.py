@@ -0,0 +1,29 @@
+# Generated manually for the persisted sync scheduler state
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0018_mailboxpushstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountSyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('interval', models.PositiveIntegerField(default=0)),
+                ('failures', models.PositiveIntegerField(default=0)),
+                ('auth_failed', models.BooleanField(default=False)),
+                ('next_sync_at', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('account', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='sync_schedule', to='mail.emailaccount')),
+            ],
+            options={
+                'verbose_name': 'Account Sync State',
+                'verbose_name_plural': 'Account Sync States',
+            },
+        ),
+    ]
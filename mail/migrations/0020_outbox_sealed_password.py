@@ -0,0 +1,27 @@
+# Generated manually for encrypted outbox SMTP passwords
+
+from django.db import migrations, models
+
+
+def seal_passwords(apps, schema_editor):
+    from mail.services.credentials import seal
+
+    OutboxMessage = apps.get_model('mail', 'OutboxMessage')
+    for entry in OutboxMessage.objects.exclude(smtp_password='').only('pk', 'smtp_password'):
+        OutboxMessage.objects.filter(pk=entry.pk).update(smtp_password=seal(entry.smtp_password))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0019_accountsyncstate'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='outboxmessage',
+            name='smtp_password',
+            field=models.CharField(blank=True, default='', max_length=512),
+        ),
+        migrations.RunPython(seal_passwords, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated manually for encrypted mail merge SMTP passwords
+
+from django.db import migrations, models
+
+
+def seal_passwords(apps, schema_editor):
+    from mail.services.credentials import seal
+
+    MailMergeJob = apps.get_model('mail', 'MailMergeJob')
+    # Failed jobs no longer keep a password; resuming one asks for it again
+    MailMergeJob.objects.filter(status='failed').exclude(smtp_password='').update(smtp_password='')
+    for job in MailMergeJob.objects.exclude(smtp_password='').only('pk', 'smtp_password'):
+        MailMergeJob.objects.filter(pk=job.pk).update(smtp_password=seal(job.smtp_password))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0020_outbox_sealed_password'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mailmergejob',
+            name='smtp_password',
+            field=models.CharField(blank=True, default='', max_length=512),
+        ),
+        migrations.RunPython(seal_passwords, migrations.RunPython.noop),
+    ]
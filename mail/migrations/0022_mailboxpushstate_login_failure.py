@@ -0,0 +1,23 @@
+# Generated manually for the IDLE watcher login backoff
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0021_mailmergejob_sealed_password'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailboxpushstate',
+            name='failed_digest',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='mailboxpushstate',
+            name='failed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
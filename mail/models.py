@@ -1,8 +1,12 @@
+import zlib
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth.models import User
 from django.core.validators import MinValueValidator, MaxValueValidator
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 
 class Domain(models.Model):
     """Domain model for email domains"""
@@ -168,11 +172,149 @@ class EmailFolder(models.Model):
         return f"{self.account.email} - {self.display_name}"
 
     def update_counts(self):
-        """Update unread and total message counts"""
+        """Recount unread and total messages (full scan; use adjust_counts() on hot paths)"""
         self.total_count = self.messages.count()
         self.unread_count = self.messages.filter(is_read=False).count()
         self.save(update_fields=['total_count', 'unread_count'])
 
+    def adjust_counts(self, total=0, unread=0):
+        """Apply counter deltas with an atomic F() update (no COUNT over the folder's messages)"""
+        EmailFolder.adjust_folder_counts(self.pk, total, unread)
+
+    @staticmethod
+    def adjust_folder_counts(folder_id, total=0, unread=0):
+        if total or unread:
+            EmailFolder.objects.filter(pk=folder_id).update(
+                total_count=models.F('total_count') + total,
+                unread_count=models.F('unread_count') + unread,
+            )
+
+    @classmethod
+    def reconcile_counts(cls, folders=None):
+        """
+        Fix counters that drifted from the stored messages
+
+        Args:
+            folders: EmailFolder queryset to check (all folders if None)
+
+        Returns:
+            int: number of folders whose counters were corrected
+        """
+        folders = cls.objects.all() if folders is None else folders
+        actual = folders.annotate(
+            actual_total=models.Count('messages'),
+            actual_unread=models.Count('messages', filter=models.Q(messages__is_read=False)),
+        ).values_list('pk', 'total_count', 'unread_count', 'actual_total', 'actual_unread')
+
+        corrected = 0
+        for pk, total, unread, actual_total, actual_unread in actual:
+            if (total, unread) != (actual_total, actual_unread):
+                cls.objects.filter(pk=pk).update(total_count=actual_total, unread_count=actual_unread)
+                corrected += 1
+        return corrected
+
+
+class FolderSyncState(models.Model):
+    """IMAP sync checkpoint of a folder (CONDSTORE/QRESYNC incremental sync)"""
+
+    folder = models.OneToOneField(EmailFolder, on_delete=models.CASCADE, related_name='sync_state')
+
+    # Mailbox name on the IMAP server (may differ in case from folder.name)
+    mailbox = models.CharField(max_length=255)
+    uidvalidity = models.BigIntegerField(null=True, blank=True)
+    last_uid = models.BigIntegerField(default=0)  # Highest UID stored locally
+    highest_modseq = models.BigIntegerField(null=True, blank=True)  # HIGHESTMODSEQ at the last sync
+    last_synced_at = models.DateTimeField(null=True, blank=True)
+    last_full_scan = models.DateTimeField(null=True, blank=True)  # Last comparison of every stored UID with the server
+
+    # Consecutive failed syncs (reset by a successful one)
+    error_count = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+    last_error_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = _('Folder Sync State')
+        verbose_name_plural = _('Folder Sync States')
+
+    def __str__(self):
+        return f"{self.folder} (uid {self.last_uid}, modseq {self.highest_modseq})"
+
+    @classmethod
+    def record_result(cls, account, folder_names, error=None):
+        """Reset (error=None) or bump the error counters of an account's folders in one UPDATE"""
+        states = cls.objects.filter(folder__account=account, folder__name__in=folder_names)
+        if error is None:
+            return states.exclude(error_count=0, last_error='').update(error_count=0, last_error='')
+        return states.update(error_count=models.F('error_count') + 1, last_error=error[:2000],
+                             last_error_at=timezone.now())
+
+
+class AccountSyncState(models.Model):
+    """Sync schedule of an account (adaptive interval and failure backoff), kept across scheduler restarts"""
+
+    account = models.OneToOneField(EmailAccount, on_delete=models.CASCADE, related_name='sync_schedule')
+
+    interval = models.PositiveIntegerField(default=0)  # Seconds between syncs while the account is healthy
+    failures = models.PositiveIntegerField(default=0)  # Consecutive failed syncs (drives the backoff)
+    auth_failed = models.BooleanField(default=False)  # Last failure was a login/connection failure
+    next_sync_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    class Meta:
+        verbose_name = _('Account Sync State')
+        verbose_name_plural = _('Account Sync States')
+
+    def __str__(self):
+        return f"{self.account} (next {self.next_sync_at}, failures {self.failures})"
+
+
+# Body encoding versions (first byte of EmailMessageBody data)
+BODY_RAW = 0
+BODY_ZLIB = 1
+
+# Bodies shorter than this are stored uncompressed; zlib overhead outweighs the gain
+BODY_COMPRESS_MIN = 256
+
+
+def compress_body(value):
+    """Encode body text as <version byte><payload>, zlib-compressed when that makes it smaller"""
+    if value is None:
+        return None
+    data = value.encode('utf-8')
+    if len(data) >= BODY_COMPRESS_MIN:
+        compressed = zlib.compress(data, 6)
+        if len(compressed) < len(data):
+            return bytes([BODY_ZLIB]) + compressed
+    return bytes([BODY_RAW]) + data
+
+
+def decompress_body(data):
+    """Decode data written by compress_body()"""
+    if data is None:
+        return None
+    data = bytes(data)  # memoryview from the database driver
+    if not data:
+        return ''
+    version, payload = data[0], data[1:]
+    if version == BODY_ZLIB:
+        payload = zlib.decompress(payload)
+    elif version != BODY_RAW:
+        raise ValueError(f"Unknown message body encoding {version}")
+    return payload.decode('utf-8')
+
+
+class EmailMessageQuerySet(models.QuerySet):
+
+    def with_body(self):
+        """Load bodies in the same query (select_related on EmailMessageBody)"""
+        return self.select_related('body')
+
+
+class EmailMessageManager(models.Manager.from_queryset(EmailMessageQuerySet)):
+    """Metadata-only by default: the search vector is only used inside queries"""
+
+    def get_queryset(self):
+        return super().get_queryset().defer('search_vector')
+
 
 class EmailMessage(models.Model):
     """Email message model"""
@@ -191,15 +333,14 @@ class EmailMessage(models.Model):
     cc_recipients = models.JSONField(default=list)  # List of email addresses
     bcc_recipients = models.JSONField(default=list)  # List of email addresses
 
-    # Content
-    body_text = models.TextField(blank=True, null=True)
-    body_html = models.TextField(blank=True, null=True)
+    # Content (bodies live compressed in EmailMessageBody; see body_text / body_html)
     snippet = models.TextField(blank=True, null=True) 
 
     # Metadata
     date_sent = models.DateTimeField(help_text="Date when email was sent (from email header)")
     date_received = models.DateTimeField(help_text="Date when email was received (from email header or server)")
     size_bytes = models.IntegerField(default=0)
+    raw_digest = models.CharField(max_length=64, blank=True, null=True)  # sha256 of the raw RFC822 in services/raw_store.py
 
     # Status
     is_read = models.BooleanField(default=False)
@@ -209,12 +350,18 @@ class EmailMessage(models.Model):
     # Flags
     flags = models.JSONField(default=list)  # ['\\Seen', '\\Flagged', etc.]
 
+    # Weighted full-text index (subject, sender, recipients, body); see services/message_search.py
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = EmailMessageManager()
+
     class Meta:
         verbose_name = _('Email Message')
         verbose_name_plural = _('Email Messages')
         ordering = ['-date_received']
         indexes = [
             models.Index(fields=['folder', 'date_received']),
+            GinIndex(fields=['search_vector'], name='mail_message_search_gin'),
         ]
 
     def __str__(self):
@@ -233,6 +380,261 @@ class EmailMessage(models.Model):
         """Derived from folder.account (3NF compliance)"""
         return self.folder.account
 
+    def _body_record(self):
+        """This message's EmailMessageBody (a new unsaved one if it has none yet)"""
+        try:
+            return self.body
+        except EmailMessageBody.DoesNotExist:
+            self.body = EmailMessageBody(message=self)
+            return self.body
+
+    @property
+    def body_text(self):
+        return self._body_record().text
+
+    @body_text.setter
+    def body_text(self, value):
+        self._body_record().text = value
+        self._body_changed = True
+
+    @property
+    def body_html(self):
+        return self._body_record().html
+
+    @body_html.setter
+    def body_html(self, value):
+        self._body_record().html = value
+        self._body_changed = True
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        if getattr(self, '_body_changed', False):
+            body = self._body_record()
+            body.message = self
+            body.save()
+            self._body_changed = False
+
+
+class EmailMessageBody(models.Model):
+    """Compressed bodies of an EmailMessage, kept out of the row used for listings and counts"""
+
+    message = models.OneToOneField(EmailMessage, on_delete=models.CASCADE, primary_key=True, related_name='body')
+    text_data = models.BinaryField(null=True, blank=True)  # compress_body() of the plain text body
+    html_data = models.BinaryField(null=True, blank=True)  # compress_body() of the HTML body
+
+    class Meta:
+        verbose_name = _('Email Message Body')
+        verbose_name_plural = _('Email Message Bodies')
+
+    def __str__(self):
+        return f"Body of message {self.message_id}"
+
+    @property
+    def text(self):
+        return decompress_body(self.text_data)
+
+    @text.setter
+    def text(self, value):
+        self.text_data = compress_body(value)
+
+    @property
+    def html(self):
+        return decompress_body(self.html_data)
+
+    @html.setter
+    def html(self, value):
+        self.html_data = compress_body(value)
+
+
+class MessageLocation(models.Model):
+    """
+    Where a message currently is on the IMAP server
+
+    Maps (uidvalidity, uid) and the Message-ID header to a folder, so a message is found
+    with one lookup and one targeted FETCH. Unlike EmailMessage, a Message-ID can have
+    several locations (the same message in INBOX and Sent, copies). Kept current by sync
+    and by move/delete actions; see services/message_locations.py.
+    """
+
+    folder = models.ForeignKey(EmailFolder, on_delete=models.CASCADE, related_name='locations')
+    uidvalidity = models.BigIntegerField()
+    uid = models.BigIntegerField()
+    message_id = models.CharField(max_length=255, blank=True, default='')  # Message-ID header
+
+    class Meta:
+        verbose_name = _('Message Location')
+        verbose_name_plural = _('Message Locations')
+        constraints = [
+            models.UniqueConstraint(fields=['folder', 'uidvalidity', 'uid'], name='mail_location_unique_uid'),
+        ]
+        indexes = [
+            models.Index(fields=['uidvalidity', 'uid'], name='mail_location_uid_idx'),
+            models.Index(fields=['message_id'], name='mail_location_msgid_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.message_id or '?'} -> {self.folder} ({self.uidvalidity}:{self.uid})"
+
+
+class OutboxMessage(models.Model):
+    """
+    Outgoing message waiting for (or done with) SMTP delivery
+
+    Sending only inserts a row; the run_outbox_worker command delivers it, retries
+    temporary failures with backoff and records the outcome. See services/outbox.py.
+    """
+
+    STATUS_QUEUED = 'queued'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, _('Queued')),
+        (STATUS_SENDING, _('Sending')),
+        (STATUS_SENT, _('Sent')),
+        (STATUS_FAILED, _('Failed')),
+    ]
+
+    account = models.ForeignKey(EmailAccount, on_delete=models.CASCADE, related_name='outbox')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    message_id = models.CharField(max_length=255)  # Message-ID header of the rendered message
+
+    # What the Sent copy is stored with
+    subject = models.TextField(blank=True, default='')
+    to_recipients = models.JSONField(default=list)
+    cc_recipients = models.JSONField(default=list)
+    bcc_recipients = models.JSONField(default=list)
+    body_text = models.TextField(blank=True, default='')
+    body_html = models.TextField(blank=True, null=True)
+
+    # Rendered RFC822 message (attachments included) and SMTP envelope recipients
+    raw = models.BinaryField()
+    recipients = models.JSONField(default=list)
+    # Session password of the sender for SMTP AUTH, sealed by services/credentials.py;
+    # cleared once the message is sent or failed
+    smtp_password = models.CharField(max_length=512, blank=True, default='')
+
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)  # When a worker claimed it (crash recovery)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = _('Outbox Message')
+        verbose_name_plural = _('Outbox Messages')
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='mail_outbox_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.message_id} from {self.account.email} ({self.status})"
+
+
+class MailMergeJob(models.Model):
+    """
+    Bulk send of an EmailTemplate to the sender's contacts (optionally one tag)
+
+    Progress is checkpointed while sending: last_contact_id is the highest contact pk
+    whose message has a known outcome, so an interrupted job resumes after it.
+    See services/mail_merge.py.
+    """
+
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_FAILED = 'failed'
+    STATUS_COMPLETED = 'completed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, _('Pending')),
+        (STATUS_RUNNING, _('Running')),
+        (STATUS_FAILED, _('Failed')),
+        (STATUS_COMPLETED, _('Completed')),
+    ]
+
+    account = models.ForeignKey(EmailAccount, on_delete=models.CASCADE, related_name='merge_jobs')
+    template = models.ForeignKey('EmailTemplate', on_delete=models.CASCADE, related_name='merge_jobs')
+    tag = models.CharField(max_length=50, blank=True, default='')  # Only contacts with this tag
+    context = models.JSONField(default=dict)  # Extra template variables, same for every recipient
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+
+    total = models.PositiveIntegerField(default=0)
+    sent_count = models.PositiveIntegerField(default=0)
+    failed_count = models.PositiveIntegerField(default=0)
+    last_contact_id = models.BigIntegerField(default=0)  # Resume cursor
+    failures = models.JSONField(default=list)  # Latest rejected recipients: [{'email': ..., 'error': ...}]
+    last_error = models.TextField(blank=True, default='')  # Why the job stopped, when it failed
+
+    # Session password of the sender for SMTP AUTH, sealed by services/credentials.py;
+    # cleared once the job completes or fails
+    smtp_password = models.CharField(max_length=512, blank=True, default='')
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)  # Also the heartbeat of a running job
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = _('Mail Merge Job')
+        verbose_name_plural = _('Mail Merge Jobs')
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.template.name} from {self.account.email} ({self.sent_count}/{self.total}, {self.status})"
+
+
+class RateLimitBucket(models.Model):
+    """
+    Token bucket of an outbound rate limit, shared by every process sending mail
+
+    Rows are keyed 'domain:<id>' or 'account:<id>'; tokens is the level at updated_at and
+    is refilled lazily when the row is next locked. See services/rate_limit.py.
+    """
+
+    key = models.CharField(max_length=64, unique=True)
+    tokens = models.FloatField()
+    updated_at = models.DateTimeField()
+
+    class Meta:
+        verbose_name = _('Rate Limit Bucket')
+        verbose_name_plural = _('Rate Limit Buckets')
+
+    def __str__(self):
+        return f"{self.key}: {self.tokens:.1f}"
+
+
+class MailboxPushState(models.Model):
+    """
+    Push channel state of one account's watched folder, shared by all web processes
+
+    Versions and recent events live here rather than in process memory so a poll served
+    by any worker sees the same sequence. The watcher fields are a lease: only the
+    process named in ``watcher`` holds the IDLE connection while its heartbeat is fresh.
+    See services/idle_watcher.py.
+    """
+
+    email = models.EmailField(unique=True)  # Lowercased account address
+    folder = models.CharField(max_length=255, default='INBOX')
+    version = models.PositiveIntegerField(default=0)
+    unread_count = models.PositiveIntegerField(default=0)
+    total_count = models.PositiveIntegerField(default=0)
+    events = models.JSONField(default=list)  # Latest events, oldest first
+    error = models.CharField(max_length=255, blank=True, default='')
+
+    watcher = models.CharField(max_length=100, blank=True, default='')  # "<host>:<pid>" holding IDLE
+    watcher_heartbeat = models.DateTimeField(null=True, blank=True)
+    last_polled = models.DateTimeField(null=True, blank=True)
+    # Last refused login: SHA-256 of the password and when, so polls don't retry it right away
+    failed_digest = models.CharField(max_length=64, blank=True, default='')
+    failed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = _('Mailbox Push State')
+        verbose_name_plural = _('Mailbox Push States')
+
+    def __str__(self):
+        return f"{self.email} {self.folder} v{self.version}"
+
 
 class EmailAttachment(models.Model):
     """Email attachment model"""
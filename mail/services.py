@@ -6,18 +6,22 @@ import imapclient
 import email
 import ssl
 import smtplib
-from email.utils import parseaddr, parsedate_to_datetime
 from datetime import datetime
+from email.utils import make_msgid
 import logging
 
 # Import Django email classes FIRST to avoid namespace conflicts
-from django.core.mail import EmailMessage as DjangoEmailMessage, EmailMultiAlternatives
+from django.core.mail import EmailMessage as DjangoEmailMessage, EmailMultiAlternatives, get_connection
 from django.core.mail.backends.smtp import EmailBackend
 from django.conf import settings
 from django.utils import timezone
+from django.db import transaction
 
 # Import models AFTER Django imports - use alias to avoid conflict with Django's EmailMessage
 from . import models as mail_models
+from .message_parser import parse_email
+from .services import rate_limit
+from .services.message_locations import forget_locations, record_locations
 
 logger = logging.getLogger(__name__)
 
@@ -52,6 +56,7 @@ class DjangoEmailService:
         Returns:
             dict: {'success': bool, 'message_id': str or None, 'error': str or None}
         """
+        token_taken = False
         try:
             # Get email password for SMTP authentication
             email_password = self._get_email_password()
@@ -62,89 +67,112 @@ class DjangoEmailService:
                     'error': 'Email password required for SMTP authentication'
                 }
             
-            # Temporarily replace email backend and set credentials
-            original_backend = settings.EMAIL_BACKEND
-            original_host_user = settings.EMAIL_HOST_USER
-            original_host_password = settings.EMAIL_HOST_PASSWORD
+            # Sent right away, so over the limit the send is refused (the outbox waits instead)
+            wait, limiting = rate_limit.take(self.email_account)
+            if limiting:
+                return {
+                    'success': False,
+                    'message_id': None,
+                    'error': rate_limit.limit_error(self.email_account, wait)
+                }
+            token_taken = True
+            
+            # Credentials travel with the connection object; settings stay untouched so
+            # concurrent sends from different accounts can't pick up each other's login
+            connection = get_connection('mail.backends.PooledSMTPBackend',
+                                        username=self.email_address, password=email_password)
+            msg = self.build_message(to_emails, subject, body_text, body_html, cc_emails, bcc_emails,
+                                     attachments, connection=connection)
+            message_id = msg.extra_headers['Message-ID']
             
-            settings.EMAIL_BACKEND = 'mail.backends.CustomSMTPBackend'
-            settings.EMAIL_HOST_USER = self.email_address  # Use email address as SMTP username
-            settings.EMAIL_HOST_PASSWORD = email_password  # Use email password for SMTP auth
+            # Send email - check return value (1 = sent, 0 = failed)
+            logger.info(f"Attempting to send email from {self.email_address} to {to_emails}")
+            sent_count = msg.send()
+            logger.info(f"SMTP send returned: {sent_count}")
+            if sent_count == 0:
+                raise Exception("SMTP send returned 0 - email was not sent. Check SMTP server logs.")
+            token_taken = False  # used by the message that went out
             
-            sent_count = 0
-            msg = None
+            # Save sent email to IMAP Sent folder
+            sent_ref = None
             try:
-                # Create email message
-                if body_html:
-                    msg = EmailMultiAlternatives(
-                        subject=subject,
-                        body=body_text,
-                        from_email=self.email_address,
-                        to=to_emails,
-                        cc=cc_emails or [],
-                        bcc=bcc_emails or [],
-                    )
-                    msg.attach_alternative(body_html, "text/html")
-                else:
-                    msg = DjangoEmailMessage(
-                        subject=subject,
-                        body=body_text,
-                        from_email=self.email_address,
-                        to=to_emails,
-                        cc=cc_emails or [],
-                        bcc=bcc_emails or [],
-                    )
-                
-                # Add attachments
-                if attachments:
-                    for attachment in attachments:
-                        if isinstance(attachment, tuple):
-                            filename, content, mimetype = attachment
-                            msg.attach(filename, content, mimetype)
-                        else:
-                            # Assume it's a file path
-                            with open(attachment, 'rb') as f:
-                                msg.attach(attachment, f.read())
-                
-                # Send email - check return value (1 = sent, 0 = failed)
-                logger.info(f"Attempting to send email from {self.email_address} to {to_emails}")
-                sent_count = msg.send()
-                logger.info(f"SMTP send returned: {sent_count}")
-                if sent_count == 0:
-                    raise Exception("SMTP send returned 0 - email was not sent. Check SMTP server logs.")
-                
-                # Save sent email to IMAP Sent folder
-                try:
-                    self._save_sent_to_imap(msg, to_emails, cc_emails, bcc_emails, subject, body_text, body_html)
-                except Exception as e:
-                    logger.warning(f"Failed to save sent email to IMAP: {e}")
-                    # Continue even if IMAP save fails
-            finally:
-                # Restore original backend and credentials
-                settings.EMAIL_BACKEND = original_backend
-                settings.EMAIL_HOST_USER = original_host_user
-                settings.EMAIL_HOST_PASSWORD = original_host_password
+                sent_ref = self._save_sent_to_imap(msg)[0]
+            except Exception as e:
+                logger.warning(f"Failed to save sent email to IMAP: {e}")
+                # Continue even if IMAP save fails
             
             # Only store in database if email was actually sent
-            if sent_count > 0 and msg:
+            if sent_count > 0:
                 sent_folder = self._get_or_create_folder('Sent', 'sent')
                 self._store_sent_email(sent_folder, to_emails, cc_emails, bcc_emails, 
-                                       subject, body_text, body_html)
+                                       subject, body_text, body_html, message_id=message_id, ref=sent_ref)
             
             return {
                 'success': True,
-                'message_id': msg.message().get('Message-ID', '') if msg else None,
+                'message_id': message_id,
                 'error': None
             }
             
         except Exception as e:
             logger.error(f"Failed to send email: {e}")
+            if token_taken:
+                rate_limit.refund(self.email_account)
             return {
                 'success': False,
                 'message_id': None,
                 'error': str(e)
             }
     
+    def build_message(self, to_emails, subject, body_text, body_html=None,
+                      cc_emails=None, bcc_emails=None, attachments=None, connection=None):
+        """
+        Build the Django email message sent from this account
+        
+        Args:
+            attachments: List of file paths or (filename, content, mimetype) tuples
+            connection: Email backend used by msg.send() (optional)
+        
+        Returns:
+            EmailMessage or EmailMultiAlternatives with a fixed Message-ID header
+        """
+        # Generated once: EmailMessage.message() would mint a new Message-ID on every call
+        headers = {'Message-ID': make_msgid(domain=self.email_address.split('@')[-1])}
+        if body_html:
+            msg = EmailMultiAlternatives(
+                subject=subject,
+                body=body_text,
+                from_email=self.email_address,
+                to=to_emails,
+                cc=cc_emails or [],
+                bcc=bcc_emails or [],
+                connection=connection,
+                headers=headers,
+            )
+            msg.attach_alternative(body_html, "text/html")
+        else:
+            msg = DjangoEmailMessage(
+                subject=subject,
+                body=body_text,
+                from_email=self.email_address,
+                to=to_emails,
+                cc=cc_emails or [],
+                bcc=bcc_emails or [],
+                connection=connection,
+                headers=headers,
+            )
+        
+        # Add attachments
+        if attachments:
+            for attachment in attachments:
+                if isinstance(attachment, tuple):
+                    filename, content, mimetype = attachment
+                    msg.attach(filename, content, mimetype)
+                else:
+                    # Assume it's a file path
+                    with open(attachment, 'rb') as f:
+                        msg.attach(attachment, f.read())
+        return msg
+    
     def receive_emails(self, folder_name='INBOX', limit=50):
         """
         Receive emails from IMAP server and store in database
@@ -156,125 +184,225 @@ class DjangoEmailService:
         Returns:
             dict: {'success': bool, 'count': int, 'error': str or None}
         """
+        return self.sync_folders([folder_name], limit=limit)[folder_name]
+    
+    def sync_folders(self, folder_names, limit=50):
+        """
+        Sync several folders over a single IMAP login
+        
+        Args:
+            folder_names: IMAP folder names, synced in order
+            limit: Maximum number of new emails to fetch per folder
+        
+        Returns:
+            dict: {folder name: {'success', 'count', 'bytes', 'error', ...}}; a connection
+            or login failure is reported for every folder not synced yet, with 'auth_failed' set
+            when it was a login failure
+        """
+        results = {}
+        imap_password = self._get_email_password()
+        if not imap_password:
+            return {name: {'success': False, 'count': 0, 'bytes': 0, 'error': 'Email password not provided',
+                           'auth_failed': True}
+                    for name in folder_names}
+        
         try:
-            # Get IMAP settings from email account or settings
-            imap_host = getattr(settings, 'EMAIL_IMAP_HOST', 'localhost')
-            imap_port = getattr(settings, 'EMAIL_IMAP_PORT', 143)
-            imap_use_ssl = getattr(settings, 'EMAIL_IMAP_USE_SSL', False)
-            imap_user = self.email_address
-            imap_password = self._get_email_password()
-            
-            if not imap_password:
-                return {
-                    'success': False,
-                    'count': 0,
-                    'error': 'Email password not provided'
-                }
-            
-            # Map folder names to folder types
-            folder_type_map = {
-                'INBOX': 'inbox',
-                'Sent': 'sent',
-                'Drafts': 'drafts',
-                'Spam': 'spam',
-                'Junk': 'spam',
-                'Trash': 'trash',
-                'Deleted': 'trash',
-            }
-            folder_type = folder_type_map.get(folder_name, 'custom')
-            
-            # Connect to IMAP server (Dovecot)
-            # Use STARTTLS if not using SSL
-            import ssl
-            ssl_context = ssl.create_default_context()
-            # Skip certificate verification for development (host.docker.internal)
-            if imap_host == 'host.docker.internal':
-                ssl_context.check_hostname = False
-                ssl_context.verify_mode = ssl.CERT_NONE
-            
-            with imapclient.IMAPClient(imap_host, port=imap_port, ssl=imap_use_ssl, ssl_context=ssl_context if imap_use_ssl else None) as client:
-                # Use STARTTLS if not using SSL (required for plaintext auth)
-                if not imap_use_ssl:
-                    client.starttls(ssl_context=ssl_context)
-                client.login(imap_user, imap_password)
+            with self._connect_imap(imap_password) as client:
+                # QRESYNC (implies CONDSTORE) lets flag changes and expunges be fetched incrementally
+                capabilities = client.capabilities()
+                qresync = b'QRESYNC' in capabilities
+                condstore = qresync or b'CONDSTORE' in capabilities
+                self._mailbox_list = None
+                self._qresync_enabled = False
                 
-                # List available folders
-                available_folders = [f[2] for f in client.list_folders()]
-                
-                # Check if folder exists (try different variations)
-                imap_folder = folder_name
-                if folder_name not in available_folders:
-                    # Try case-insensitive match
-                    for f in available_folders:
-                        if f.upper() == folder_name.upper():
-                            imap_folder = f
-                            break
-                    else:
-                        return {
-                            'success': False,
-                            'count': 0,
-                            'error': f"Folder '{folder_name}' doesn't exist"
-                        }
-                
-                client.select_folder(imap_folder)
-                
-                # Search for ALL messages (not just unread)
-                messages = client.search(['ALL'])
-                if not messages:
-                    return {'success': True, 'count': 0, 'error': None}
-                
-                # Limit results
-                messages = messages[:limit]
-                
-                # Fetch messages
-                fetched = client.fetch(messages, ['RFC822', 'FLAGS', 'ENVELOPE'])
-                
-                # Get or create folder
-                db_folder = self._get_or_create_folder(folder_name, folder_type)
-                
-                count = 0
-                for uid, data in fetched.items():
+                for folder_name in folder_names:
                     try:
-                        raw_email = data[b'RFC822']
-                        msg = email.message_from_bytes(raw_email)
-                        
-                        # Parse email
-                        email_data = self._parse_email(msg)
-                        
-                        # Check if message already exists
-                        message_id = email_data.get('message_id')
-                        if message_id and mail_models.EmailMessage.objects.filter(message_id=message_id).exists():
-                            continue
-                        
-                        # Check if email is spam and route to Spam folder
-                        is_spam = email_data.get('is_spam', False)
-                        if is_spam:
-                            # Get or create Spam folder
-                            spam_folder = self._get_or_create_folder('Spam', 'spam')
-                            db_folder = spam_folder
-                            logger.info(f"Email '{email_data.get('subject')}' from '{email_data.get('sender')}' marked as spam (score: {email_data.get('spam_score')})")
-                        
-                        # Store in database
-                        self._store_received_email(db_folder, email_data, uid)
-                        count += 1
-                        
+                        results[folder_name] = self._sync_folder(client, folder_name, limit, qresync, condstore)
+                    except (imapclient.exceptions.IMAPClientAbortError, OSError):
+                        # Connection is gone; the remaining folders fail with it
+                        raise
                     except Exception as e:
-                        logger.error(f"Error processing email UID {uid}: {e}")
-                        continue
-                
-                return {
-                    'success': True,
-                    'count': count,
-                    'error': None
-                }
+                        logger.error(f"Failed to receive emails from {folder_name}: {e}")
+                        results[folder_name] = {'success': False, 'count': 0, 'bytes': 0, 'error': str(e)}
                 
         except Exception as e:
             logger.error(f"Failed to receive emails: {e}")
-            return {
-                'success': False,
-                'count': 0,
-                'error': str(e)
-            }
+            auth_failed = isinstance(e, imapclient.exceptions.LoginError)
+            results = {name: results.get(name) or {'success': False, 'count': 0, 'bytes': 0, 'error': str(e),
+                                                   'auth_failed': auth_failed}
+                       for name in folder_names}
+        
+        self._record_sync_results(results)
+        return results
+    
+    def _record_sync_results(self, results):
+        """Reset or bump FolderSyncState error counters from sync_folders() results"""
+        failed = {}
+        for name, result in results.items():
+            if not result.get('success'):
+                failed.setdefault(result.get('error') or 'Unknown error', []).append(name)
+        succeeded = [name for name, result in results.items() if result.get('success')]
+        if succeeded:
+            mail_models.FolderSyncState.record_result(self.email_account, succeeded)
+        for error, names in failed.items():
+            mail_models.FolderSyncState.record_result(self.email_account, names, error=error)
+    
+    def _connect_imap(self, imap_password):
+        """Open and authenticate an IMAPClient session (usable as a context manager)"""
+        # Get IMAP settings from email account or settings
+        imap_host = getattr(settings, 'EMAIL_IMAP_HOST', 'localhost')
+        imap_port = getattr(settings, 'EMAIL_IMAP_PORT', 143)
+        imap_use_ssl = getattr(settings, 'EMAIL_IMAP_USE_SSL', False)
+        
+        # Connect to IMAP server (Dovecot)
+        # Use STARTTLS if not using SSL
+        ssl_context = ssl.create_default_context()
+        # Skip certificate verification for development (host.docker.internal)
+        if imap_host == 'host.docker.internal':
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+        
+        client = imapclient.IMAPClient(imap_host, port=imap_port, ssl=imap_use_ssl, ssl_context=ssl_context if imap_use_ssl else None)
+        try:
+            # Use STARTTLS if not using SSL (required for plaintext auth)
+            if not imap_use_ssl:
+                client.starttls(ssl_context=ssl_context)
+            client.login(self.email_address, imap_password)
+        except Exception:
+            client.shutdown()
+            raise
+        return client
+    
+    def _available_mailboxes(self, client):
+        """Folder names on the server, listed once per sync_folders() call"""
+        if self._mailbox_list is None:
+            self._mailbox_list = [f[2] for f in client.list_folders()]
+        return self._mailbox_list
+    
+    def _sync_folder(self, client, folder_name, limit, qresync, condstore):
+        """Sync one folder on a logged-in client; see sync_folders()"""
+        # Map folder names to folder types
+        folder_type_map = {
+            'INBOX': 'inbox',
+            'Sent': 'sent',
+            'Drafts': 'drafts',
+            'Spam': 'spam',
+            'Junk': 'spam',
+            'Trash': 'trash',
+            'Deleted': 'trash',
+        }
+        folder_type = folder_type_map.get(folder_name, 'custom')
+        
+        # Get or create folder and its sync checkpoint
+        db_folder = self._get_or_create_folder(folder_name, folder_type)
+        sync_state = mail_models.FolderSyncState.objects.filter(folder=db_folder).first()
+        
+        if sync_state is None:
+            available_folders = self._available_mailboxes(client)
+            
+            # Check if folder exists (try different variations)
+            imap_folder = folder_name
+            if folder_name not in available_folders:
+                # Try case-insensitive match
+                for f in available_folders:
+                    if f.upper() == folder_name.upper():
+                        imap_folder = f
+                        break
+                else:
+                    return {
+                        'success': False,
+                        'count': 0,
+                        'bytes': 0,
+                        'error': f"Folder '{folder_name}' doesn't exist"
+                    }
+            sync_state = mail_models.FolderSyncState(folder=db_folder, mailbox=imap_folder)
+        imap_folder = sync_state.mailbox
+        
+        # One STATUS round trip tells whether anything changed since the last sync
+        status_items = [b'UIDVALIDITY', b'UIDNEXT'] + ([b'HIGHESTMODSEQ'] if condstore else [])
+        folder_status = client.folder_status(imap_folder, status_items)
+        uidvalidity = folder_status.get(b'UIDVALIDITY')
+        uidnext = folder_status.get(b'UIDNEXT', 0)
+        highest_modseq = folder_status.get(b'HIGHESTMODSEQ')
+        
+        if sync_state.uidvalidity != uidvalidity:
+            with transaction.atomic():
+                if sync_state.uidvalidity is not None:
+                    # UIDs were reassigned: stored UIDs are meaningless, resync from scratch
+                    logger.warning(f"UIDVALIDITY of {imap_folder} changed ({sync_state.uidvalidity} -> {uidvalidity}), resyncing")
+                    db_folder.messages.update(uid=None)
+                forget_locations(db_folder, keep_uidvalidity=uidvalidity)
+                sync_state.uidvalidity = uidvalidity
+                sync_state.last_uid = 0
+                sync_state.highest_modseq = None
+                sync_state.save()
+        
+        has_new = uidnext - 1 > sync_state.last_uid
+        has_changes = not condstore or sync_state.highest_modseq is None or highest_modseq != sync_state.highest_modseq
+        if not has_new and not (has_changes and sync_state.last_uid):
+            sync_state.highest_modseq = highest_modseq
+            sync_state.last_synced_at = timezone.now()
+            sync_state.save()
+            return {'success': True, 'count': 0, 'bytes': 0, 'error': None}
+        
+        # Read-only so fetching bodies never sets \Seen on the server
+        if qresync and not self._qresync_enabled:
+            client.enable('QRESYNC')
+            self._qresync_enabled = True
+        client.select_folder(imap_folder, readonly=True)
+        
+        flags_updated = vanished = 0
+        if sync_state.last_uid and has_changes:
+            flags_updated, vanished = self._sync_known_messages(client, db_folder, sync_state, qresync, condstore)
+        
+        # Fetch only UIDs above the checkpoint, oldest first so an interrupted run resumes
+        new_uids = []
+        truncated = False
+        if has_new:
+            new_uids = sorted(uid for uid in client.search(['UID', f'{sync_state.last_uid + 1}:*'])
+                              if uid > sync_state.last_uid)
+            truncated = limit is not None and len(new_uids) > limit
+            new_uids = new_uids[:limit]
+        
+        # Fetch in batches and hand them to the ingest pipeline, which parses, classifies and
+        # stores them while the next batch downloads; each batch commits together with
+        # last_uid, so an interrupted sync resumes after it
+        count = fetched_bytes = 0
+        if new_uids:
+            from .services.ingest_pipeline import IngestPipeline
+            
+            pipeline = IngestPipeline(self, db_folder, sync_state).start()
+            batch_size = getattr(settings, 'EMAIL_SYNC_BATCH_SIZE', 100)
+            try:
+                for start in range(0, len(new_uids), batch_size):
+                    batch_uids = new_uids[start:start + batch_size]
+                    fetched = client.fetch(batch_uids, ['BODY.PEEK[]', 'FLAGS'])
+                    fetched_bytes += sum(len(data.get(b'BODY[]') or b'') for data in fetched.values())
+                    pipeline.submit(fetched, batch_uids[-1])
+            except Exception:
+                # Let already fetched batches commit before giving up on the folder
+                pipeline.close(raise_errors=False)
+                raise
+            count = pipeline.close()
+        
+        if has_new and not truncated:
+            # Every UID below UIDNEXT has been fetched or was expunged before we looked; without
+            # this, a gap left by expunged new mail would cost a SELECT + SEARCH on every sync
+            self._save_checkpoint(sync_state, uidnext - 1)
+        
+        # HIGHESTMODSEQ was read before our fetches, so only now is it safe to advance
+        sync_state.highest_modseq = highest_modseq
+        sync_state.last_synced_at = timezone.now()
+        sync_state.save()
+        
+        return {
+            'success': True,
+            'count': count,
+            'bytes': fetched_bytes,
+            'flags_updated': flags_updated,
+            'vanished': vanished,
+            'error': None
+        }
     
     def _get_email_password(self):
         """Get email password from account or settings"""
@@ -298,125 +426,217 @@ class DjangoEmailService:
         )
         return folder
     
-    def _parse_email(self, msg):
-        """Parse email message into structured data"""
-        # Extract headers
-        subject = msg.get('Subject', 'No Subject')
-        from_addr = parseaddr(msg.get('From', ''))[1]
-        from_name = parseaddr(msg.get('From', ''))[0]
-        
-        # Parse recipients
-        to_recipients = [parseaddr(addr)[1] for addr in msg.get_all('To', [])]
-        cc_recipients = [parseaddr(addr)[1] for addr in msg.get_all('Cc', [])]
-        bcc_recipients = [parseaddr(addr)[1] for addr in msg.get_all('Bcc', [])]
-        
-        # Check spam score from headers (common spam detection headers)
-        spam_score = None
-        spam_status = None
-        is_spam = False
-        
-        # Check X-Spam-Score header (used by many spam filters like SpamAssassin)
-        spam_score_str = msg.get('X-Spam-Score') or msg.get('X-Spam-Level') or msg.get('X-Spam-Status')
-        if spam_score_str:
-            try:
-                # Extract numeric score from header (e.g., "X-Spam-Score: 5.2" or "X-Spam-Status: Yes, score=5.2")
-                import re
-                score_match = re.search(r'[\d.]+', str(spam_score_str))
-                if score_match:
-                    spam_score = float(score_match.group())
-                    # Check if spam status indicates spam
-                    spam_status = str(spam_score_str).lower()
-                    if 'yes' in spam_status or spam_score >= 5.0:  # Default threshold
-                        is_spam = True
-            except (ValueError, AttributeError) as e:
-                logger.debug(f"Could not parse spam score '{spam_score_str}': {e}")
-        
-        # Also check X-Spam-Flag header
-        spam_flag = msg.get('X-Spam-Flag', '').lower()
-        if spam_flag in ('yes', 'true', '1'):
-            is_spam = True
-        
-        # Check domain spam threshold if available
-        if from_addr and hasattr(self, 'email_account') and self.email_account.domain:
-            domain = self.email_account.domain
-            if hasattr(domain, 'antispam') and domain.antispam:
-                spam_threshold = getattr(domain, 'spam_threshold', 5)
-                if spam_score is not None and spam_score >= spam_threshold:
-                    is_spam = True
-        
-        # Parse date from email header (RFC 2822 format)
-        date_str = msg.get('Date')
-        date_sent = None
-        date_received = None
-        if date_str:
-            try:
-                # Parse RFC 2822 date format (e.g., "Mon, 9 Nov 2025 17:18:44 +0000")
-                parsed_date = parsedate_to_datetime(date_str)
-                if parsed_date:
-                    date_sent = parsed_date
-                    date_received = parsed_date  # Use same date if no received date available
-                else:
-                    # Fallback to current time if parsing fails
-                    date_sent = timezone.now()
-                    date_received = timezone.now()
-            except Exception as e:
-                logger.warning(f"Failed to parse date '{date_str}': {e}")
-                # Fallback to current time if parsing fails
-                date_sent = timezone.now()
-                date_received = timezone.now()
-        else:
-            # No date header - use current time
-            date_sent = timezone.now()
-            date_received = timezone.now()
-        
-        # Extract body
-        body_text = ''
-        body_html = ''
-        
-        if msg.is_multipart():
-            for part in msg.walk():
-                content_type = part.get_content_type()
-                if content_type == 'text/plain' and not body_text:
-                    body_text = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                elif content_type == 'text/html' and not body_html:
-                    body_html = part.get_payload(decode=True).decode('utf-8', errors='ignore')
+    def _sync_known_messages(self, client, db_folder, sync_state, qresync, condstore):
+        """
+        Apply flag changes and expunges for already stored UIDs (1:last_uid)
+
+        With QRESYNC this is a single UID FETCH (CHANGEDSINCE ... VANISHED); with CONDSTORE only,
+        expunges are found with an extra UID SEARCH; without CONDSTORE only expunges are synced.
+
+        Returns:
+            tuple: (number of messages with updated flags, number of messages removed)
+        """
+        known_range = f'1:{sync_state.last_uid}'
+        flags_updated = 0
+        
+        if condstore and sync_state.highest_modseq:
+            modifiers = [f'CHANGEDSINCE {sync_state.highest_modseq}'] + (['VANISHED'] if qresync else [])
+            changed = client.fetch(known_range, ['FLAGS'], modifiers=modifiers)
+            
+            # Group by flag set so each distinct combination is one UPDATE
+            by_flags = {}
+            for uid, data in changed.items():
+                flags = tuple(f.decode('utf-8', errors='ignore') if isinstance(f, bytes) else str(f)
+                              for f in data.get(b'FLAGS', ()))
+                by_flags.setdefault(flags, []).append(str(uid))
+            
+            with transaction.atomic():
+                # Unread delta from the rows whose read state actually flips
+                was_read = dict(db_folder.messages.filter(uid__in=[uid for uids in by_flags.values() for uid in uids])
+                                .values_list('uid', 'is_read'))
+                unread_delta = 0
+                for flags, uids in by_flags.items():
+                    is_read = '\\Seen' in flags
+                    flipped = sum(1 for uid in uids if was_read.get(uid, is_read) != is_read)
+                    unread_delta += -flipped if is_read else flipped
+                    flags_updated += db_folder.messages.filter(uid__in=uids).update(
+                        flags=list(flags),
+                        is_read=is_read,
+                        is_starred='\\Flagged' in flags,
+                    )
+                db_folder.adjust_counts(unread=unread_delta)
+        
+        if qresync and sync_state.highest_modseq:
+            # VANISHED (EARLIER) responses are left untagged by the FETCH above
+            gone = set()
+            for line in self._pop_untagged(client, 'VANISHED'):
+                line = line.decode('ascii', errors='ignore') if isinstance(line, bytes) else str(line)
+                gone.update(self._parse_uid_set(line.replace('(EARLIER)', '').strip(), sync_state.last_uid))
         else:
-            content_type = msg.get_content_type()
-            payload = msg.get_payload(decode=True)
-            if payload:
-                decoded = payload.decode('utf-8', errors='ignore')
-                if content_type == 'text/html':
-                    body_html = decoded
-                else:
-                    body_text = decoded
+            present = set(client.search(['UID', known_range]))
+            local = {int(uid) for uid in db_folder.messages.exclude(uid=None).values_list('uid', flat=True)
+                     if uid.isdigit() and int(uid) <= sync_state.last_uid}
+            gone = local - present
+            sync_state.last_full_scan = timezone.now()
         
-        # Generate snippet
-        snippet = (body_text or body_html or '')[:200]
+        vanished = 0
+        if gone:
+            with transaction.atomic():
+                doomed = db_folder.messages.filter(uid__in=[str(uid) for uid in gone])
+                unread_gone = doomed.filter(is_read=False).count()
+                _, deleted = doomed.delete()
+                # delete() totals include cascaded attachments; count messages only
+                vanished = deleted.get(mail_models.EmailMessage._meta.label, 0)
+                db_folder.adjust_counts(total=-vanished, unread=-unread_gone)
+                forget_locations(db_folder, gone)
         
-        return {
-            'message_id': msg.get('Message-ID', ''),
-            'subject': subject,
-            'sender': from_addr,
-            'sender_name': from_name,
-            'to_recipients': to_recipients,
-            'cc_recipients': cc_recipients,
-            'bcc_recipients': bcc_recipients,
-            'body_text': body_text,
-            'body_html': body_html,
-            'snippet': snippet,
-            'date_sent': date_sent,
-            'date_received': date_received,
-            'size_bytes': len(msg.as_bytes()),
-            'spam_score': spam_score,
-            'spam_status': spam_status,
-            'is_spam': is_spam,
+        return flags_updated, vanished
+    
+    @staticmethod
+    def _pop_untagged(client, name):
+        """
+        Remove and return the untagged ``name`` responses left by the last command
+
+        IMAPClient only parses the responses it expects; others, such as VANISHED (EARLIER)
+        after a QRESYNC FETCH, stay on its imaplib connection. This is the one place that
+        reads that private attribute (present in imapclient 2.x through 4.x).
+        """
+        return client._imap.untagged_responses.pop(name, [])
+    
+    @staticmethod
+    def _parse_uid_set(uid_set, max_uid):
+        """Expand an IMAP UID set such as '41,43:46' into UIDs, ignoring UIDs above max_uid"""
+        uids = []
+        for chunk in uid_set.split(','):
+            if ':' in chunk:
+                low, high = sorted(int(n) for n in chunk.split(':'))
+                uids.extend(range(low, min(high, max_uid) + 1))
+            elif chunk.strip().isdigit() and int(chunk) <= max_uid:
+                uids.append(int(chunk))
+        return uids
+    
+    def _parse_email(self, msg):
+        """Parse email message into structured data, spam-classified for this account"""
+        return self._classify(parse_email(msg))
+    
+    def _classify(self, email_data):
+        """Apply the domain's spam threshold on top of the X-Spam-* verdict from parsing"""
+        domain = self.email_account.domain
+        if email_data['sender'] and domain and getattr(domain, 'antispam', False):
+            spam_threshold = getattr(domain, 'spam_threshold', 5)
+            if email_data['spam_score'] is not None and email_data['spam_score'] >= spam_threshold:
+                email_data['is_spam'] = True
+        return email_data
+    
+    def _persist_messages(self, db_folder, parsed, sync_state=None, last_uid=None):
+        """
+        Store a batch of parsed messages with a fixed number of queries
+        
+        One message_id__in query finds messages that are already stored, new rows are
+        written with a single bulk_create and folder counters are adjusted once per
+        touched folder, all in one transaction.
+        
+        Args:
+            db_folder: EmailFolder the UIDs belong to
+            parsed: list of (uid, email_data, flags, raw bytes), already classified
+            sync_state: FolderSyncState checkpoint saved in the same transaction
+            last_uid: Highest UID requested in this batch (UIDs gone from the server
+                or that fail to parse are passed over too)
+        
+        Returns:
+            tuple: (number of new messages, pks of the new rows)
+        """
+        from .services.message_search import update_search_vectors
+        from .services.raw_store import raw_store
+        
+        if not parsed:
+            self._save_checkpoint(sync_state, last_uid)
+            return 0, []
+        
+        # message_id -> (pk, folder_id, uid) of rows already in the database
+        message_ids = {email_data['message_id'] for _, email_data, _, _ in parsed if email_data.get('message_id')}
+        existing = {
+            message_id: (pk, folder_id, stored_uid)
+            for message_id, pk, folder_id, stored_uid in mail_models.EmailMessage.objects.filter(
+                message_id__in=message_ids).values_list('message_id', 'pk', 'folder_id', 'uid')
         }
+        
+        relinked = []
+        new_messages = []
+        bodies = {}  # message_id -> (text, html), stored in EmailMessageBody after the insert
+        spam_folder = None
+        for uid, email_data, flags, raw in parsed:
+            message_id = email_data.get('message_id')
+            if message_id in existing:
+                pk, folder_id, stored_uid = existing[message_id]
+                if pk and folder_id == db_folder.id and stored_uid is None:
+                    # Re-link a message whose UID was cleared by a UIDVALIDITY change
+                    relinked.append(mail_models.EmailMessage(pk=pk, uid=str(uid)))
+                continue
+            if message_id:
+                # The same message can appear twice in one batch; keep the first copy
+                existing[message_id] = (None, None, None)
+            
+            # Check if email is spam and route to Spam folder
+            target_folder = db_folder
+            if email_data.get('is_spam', False):
+                spam_folder = spam_folder or self._get_or_create_folder('Spam', 'spam')
+                target_folder = spam_folder
+                logger.info(f"Email '{email_data.get('subject')}' from '{email_data.get('sender')}' marked as spam (score: {email_data.get('spam_score')})")
+            
+            message = self._build_received_email(target_folder, email_data, uid, flags=flags)
+            if raw_store.enabled:
+                try:
+                    message.raw_digest = raw_store.put(raw)
+                except OSError as e:
+                    logger.warning(f"Could not keep raw copy of UID {uid}: {e}")
+            new_messages.append(message)
+            bodies[message.message_id] = (email_data['body_text'], email_data['body_html'])
+        
+        with transaction.atomic():
+            if sync_state is not None:
+                # Every fetched UID, including messages stored under another folder (moves, copies)
+                record_locations(db_folder, sync_state.uidvalidity,
+                                 [(uid, email_data['message_id']) for uid, email_data, _, _ in parsed])
+            if relinked:
+                mail_models.EmailMessage.objects.bulk_update(relinked, ['uid'])
+            if new_messages:
+                # ignore_conflicts covers a concurrent sync inserting the same Message-ID
+                mail_models.EmailMessage.objects.bulk_create(new_messages, ignore_conflicts=True)
+                # Conflict-ignoring inserts don't return ids; one lookup maps Message-IDs to rows
+                pks = dict(mail_models.EmailMessage.objects.filter(
+                    message_id__in=list(bodies)).values_list('message_id', 'pk'))
+                mail_models.EmailMessageBody.objects.bulk_create([
+                    mail_models.EmailMessageBody(message_id=pks[message_id], text=text, html=html)
+                    for message_id, (text, html) in bodies.items() if message_id in pks
+                ], ignore_conflicts=True)
+                update_search_vectors({pks[message_id]: text for message_id, (text, _) in bodies.items()
+                                       if message_id in pks})
+                # Counter deltas instead of recounting; reconcile_folder_counts fixes rows
+                # skipped as conflicts
+                for folder in {message.folder_id: message.folder for message in new_messages}.values():
+                    batch = [message for message in new_messages if message.folder_id == folder.pk]
+                    folder.adjust_counts(total=len(batch), unread=sum(1 for message in batch if not message.is_read))
+            self._save_checkpoint(sync_state, last_uid)
+        return len(new_messages), list(pks.values()) if new_messages else []
+    
+    @staticmethod
+    def _save_checkpoint(sync_state, last_uid):
+        """Advance a folder's last_uid (never backwards)"""
+        if sync_state is None or last_uid is None or last_uid <= sync_state.last_uid:
+            return
+        sync_state.last_uid = last_uid
+        if sync_state.pk:
+            sync_state.save(update_fields=['last_uid'])
+        else:
+            sync_state.save()
     
-    def _store_received_email(self, folder, email_data, uid=None):
-        """Store received email in database"""
-        mail_models.EmailMessage.objects.create(
+    def _build_received_email(self, folder, email_data, uid=None, flags=None):
+        """Unsaved EmailMessage (metadata only) for a received email"""
+        flags = flags or []
+        return mail_models.EmailMessage(
             folder=folder,
-            message_id=email_data['message_id'] or f"django-{timezone.now().timestamp()}",
+            message_id=email_data['message_id'],
             uid=str(uid) if uid else None,
             subject=email_data['subject'],
             sender=email_data['sender'],
@@ -424,112 +644,90 @@ class DjangoEmailService:
             to_recipients=email_data['to_recipients'],
             cc_recipients=email_data['cc_recipients'],
             bcc_recipients=email_data['bcc_recipients'],
-            body_text=email_data['body_text'],
-            body_html=email_data['body_html'],
             snippet=email_data['snippet'],
             date_sent=email_data['date_sent'],
             date_received=email_data.get('date_received', email_data['date_sent']),  # Use received date or fallback to sent date
             size_bytes=email_data['size_bytes'],
-            is_read=False,
+            is_read='\\Seen' in flags,
+            is_starred='\\Flagged' in flags,
+            flags=flags,
         )
-        
-        # Update folder counts
-        folder.update_counts()
     
     def _store_sent_email(self, folder, to_emails, cc_emails, bcc_emails, 
-                          subject, body_text, body_html):
-        """Store sent email in database"""
+                          subject, body_text, body_html, message_id=None, ref=None):
+        """
+        Store sent email in database
+        
+        Args:
+            message_id: Message-ID header of the sent message
+            ref: '<uidvalidity>:<uid>' of the Sent copy from APPENDUID, so sync recognises it
+        """
+        from .services.imap_fetch import parse_message_ref
+        from .services.message_search import update_search_vectors
+        
         now = timezone.now()
-        mail_models.EmailMessage.objects.create(
-            folder=folder,
-            message_id=f"sent-{now.timestamp()}",
-            subject=subject,
-            sender=self.email_address,
-            to_recipients=to_emails,
-            cc_recipients=cc_emails or [],
-            bcc_recipients=bcc_emails or [],
-            body_text=body_text,
-            body_html=body_html,
-            snippet=(body_text or body_html or '')[:200],
-            date_sent=now,
-            date_received=now,  # For sent emails, received date is same as sent date
-            size_bytes=len(body_text or body_html or ''),
-            is_read=True,  # Sent emails are marked as read
-        )
+        message_id = message_id or f"sent-{now.timestamp()}"
+        if mail_models.EmailMessage.objects.filter(message_id=message_id).exists():
+            return  # A sync already picked up the Sent copy
+        uidvalidity, uid = parse_message_ref(ref) if ref else (None, None)
+        
+        with transaction.atomic():
+            sent = mail_models.EmailMessage.objects.create(
+                folder=folder,
+                message_id=message_id,
+                uid=str(uid) if uid else None,
+                subject=subject,
+                sender=self.email_address,
+                to_recipients=to_emails,
+                cc_recipients=cc_emails or [],
+                bcc_recipients=bcc_emails or [],
+                body_text=body_text,
+                body_html=body_html,
+                snippet=(body_text or body_html or '')[:200],
+                date_sent=now,
+                date_received=now,  # For sent emails, received date is same as sent date
+                size_bytes=len(body_text or body_html or ''),
+                is_read=True,  # Sent emails are marked as read
+            )
+            if uidvalidity:
+                record_locations(folder, uidvalidity, [(uid, message_id)])
+        
+        update_search_vectors({sent.pk: body_text})
         
         # Update folder counts
-        folder.update_counts()
+        folder.adjust_counts(total=1)
     
-    def _save_sent_to_imap(self, email_message, to_emails, cc_emails, bcc_emails, subject, body_text, body_html):
-        """Save sent email to IMAP Sent folder"""
+    def _save_sent_to_imap(self, *messages):
+        """
+        Append sent messages to the IMAP Sent folder over a pooled session
+        
+        Several messages go out as one MULTIAPPEND when the server supports it.
+        
+        Args:
+            messages: Django email messages or rendered RFC822 bytes
+        
+        Returns:
+            list: '<uidvalidity>:<uid>' per message from APPENDUID (None entries when the
+            server lacks UIDPLUS, all None without a password)
+        """
+        from .services.imap_append import append_messages
+        from .services.imap_pool import imap_pool
+        from .services.folder_status import invalidate_folder_status
+        
+        imap_password = self._get_email_password()
+        if not imap_password:
+            logger.warning("No email password available for IMAP save")
+            return [None] * len(messages)
+        
+        raw_messages = [message if isinstance(message, bytes) else message.message().as_bytes(linesep='\r\n')
+                        for message in messages]
         try:
-            import imaplib
-            import socket
-            import os
-            from email.mime.text import MIMEText
-            from email.mime.multipart import MIMEMultipart
-            
-            # Get IMAP settings
-            imap_host = getattr(settings, 'EMAIL_IMAP_HOST', 'mail.fayvad.com')
-            imap_port = getattr(settings, 'EMAIL_IMAP_PORT', 993)
-            imap_use_ssl = getattr(settings, 'EMAIL_IMAP_USE_SSL', True)
-            imap_user = self.email_address
-            imap_password = self._get_email_password()
-            
-            if not imap_password:
-                logger.warning("No email password available for IMAP save")
-                return
-            
-            # Use IP if hostname resolution fails
-            if os.path.exists('/.dockerenv'):
-                imap_host = getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
-            else:
-                try:
-                    socket.gethostbyname(imap_host)
-                except socket.gaierror:
-                    imap_host = getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
-            
-            # Connect to IMAP
-            if imap_use_ssl:
-                mail = imaplib.IMAP4_SSL(imap_host, imap_port, timeout=10)
-            else:
-                mail = imaplib.IMAP4(imap_host, imap_port, timeout=10)
-            
-            mail.login(imap_user, imap_password)
-            
-            # Create Sent folder if it doesn't exist
-            try:
-                mail.select('Sent')
-            except:
-                mail.create('Sent')
-                mail.select('Sent')
-            
-            # Use the email message object directly if it has as_bytes method
-            # Otherwise create a new message
-            if hasattr(email_message, 'message'):
-                # Django EmailMessage object
-                raw_message = email_message.message().as_bytes()
-            else:
-                # Create email message for IMAP
-                if body_html:
-                    msg = MIMEMultipart('alternative')
-                    msg.attach(MIMEText(body_text, 'plain'))
-                    msg.attach(MIMEText(body_html, 'html'))
-                else:
-                    msg = MIMEText(body_text, 'plain')
-                
-                msg['From'] = self.email_address
-                msg['To'] = ', '.join(to_emails)
-                if cc_emails:
-                    msg['Cc'] = ', '.join(cc_emails)
-                msg['Subject'] = subject
-                raw_message = msg.as_bytes()
-            
-            # Append to Sent folder
-            mail.append('Sent', None, None, raw_message)
-            mail.logout()
-            
+            with imap_pool.session(self.email_address, imap_password) as mail:
+                refs = append_messages(mail, 'Sent', raw_messages)
         except Exception as e:
             logger.error(f"Error saving sent email to IMAP: {e}")
             raise
+        
+        invalidate_folder_status(self.email_address)
+        return refs
 
@@ -2,6 +2,7 @@
 Email and Domain Management Services
 """
 from .domain_manager import DomainManager, NamecheapDomainService
+from .imap_pool import IMAPSessionPool, IMAPConnectionError, IMAPFolderError, imap_pool, resolve_imap_host
 
 # Import DjangoEmailService from services.py (parent module)
 import importlib.util
@@ -16,7 +17,10 @@ if os.path.exists(services_file):
 else:
     DjangoEmailService = None
 
-__all__ = ['DomainManager', 'NamecheapDomainService']
+__all__ = [
+    'DomainManager', 'NamecheapDomainService',
+    'IMAPSessionPool', 'IMAPConnectionError', 'IMAPFolderError', 'imap_pool', 'resolve_imap_host',
+]
 if DjangoEmailService:
     __all__.append('DjangoEmailService')
 
@@ -0,0 +1,66 @@
+"""
+Stored SMTP credentials
+Outbox messages and merge jobs carry the sender's password until they are delivered.
+It is never stored in plaintext: seal() encrypts it with Fernet (AES-128-CBC with an
+HMAC-SHA256 tag, from the cryptography package) under EMAIL_CREDENTIAL_KEY, which lives
+in the environment, not the database. A leaked row is useless without the key, and
+unseal() refuses a token older than EMAIL_CREDENTIAL_MAX_AGE seconds.
+
+Generate a key with:
+    python -c "from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())"
+"""
+from cryptography.fernet import Fernet, InvalidToken
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _fernet():
+    """Fernet for EMAIL_CREDENTIAL_KEY; there is deliberately no fallback to SECRET_KEY"""
+    key = getattr(settings, 'EMAIL_CREDENTIAL_KEY', '')
+    if not key:
+        raise ImproperlyConfigured('EMAIL_CREDENTIAL_KEY must be set to store SMTP passwords')
+    try:
+        return Fernet(key)
+    except (TypeError, ValueError) as e:
+        raise ImproperlyConfigured(f'EMAIL_CREDENTIAL_KEY is not a valid Fernet key: {e}') from e
+
+
+def seal(password):
+    """
+    Encrypt a password for storage
+
+    Returns:
+        str: sealed value ('' for no password)
+
+    Raises:
+        ImproperlyConfigured: EMAIL_CREDENTIAL_KEY is missing or invalid
+    """
+    if not password:
+        return ''
+    return _fernet().encrypt(password.encode('utf-8')).decode('ascii')
+
+
+def unseal(value, max_age=None):
+    """
+    Recover a password stored by seal()
+
+    Args:
+        value: Sealed value
+        max_age: Seconds a sealed value stays usable (default: EMAIL_CREDENTIAL_MAX_AGE)
+
+    Returns:
+        str or None: the password, or None when there is none, it expired or was tampered with
+    """
+    if not value:
+        return None
+    if max_age is None:
+        max_age = getattr(settings, 'EMAIL_CREDENTIAL_MAX_AGE', 86400)
+    try:
+        return _fernet().decrypt(value.encode('ascii'), ttl=max_age).decode('utf-8')
+    except (InvalidToken, UnicodeEncodeError):
+        # Fernet doesn't tell an expired token from a forged one
+        logger.warning("Stored SMTP password has expired or is not valid (changed key?)")
+        return None
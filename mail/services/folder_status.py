@@ -0,0 +1,170 @@
+"""
+IMAP folder counters
+Folder list with MESSAGES / UNSEEN counts from a single LIST-STATUS command
+(per-folder STATUS as fallback), cached per account for the folder sidebar
+"""
+from django.conf import settings
+from django.core.cache import cache
+from imapclient.imap_utf7 import decode as decode_utf7
+from imapclient.response_parser import parse_response
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Folders always shown in the sidebar, in this order, even if missing on the server
+DEFAULT_FOLDERS = ['INBOX', 'Sent', 'Drafts', 'Trash', 'Spam']
+
+FOLDER_TYPE_MAP = {
+    'INBOX': 'inbox',
+    'Sent': 'sent',
+    'Drafts': 'drafts',
+    'Trash': 'trash',
+    'Spam': 'spam',
+}
+
+# RFC 6154 special-use flags for folders not named like the defaults
+SPECIAL_USE_TYPES = {
+    '\\sent': 'sent',
+    '\\drafts': 'drafts',
+    '\\trash': 'trash',
+    '\\junk': 'spam',
+}
+
+
+def _to_str(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='ignore')
+    return str(value)
+
+
+def quote_mailbox(name):
+    """Quote a mailbox name for commands where imaplib passes arguments through verbatim"""
+    if name.startswith('"') or not any(char in name for char in ' (){%*"\\]'):
+        return name
+    return '"' + name.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _status_items(conn):
+    """STATUS data items to request; HIGHESTMODSEQ only when the server supports CONDSTORE"""
+    items = ['MESSAGES', 'UNSEEN']
+    if 'CONDSTORE' in conn.capabilities:
+        items.append('HIGHESTMODSEQ')
+    return f"({' '.join(items)})"
+
+
+def _parse_status(data):
+    """Parse untagged STATUS responses into {folder name: {'MESSAGES': n, ...}}"""
+    parsed = parse_response([item for item in data if item is not None]) if data else ()
+    statuses = {}
+    for i in range(0, len(parsed) - 1, 2):
+        values = parsed[i + 1]
+        statuses[_to_str(parsed[i])] = {
+            _to_str(values[j]).upper(): values[j + 1] for j in range(0, len(values) - 1, 2)
+        }
+    return statuses
+
+
+def _parse_list(data):
+    """Parse untagged LIST responses into [(name, lowercase flags)] for selectable folders"""
+    parsed = parse_response([item for item in data if item is not None]) if data else ()
+    folders = []
+    for i in range(0, len(parsed) - 2, 3):
+        flags = {_to_str(flag).lower() for flag in parsed[i]}
+        if '\\noselect' in flags or '\\nonexistent' in flags:
+            continue
+        folders.append((_to_str(parsed[i + 2]), flags))
+    return folders
+
+
+def _folder_entry(name, flags=(), status=None):
+    status = status or {}
+    folder_type = FOLDER_TYPE_MAP.get(name) or next(
+        (SPECIAL_USE_TYPES[flag] for flag in flags if flag in SPECIAL_USE_TYPES), 'other')
+    entry = {
+        'name': name,
+        'display_name': decode_utf7(name.encode('ascii', errors='ignore')) if '&' in name else name,
+        'type': folder_type,
+        'total': status.get('MESSAGES', 0),
+        'unseen': status.get('UNSEEN', 0),
+    }
+    if 'HIGHESTMODSEQ' in status:
+        entry['highestmodseq'] = status['HIGHESTMODSEQ']
+    return entry
+
+
+def get_folder_status(conn, folder_name):
+    """
+    Counters for a single folder using STATUS (no SELECT needed)
+
+    Returns:
+        folder dict (name, type, total, unseen[, highestmodseq]) or None if the folder doesn't exist
+    """
+    typ, data = conn.status(quote_mailbox(folder_name), _status_items(conn))
+    if typ != 'OK':
+        return None
+    status = next(iter(_parse_status(data).values()), {})
+    return _folder_entry(folder_name, status=status)
+
+
+def list_folder_status(conn):
+    """
+    List every selectable folder with its counters
+
+    Uses LIST ... RETURN (STATUS ...) when the server advertises LIST-STATUS (one round trip),
+    otherwise LIST followed by one STATUS per folder.
+
+    Returns:
+        list of folder dicts, default folders first (in DEFAULT_FOLDERS order), then custom folders
+    """
+    status_items = _status_items(conn)
+    if 'LIST-STATUS' in conn.capabilities:
+        typ, _ = conn.xatom('LIST', '""', '*', 'RETURN', f'(STATUS {status_items})')
+        _, list_data = conn.response('LIST')
+        _, status_data = conn.response('STATUS')
+        if typ != 'OK':
+            raise conn.error('LIST-STATUS failed')
+        statuses = _parse_status(status_data)
+        folders = _parse_list(list_data)
+    else:
+        typ, list_data = conn.list()
+        if typ != 'OK':
+            raise conn.error('LIST failed')
+        folders = _parse_list(list_data)
+        statuses = {}
+        for name, _ in folders:
+            typ, data = conn.status(quote_mailbox(name), status_items)
+            if typ == 'OK':
+                statuses.update(_parse_status(data))
+
+    entries = {name: _folder_entry(name, flags, statuses.get(name)) for name, flags in folders}
+    ordered = [entries.pop(name, None) or _folder_entry(name) for name in DEFAULT_FOLDERS]
+    return ordered + sorted(entries.values(), key=lambda folder: folder['display_name'].lower())
+
+
+def _cache_key(email_address):
+    return f'imap_folder_status_{email_address.lower()}'
+
+
+def get_cached_folder_status(email_address):
+    """Cached folder list for an account, or None"""
+    return cache.get(_cache_key(email_address))
+
+
+def set_cached_folder_status(email_address, folders):
+    timeout = getattr(settings, 'EMAIL_FOLDER_STATUS_CACHE_TTL', 30)
+    cache.set(_cache_key(email_address), folders, timeout=timeout)
+
+
+def update_cached_folder(email_address, folder):
+    """Refresh one folder's counters in the cached list (no-op when nothing is cached)"""
+    folders = get_cached_folder_status(email_address)
+    if folders is None:
+        return
+    counters = {key: folder[key] for key in ('total', 'unseen', 'highestmodseq') if key in folder}
+    folders = [{**cached, **counters} if cached['name'] == folder['name'] else cached for cached in folders]
+    set_cached_folder_status(email_address, folders)
+
+
+def invalidate_folder_status(email_address):
+    """Drop cached counters after actions that change flags or move/delete messages"""
+    cache.delete(_cache_key(email_address))
@@ -0,0 +1,339 @@
+"""
+IMAP IDLE watcher
+One background IDLE connection per active account pushes new-mail and flag-change
+events to polling browsers, so Dovecot load follows mail arrival instead of the
+number of open tabs
+
+Versions, counters and recent events are kept in MailboxPushState rows, so every web
+process answers polls from the same sequence; a lease on the row makes sure only one
+process holds the IDLE connection of an account. Watcher threads close their database
+connection after each write, so idling watchers don't tie up database connections.
+"""
+import hashlib
+import os
+import socket
+import ssl
+import threading
+import time
+from datetime import timedelta
+import imapclient
+from imapclient.exceptions import LoginError
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from mail.models import MailboxPushState
+from .imap_pool import resolve_imap_host
+from .folder_status import update_cached_folder
+from .message_cache import message_cache
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Events kept per account for clients that reconnect between polls
+EVENT_BACKLOG = 100
+
+
+def snapshot(state, since=None):
+    """Response payload of a MailboxPushState with the events newer than ``since``"""
+    return {
+        'version': state.version,
+        'folder': state.folder,
+        'unread_count': state.unread_count,
+        'total_count': state.total_count,
+        'events': [event for event in state.events if since is not None and event['version'] > since],
+        'error': state.error or None,
+    }
+
+
+class MailboxWatcher(threading.Thread):
+    """Holds IDLE on one folder of one account and publishes changes to the hub"""
+
+    def __init__(self, hub, email_address, password, folder='INBOX'):
+        super().__init__(name=f"imap-idle-{email_address}", daemon=True)
+        self.hub = hub
+        self.email_address = email_address
+        self.password = password
+        self.folder = folder
+        self.password_digest = hashlib.sha256(password.encode('utf-8')).hexdigest()
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    @property
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    def _connect(self):
+        ssl_context = ssl.create_default_context()
+        imap_host = resolve_imap_host()
+        if imap_host == getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242'):
+            # Certificate is issued for the hostname, not the IP fallback
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+        client = imapclient.IMAPClient(imap_host, port=993, ssl=True, ssl_context=ssl_context,
+                                       timeout=self.hub.socket_timeout)
+        client.login(self.email_address, self.password)
+        return client
+
+    def _wanted(self):
+        """hub.wanted(), closing this thread's database connection so it isn't held while idling"""
+        try:
+            return self.hub.wanted(self)
+        finally:
+            connection.close()
+
+    def _publish(self, kind, total, unseen, **details):
+        """hub.publish(), closing this thread's database connection afterwards"""
+        try:
+            self.hub.publish(self.email_address, kind, total, unseen, **details)
+        finally:
+            connection.close()
+
+    def _refresh_counters(self, client):
+        status = client.folder_status(self.folder, [b'MESSAGES', b'UNSEEN'])
+        return status.get(b'MESSAGES', 0), status.get(b'UNSEEN', 0)
+
+    def _watch(self, client):
+        """IDLE until stopped; re-issue IDLE every renew interval as servers drop long IDLEs"""
+        client.select_folder(self.folder, readonly=True)
+        total, unseen = self._refresh_counters(client)
+        self._publish(None, total, unseen)
+
+        if not client.has_capability('IDLE'):
+            # No IDLE: fall back to a server-side NOOP poll, still shared by all tabs
+            while not self.stopped and self._wanted():
+                self._stop_event.wait(self.hub.noop_interval)
+                responses = client.noop()[1]
+                total, unseen = self._handle(client, responses, total, unseen)
+            return
+
+        while not self.stopped and self._wanted():
+            client.idle()
+            renew_at = time.monotonic() + self.hub.renew_interval
+            responses = []
+            try:
+                while not responses and not self.stopped and time.monotonic() < renew_at:
+                    responses = client.idle_check(timeout=self.hub.check_interval)
+                    if not self._wanted():
+                        break
+            finally:
+                responses += client.idle_done()[1]
+            total, unseen = self._handle(client, responses, total, unseen)
+
+    def _handle(self, client, responses, total, unseen):
+        """Turn untagged EXISTS / EXPUNGE / FETCH responses into events"""
+        kinds = {response[1] for response in responses if len(response) > 1}
+        if not kinds & {b'EXISTS', b'EXPUNGE', b'FETCH'}:
+            return total, unseen
+
+        new_total, new_unseen = self._refresh_counters(client)
+        if b'EXISTS' in kinds and new_total > total:
+            self._publish('new_mail', new_total, new_unseen, new_count=new_total - total)
+        if b'EXPUNGE' in kinds:
+            self._publish('expunge', new_total, new_unseen)
+        if b'FETCH' in kinds:
+            self._publish('flags', new_total, new_unseen)
+        return new_total, new_unseen
+
+    def run(self):
+        backoff = 5
+        while not self.stopped and self._wanted():
+            client = None
+            try:
+                client = self._connect()
+                backoff = 5
+                self._watch(client)
+            except LoginError as e:
+                logger.warning(f"IDLE login failed for {self.email_address}: {e}")
+                self.hub.fail(self, 'Authentication failed')
+                break
+            except Exception as e:
+                logger.warning(f"IDLE connection for {self.email_address} lost: {e}")
+                self._stop_event.wait(backoff)
+                backoff = min(backoff * 2, 60)
+            finally:
+                if client is not None:
+                    try:
+                        client.logout()
+                    except Exception:
+                        pass
+        self.hub.detach(self)
+        connection.close()
+
+
+class IdleHub:
+    """
+    Registry of this process's IDLE watchers and the polling side of the push channel
+
+    A watcher is started by the first subscriber of an account, in whichever process
+    serves that poll, unless another process holds the account's watcher lease. It
+    stops once no client has polled for ``linger`` seconds or its lease is taken over.
+    A password the server refused is not tried again for ``login_backoff`` seconds;
+    polls get the error instead.
+    """
+
+    def __init__(self, max_watchers=None, linger=None, renew_interval=None, lease=None, login_backoff=None,
+                 check_interval=30, noop_interval=30, socket_timeout=60, poll_interval=1):
+        self.max_watchers = max_watchers or getattr(settings, 'EMAIL_IDLE_MAX_WATCHERS', 100)
+        self.linger = linger or getattr(settings, 'EMAIL_IDLE_LINGER', 120)
+        self.renew_interval = renew_interval or getattr(settings, 'EMAIL_IDLE_RENEW_INTERVAL', 600)
+        self.lease = lease or getattr(settings, 'EMAIL_IDLE_WATCHER_LEASE', 90)
+        self.login_backoff = login_backoff or getattr(settings, 'EMAIL_IDLE_LOGIN_BACKOFF', 300)
+        self.check_interval = check_interval
+        self.noop_interval = noop_interval
+        self.socket_timeout = socket_timeout
+        self.poll_interval = poll_interval  # Seconds between state reads while a long-poll waits
+
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._condition = threading.Condition()  # notified by this process's watchers
+        self._watchers = {}  # email -> MailboxWatcher
+
+    def subscribe(self, email_address, password, folder='INBOX'):
+        """
+        Make sure an IDLE watcher runs for the account, here or in another process
+
+        Returns:
+            True if the account is watched, False if this process's watcher limit is reached
+        """
+        key = email_address.lower()
+        digest = hashlib.sha256(password.encode('utf-8')).hexdigest()
+        now = timezone.now()
+        state, _ = MailboxPushState.objects.get_or_create(email=key, defaults={'folder': folder})
+        MailboxPushState.objects.filter(pk=state.pk).update(last_polled=now)
+
+        if (state.failed_digest == digest and state.failed_at
+                and now - state.failed_at < timedelta(seconds=self.login_backoff)):
+            # Refused recently: every poll would log in again with it; state.error answers instead
+            return True
+
+        with self._condition:
+            watcher = self._watchers.get(key)
+            if watcher and watcher.is_alive() and watcher.password_digest == digest and not watcher.stopped:
+                return True
+
+        # Take the lease unless a live watcher elsewhere holds it
+        claimed = MailboxPushState.objects.filter(pk=state.pk).filter(
+            Q(watcher='') | Q(watcher=self.owner) | Q(watcher_heartbeat__isnull=True)
+            | Q(watcher_heartbeat__lt=now - timedelta(seconds=self.lease))
+        ).update(watcher=self.owner, watcher_heartbeat=now, error='', failed_digest='', failed_at=None)
+        if not claimed:
+            return True
+
+        with self._condition:
+            watcher = self._watchers.get(key)
+            if watcher:
+                # Password changed or watcher died: start over
+                watcher.stop()
+            elif len(self._watchers) >= self.max_watchers:
+                MailboxPushState.objects.filter(pk=state.pk, watcher=self.owner).update(watcher='')
+                return False
+            watcher = MailboxWatcher(self, email_address, password, folder)
+            self._watchers[key] = watcher
+        watcher.start()
+        return True
+
+    def wait_for_events(self, email_address, since=None, timeout=0):
+        """
+        Wait until the account has events newer than ``since`` or ``timeout`` expires
+
+        Changes published in this process wake the wait at once; the shared state is
+        re-read every ``poll_interval`` seconds for changes published elsewhere.
+
+        Args:
+            email_address: Watched account
+            since: Last version the client has seen (None returns the current state at once)
+            timeout: Seconds to wait (0 answers at once)
+
+        Returns:
+            snapshot() dict, with 'error' set if the watcher failed, or None if unknown
+        """
+        key = email_address.lower()
+        deadline = time.monotonic() + timeout
+        while True:
+            state = MailboxPushState.objects.filter(email=key).first()
+            if state is None:
+                return None
+            remaining = deadline - time.monotonic()
+            # since > version only happens if the state row was recreated; resync the client
+            if since is None or state.version != since or state.error or remaining <= 0:
+                MailboxPushState.objects.filter(pk=state.pk).update(last_polled=timezone.now())
+                return snapshot(state, since)
+            with self._condition:
+                self._condition.wait(min(remaining, self.poll_interval))
+
+    def publish(self, email_address, kind, total, unseen, **details):
+        """Record new counters (and an event unless ``kind`` is None) and wake waiting clients"""
+        key = email_address.lower()
+        with transaction.atomic():
+            state = MailboxPushState.objects.select_for_update().filter(email=key).first()
+            if state is None:
+                return
+            changed = (total, unseen) != (state.total_count, state.unread_count)
+            state.total_count, state.unread_count = total, unseen
+            if kind is not None:
+                state.version += 1
+                state.events = (state.events + [{
+                    'version': state.version,
+                    'type': kind,
+                    'folder': state.folder,
+                    'unread_count': unseen,
+                    'total_count': total,
+                    **details,
+                }])[-EVENT_BACKLOG:]
+            elif changed:
+                state.version += 1
+            state.save(update_fields=['total_count', 'unread_count', 'version', 'events'])
+        with self._condition:
+            self._condition.notify_all()
+        update_cached_folder(email_address, {'name': state.folder, 'total': total, 'unseen': unseen})
+        if kind in ('flags', 'expunge'):
+            # Another client changed or removed messages; cached details may show stale flags
+            message_cache.invalidate(email_address, state.folder)
+
+    def wanted(self, watcher):
+        """
+        False once the watcher was replaced, lost its lease or nobody polled for ``linger`` seconds
+
+        Also renews the lease; watchers call this at least every ``check_interval`` seconds.
+        """
+        key = watcher.email_address.lower()
+        with self._condition:
+            if self._watchers.get(key) is not watcher:
+                return False
+        now = timezone.now()
+        return bool(MailboxPushState.objects.filter(
+            email=key, watcher=self.owner, last_polled__gte=now - timedelta(seconds=self.linger),
+        ).update(watcher_heartbeat=now))
+
+    def fail(self, watcher, error):
+        """Report a refused login to polling clients and hold off retrying the same password"""
+        key = watcher.email_address.lower()
+        with self._condition:
+            current = self._watchers.get(key) is watcher
+        if current:
+            MailboxPushState.objects.filter(email=key, watcher=self.owner).update(
+                error=error, failed_digest=watcher.password_digest, failed_at=timezone.now())
+        with self._condition:
+            self._condition.notify_all()
+
+    def detach(self, watcher):
+        """Forget a finished watcher and give up its lease"""
+        key = watcher.email_address.lower()
+        with self._condition:
+            if self._watchers.get(key) is not watcher:
+                return
+            del self._watchers[key]
+            self._condition.notify_all()
+        MailboxPushState.objects.filter(email=key, watcher=self.owner).update(watcher='', watcher_heartbeat=None)
+
+    def stop_all(self):
+        with self._condition:
+            watchers = list(self._watchers.values())
+        for watcher in watchers:
+            watcher.stop()
+
+
+# Process-wide hub shared by the long-poll endpoint
+imap_idle_hub = IdleHub()
@@ -0,0 +1,158 @@
+"""
+IMAP bulk message actions
+Flag, move and delete many messages with one UID set per command, RFC 6851 MOVE
+when the server has it and UID EXPUNGE (UIDPLUS) limited to the affected messages
+"""
+from .folder_status import quote_mailbox
+from .imap_fetch import make_message_ref
+import logging
+
+logger = logging.getLogger(__name__)
+
+# UIDs per command; keeps scattered selections well below server command-line limits
+UID_SET_BATCH = 1000
+
+FLAG_ACTIONS = {
+    'mark_read': ('+FLAGS.SILENT', '(\\Seen)'),
+    'mark_unread': ('-FLAGS.SILENT', '(\\Seen)'),
+    'star': ('+FLAGS.SILENT', '(\\Flagged)'),
+    'unstar': ('-FLAGS.SILENT', '(\\Flagged)'),
+}
+ACTIONS = tuple(FLAG_ACTIONS) + ('delete', 'move')
+
+
+def build_uid_set(uids):
+    """Compress UIDs into an IMAP sequence set, e.g. [1, 2, 3, 7, 9, 10] -> '1:3,7,9:10'"""
+    ranges = []
+    for uid in sorted({int(uid) for uid in uids}):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(str(low) if low == high else f'{low}:{high}' for low, high in ranges)
+
+
+def expand_uid_set(uid_set):
+    """Expand a numeric IMAP sequence set such as '41,43:46' into a list of UIDs"""
+    uids = []
+    for chunk in uid_set.split(','):
+        if ':' in chunk:
+            low, high = sorted(int(n) for n in chunk.split(':'))
+            uids.extend(range(low, high + 1))
+        elif chunk.strip().isdigit():
+            uids.append(int(chunk))
+    return uids
+
+
+def _existing_uids(conn, uid_set):
+    typ, data = conn.uid('SEARCH', None, 'UID', uid_set)
+    if typ != 'OK':
+        raise conn.error(f'UID SEARCH failed: {data}')
+    return {int(uid) for uid in data[0].split()} if data and data[0] else set()
+
+
+def expunge_uids(conn, uid_set):
+    """
+    Expunge only the given UIDs (which must already be flagged \\Deleted)
+
+    Uses UID EXPUNGE when the server has UIDPLUS. Otherwise other messages flagged
+    \\Deleted (e.g. by another client) are unflagged around a plain EXPUNGE so they survive it.
+    """
+    if 'UIDPLUS' in conn.capabilities:
+        return conn.uid('EXPUNGE', uid_set)
+    typ, data = conn.uid('SEARCH', None, 'DELETED', 'NOT', 'UID', uid_set)
+    others = build_uid_set(data[0].split()) if typ == 'OK' and data and data[0] else ''
+    if others:
+        conn.uid('STORE', others, '-FLAGS.SILENT', '(\\Deleted)')
+    try:
+        return conn.expunge()
+    finally:
+        if others:
+            conn.uid('STORE', others, '+FLAGS.SILENT', '(\\Deleted)')
+
+
+def _copyuid_map(conn):
+    """Source UID -> (uidvalidity, destination UID) from the COPYUID response code of a MOVE"""
+    _, data = conn.response('COPYUID')
+    moved = {}
+    for item in data or []:
+        if item is None:
+            continue
+        parts = (item.decode('ascii', errors='ignore') if isinstance(item, bytes) else str(item)).split()
+        if len(parts) < 3 or not parts[0].isdigit():
+            continue
+        pairs = zip(expand_uid_set(parts[1]), expand_uid_set(parts[2]))
+        moved.update({source: (int(parts[0]), target) for source, target in pairs})
+    return moved
+
+
+def _apply_batch(conn, action, uid_set, target_folder):
+    """
+    Run one action on one UID set
+
+    Returns:
+        {source uid: new message reference} for moves reported through COPYUID
+    """
+    if action in FLAG_ACTIONS:
+        typ, data = conn.uid('STORE', uid_set, *FLAG_ACTIONS[action])
+    elif action == 'delete':
+        typ, data = conn.uid('STORE', uid_set, '+FLAGS.SILENT', '(\\Deleted)')
+        if typ == 'OK':
+            typ, data = expunge_uids(conn, uid_set)
+    elif 'MOVE' in conn.capabilities:
+        conn.response('COPYUID')  # drop leftovers so only this MOVE's mapping is read
+        typ, data = conn.uid('MOVE', uid_set, quote_mailbox(target_folder))
+    else:
+        typ, data = conn.uid('COPY', uid_set, quote_mailbox(target_folder))
+        if typ == 'OK':
+            typ, data = conn.uid('STORE', uid_set, '+FLAGS.SILENT', '(\\Deleted)')
+        if typ == 'OK':
+            typ, data = expunge_uids(conn, uid_set)
+    if typ != 'OK':
+        raise conn.error(f'{action} failed: {data}')
+
+    if action != 'move':
+        return {}
+    return {source: make_message_ref(validity, target) for source, (validity, target) in _copyuid_map(conn).items()}
+
+
+def apply_action(conn, action, uids, target_folder=None):
+    """
+    Apply a flag, delete or move action to a set of messages in the selected folder
+
+    Each batch of up to UID_SET_BATCH UIDs costs one UID SEARCH (to tell which UIDs
+    still exist) plus one command per step, instead of one command per message.
+
+    Args:
+        conn: imaplib connection with the folder selected read-write
+        action: One of ACTIONS
+        uids: Message UIDs (int or str)
+        target_folder: Destination folder for 'move'
+
+    Returns:
+        {uid: {'status': 'ok' | 'not_found' | 'failed', ['id': new reference after a move],
+        ['error': message]}}
+    """
+    if action not in ACTIONS:
+        raise ValueError(f'Unknown action: {action}')
+    if action == 'move' and not target_folder:
+        raise ValueError('Target folder required for move')
+
+    uids = sorted({int(uid) for uid in uids})
+    results = {}
+    for start in range(0, len(uids), UID_SET_BATCH):
+        batch = uids[start:start + UID_SET_BATCH]
+        try:
+            existing = _existing_uids(conn, build_uid_set(batch))
+            results.update({uid: {'status': 'not_found'} for uid in batch if uid not in existing})
+            if not existing:
+                continue
+            moved = _apply_batch(conn, action, build_uid_set(existing), target_folder)
+            for uid in existing:
+                results[uid] = {'status': 'ok', 'id': moved[uid]} if uid in moved else {'status': 'ok'}
+        except conn.abort:
+            raise
+        except conn.error as e:
+            logger.error(f"IMAP {action} on UIDs {batch[0]}-{batch[-1]} failed: {e}")
+            results.update({uid: {'status': 'failed', 'error': str(e)} for uid in batch if uid not in results})
+    return results
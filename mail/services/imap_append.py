@@ -0,0 +1,108 @@
+"""
+IMAP APPEND helpers
+Store several messages in a mailbox with one RFC 3502 MULTIAPPEND command when the
+server supports it (one APPEND each otherwise) and read their new UIDs from the
+RFC 4315 APPENDUID response code, so the stored copies need no resync to be found
+"""
+import imaplib
+from .folder_status import quote_mailbox
+from .imap_actions import expand_uid_set
+from .imap_fetch import make_message_ref
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Messages per MULTIAPPEND command; a failed command rejects all of its messages
+MULTIAPPEND_BATCH = 50
+
+
+def _appenduid(conn):
+    """(uidvalidity, [uids]) from the APPENDUID response code of the last APPEND, or (None, [])"""
+    _, data = conn.response('APPENDUID')
+    for item in reversed(data or []):
+        if item is None:
+            continue
+        parts = (item.decode('ascii', errors='ignore') if isinstance(item, bytes) else str(item)).split()
+        if len(parts) >= 2 and parts[0].isdigit():
+            return int(parts[0]), expand_uid_set(parts[1])
+    return None, []
+
+
+class _Literals:
+    """Feeds the messages of a MULTIAPPEND, one per continuation request"""
+
+    def __init__(self, messages, flags):
+        self.pending = list(messages)
+        self.flags = flags
+
+    def announce(self):
+        return f'{self.flags} {{{len(self.pending[0])}}}'
+
+    def next(self, continuation):
+        literal = self.pending.pop(0)
+        if self.pending:
+            literal += b' ' + self.announce().encode('ascii')
+        return literal
+
+
+def _multiappend(conn, mailbox, messages, flags):
+    """
+    One APPEND command carrying every message as its own literal
+
+    imaplib sends a single literal per command unless the literal is a bound method,
+    which it calls on every continuation request (the mechanism behind AUTHENTICATE).
+    The command line announces the first literal; each answer is a message followed by
+    the announcement of the next one, and the last message ends the command.
+    """
+    literals = _Literals(messages, flags)
+    conn.literal = literals.next
+    return conn._simple_command('APPEND', quote_mailbox(mailbox), literals.announce())
+
+
+def _append_batch(conn, mailbox, messages, flags):
+    conn.response('APPENDUID')  # drop leftovers so only this command's UIDs are read
+    if len(messages) > 1 and 'MULTIAPPEND' in conn.capabilities:
+        typ, data = _multiappend(conn, mailbox, messages, flags)
+        if typ != 'OK':
+            raise conn.error(f'MULTIAPPEND failed: {data}')
+        uidvalidity, uids = _appenduid(conn)
+        if len(uids) != len(messages):
+            uids = [None] * len(messages)
+        return uidvalidity, uids
+
+    uidvalidity, uids = None, []
+    for message in messages:
+        typ, data = conn.append(quote_mailbox(mailbox), flags, None, message)
+        if typ != 'OK':
+            raise conn.error(f'APPEND failed: {data}')
+        uidvalidity, appended = _appenduid(conn)
+        uids.append(appended[0] if appended else None)
+    return uidvalidity, uids
+
+
+def append_messages(conn, mailbox, messages, flags='(\\Seen)'):
+    """
+    Append raw messages to a mailbox, creating it when the server answers TRYCREATE
+
+    Args:
+        conn: Authenticated imaplib connection (any state; APPEND needs no SELECT)
+        messages: list of RFC822 bytes
+
+    Returns:
+        list: message reference ('<uidvalidity>:<uid>') per message, None where the
+        server didn't report one (no UIDPLUS)
+    """
+    messages = [imaplib.MapCRLF.sub(imaplib.CRLF, message) for message in messages]
+    refs = []
+    for start in range(0, len(messages), MULTIAPPEND_BATCH):
+        batch = messages[start:start + MULTIAPPEND_BATCH]
+        try:
+            uidvalidity, uids = _append_batch(conn, mailbox, batch, flags)
+        except conn.error as e:
+            if 'TRYCREATE' not in str(e).upper():
+                raise
+            logger.info(f"Creating mailbox {mailbox} for APPEND")
+            conn.create(quote_mailbox(mailbox))
+            uidvalidity, uids = _append_batch(conn, mailbox, batch, flags)
+        refs.extend(make_message_ref(uidvalidity, uid) if uidvalidity and uid else None for uid in uids)
+    return refs
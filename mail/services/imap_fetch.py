@@ -0,0 +1,396 @@
+"""
+IMAP FETCH helpers
+UID message references, batched header-only message fetching and BODYSTRUCTURE-driven
+partial fetching of message bodies for the email API
+"""
+import base64
+import binascii
+import quopri
+import re
+from email.header import decode_header, make_header
+from imapclient.response_parser import parse_fetch_response
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Size of the partial body peek used to build list snippets
+SNIPPET_PEEK_BYTES = 1024
+SNIPPET_LENGTH = 100
+
+SUMMARY_FETCH_ITEMS = f'(UID FLAGS ENVELOPE RFC822.SIZE BODYSTRUCTURE BODY.PEEK[1]<0.{SNIPPET_PEEK_BYTES}>)'
+
+
+class StaleMessageRef(Exception):
+    """Raised when a message reference was issued under a different UIDVALIDITY"""
+
+
+def make_message_ref(uidvalidity, uid):
+    """Stable API identity for a message: '<uidvalidity>:<uid>'"""
+    return f"{uidvalidity}:{uid}" if uidvalidity else str(uid)
+
+
+def parse_message_ref(ref):
+    """
+    Split a message reference into (uidvalidity, uid)
+
+    A bare number is accepted as a UID without UIDVALIDITY (uidvalidity is None).
+    Raises ValueError for malformed references.
+    """
+    ref = str(ref).strip()
+    if ':' in ref:
+        uidvalidity, uid = ref.split(':', 1)
+        return int(uidvalidity), int(uid)
+    return None, int(ref)
+
+
+def resolve_uid(conn, ref):
+    """
+    Resolve a message reference to a UID in the folder selected on ``conn``
+
+    Raises:
+        StaleMessageRef: the folder's UIDVALIDITY no longer matches the reference
+    """
+    uidvalidity, uid = parse_message_ref(ref)
+    current = getattr(conn, 'uidvalidity', None)
+    if uidvalidity and current and uidvalidity != current:
+        raise StaleMessageRef(f"Message reference {ref} is stale (UIDVALIDITY is now {current})")
+    return str(uid)
+
+
+def _to_str(value, default=''):
+    if value is None:
+        return default
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='ignore')
+    return str(value)
+
+
+def decode_mime_header(value, default=''):
+    """Decode an RFC 2047 encoded header value (bytes or str)"""
+    value = _to_str(value)
+    if not value:
+        return default
+    try:
+        return str(make_header(decode_header(value)))
+    except Exception:
+        return value
+
+
+def format_address(address):
+    """Convert an ENVELOPE address into (display name, email address)"""
+    name = decode_mime_header(address.name)
+    mailbox = _to_str(address.mailbox)
+    host = _to_str(address.host)
+    email_address = f"{mailbox}@{host}" if host else mailbox
+    return name, email_address
+
+
+def envelope_addresses(addresses):
+    """List of email addresses from an ENVELOPE address list"""
+    return [format_address(addr)[1] for addr in (addresses or []) if addr.mailbox]
+
+
+def _params_dict(params):
+    """Convert a BODYSTRUCTURE parameter list into a lowercase-keyed dict"""
+    if not params or not isinstance(params, (tuple, list)):
+        return {}
+    items = list(params)
+    return {
+        _to_str(items[i]).lower(): decode_mime_header(items[i + 1])
+        for i in range(0, len(items) - 1, 2)
+    }
+
+
+def is_multipart(structure):
+    return bool(structure) and isinstance(structure[0], list)
+
+
+def describe_part(structure, part_number):
+    """
+    Describe a single (non-multipart) BODYSTRUCTURE part
+
+    Returns:
+        dict with part number, content type, params, encoding, size, disposition and filename
+    """
+    main_type = _to_str(structure[0]).lower()
+    sub_type = _to_str(structure[1]).lower()
+
+    # Extension data position depends on the part type (RFC 3501 section 7.4.2)
+    if main_type == 'text':
+        disposition_index = 9
+    elif main_type == 'message' and sub_type == 'rfc822':
+        disposition_index = 11
+    else:
+        disposition_index = 8
+
+    disposition, disposition_params = '', {}
+    if len(structure) > disposition_index and isinstance(structure[disposition_index], (tuple, list)):
+        raw = structure[disposition_index]
+        disposition = _to_str(raw[0]).lower()
+        disposition_params = _params_dict(raw[1] if len(raw) > 1 else None)
+
+    params = _params_dict(structure[2])
+    return {
+        'part': part_number,
+        'content_type': f"{main_type}/{sub_type}",
+        'params': params,
+        'content_id': _to_str(structure[3]).strip('<>') or None,
+        'encoding': _to_str(structure[5]).lower(),
+        'size': structure[6] if isinstance(structure[6], int) else 0,
+        'disposition': disposition,
+        'filename': disposition_params.get('filename') or params.get('name') or None,
+    }
+
+
+def iter_parts(structure, prefix=''):
+    """Yield describe_part() dicts for every leaf part, numbered the way BODY[<part>] expects"""
+    if not structure:
+        return
+    if is_multipart(structure):
+        for index, child in enumerate(structure[0], start=1):
+            number = f"{prefix}.{index}" if prefix else str(index)
+            yield from iter_parts(child, number)
+    else:
+        yield describe_part(structure, prefix or '1')
+
+
+def is_attachment(part):
+    """True for parts that are shown as attachments rather than as the message body"""
+    if part['disposition'] == 'attachment':
+        return True
+    if part['filename'] and not part['content_type'].startswith('text/'):
+        return part['disposition'] != 'inline' or not part['content_id']
+    return False
+
+
+def has_attachments(structure):
+    return any(is_attachment(part) for part in iter_parts(structure))
+
+
+def decode_transfer_encoding(payload, encoding):
+    """Decode a (possibly truncated) base64 / quoted-printable payload"""
+    if encoding == 'base64':
+        compact = re.sub(rb'[^A-Za-z0-9+/=]', b'', payload)
+        compact = compact[:len(compact) - len(compact) % 4]
+        try:
+            return base64.b64decode(compact)
+        except (binascii.Error, ValueError):
+            return b''
+    if encoding == 'quoted-printable':
+        return quopri.decodestring(payload)
+    return payload
+
+
+def decode_part_text(payload, charset=None):
+    """Decode a text part payload, falling back to UTF-8 for unknown charsets"""
+    try:
+        return payload.decode(charset or 'utf-8', errors='ignore')
+    except LookupError:
+        return payload.decode('utf-8', errors='ignore')
+
+
+def snippet_from_peek(structure, peek):
+    """Build a short plain-text snippet from the partial BODY[1] peek"""
+    if not peek or not structure:
+        return ''
+
+    first = structure
+    if is_multipart(first):
+        first = first[0][0]
+    if is_multipart(first):
+        # Part 1 is itself multipart: skip its first boundary + part headers, stop at the next boundary
+        while is_multipart(first):
+            boundary = _params_dict(first[2] if len(first) > 2 else None).get('boundary')
+            first = first[0][0]
+        header_end = peek.find(b'\r\n\r\n')
+        if header_end == -1:
+            return ''
+        peek = peek[header_end + 4:]
+        if boundary:
+            peek = peek.split(b'\r\n--' + boundary.encode('utf-8', errors='ignore'), 1)[0]
+
+    part = describe_part(first, '1')
+    if not part['content_type'].startswith('text/'):
+        return ''
+
+    text = decode_part_text(decode_transfer_encoding(peek, part['encoding']), part['params'].get('charset'))
+    if part['content_type'] == 'text/html':
+        text = re.sub(r'<(style|script)[^>]*>.*?(</\1>|$)', ' ', text, flags=re.S | re.I)
+        text = re.sub(r'<[^>]*>?', ' ', text)
+    return re.sub(r'\s+', ' ', text).strip()[:SNIPPET_LENGTH]
+
+
+def summarize_message(data):
+    """Turn a parsed FETCH response (SUMMARY_FETCH_ITEMS) into the list representation"""
+    envelope = data.get(b'ENVELOPE')
+    structure = data.get(b'BODYSTRUCTURE')
+    flags = [_to_str(flag) for flag in data.get(b'FLAGS', ())]
+
+    peek = b''
+    for key, value in data.items():
+        if isinstance(key, bytes) and key.startswith(b'BODY[1]'):
+            peek = value or b''
+            break
+
+    sender_name, sender_email = ('', '')
+    if envelope and envelope.from_:
+        sender_name, sender_email = format_address(envelope.from_[0])
+
+    date_received = None
+    if envelope and envelope.date:
+        date_received = envelope.date.isoformat()
+
+    return {
+        'uid': data.get(b'UID'),
+        'message_id': _to_str(envelope.message_id) if envelope else '',
+        'subject': decode_mime_header(envelope.subject if envelope else None, '(no subject)'),
+        'sender': sender_email or 'Unknown',
+        'from_display': f"{sender_name} <{sender_email}>" if sender_name else (sender_email or 'Unknown'),
+        'to_recipients': envelope_addresses(envelope.to) if envelope else [],
+        'cc_recipients': envelope_addresses(envelope.cc) if envelope else [],
+        'date_received': date_received,
+        'is_read': '\\Seen' in flags,
+        'is_starred': '\\Flagged' in flags,
+        'flags': flags,
+        'size_bytes': data.get(b'RFC822.SIZE', 0),
+        'has_attachments': has_attachments(structure),
+        'snippet': snippet_from_peek(structure, peek),
+    }
+
+
+def fetch_summaries(conn, message_set):
+    """
+    Fetch list metadata for a whole range of messages in a single FETCH
+
+    Args:
+        conn: imaplib connection with the folder selected
+        message_set: IMAP sequence set (e.g. '51:100')
+
+    Returns:
+        dict mapping sequence number -> summarize_message() dict
+    """
+    typ, data = conn.fetch(message_set, SUMMARY_FETCH_ITEMS)
+    if typ != 'OK':
+        raise conn.error(f"FETCH {message_set} failed: {data}")
+
+    parsed = parse_fetch_response([item for item in data if item is not None],
+                                  normalise_times=False, uid_is_key=False)
+    summaries = {}
+    for seq, item in parsed.items():
+        try:
+            summaries[seq] = summarize_message(item)
+        except Exception as e:
+            logger.error(f"Error summarizing message {seq}: {e}")
+    return summaries
+
+
+DETAIL_FETCH_ITEMS = '(UID FLAGS RFC822.SIZE BODYSTRUCTURE BODY.PEEK[HEADER])'
+
+
+def _parse_single(conn_data):
+    """Parse a one-message FETCH response into its attribute dict (or None)"""
+    parsed = parse_fetch_response([item for item in conn_data if item is not None],
+                                  normalise_times=False, uid_is_key=False)
+    return next(iter(parsed.values()), None)
+
+
+def fetch_message_structure(conn, uid):
+    """
+    Fetch flags, size, BODYSTRUCTURE and the header block of one message (no body bytes)
+
+    Returns:
+        dict with b'FLAGS', b'BODYSTRUCTURE', b'BODY[HEADER]', ... or None if the UID doesn't exist
+    """
+    typ, data = conn.uid('FETCH', uid, DETAIL_FETCH_ITEMS)
+    if typ != 'OK' or not data or data[0] is None:
+        return None
+    return _parse_single(data)
+
+
+def display_parts(structure):
+    """
+    Pick the parts to render: the first text/plain and text/html that aren't attachments
+
+    Returns:
+        (text part, html part) describe_part() dicts, either may be None
+    """
+    text_part = html_part = None
+    for part in iter_parts(structure):
+        if is_attachment(part):
+            continue
+        if part['content_type'] == 'text/plain' and text_part is None:
+            text_part = part
+        elif part['content_type'] == 'text/html' and html_part is None:
+            html_part = part
+    return text_part, html_part
+
+
+def decoded_size(part):
+    """Approximate decoded size of a part from its encoded BODYSTRUCTURE size"""
+    if part['encoding'] == 'base64':
+        # 76 base64 characters + CRLF carry 57 bytes
+        return part['size'] * 57 // 78
+    return part['size']
+
+
+def attachment_manifest(structure):
+    """Attachments and inline (cid:) parts described from BODYSTRUCTURE, without their bytes"""
+    return [
+        {
+            'part': part['part'],
+            'filename': part['filename'] or f"part-{part['part']}",
+            'content_type': part['content_type'],
+            'size': decoded_size(part),
+            'content_id': part['content_id'],
+            'inline': not is_attachment(part),
+        }
+        for part in iter_parts(structure)
+        if is_attachment(part) or (part['content_id'] and not part['content_type'].startswith('text/'))
+    ]
+
+
+def fetch_body_parts(conn, uid, parts, peek=False):
+    """
+    Fetch and decode the given text parts in one UID FETCH
+
+    Args:
+        conn: imaplib connection with the folder selected
+        uid: Message UID
+        parts: describe_part() dicts
+        peek: Use BODY.PEEK (don't set \\Seen)
+
+    Returns:
+        dict mapping part number -> decoded text
+    """
+    if not parts:
+        return {}
+    section = 'BODY.PEEK' if peek else 'BODY'
+    items = ' '.join(f"{section}[{part['part']}]" for part in parts)
+    typ, data = conn.uid('FETCH', uid, f'({items})')
+    if typ != 'OK' or not data or data[0] is None:
+        return {}
+    fetched = _parse_single(data) or {}
+    texts = {}
+    for part in parts:
+        payload = fetched.get(f"BODY[{part['part']}]".encode('ascii')) or b''
+        payload = decode_transfer_encoding(payload, part['encoding'])
+        texts[part['part']] = decode_part_text(payload, part['params'].get('charset'))
+    return texts
+
+
+def find_part(structure, part_number):
+    """describe_part() dict for a part number, or None"""
+    return next((part for part in iter_parts(structure) if part['part'] == part_number), None)
+
+
+
+def fetch_part_info(conn, uid, part_number):
+    """
+    Look a part up in the message's BODYSTRUCTURE (no body bytes are fetched)
+
+    Returns:
+        describe_part() dict, or None if the message or part doesn't exist
+    """
+    typ, data = conn.uid('FETCH', uid, '(BODYSTRUCTURE)')
+    fetched = _parse_single(data) if typ == 'OK' and data and data[0] is not None else None
+    return find_part(fetched.get(b'BODYSTRUCTURE'), part_number) if fetched else None
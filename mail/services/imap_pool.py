@@ -0,0 +1,359 @@
+"""
+IMAP Session Pool
+Keeps authenticated, already-selected Dovecot connections alive between API calls
+so views borrow a session instead of doing TLS + LOGIN on every request
+"""
+import hashlib
+import imaplib
+import os
+import socket
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from django.conf import settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def resolve_imap_host():
+    """Resolve the IMAP host, falling back to the mail server IP (Docker / DNS failure)"""
+    if os.path.exists('/.dockerenv'):
+        return getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
+
+    imap_host = getattr(settings, 'EMAIL_IMAP_HOST', 'mail.fayvad.com')
+    try:
+        socket.gethostbyname(imap_host)
+    except socket.gaierror:
+        imap_host = getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
+        logger.info(f"Using IP address {imap_host} instead of hostname")
+    return imap_host
+
+
+class IMAPConnectionError(Exception):
+    """Raised when a new IMAP session cannot be opened or authenticated"""
+
+
+class IMAPPoolExhausted(IMAPConnectionError):
+    """Raised when no session becomes available within the pool's acquire timeout"""
+
+
+class IMAPFolderError(Exception):
+    """Raised when the folder requested from acquire() cannot be selected"""
+
+
+class PooledIMAP4_SSL(imaplib.IMAP4_SSL):
+    """IMAP4_SSL connection that remembers its selected folder so SELECT can be skipped on reuse"""
+
+    selected_folder = None
+    uidvalidity = None
+    _select_data = None
+
+    def select(self, mailbox='INBOX', readonly=False):
+        if not readonly and self.state == 'SELECTED' and self.selected_folder == mailbox:
+            # NOOP is cheaper than re-opening the mailbox and still delivers EXISTS updates.
+            # Expunges by other clients shift the count without an EXISTS, so re-select then.
+            typ, _ = self.noop()
+            if typ == 'OK' and 'EXPUNGE' not in self.untagged_responses:
+                typ, data = self.response('EXISTS')
+                if data and data[-1] is not None:
+                    self._select_data = [data[-1]]
+                self.untagged_responses = {}
+                return 'OK', self._select_data
+        self.selected_folder = None
+        self.uidvalidity = None
+        typ, data = super().select(mailbox, readonly)
+        if typ == 'OK':
+            _, validity = self.response('UIDVALIDITY')
+            if validity and validity[-1] is not None:
+                self.uidvalidity = int(validity[-1])
+            if not readonly:
+                self.selected_folder = mailbox
+                self._select_data = data
+        return typ, data
+
+    def login(self, user, password):
+        typ, data = super().login(user, password)
+        # Extensions such as MOVE, UIDPLUS and CONDSTORE are only advertised after authentication;
+        # take them from the [CAPABILITY ...] response code when the server sends one
+        text = data[-1].decode('ascii', errors='ignore') if data and isinstance(data[-1], bytes) else ''
+        if text.upper().startswith('[CAPABILITY '):
+            self.capabilities = tuple(text[len('[CAPABILITY '):text.index(']')].upper().split())
+        else:
+            self._get_capabilities()
+        return typ, data
+
+    def expunge(self):
+        # Our own expunge changes the message count; force a real SELECT next time
+        self.selected_folder = None
+        return super().expunge()
+
+    def close(self):
+        self.selected_folder = None
+        return super().close()
+
+    def logout(self):
+        self.selected_folder = None
+        return super().logout()
+
+
+class IMAPSessionPool:
+    """
+    Pool of authenticated IMAP sessions keyed by account credentials
+
+    Sessions are leased exclusively: acquire() hands out a connection, release() returns it
+    to the pool and discard() closes it (use discard after errors, when the connection state
+    is unknown). At most ``max_size`` sessions are open, ``max_per_account`` of them for one
+    account, idle or leased; acquire() waits up to ``acquire_timeout`` seconds for a slot,
+    closing the least recently used idle session when that makes room. Idle sessions are
+    closed after ``idle_timeout`` seconds and checked with NOOP when they have been idle
+    longer than ``noop_interval``.
+    """
+
+    def __init__(self, max_size=None, max_per_account=None, idle_timeout=None,
+                 noop_interval=None, acquire_timeout=None, port=993, timeout=10):
+        self.max_size = max_size or getattr(settings, 'EMAIL_IMAP_POOL_MAX_SIZE', 50)
+        self.max_per_account = max_per_account or getattr(settings, 'EMAIL_IMAP_POOL_MAX_PER_ACCOUNT', 4)
+        self.idle_timeout = idle_timeout or getattr(settings, 'EMAIL_IMAP_POOL_IDLE_TIMEOUT', 300)
+        self.noop_interval = noop_interval or getattr(settings, 'EMAIL_IMAP_POOL_NOOP_INTERVAL', 30)
+        self.acquire_timeout = acquire_timeout or getattr(settings, 'EMAIL_IMAP_POOL_ACQUIRE_TIMEOUT', 10)
+        self.port = port
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._freed = threading.Condition(self._lock)  # notified whenever a slot or idle session frees up
+        self._idle = {}              # key -> deque of (connection, last_used)
+        self._leased = {}            # id(connection) -> key
+        self._open_count = 0         # idle + leased + being opened
+        self._per_account = Counter()  # email address -> open sessions
+
+    @staticmethod
+    def _make_key(email_address, password):
+        """Key sessions by account and password so a changed password never reuses a session"""
+        digest = hashlib.sha256(password.encode('utf-8')).hexdigest()
+        return (email_address.lower(), digest)
+
+    def _connect(self, email_address, password):
+        """Open and authenticate a new IMAP session"""
+        try:
+            conn = PooledIMAP4_SSL(resolve_imap_host(), self.port, timeout=self.timeout)
+        except Exception as e:
+            raise IMAPConnectionError(str(e)) from e
+        try:
+            conn.login(email_address, password)
+        except Exception as e:
+            self._close(conn)
+            raise IMAPConnectionError(str(e)) from e
+        return conn
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.logout()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _is_alive(conn):
+        try:
+            typ, _ = conn.noop()
+            return typ == 'OK'
+        except Exception:
+            return False
+
+    def _forget_locked(self, key, count=1):
+        """Account for closed sessions of ``key`` and wake up waiting acquirers"""
+        self._open_count -= count
+        self._per_account[key[0]] -= count
+        if self._per_account[key[0]] <= 0:
+            del self._per_account[key[0]]
+        self._freed.notify_all()
+
+    def _reap_locked(self, now):
+        """Detach idle sessions past their timeout; caller closes them outside the lock"""
+        expired = []
+        for key in list(self._idle):
+            sessions = self._idle[key]
+            while sessions and now - sessions[0][1] > self.idle_timeout:
+                expired.append(sessions.popleft()[0])
+                self._forget_locked(key)
+            if not sessions:
+                del self._idle[key]
+        return expired
+
+    def _evict_locked(self, email_address=None):
+        """Detach the least recently used idle session (of one account, if given), or None"""
+        keys = [key for key in self._idle if email_address is None or key[0] == email_address]
+        if not keys:
+            return None
+        key = min(keys, key=lambda k: self._idle[k][0][1])
+        conn = self._idle[key].popleft()[0]
+        if not self._idle[key]:
+            del self._idle[key]
+        self._forget_locked(key)
+        return conn
+
+    def _checkout(self, key, deadline):
+        """
+        Take an idle session of ``key`` or reserve a slot for a new one
+
+        Returns:
+            tuple: ((connection, last_used) or None when a slot was reserved, sessions to close)
+
+        Raises:
+            IMAPPoolExhausted: no slot freed up before ``deadline``
+        """
+        closing = []
+        with self._freed:
+            while True:
+                closing += self._reap_locked(time.monotonic())
+                sessions = self._idle.get(key)
+                if sessions:
+                    # Most recently used first - it is the most likely to still be alive
+                    entry = sessions.pop()
+                    if not sessions:
+                        del self._idle[key]
+                    return entry, closing
+
+                # Idle sessions of other keys (another account, an old password) give way
+                if self._per_account[key[0]] >= self.max_per_account:
+                    victim = self._evict_locked(key[0])
+                elif self._open_count >= self.max_size:
+                    victim = self._evict_locked()
+                else:
+                    victim = None
+                if victim is not None:
+                    closing.append(victim)
+                if self._open_count < self.max_size and self._per_account[key[0]] < self.max_per_account:
+                    self._open_count += 1
+                    self._per_account[key[0]] += 1
+                    return None, closing
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._freed.wait(remaining)
+        for conn in closing:
+            self._close(conn)
+        raise IMAPPoolExhausted(f"No IMAP session available for {key[0]} within {self.acquire_timeout}s")
+
+    def acquire(self, email_address, password, folder=None):
+        """
+        Borrow an authenticated session, opening one if none is idle
+
+        Args:
+            email_address: Account email address (IMAP login)
+            password: Account password
+            folder: Optional folder to have selected on the returned session
+
+        Returns:
+            PooledIMAP4_SSL connection (must be passed back to release() or discard())
+
+        Raises:
+            IMAPConnectionError: the session can't be opened (IMAPPoolExhausted: the pool is full)
+            IMAPFolderError: ``folder`` can't be selected (the session went back to the pool)
+        """
+        key = self._make_key(email_address, password)
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            entry, closing = self._checkout(key, deadline)
+            for stale in closing:
+                self._close(stale)
+
+            if entry is None:
+                try:
+                    conn = self._connect(email_address, password)
+                except BaseException:
+                    with self._lock:
+                        self._forget_locked(key)
+                    raise
+                break
+
+            conn, last_used = entry
+            if time.monotonic() - last_used <= self.noop_interval or self._is_alive(conn):
+                break
+
+            logger.info(f"Dropping dead IMAP session for {email_address}")
+            self._close(conn)
+            with self._lock:
+                self._forget_locked(key)
+
+        with self._lock:
+            self._leased[id(conn)] = key
+
+        if folder:
+            try:
+                typ, data = conn.select(folder)
+            except BaseException:
+                self.discard(conn)
+                raise
+            if typ != 'OK':
+                self.release(conn)
+                detail = data[0].decode('utf-8', errors='ignore') if data and isinstance(data[0], bytes) else data
+                raise IMAPFolderError(f"Cannot select folder {folder}: {detail}")
+        return conn
+
+    def release(self, conn):
+        """Return a healthy session to the pool"""
+        with self._lock:
+            key = self._leased.pop(id(conn), None)
+            if key is None:
+                return
+            self._idle.setdefault(key, deque()).append((conn, time.monotonic()))
+            self._freed.notify_all()
+
+    def discard(self, conn):
+        """Close a session whose state is unknown (after an error) instead of pooling it"""
+        with self._lock:
+            key = self._leased.pop(id(conn), None)
+            if key is None:
+                return
+            self._forget_locked(key)
+        self._close(conn)
+
+    @contextmanager
+    def session(self, email_address, password, folder=None):
+        """Context manager around acquire()/release(); connection-level errors discard the session"""
+        conn = self.acquire(email_address, password, folder=folder)
+        try:
+            yield conn
+        except (imaplib.IMAP4.abort, OSError):
+            self.discard(conn)
+            raise
+        except Exception:
+            # Command-level failures (NO/BAD, parsing, caller errors) leave the session usable
+            self.release(conn)
+            raise
+        except BaseException:
+            self.discard(conn)
+            raise
+        else:
+            self.release(conn)
+
+    def close_account(self, email_address):
+        """Close every idle session of an account (e.g. on logout or password change)"""
+        email_address = email_address.lower()
+        with self._lock:
+            closing = []
+            for key in [key for key in self._idle if key[0] == email_address]:
+                sessions = self._idle.pop(key)
+                closing += [conn for conn, _ in sessions]
+                self._forget_locked(key, len(sessions))
+        for conn in closing:
+            self._close(conn)
+
+    def close_all(self):
+        """Close every idle session"""
+        with self._lock:
+            closing = []
+            for key, sessions in self._idle.items():
+                closing += [conn for conn, _ in sessions]
+                self._forget_locked(key, len(sessions))
+            self._idle.clear()
+        for conn in closing:
+            self._close(conn)
+
+
+# Process-wide pool shared by the API and mail views
+imap_pool = IMAPSessionPool()
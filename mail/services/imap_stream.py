@@ -0,0 +1,239 @@
+"""
+IMAP part streaming
+Reads one MIME part in BODY.PEEK[part]<offset.length> chunks and decodes
+base64 / quoted-printable on the fly, so attachments are served with bounded
+memory and byte ranges can be resumed
+"""
+import base64
+import quopri
+import re
+from django.conf import settings
+from .imap_fetch import _parse_single
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Encoded bytes inspected to learn the base64 line layout
+LAYOUT_PROBE_BYTES = 1024
+
+
+class PartReader:
+    """
+    Chunked reader for one MIME part of one message
+
+    Args:
+        conn: imaplib connection with the message's folder selected
+        uid: Message UID
+        part: describe_part() dict of the part (from BODYSTRUCTURE)
+        chunk_size: Encoded bytes per FETCH
+    """
+
+    def __init__(self, conn, uid, part, chunk_size=None):
+        self.conn = conn
+        self.uid = uid
+        self.part = part
+        self.encoding = part['encoding']
+        self.encoded_size = part['size']
+        self.chunk_size = chunk_size or getattr(settings, 'EMAIL_ATTACHMENT_CHUNK_BYTES', 1024 * 1024)
+        self._line_length = None  # base64 characters per line; 0 = no line breaks, None = irregular
+        self._layout_known = False
+
+    def _fetch(self, offset, length):
+        """Encoded bytes [offset, offset + length) of the part"""
+        section = f"BODY.PEEK[{self.part['part']}]<{offset}.{length}>"
+        typ, data = self.conn.uid('FETCH', self.uid, f'({section})')
+        if typ != 'OK' or not data or data[0] is None:
+            raise self.conn.error(f"FETCH {section} failed: {data}")
+        fetched = _parse_single(data) or {}
+        prefix = f"BODY[{self.part['part']}]".encode('ascii')
+        for key, value in fetched.items():
+            if isinstance(key, bytes) and key.startswith(prefix):
+                return value or b''
+        return b''
+
+    def _probe_layout(self):
+        """Learn the base64 line length from the first lines; lines must be uniform for offset math"""
+        if self._layout_known:
+            return
+        self._layout_known = True
+        head = self._fetch(0, min(self.encoded_size, LAYOUT_PROBE_BYTES))
+        lines = head.split(b'\r\n')
+        if len(lines) == 1:
+            self._line_length = 0
+            return
+        # The last piece may be cut off by the probe; every complete line must have the same length,
+        # except the part's final line when the probe reached it
+        complete = lines[:-1]
+        length = len(complete[0])
+        if len(head) >= self.encoded_size:
+            complete, last = complete[:-1], complete[-1]
+            if len(last) > length:
+                return
+        if length % 4 == 0 and length > 0 and all(len(line) == length for line in complete):
+            self._line_length = length
+
+    @property
+    def size(self):
+        """Decoded size in bytes, or None when it can't be known without decoding everything"""
+        if self.encoding not in ('base64', 'quoted-printable'):
+            return self.encoded_size
+        if self.encoding == 'quoted-printable' or self.encoded_size == 0:
+            return None if self.encoded_size else 0
+
+        self._probe_layout()
+        if self._line_length is None:
+            return None
+        tail = self._fetch(max(0, self.encoded_size - 8), min(self.encoded_size, 8))
+        if self._line_length == 0:
+            clean = self.encoded_size - (2 if tail.endswith(b'\r\n') else 0)
+        else:
+            stride = self._line_length + 2
+            full_lines, remainder = divmod(self.encoded_size, stride)
+            if remainder and tail.endswith(b'\r\n'):
+                remainder -= 2
+            clean = full_lines * self._line_length + remainder
+        padding = len(tail.rstrip(b'\r\n')) - len(tail.rstrip(b'\r\n').rstrip(b'='))
+        return clean // 4 * 3 - padding
+
+    def _start_position(self, start):
+        """
+        Encoded offset to start reading from for decoded offset ``start``
+
+        Returns:
+            (encoded offset, decoded bytes to skip after decoding from there)
+        """
+        if start == 0:
+            return 0, 0
+        if self.encoding not in ('base64', 'quoted-printable'):
+            return start, 0
+        if self.encoding == 'base64':
+            self._probe_layout()
+            if self._line_length == 0:
+                return start // 3 * 4, start % 3
+            if self._line_length:
+                per_line = self._line_length // 4 * 3
+                line = start // per_line
+                return line * (self._line_length + 2), start - line * per_line
+        # Irregular layout / quoted-printable: decode from the beginning and skip
+        return 0, start
+
+    def iter_encoded(self, offset=0):
+        while offset < self.encoded_size:
+            chunk = self._fetch(offset, min(self.chunk_size, self.encoded_size - offset))
+            if not chunk:
+                break
+            offset += len(chunk)
+            yield chunk
+
+    def iter_decoded(self, offset=0):
+        """Decode the encoded stream starting at encoded ``offset`` (a line/quantum boundary)"""
+        pending = b''
+        for chunk in self.iter_encoded(offset):
+            if self.encoding == 'base64':
+                pending += re.sub(rb'[^A-Za-z0-9+/=]', b'', chunk)
+                usable = len(pending) - len(pending) % 4
+                if usable:
+                    yield base64.b64decode(pending[:usable])
+                    pending = pending[usable:]
+            elif self.encoding == 'quoted-printable':
+                # Soft line breaks never span lines, so decode up to the last complete line
+                pending += chunk
+                cut = pending.rfind(b'\n') + 1
+                if cut:
+                    yield quopri.decodestring(pending[:cut])
+                    pending = pending[cut:]
+            else:
+                yield chunk
+        if pending:
+            if self.encoding == 'base64':
+                pending = pending[:len(pending) - len(pending) % 4]
+                if pending:
+                    yield base64.b64decode(pending)
+            else:
+                yield quopri.decodestring(pending)
+
+    def iter_range(self, start=0, end=None):
+        """
+        Yield decoded bytes [start, end] (inclusive end, as in HTTP Range)
+
+        Args:
+            start: First decoded byte
+            end: Last decoded byte, or None for the rest of the part
+        """
+        offset, skip = self._start_position(start)
+        remaining = None if end is None else end - start + 1
+        for data in self.iter_decoded(offset):
+            if skip:
+                if len(data) <= skip:
+                    skip -= len(data)
+                    continue
+                data = data[skip:]
+                skip = 0
+            if remaining is not None:
+                if len(data) >= remaining:
+                    yield data[:remaining]
+                    return
+                remaining -= len(data)
+            if data:
+                yield data
+
+
+def parse_range_header(header, size):
+    """
+    Parse a single-range ``Range: bytes=...`` header
+
+    Returns:
+        (start, end) inclusive, None if there is no usable range, or 'invalid' if unsatisfiable
+    """
+    match = re.fullmatch(r'\s*bytes=(\d*)-(\d*)\s*', header or '')
+    if not match or size is None or (not match.group(1) and not match.group(2)):
+        return None
+    if match.group(1):
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else size - 1
+    else:
+        # Suffix range: the last N bytes
+        start = max(0, size - int(match.group(2)))
+        end = size - 1
+    if start >= size or start > end:
+        return 'invalid'
+    return start, min(end, size - 1)
+
+
+class SessionStream:
+    """
+    Iterator handed to StreamingHttpResponse that returns the pooled IMAP session when done
+
+    Django calls close() when the response finishes (or the client goes away), even if
+    iteration never started; the session is released, or discarded after a failed FETCH.
+    """
+
+    def __init__(self, chunks, pool, conn):
+        self._chunks = iter(chunks)
+        self._pool = pool
+        self._conn = conn
+        self._failed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._chunks)
+        except StopIteration:
+            self.close()
+            raise
+        except Exception as e:
+            logger.error(f"Streaming message part failed: {e}")
+            self._failed = True
+            self.close()
+            raise
+
+    def close(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        if self._failed:
+            self._pool.discard(conn)
+        else:
+            self._pool.release(conn)
@@ -0,0 +1,52 @@
+"""
+Post-ingest hooks
+Functions run by the ingest pipeline after a batch of received messages is committed.
+Enable them through EMAIL_INGEST_HOOKS (dotted paths) or ingest_pipeline.register_hook().
+"""
+from django.db.models import Max
+from mail.models import Contact
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def extract_contacts(email_account, messages):
+    """
+    Add senders of new (non-spam) mail to the account owner's contacts
+
+    Existing contacts only get last_contacted moved forward; new ones are created with
+    source='email'.
+    """
+    senders = {}
+    for sender, sender_name, last in (messages.exclude(folder__folder_type='spam').exclude(sender='')
+                                      .values('sender', 'sender_name').annotate(last=Max('date_received'))
+                                      .values_list('sender', 'sender_name', 'last')):
+        address = sender.lower()
+        if address != email_account.email.lower() and (address not in senders or last > senders[address][1]):
+            senders[address] = (sender_name or '', last)
+    if not senders:
+        return
+
+    known = Contact.objects.filter(email__in=list(senders))
+    for contact in known.filter(user=email_account.user):
+        last = senders[contact.email.lower()][1]
+        if contact.last_contacted is None or contact.last_contacted < last:
+            Contact.objects.filter(pk=contact.pk).update(last_contacted=last)
+
+    existing = {address.lower() for address in known.values_list('email', flat=True)}
+    new_contacts = []
+    for address, (name, last) in senders.items():
+        if address in existing:
+            continue
+        first_name, _, last_name = name.strip().partition(' ')
+        new_contacts.append(Contact(
+            user=email_account.user,
+            email=address,
+            first_name=first_name[:100] or address.split('@')[0][:100],
+            last_name=last_name[:100],
+            source='email',
+            last_contacted=last,
+        ))
+    # Contact.email is unique across users; a concurrent insert of the same address is skipped
+    Contact.objects.bulk_create(new_contacts, ignore_conflicts=True)
+    logger.debug(f"Extracted {len(new_contacts)} contact(s) for {email_account.email}")
@@ -0,0 +1,257 @@
+"""
+Staged ingest pipeline
+fetch -> parse -> classify/route + persist -> post-process hooks
+
+The sync loop only fetches; parsing and storing each run in their own thread connected
+by bounded queues, so a slow stage pushes back on fetching instead of buffering the whole
+folder. Parsing is CPU-bound and runs in a shared process pool. Classification is cheap
+and runs on the persist thread just before the batch is stored. Post-processing hooks
+(contact extraction, notifications, ...) run on a process-wide thread after the batch
+is committed and never hold up the sync.
+"""
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.utils.module_loading import import_string
+from mail.message_parser import parse_message
+import logging
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()  # end-of-stream marker passed down the stages
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+
+def get_parse_pool():
+    """Process pool shared by all pipelines, or None when EMAIL_INGEST_PARSE_PROCESSES is 0"""
+    global _parse_pool
+    processes = getattr(settings, 'EMAIL_INGEST_PARSE_PROCESSES', 2)
+    if not processes:
+        return None
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            # forkserver: forking a process that already runs sync threads can deadlock the child
+            _parse_pool = ProcessPoolExecutor(max_workers=processes,
+                                              mp_context=multiprocessing.get_context('forkserver'))
+        return _parse_pool
+
+
+def _reset_parse_pool():
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is not None:
+            _parse_pool.shutdown(wait=False, cancel_futures=True)
+        _parse_pool = None
+
+
+def parse_raw_messages(raws):
+    """parse_message() over a list of raw messages, in the process pool when there is one"""
+    pool = get_parse_pool()
+    if pool is None or len(raws) < 2:
+        return [parse_message(raw) for raw in raws]
+    try:
+        return list(pool.map(parse_message, raws, chunksize=max(1, len(raws) // (pool._max_workers * 4))))
+    except BrokenProcessPool:
+        logger.warning("Parse worker process died; parsing this batch inline")
+        _reset_parse_pool()
+        return [parse_message(raw) for raw in raws]
+
+
+# Post-processing hooks
+
+_registered_hooks = []
+
+
+def register_hook(hook):
+    """
+    Add a post-ingest hook: hook(email_account, messages) with messages a queryset of the
+    newly stored EmailMessages of one batch. Hooks can also be listed in EMAIL_INGEST_HOOKS.
+    """
+    if hook not in _registered_hooks:
+        _registered_hooks.append(hook)
+    return hook
+
+
+def get_hooks():
+    return [import_string(path) for path in getattr(settings, 'EMAIL_INGEST_HOOKS', [])] + _registered_hooks
+
+
+class HookRunner:
+    """Background thread running post-ingest hooks for committed batches"""
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize if maxsize is not None else getattr(settings, 'EMAIL_INGEST_HOOK_QUEUE_SIZE', 1000)
+        self._queue = queue.Queue(self.maxsize)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, account_id, message_pks):
+        if not message_pks or not get_hooks():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='mail-ingest-hooks', daemon=True)
+                self._thread.start()
+        try:
+            self._queue.put_nowait((account_id, message_pks))
+        except queue.Full:
+            # Dropping post-processing is better than stalling sync behind it
+            logger.warning(f"Ingest hook queue full; skipping hooks for {len(message_pks)} message(s)")
+
+    def _run(self):
+        from mail.models import EmailAccount, EmailMessage
+
+        while True:
+            account_id, message_pks = self._queue.get()
+            try:
+                close_old_connections()
+                email_account = EmailAccount.objects.get(pk=account_id)
+                for hook in get_hooks():
+                    try:
+                        hook(email_account, EmailMessage.objects.filter(pk__in=message_pks))
+                    except Exception as e:
+                        logger.error(f"Ingest hook {getattr(hook, '__name__', hook)} failed: {e}")
+            except Exception as e:
+                logger.error(f"Ingest hooks for account {account_id} failed: {e}")
+            finally:
+                if self._queue.empty():
+                    # Don't hold a database connection while waiting for the next batch
+                    connection.close()
+                self._queue.task_done()
+
+    def drain(self, timeout=None):
+        """Wait until queued hooks have run (e.g. before a one-shot command exits)"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+
+# Process-wide hook runner shared by all pipelines
+hook_runner = HookRunner()
+
+
+class _Stage(threading.Thread):
+    """One pipeline stage: func(batch) for each batch from inbox, results to outbox"""
+
+    def __init__(self, pipeline, name, func, inbox, outbox):
+        super().__init__(name=f'mail-ingest-{name}', daemon=True)
+        self.pipeline = pipeline
+        self.func = func
+        self.inbox = inbox
+        self.outbox = outbox
+
+    def run(self):
+        try:
+            while True:
+                batch = self.inbox.get()
+                if batch is _DONE:
+                    break
+                if self.pipeline.error is not None:
+                    continue  # keep draining so upstream never blocks on a full queue
+                try:
+                    result = self.func(batch)
+                except Exception as e:
+                    self.pipeline.fail(e)
+                    continue
+                if self.outbox is not None:
+                    self.outbox.put(result)
+        finally:
+            if self.outbox is not None:
+                self.outbox.put(_DONE)
+            # Stages that touched the database hold their own connection
+            connection.close()
+
+
+class IngestPipeline:
+    """
+    Ingest fetched batches of one folder through the pipeline stages
+
+    Args:
+        service: DjangoEmailService of the account (classification and persistence)
+        db_folder: EmailFolder the UIDs belong to
+        sync_state: FolderSyncState checkpoint advanced with each committed batch
+        queue_size: Batches buffered between two stages
+
+    Usage:
+        pipeline = IngestPipeline(service, folder, state).start()
+        pipeline.submit(fetched, last_uid)  # blocks while the pipeline is full
+        count = pipeline.close()            # waits for the last batch; raises a stage error
+    """
+
+    def __init__(self, service, db_folder, sync_state, queue_size=None):
+        self.service = service
+        self.db_folder = db_folder
+        self.sync_state = sync_state
+        queue_size = queue_size or getattr(settings, 'EMAIL_INGEST_QUEUE_SIZE', 2)
+
+        self.count = 0
+        self.error = None
+        # Two threads per pipeline; with EMAIL_SYNC_WORKERS folder syncs in parallel, every
+        # extra stage would multiply the thread count
+        self._queues = [queue.Queue(queue_size) for _ in range(2)]
+        self._stages = [
+            _Stage(self, 'parse', self.parse, self._queues[0], self._queues[1]),
+            _Stage(self, 'persist', self.persist, self._queues[1], None),
+        ]
+
+    def start(self):
+        for stage in self._stages:
+            stage.start()
+        return self
+
+    def fail(self, error):
+        if self.error is None:
+            self.error = error
+
+    def submit(self, fetched, last_uid):
+        """Queue a fetch() result; last_uid is the highest UID requested for it"""
+        if self.error is not None:
+            raise self.error
+        self._queues[0].put({'fetched': fetched, 'last_uid': last_uid})
+
+    def close(self, raise_errors=True):
+        """Flush and stop the stages; returns the number of new messages stored"""
+        self._queues[0].put(_DONE)
+        for stage in self._stages:
+            stage.join()
+        if self.error is not None and raise_errors:
+            raise self.error
+        return self.count
+
+    # Stages
+
+    def parse(self, batch):
+        uids = sorted(batch['fetched'])
+        raws = [batch['fetched'][uid][b'BODY[]'] for uid in uids]
+        parsed = []
+        for uid, raw, (email_data, error) in zip(uids, raws, parse_raw_messages(raws)):
+            if error is not None:
+                logger.error(f"Error processing email UID {uid}: {error}")
+                continue
+            flags = [f.decode('utf-8', errors='ignore') if isinstance(f, bytes) else str(f)
+                     for f in batch['fetched'][uid].get(b'FLAGS', ())]
+            parsed.append((uid, email_data, flags, raw))
+        batch['parsed'] = parsed
+        return batch
+
+    def classify(self, batch):
+        for _, email_data, _, _ in batch['parsed']:
+            self.service._classify(email_data)
+        return batch
+
+    def persist(self, batch):
+        self.classify(batch)
+        count, new_pks = self.service._persist_messages(
+            self.db_folder, batch['parsed'], sync_state=self.sync_state, last_uid=batch['last_uid'])
+        self.count += count
+        hook_runner.submit(self.service.email_account.pk, new_pks)
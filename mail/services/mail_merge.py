@@ -0,0 +1,349 @@
+"""
+Mail merge
+Sends an EmailTemplate to a set of contacts: the template is compiled once, messages
+are rendered one recipient at a time from a streaming generator and go out back to
+back over one pooled SMTP session, with RFC 2920 PIPELINING when the server offers it.
+Progress is checkpointed on the MailMergeJob so an interrupted job resumes where it
+stopped instead of starting over. Each message takes a rate limit token; when the
+sender's domain or account runs out, the job waits for the next one.
+"""
+import re
+import smtplib
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q
+from django.template import Context, Engine
+from django.utils import timezone
+from mail.models import Contact, MailMergeJob
+from . import credentials, rate_limit
+from .smtp_pool import smtp_pool
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Rejected recipients kept on the job (the count is always exact)
+MAX_RECORDED_FAILURES = 100
+
+# Reconnects within one run after the SMTP connection drops
+MAX_RECONNECTS = 3
+
+# Same HTML detection as the compose form
+HTML_PATTERN = re.compile(r'<[a-z][\s\S]*>', re.IGNORECASE)
+
+# Standalone engines: templates come from the database, no loaders needed
+_text_engine = Engine(autoescape=False)
+_html_engine = Engine(autoescape=True)
+
+
+def _variable_defaults(variables):
+    """Default values from EmailTemplate.variables ({name: default} or a JSON schema)"""
+    if not isinstance(variables, dict):
+        return {}
+    if isinstance(variables.get('properties'), dict):
+        return {name: spec['default'] for name, spec in variables['properties'].items()
+                if isinstance(spec, dict) and 'default' in spec}
+    return {name: value for name, value in variables.items() if not isinstance(value, dict)}
+
+
+def contact_context(contact):
+    """Template variables describing one recipient"""
+    return {
+        'first_name': contact.first_name,
+        'last_name': contact.last_name,
+        'full_name': contact.full_name,
+        'email': contact.email,
+        'company': contact.company,
+        'job_title': contact.job_title,
+    }
+
+
+class CompiledTemplate:
+    """
+    An EmailTemplate parsed once and rendered per recipient
+
+    Bodies containing HTML are rendered with autoescaping and sent with a plain text
+    alternative; subjects are collapsed to a single line.
+    """
+
+    def __init__(self, template, context=None):
+        self.is_html = bool(HTML_PATTERN.search(template.body_template))
+        self.subject = _text_engine.from_string(template.subject_template)
+        self.body = (_html_engine if self.is_html else _text_engine).from_string(template.body_template)
+        self.defaults = {**_variable_defaults(template.variables), **(context or {})}
+
+    def render(self, contact):
+        """
+        Returns:
+            tuple: (subject, body_text, body_html or None)
+        """
+        context = Context({**self.defaults, **contact_context(contact)})
+        subject = ' '.join(self.subject.render(context).split())
+        body = self.body.render(context)
+        if not self.is_html:
+            return subject, body, None
+        body_text = re.sub(r'\s+', ' ', re.sub(r'<[^>]+>', '', body)).strip()
+        return subject, body_text, body
+
+
+def merge_recipients(email_account, tag=''):
+    """Active contacts of the account owner, optionally only those with a tag"""
+    contacts = Contact.objects.filter(user=email_account.user, is_active=True)
+    if tag:
+        contacts = contacts.filter(tags__contains=[tag])
+    return contacts
+
+
+def iter_messages(job, compiled, email_service, after_pk=0):
+    """
+    Render the job's messages one contact at a time, in contact pk order
+
+    Yields:
+        tuple: (contact, RFC822 bytes, envelope recipients)
+    """
+    contacts = merge_recipients(job.account, job.tag).filter(pk__gt=after_pk).order_by('pk')
+    for contact in contacts.iterator(chunk_size=500):
+        subject, body_text, body_html = compiled.render(contact)
+        msg = email_service.build_message([contact.email], subject, body_text, body_html)
+        yield contact, msg.message().as_bytes(linesep='\r\n'), msg.recipients()
+
+
+def _reply_error(reply):
+    code, text = reply
+    return f"{code} {text.decode('utf-8', errors='ignore') if isinstance(text, bytes) else text}"
+
+
+class SMTPPipeline:
+    """
+    Send messages back to back over one smtplib connection
+
+    With PIPELINING, a message's MAIL FROM, RCPT TOs and DATA go out in one write and the
+    reply to the previous message's end of data is read along with theirs, so each message
+    costs two round trips instead of three plus one per recipient. Without it (or with
+    pipelining=False) messages go through sendmail() one by one.
+
+    send() and flush() return (token, error) outcomes as they become known, in order;
+    error is None for accepted messages.
+    """
+
+    def __init__(self, conn, pipelining=True):
+        conn.ehlo_or_helo_if_needed()
+        self.conn = conn
+        self.pipelining = pipelining and conn.has_extn('pipelining')
+        self._pending = None  # token of the message whose end-of-data reply is unread
+        self._unsent = b''    # its data, written together with the next message's commands
+
+    def send(self, sender, recipients, raw, token):
+        if not self.pipelining:
+            return [(token, self._sendmail(sender, recipients, raw))]
+
+        conn = self.conn
+        commands = ([f'MAIL FROM:{smtplib.quoteaddr(sender)}']
+                    + [f'RCPT TO:{smtplib.quoteaddr(recipient)}' for recipient in recipients] + ['DATA'])
+        conn.send(self._unsent + ''.join(f'{command}\r\n' for command in commands).encode('ascii'))
+        self._unsent = b''
+        outcomes = self._read_pending()
+        replies = [conn.getreply() for _ in commands]
+        mail_reply, rcpt_replies, data_reply = replies[0], replies[1:-1], replies[-1]
+
+        error = None
+        if mail_reply[0] != 250:
+            error = _reply_error(mail_reply)
+        elif not any(code in (250, 251) for code, _ in rcpt_replies):
+            error = _reply_error(rcpt_replies[0])
+
+        if data_reply[0] == 354 and error is None:
+            self._unsent = re.sub(rb'(?m)^\.', b'..', raw) + (b'' if raw.endswith(b'\r\n') else b'\r\n') + b'.\r\n'
+            self._pending = token
+            return outcomes
+        if data_reply[0] == 354:
+            # Nothing deliverable but the server wants data anyway: send an empty message to get out
+            conn.send(b'.\r\n')
+            conn.getreply()
+        error = error or _reply_error(data_reply)
+        conn.rset()
+        outcomes.append((token, error))
+        return outcomes
+
+    def flush(self):
+        """Finish the last message sent and read its reply"""
+        if self._unsent:
+            self.conn.send(self._unsent)
+            self._unsent = b''
+        return self._read_pending()
+
+    def _read_pending(self):
+        if self._pending is None:
+            return []
+        token, self._pending = self._pending, None
+        reply = self.conn.getreply()
+        return [(token, None if reply[0] == 250 else _reply_error(reply))]
+
+    def _sendmail(self, sender, recipients, raw):
+        try:
+            refused = self.conn.sendmail(sender, recipients, raw)
+        except smtplib.SMTPRecipientsRefused as e:
+            return _reply_error(next(iter(e.recipients.values())))
+        except (smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+            return _reply_error((e.smtp_code, e.smtp_error))
+        if refused and len(refused) == len(recipients):
+            return _reply_error(next(iter(refused.values())))
+        return None
+
+
+class _Progress:
+    """Outcomes of a running job, checkpointed every ``every`` messages"""
+
+    def __init__(self, job, every, callback=None):
+        self.job = job
+        self.every = every
+        self.callback = callback
+        self.unsaved = 0
+        self.sent_contacts = []
+
+    def record(self, contact, error):
+        job = self.job
+        job.last_contact_id = contact.pk
+        if error:
+            job.failed_count += 1
+            job.failures = (job.failures + [{'email': contact.email, 'error': error[:500]}])[-MAX_RECORDED_FAILURES:]
+            # Rejected by the server: the rate limit token taken for it goes back
+            rate_limit.refund(job.account)
+        else:
+            job.sent_count += 1
+            self.sent_contacts.append(contact.pk)
+        self.unsaved += 1
+        if self.unsaved >= self.every:
+            self.save()
+
+    def save(self):
+        self.job.save(update_fields=['sent_count', 'failed_count', 'last_contact_id', 'failures', 'updated_at'])
+        if self.sent_contacts:
+            Contact.objects.filter(pk__in=self.sent_contacts).update(last_contacted=timezone.now())
+        self.sent_contacts = []
+        self.unsaved = 0
+        if self.callback:
+            self.callback(self.job)
+
+
+def _wait_for_token(job, seconds):
+    """Sleep until the rate limit has a token again, keeping the job's heartbeat fresh"""
+    heartbeat = getattr(settings, 'EMAIL_MERGE_LEASE', 600) / 2
+    deadline = time.monotonic() + seconds
+    while (remaining := deadline - time.monotonic()) > 0:
+        time.sleep(min(remaining, heartbeat))
+        job.save(update_fields=['updated_at'])
+
+
+def create_job(email_account, template, tag='', context=None, password=None):
+    """
+    Queue a merge of ``template`` to the account owner's contacts
+
+    Raises:
+        django.template.TemplateSyntaxError: the template doesn't compile
+    """
+    CompiledTemplate(template, context)
+    return MailMergeJob.objects.create(
+        account=email_account,
+        template=template,
+        tag=tag or '',
+        context=context or {},
+        total=merge_recipients(email_account, tag).count(),
+        smtp_password=credentials.seal(password),
+    )
+
+
+def claimable_jobs():
+    """Pending jobs and running jobs whose runner stopped checkpointing (it died)"""
+    stale = timezone.now() - timedelta(seconds=getattr(settings, 'EMAIL_MERGE_LEASE', 600))
+    return MailMergeJob.objects.filter(
+        Q(status=MailMergeJob.STATUS_PENDING) | Q(status=MailMergeJob.STATUS_RUNNING, updated_at__lt=stale)
+    ).order_by('created_at')
+
+
+def claim_job(job):
+    """Mark a job running unless another runner got to it first"""
+    claimed = MailMergeJob.objects.filter(pk=job.pk, status=job.status, updated_at=job.updated_at).update(
+        status=MailMergeJob.STATUS_RUNNING, last_error='', updated_at=timezone.now())
+    if claimed:
+        job.refresh_from_db()
+    return bool(claimed)
+
+
+def run_job(job, password=None, pipelining=None, checkpoint_every=None, progress=None):
+    """
+    Send a claimed job from its resume cursor to the end
+
+    Args:
+        password: Fallback SMTP password when the job carries none (or it expired)
+        pipelining: Use PIPELINING when offered (default: EMAIL_MERGE_PIPELINING)
+        checkpoint_every: Messages between progress saves (default: EMAIL_MERGE_CHECKPOINT_EVERY)
+        progress: Optional callable(job) called at every checkpoint
+
+    Returns:
+        MailMergeJob (completed, or failed with last_error; rerun it to resume)
+    """
+    from mail.services import DjangoEmailService
+
+    if pipelining is None:
+        pipelining = getattr(settings, 'EMAIL_MERGE_PIPELINING', True)
+    tracker = _Progress(job, checkpoint_every or getattr(settings, 'EMAIL_MERGE_CHECKPOINT_EVERY', 20), progress)
+
+    email_service = DjangoEmailService(job.account)
+    email_service._password = credentials.unseal(job.smtp_password) or password
+    sender = job.account.email
+    reconnects = 0
+    try:
+        compiled = CompiledTemplate(job.template, job.context)
+        while True:
+            try:
+                conn = smtp_pool.acquire(sender, email_service._get_email_password())
+                try:
+                    pipeline = SMTPPipeline(conn, pipelining)
+                    wait = 0
+                    for contact, raw, recipients in iter_messages(job, compiled, email_service, job.last_contact_id):
+                        wait, limiting = rate_limit.take(job.account)
+                        if limiting:
+                            break
+                        for done, error in pipeline.send(sender, recipients, raw, contact):
+                            tracker.record(done, error)
+                    for done, error in pipeline.flush():
+                        tracker.record(done, error)
+                except BaseException:
+                    # Replies may still be unread; the connection can't be handed to anyone else
+                    smtp_pool.discard(conn)
+                    raise
+                smtp_pool.release(conn)
+                if not wait:
+                    break
+                # Rate limited: give the connection back while waiting, resume from the checkpoint
+                tracker.save()
+                logger.info(f"Merge job {job.pk} waiting {wait:.0f}s for the sending limit of {job.account.email}")
+                _wait_for_token(job, wait)
+            except smtplib.SMTPResponseException:
+                # A server reply such as a refused login (SMTPException is an OSError) won't change on reconnect
+                raise
+            except (smtplib.SMTPServerDisconnected, OSError) as e:
+                # Messages without a reply yet are resent from the checkpoint on the new connection
+                reconnects += 1
+                if reconnects > MAX_RECONNECTS:
+                    raise
+                logger.warning(f"SMTP connection lost during merge job {job.pk}, reconnecting: {e}")
+                tracker.save()
+    except Exception as e:
+        logger.error(f"Merge job {job.pk} stopped after {job.sent_count} message(s): {e}")
+        tracker.save()
+        job.status = MailMergeJob.STATUS_FAILED
+        job.last_error = str(e)[:2000]
+        # Resuming a failed job takes the password again (run_mail_merge --password)
+        job.smtp_password = ''
+        job.save(update_fields=['status', 'last_error', 'smtp_password', 'updated_at'])
+        return job
+
+    tracker.save()
+    job.status = MailMergeJob.STATUS_COMPLETED
+    job.finished_at = timezone.now()
+    job.smtp_password = ''
+    job.save(update_fields=['status', 'finished_at', 'smtp_password', 'updated_at'])
+    logger.info(f"Merge job {job.pk} completed: {job.sent_count} sent, {job.failed_count} rejected")
+    return job
@@ -0,0 +1,266 @@
+"""
+Parsed message cache
+LRU cache of the message detail representation keyed by
+(account, folder, uidvalidity, uid), with a memory budget and an optional disk tier.
+Each process has its own cache; entries expire after EMAIL_MESSAGE_CACHE_TTL seconds
+and are checked against account, folder and message generations in the shared Django
+cache, which invalidate() replaces so the other processes drop their copies too
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ParsedMessageCache:
+    """
+    Byte-budgeted LRU cache of parsed messages
+
+    Entries are stored JSON-encoded; the encoded size counts against ``max_bytes``.
+    When ``disk_dir`` is set, entries evicted from memory are written there and the
+    directory is trimmed (oldest access first) to ``disk_max_bytes``.
+    A (uidvalidity, uid) pair never points at a different message, so entries only
+    go stale through flag changes, moves and deletes - callers invalidate on those.
+    Changes made by another process or seen only by its IDLE watcher reach this one
+    through the shared generations, or at the latest after ``ttl`` seconds.
+    """
+
+    def __init__(self, max_bytes=None, disk_dir=None, disk_max_bytes=None, ttl=None):
+        self.max_bytes = max_bytes if max_bytes is not None else getattr(
+            settings, 'EMAIL_MESSAGE_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+        self.disk_dir = disk_dir if disk_dir is not None else getattr(settings, 'EMAIL_MESSAGE_CACHE_DIR', '')
+        self.disk_max_bytes = disk_max_bytes if disk_max_bytes is not None else getattr(
+            settings, 'EMAIL_MESSAGE_CACHE_DISK_MAX_BYTES', 512 * 1024 * 1024)
+        self.ttl = ttl if ttl is not None else getattr(settings, 'EMAIL_MESSAGE_CACHE_TTL', 300)
+
+        self._lock = threading.Lock()
+        # key -> (encoded bytes, generation, stored at), least recently used first
+        self._entries = OrderedDict()
+        self._size = 0
+        self._disk_size = None
+
+    @staticmethod
+    def make_key(email_address, folder, uidvalidity, uid):
+        return (email_address.lower(), folder, int(uidvalidity), int(uid))
+
+    @staticmethod
+    def _digest(value):
+        return hashlib.sha256(value.encode('utf-8')).hexdigest()[:16]
+
+    def _disk_dir_for(self, email_address, folder=None):
+        """Disk entries live in <disk_dir>/<account hash>/<folder hash>/ so they can be dropped per folder"""
+        path = os.path.join(self.disk_dir, self._digest(email_address))
+        if folder is not None:
+            path = os.path.join(path, self._digest(folder))
+        return path
+
+    def _disk_path(self, key):
+        return os.path.join(self._disk_dir_for(key[0], key[1]), f"{key[2]}-{key[3]}.json")
+
+    def _generation_keys(self, key):
+        """Shared cache keys of the account, folder and message generations of a (partial) cache key"""
+        keys = [f'imap_message_cache_generation_{self._digest(key[0])}']
+        if len(key) > 1:
+            keys.append(f'{keys[0]}_{self._digest(key[1])}')
+        if len(key) > 2:
+            keys.append(f'{keys[1]}_{key[2]}_{key[3]}')
+        return keys
+
+    def _generation(self, key):
+        """
+        Current generation of a message in the shared cache
+
+        A token missing from the shared cache (never set, expired or evicted) is replaced
+        by a new random one, so entries stored under an older generation can't match again.
+        """
+        keys = self._generation_keys(key)
+        tokens = cache.get_many(keys)
+        # Message tokens only have to outlive the entries they guard
+        for name, timeout in zip(keys, (None, None, self.ttl)):
+            if name not in tokens:
+                token = uuid.uuid4().hex
+                tokens[name] = token if cache.add(name, token, timeout=timeout) else cache.get(name)
+        return '.'.join(str(tokens[name]) for name in keys)
+
+    def _bump_generation(self, key):
+        cache.set(self._generation_keys(key)[-1], uuid.uuid4().hex, timeout=self.ttl if len(key) > 2 else None)
+
+    def _fresh(self, key, generation, stored_at):
+        return time.time() - stored_at < self.ttl and generation == self._generation(key)
+
+    def get(self, email_address, folder, uidvalidity, uid):
+        """Cached message dict or None"""
+        if not uidvalidity or not self.max_bytes:
+            return None
+        key = self.make_key(email_address, folder, uidvalidity, uid)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        from_disk = entry is None and bool(self.disk_dir)
+        if from_disk:
+            entry = self._read_disk(key)
+        if entry is None:
+            return None
+        encoded, generation, stored_at = entry
+        if not self._fresh(key, generation, stored_at):
+            self._discard(key)
+            return None
+        if from_disk:
+            self._store_memory(key, entry)
+        return json.loads(encoded)
+
+    def set(self, email_address, folder, uidvalidity, uid, message):
+        if not uidvalidity or not self.max_bytes:
+            return
+        key = self.make_key(email_address, folder, uidvalidity, uid)
+        try:
+            encoded = json.dumps(message).encode('utf-8')
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Message {uid} not cacheable: {e}")
+            return
+        self._store_memory(key, (encoded, self._generation(key), time.time()))
+
+    def _store_memory(self, key, entry):
+        if len(entry[0]) > self.max_bytes:
+            return
+        evicted = []
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous[0])
+            self._entries[key] = entry
+            self._size += len(entry[0])
+            while self._size > self.max_bytes:
+                old_key, old_entry = self._entries.popitem(last=False)
+                self._size -= len(old_entry[0])
+                evicted.append((old_key, old_entry))
+        if self.disk_dir:
+            for old_key, old_entry in evicted:
+                self._write_disk(old_key, old_entry)
+
+    def _discard(self, key):
+        """Drop one expired or outdated entry from memory and disk"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= len(entry[0])
+        if self.disk_dir:
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+
+    def _read_disk(self, key):
+        """(encoded, generation, stored at) from a cache file: a JSON header line, then the message"""
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                header, encoded = f.read().split(b'\n', 1)
+            os.utime(path)  # mtime doubles as last access for trimming
+            header = json.loads(header)
+            return encoded, header['generation'], header['stored_at']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write_disk(self, key, entry):
+        encoded, generation, stored_at = entry
+        data = json.dumps({'generation': generation, 'stored_at': stored_at}).encode('utf-8') + b'\n' + encoded
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Failed to write message cache file {path}: {e}")
+            return
+        with self._lock:
+            if self._disk_size is not None:
+                self._disk_size += len(data)
+            over_budget = self._disk_size is None or self._disk_size > self.disk_max_bytes
+        if over_budget:
+            self._trim_disk()
+
+    def _trim_disk(self):
+        """Delete least recently used cache files until the directory fits the disk budget"""
+        files = []
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_size = total
+
+    def invalidate(self, email_address, folder=None, uidvalidity=None, uid=None):
+        """
+        Drop cached messages
+
+        Entries of this process are removed, and the shared generation of the message,
+        folder or account is replaced so other processes stop serving their copies too.
+
+        Args:
+            email_address: Account whose entries are dropped
+            folder: Limit to one folder (all folders of the account if None)
+            uidvalidity, uid: Limit to one message (needs folder)
+        """
+        email_address = email_address.lower()
+        if folder is not None and uidvalidity and uid is not None:
+            keys = [self.make_key(email_address, folder, uidvalidity, uid)]
+            scope = keys[0]
+        else:
+            scope = (email_address,) if folder is None else (email_address, folder)
+            with self._lock:
+                keys = [key for key in self._entries
+                        if key[0] == email_address and (folder is None or key[1] == folder)]
+        with self._lock:
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._size -= len(entry[0])
+        self._bump_generation(scope)
+        if self.disk_dir:
+            self._invalidate_disk(email_address, folder, uidvalidity, uid)
+
+    def _invalidate_disk(self, email_address, folder, uidvalidity, uid):
+        try:
+            if folder is not None and uidvalidity and uid is not None:
+                os.remove(self._disk_path(self.make_key(email_address, folder, uidvalidity, uid)))
+            else:
+                shutil.rmtree(self._disk_dir_for(email_address, folder))
+        except OSError:
+            pass
+        with self._lock:
+            self._disk_size = None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+# Process-wide cache shared by the API and mail views
+message_cache = ParsedMessageCache()
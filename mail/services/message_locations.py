@@ -0,0 +1,188 @@
+"""
+Message location index
+Keeps MessageLocation (Message-ID and (uidvalidity, uid) -> folder) in step with the
+server: sync records what it fetches and drops what vanished, and move/delete actions
+update it as they run, so message lookups never probe folders one by one. The same
+actions keep the stored messages and folder counters current until the next sync
+"""
+from django.db import transaction
+from django.db.models import Q
+from mail.models import EmailFolder, EmailMessage, MessageLocation
+from .imap_fetch import parse_message_ref
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Flag actions of imap_actions -> stored EmailMessage field and value
+FLAG_FIELDS = {
+    'mark_read': ('is_read', True),
+    'mark_unread': ('is_read', False),
+    'star': ('is_starred', True),
+    'unstar': ('is_starred', False),
+}
+
+
+class Location:
+    """A message's current place on the server"""
+
+    def __init__(self, mailbox, uidvalidity, uid, message_id=''):
+        self.mailbox = mailbox
+        self.uidvalidity = uidvalidity
+        self.uid = uid
+        self.message_id = message_id
+
+    @property
+    def ref(self):
+        return f"{self.uidvalidity}:{self.uid}"
+
+
+def _folder_for(email_account, mailbox):
+    """EmailFolder synced from an IMAP mailbox name, or None"""
+    return (EmailFolder.objects.filter(account=email_account)
+            .filter(Q(sync_state__mailbox=mailbox) | Q(name=mailbox)).first())
+
+
+def locate(email_account, ref=None, message_id=None):
+    """
+    Current location of a message from its reference ('<uidvalidity>:<uid>') or Message-ID
+
+    Returns:
+        Location or None (unknown, or a bare UID without UIDVALIDITY)
+    """
+    locations = MessageLocation.objects.filter(folder__account=email_account).select_related('folder__sync_state')
+    location = None
+    if ref:
+        try:
+            uidvalidity, uid = parse_message_ref(ref)
+        except ValueError:
+            uidvalidity = uid = None
+        if uidvalidity:
+            location = locations.filter(uidvalidity=uidvalidity, uid=uid).first()
+    if location is None and message_id:
+        location = locations.filter(message_id=message_id).order_by('-pk').first()
+    if location is None:
+        return None
+    sync_state = getattr(location.folder, 'sync_state', None)
+    mailbox = sync_state.mailbox if sync_state else location.folder.name
+    return Location(mailbox, location.uidvalidity, location.uid, location.message_id)
+
+
+def record_locations(folder, uidvalidity, entries):
+    """
+    Record fetched messages of a folder
+
+    Args:
+        entries: iterable of (uid, Message-ID)
+    """
+    rows = [MessageLocation(folder=folder, uidvalidity=uidvalidity, uid=int(uid), message_id=(message_id or '')[:255])
+            for uid, message_id in entries]
+    if rows:
+        MessageLocation.objects.bulk_create(rows, update_conflicts=True, unique_fields=['folder', 'uidvalidity', 'uid'],
+                                            update_fields=['message_id'])
+
+
+def forget_locations(folder, uids=None, keep_uidvalidity=None):
+    """Drop locations of expunged UIDs, or all of a folder's locations from other UIDVALIDITY epochs"""
+    locations = MessageLocation.objects.filter(folder=folder)
+    if uids is not None:
+        locations = locations.filter(uid__in=[int(uid) for uid in uids])
+    if keep_uidvalidity is not None:
+        locations = locations.exclude(uidvalidity=keep_uidvalidity)
+    return locations.delete()[0]
+
+
+def forget_ref(email_account, uidvalidity, uid):
+    """Drop the location of a reference that no longer resolves on the server"""
+    return MessageLocation.objects.filter(folder__account=email_account, uidvalidity=uidvalidity,
+                                          uid=int(uid)).delete()[0]
+
+
+def apply_action_results(email_account, mailbox, uidvalidity, action, results, target_folder=None):
+    """
+    Update the index, stored messages and folder counters after imap_actions.apply_action()
+
+    Flag actions update is_read/is_starred. Deleted messages are dropped; moved messages
+    change folder, follow the COPYUID reference when the server reported one and are
+    otherwise re-linked by the next sync of the target. Counters take F() deltas, so a
+    move decrements the source folder and increments the target.
+    """
+    source = _folder_for(email_account, mailbox)
+    if source is None:
+        return
+    if action in FLAG_FIELDS:
+        field, value = FLAG_FIELDS[action]
+        _apply_flag(source, field, value, [uid for uid, result in results.items() if result.get('status') == 'ok'])
+        return
+    if action not in ('delete', 'move'):
+        return
+    done = {int(uid): result for uid, result in results.items() if result.get('status') in ('ok', 'not_found')}
+    if not done:
+        return
+
+    with transaction.atomic():
+        moved = MessageLocation.objects.filter(folder=source, uidvalidity=uidvalidity, uid__in=list(done))
+        message_ids = dict(moved.values_list('uid', 'message_id'))
+        moved.delete()
+
+        target = _folder_for(email_account, target_folder) if action == 'move' else None
+        if target is None:
+            _forget_messages(source, done)
+            return
+        # Messages already gone from the server did not reach the target
+        _forget_messages(source, [uid for uid, result in done.items() if result['status'] == 'not_found'])
+        entries = {}
+        new_uids = {}
+        for uid, result in done.items():
+            if result['status'] == 'ok' and result.get('id'):
+                target_validity, target_uid = parse_message_ref(result['id'])
+                entries.setdefault(target_validity, []).append((target_uid, message_ids.get(uid, '')))
+                new_uids[uid] = target_uid
+        for target_validity, target_entries in entries.items():
+            record_locations(target, target_validity, target_entries)
+        _move_messages(source, target, new_uids, [uid for uid, result in done.items() if result['status'] == 'ok'])
+
+
+def _apply_flag(folder, field, value, uids):
+    """Set is_read/is_starred of a folder's stored messages, adjusting the unread counter by the rows that flip"""
+    if not uids:
+        return
+    with transaction.atomic():
+        changed = (folder.messages.filter(uid__in=[str(uid) for uid in uids])
+                   .exclude(**{field: value}).update(**{field: value}))
+        if field == 'is_read':
+            folder.adjust_counts(unread=-changed if value else changed)
+
+
+def _forget_messages(folder, uids):
+    """Delete a folder's stored messages that left the server"""
+    if not uids:
+        return
+    rows = dict(folder.messages.select_for_update().filter(uid__in=[str(uid) for uid in uids])
+                .values_list('pk', 'is_read'))
+    if rows:
+        EmailMessage.objects.filter(pk__in=list(rows)).delete()
+        folder.adjust_counts(total=-len(rows), unread=-sum(1 for is_read in rows.values() if not is_read))
+
+
+def _move_messages(source, target, new_uids, uids):
+    """
+    Move stored messages to the target folder
+
+    Args:
+        new_uids: {source uid: target uid} from COPYUID; other moved rows get no UID
+            until the next sync of the target re-links them
+        uids: source UIDs moved on the server
+    """
+    if not uids:
+        return
+    rows = list(source.messages.select_for_update().filter(uid__in=[str(uid) for uid in uids])
+                .only('pk', 'uid', 'is_read'))
+    for row in rows:
+        new_uid = new_uids.get(int(row.uid))
+        row.folder = target
+        row.uid = str(new_uid) if new_uid else None
+    if rows:
+        EmailMessage.objects.bulk_update(rows, ['folder', 'uid'])
+        unread = sum(1 for row in rows if not row.is_read)
+        source.adjust_counts(total=-len(rows), unread=-unread)
+        target.adjust_counts(total=len(rows), unread=unread)
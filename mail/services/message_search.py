@@ -0,0 +1,119 @@
+"""
+Full-text search over stored messages
+PostgreSQL weighted tsvector (subject > sender > recipients > body) kept on
+EmailMessage.search_vector and queried with ranking and highlighted snippets
+"""
+import html
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connection
+from django.db.models import F
+from mail.models import EmailMessage
+from .imap_fetch import make_message_ref
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Text search configuration used for both the index and queries
+SEARCH_CONFIG = 'english'
+
+# Body characters indexed; to_tsvector fails on inputs that produce a tsvector over 1MB
+MAX_INDEXED_BODY = 200000
+
+# Bodies live compressed in EmailMessageBody, so the body part of the vector is built
+# from text passed in by the caller (already in memory at ingest) rather than a column
+UPDATE_VECTORS_SQL = """
+UPDATE mail_emailmessage AS m SET search_vector =
+    setweight(to_tsvector(%(config)s::regconfig, COALESCE(m.subject, '')), 'A')
+    || setweight(to_tsvector(%(config)s::regconfig, COALESCE(m.sender_name, '') || ' ' || COALESCE(m.sender, '')), 'B')
+    || setweight(to_tsvector(%(config)s::regconfig, COALESCE(m.to_recipients::text, '') || ' ' || COALESCE(m.cc_recipients::text, '')), 'C')
+    || setweight(to_tsvector(%(config)s::regconfig, LEFT(COALESCE(b.body, ''), %(max_body)s)), 'D')
+FROM unnest(%(ids)s::bigint[], %(bodies)s::text[]) AS b(id, body)
+WHERE m.id = b.id
+"""
+
+HEADLINES_SQL = """
+SELECT ts_headline(%(config)s::regconfig, b.body, websearch_to_tsquery(%(config)s::regconfig, %(query)s),
+                   'StartSel=<mark>, StopSel=</mark>, MaxWords=35, MinWords=15, MaxFragments=2')
+FROM unnest(%(bodies)s::text[]) WITH ORDINALITY AS b(body, n)
+ORDER BY b.n
+"""
+
+
+def update_search_vectors(bodies):
+    """
+    Recompute search_vector for messages with one UPDATE
+
+    Args:
+        bodies: dict of message pk -> plain-text body
+
+    Returns:
+        int: number of rows updated (0 on databases other than PostgreSQL, which aren't indexed)
+    """
+    if not bodies or connection.vendor != 'postgresql':
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(UPDATE_VECTORS_SQL, {
+            'config': SEARCH_CONFIG,
+            'max_body': MAX_INDEXED_BODY,
+            'ids': list(bodies),
+            'bodies': [body or '' for body in bodies.values()],
+        })
+        return cursor.rowcount
+
+
+def _headlines(query, bodies):
+    """Highlighted snippets for a page of bodies in one round trip, HTML-escaped before marking"""
+    if not bodies:
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(HEADLINES_SQL, {
+            'config': SEARCH_CONFIG,
+            'query': query,
+            'bodies': [html.escape(body[:MAX_INDEXED_BODY], quote=False) for body in bodies],
+        })
+        return [row[0] for row in cursor.fetchall()]
+
+
+def search_messages(email_account, query, folder=None, limit=25, offset=0):
+    """
+    Ranked search across an account's stored messages
+
+    Args:
+        email_account: EmailAccount to search
+        query: User query (web search syntax: words, "phrases", -excluded, OR)
+        folder: Optional folder name to restrict the search to
+        limit, offset: Page of hits
+
+    Returns:
+        list of hit dicts ordered by rank; 'snippet' is HTML-escaped body text with
+        matches wrapped in <mark>
+    """
+    search_query = SearchQuery(query, search_type='websearch', config=SEARCH_CONFIG)
+    messages = EmailMessage.objects.filter(folder__account=email_account, search_vector=search_query)
+    if folder:
+        messages = messages.filter(folder__name=folder)
+
+    hits = list(messages.with_body().select_related('folder__sync_state').annotate(
+        rank=SearchRank(F('search_vector'), search_query),
+    ).order_by('-rank', '-date_received')[offset:offset + limit])
+    headlines = _headlines(query, [message.body_text or '' for message in hits])
+
+    results = []
+    for message, headline in zip(hits, headlines):
+        sync_state = getattr(message.folder, 'sync_state', None)
+        uidvalidity = sync_state.uidvalidity if sync_state else None
+        results.append({
+            'id': make_message_ref(uidvalidity, message.uid) if message.uid else None,
+            'uid': int(message.uid) if message.uid and message.uid.isdigit() else None,
+            'uidvalidity': uidvalidity,
+            'folder': message.folder.name,
+            'subject': message.subject,
+            'sender': message.sender,
+            'sender_name': message.sender_name,
+            'date': message.date_received.isoformat() if message.date_received else None,
+            'is_read': message.is_read,
+            'is_starred': message.is_starred,
+            'snippet': headline or '',
+            'rank': round(message.rank, 6),
+        })
+    return results
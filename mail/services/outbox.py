@@ -0,0 +1,362 @@
+"""
+Outbox delivery
+Sending a message only renders it and inserts an OutboxMessage; OutboxWorker (the
+run_outbox_worker command) claims due rows, delivers them over pooled SMTP connections
+with a per-domain concurrency cap, retries temporary failures with exponential backoff
+and puts rows abandoned by a crashed worker back in the queue. Messages over their
+domain's or account's rate limit are held back until a token is available. Sent copies of delivered
+messages are appended per account in batches (MULTIAPPEND where supported).
+
+Delivery is at-least-once: a worker dying between the SMTP DATA reply and marking the
+row sent makes the message go out again after the lease expires (same Message-ID).
+"""
+import random
+import smtplib
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from mail.models import OutboxMessage
+from . import credentials, rate_limit
+from .smtp_pool import smtp_pool
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Jitter applied to retry delays so messages failed together don't retry together
+RETRY_JITTER = 0.2
+
+# Candidates locked per claimed row, so rows of saturated domains can be skipped over
+CLAIM_OVERSCAN = 4
+
+# Sent copies are appended in batches of up to this many messages per account, waiting
+# at most SENT_BATCH_DELAY seconds for a batch to fill
+SENT_BATCH_SIZE = 50
+SENT_BATCH_DELAY = 2
+
+# Outcome reported for claimed messages put back because of the rate limit
+THROTTLED = 'throttled'
+
+
+def enqueue(email_account, to_emails, subject, body_text, body_html=None,
+            cc_emails=None, bcc_emails=None, attachments=None, password=None):
+    """
+    Render a message from the account and queue it for delivery
+
+    Args:
+        password: Sender's SMTP password (kept encrypted until the message is sent or fails)
+
+    Returns:
+        OutboxMessage
+    """
+    from mail.services import DjangoEmailService
+
+    msg = DjangoEmailService(email_account).build_message(
+        to_emails, subject, body_text, body_html, cc_emails, bcc_emails, attachments)
+    return OutboxMessage.objects.create(
+        account=email_account,
+        message_id=msg.extra_headers['Message-ID'],
+        subject=subject,
+        to_recipients=list(to_emails),
+        cc_recipients=list(cc_emails or []),
+        bcc_recipients=list(bcc_emails or []),
+        body_text=body_text or '',
+        body_html=body_html,
+        raw=msg.message().as_bytes(linesep='\r\n'),
+        recipients=msg.recipients(),
+        smtp_password=credentials.seal(password),
+    )
+
+
+def claim(limit, max_per_domain=None, busy=None, throttled=None):
+    """
+    Mark up to ``limit`` due messages as sending and return them
+
+    Rows locked by another worker are skipped (SELECT ... FOR UPDATE SKIP LOCKED), so
+    several workers can share the queue.
+
+    Args:
+        max_per_domain: Messages of one sender domain allowed in flight
+        busy: domain_id -> messages of that domain already in flight in this worker
+        throttled: rate limit Buckets known to be empty; their messages aren't claimed
+    """
+    busy = Counter(busy or {})
+    now = timezone.now()
+    picked = []
+    due = OutboxMessage.objects.filter(status=OutboxMessage.STATUS_QUEUED, next_attempt_at__lte=now)
+    for bucket in throttled or ():
+        due = due.exclude(**{'account__domain_id' if bucket.kind == 'domain' else 'account_id': bucket.object_id})
+    with transaction.atomic():
+        candidates = (due.select_for_update(skip_locked=True, of=('self',))
+                      .order_by('next_attempt_at', 'pk')
+                      .values_list('pk', 'account__domain_id')[:limit * CLAIM_OVERSCAN])
+        for pk, domain_id in candidates:
+            if max_per_domain and busy[domain_id] >= max_per_domain:
+                continue
+            busy[domain_id] += 1
+            picked.append(pk)
+            if len(picked) >= limit:
+                break
+        if picked:
+            OutboxMessage.objects.filter(pk__in=picked).update(
+                status=OutboxMessage.STATUS_SENDING, locked_at=now, attempts=F('attempts') + 1)
+    if not picked:
+        return []
+    return list(OutboxMessage.objects.filter(pk__in=picked).select_related('account__domain')
+                .order_by('next_attempt_at', 'pk'))
+
+
+def defer(entry, wait):
+    """Put a claimed message back in the queue for ``wait`` seconds without counting an attempt"""
+    OutboxMessage.objects.filter(pk=entry.pk).update(
+        status=OutboxMessage.STATUS_QUEUED, locked_at=None, attempts=F('attempts') - 1,
+        next_attempt_at=timezone.now() + timedelta(seconds=wait))
+
+
+def recover_stale(lease=None):
+    """Requeue messages claimed longer than ``lease`` seconds ago (their worker died)"""
+    lease = lease or getattr(settings, 'EMAIL_OUTBOX_LEASE', 600)
+    recovered = OutboxMessage.objects.filter(
+        status=OutboxMessage.STATUS_SENDING, locked_at__lt=timezone.now() - timedelta(seconds=lease),
+    ).update(status=OutboxMessage.STATUS_QUEUED, locked_at=None, next_attempt_at=timezone.now())
+    if recovered:
+        logger.warning(f"Requeued {recovered} outbox message(s) abandoned by a stopped worker")
+    # Sent messages whose Sent copy was never filed (worker stopped in between)
+    OutboxMessage.objects.filter(
+        status=OutboxMessage.STATUS_SENT, sent_at__lt=timezone.now() - timedelta(seconds=lease),
+    ).exclude(smtp_password='').update(smtp_password='')
+    return recovered
+
+
+def is_permanent(error):
+    """5xx replies won't succeed on retry; authentication failures and everything else might"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        return False
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code >= 500
+    return False
+
+
+def retry_delay(attempts):
+    """Seconds before the next attempt after ``attempts`` failed ones"""
+    base = getattr(settings, 'EMAIL_OUTBOX_RETRY_BASE', 60)
+    delay = min(base * 2 ** max(attempts - 1, 0), getattr(settings, 'EMAIL_OUTBOX_RETRY_MAX', 3600))
+    return delay * random.uniform(1 - RETRY_JITTER, 1 + RETRY_JITTER)
+
+
+def _record_failure(entry, error):
+    # The message didn't go out; its rate limit token is for the next attempt (or another message)
+    rate_limit.refund(entry.account)
+    max_attempts = getattr(settings, 'EMAIL_OUTBOX_MAX_ATTEMPTS', 8)
+    message = str(error)[:2000]
+    if is_permanent(error) or entry.attempts >= max_attempts:
+        logger.error(f"Giving up on {entry.message_id} after {entry.attempts} attempt(s): {message}")
+        OutboxMessage.objects.filter(pk=entry.pk).update(
+            status=OutboxMessage.STATUS_FAILED, locked_at=None, last_error=message, smtp_password='')
+        return OutboxMessage.STATUS_FAILED
+    delay = retry_delay(entry.attempts)
+    logger.warning(f"Delivery of {entry.message_id} failed (attempt {entry.attempts}), retrying in {delay:.0f}s: {message}")
+    OutboxMessage.objects.filter(pk=entry.pk).update(
+        status=OutboxMessage.STATUS_QUEUED, locked_at=None, last_error=message,
+        next_attempt_at=timezone.now() + timedelta(seconds=delay))
+    return OutboxMessage.STATUS_QUEUED
+
+
+def deliver(entry, password=None):
+    """
+    Send one claimed message (its Sent copy is filed by file_sent_copies())
+
+    The caller has taken a rate limit token for it (OutboxWorker._admit); a failed
+    delivery gives the token back.
+
+    Args:
+        password: Fallback SMTP password when the message carries none
+
+    Returns:
+        str: the message's new status
+    """
+    from mail.services import DjangoEmailService
+
+    email_service = DjangoEmailService(entry.account)
+    email_service._password = credentials.unseal(entry.smtp_password) or password
+    sender = entry.account.email
+    try:
+        with smtp_pool.session(sender, email_service._get_email_password()) as conn:
+            refused = conn.sendmail(sender, entry.recipients, bytes(entry.raw))
+    except Exception as e:
+        return _record_failure(entry, e)
+
+    # The password stays until file_sent_copies() has used it for the Sent copy
+    OutboxMessage.objects.filter(pk=entry.pk).update(
+        status=OutboxMessage.STATUS_SENT, locked_at=None, sent_at=timezone.now(),
+        last_error='; '.join(f"{rcpt}: {code} {reply.decode(errors='ignore')}"
+                             for rcpt, (code, reply) in refused.items())[:2000])
+    return OutboxMessage.STATUS_SENT
+
+
+def file_sent_copies(email_account, entries, password=None):
+    """
+    Append delivered messages of one account to its Sent folder and store them
+
+    One pooled IMAP session and (with MULTIAPPEND) one command for the whole batch; the
+    APPENDUID of each copy is stored with its EmailMessage row so sync won't fetch it again.
+    Best effort, as with direct sends: a failed APPEND still stores the rows.
+    """
+    from mail.services import DjangoEmailService
+
+    email_service = DjangoEmailService(email_account)
+    email_service._password = next(filter(None, (credentials.unseal(entry.smtp_password) for entry in entries)),
+                                   None) or password
+    try:
+        refs = email_service._save_sent_to_imap(*[bytes(entry.raw) for entry in entries])
+    except Exception as e:
+        logger.warning(f"Failed to save {len(entries)} sent email(s) to IMAP: {e}")
+        refs = [None] * len(entries)
+    finally:
+        OutboxMessage.objects.filter(pk__in=[entry.pk for entry in entries]).update(smtp_password='')
+
+    sent_folder = email_service._get_or_create_folder('Sent', 'sent')
+    for entry, ref in zip(entries, refs):
+        try:
+            email_service._store_sent_email(sent_folder, entry.to_recipients, entry.cc_recipients, entry.bcc_recipients,
+                                            entry.subject, entry.body_text, entry.body_html,
+                                            message_id=entry.message_id, ref=ref)
+        except Exception as e:
+            logger.warning(f"Failed to store sent email {entry.message_id}: {e}")
+
+
+class OutboxWorker:
+    """
+    Deliver queued messages until stopped
+
+    Args:
+        workers: Messages delivered at the same time
+        max_per_domain: Messages of one sender domain delivered at the same time
+        poll_interval: Seconds between queue polls when idle
+        password: Fallback SMTP password for messages queued without one
+        progress: Optional callable(OutboxMessage, status) called as each delivery finishes,
+            or with THROTTLED when a message is held back by the rate limit
+    """
+
+    def __init__(self, workers=None, max_per_domain=None, poll_interval=None, password=None, progress=None):
+        self.workers = workers or getattr(settings, 'EMAIL_OUTBOX_WORKERS', 4)
+        self.max_per_domain = max_per_domain or getattr(settings, 'EMAIL_OUTBOX_MAX_PER_DOMAIN', 2)
+        self.poll_interval = poll_interval or getattr(settings, 'EMAIL_OUTBOX_POLL_INTERVAL', 2)
+        self.password = password
+        self.progress = progress
+        self._stop = threading.Event()
+        self._throttled = {}  # bucket key -> (Bucket, monotonic time it has a token again)
+
+    def stop(self):
+        self._stop.set()
+
+    def _deliver(self, entry):
+        try:
+            return deliver(entry, self.password)
+        finally:
+            # Worker threads get their own DB connection; don't leave it open after the message
+            connection.close()
+
+    def _file_sent(self, email_account, entries):
+        try:
+            file_sent_copies(email_account, entries, self.password)
+        except Exception as e:
+            logger.error(f"Filing Sent copies for {email_account.email} failed: {e}")
+        finally:
+            connection.close()
+
+    def _flush_sent(self, executor, sent):
+        """File the Sent copies of delivered messages, one batch per account"""
+        by_account = {}
+        for entry in sent:
+            by_account.setdefault(entry.account_id, []).append(entry)
+        for entries in by_account.values():
+            executor.submit(self._file_sent, entries[0].account, entries)
+        sent.clear()
+
+    def _admit(self, entry, totals):
+        """Take a rate limit token for a claimed message, or put it back until one is available"""
+        wait, bucket = rate_limit.take(entry.account)
+        if bucket is None:
+            return True
+        defer(entry, wait)
+        self._throttled[bucket.key] = (bucket, time.monotonic() + wait)
+        totals[THROTTLED] += 1
+        if self.progress:
+            self.progress(entry, THROTTLED)
+        return False
+
+    def _collect(self, future, entry, totals, sent):
+        try:
+            result = future.result()
+        except Exception as e:
+            # Left in 'sending'; recover_stale() requeues it after the lease
+            logger.error(f"Outbox delivery of {entry.message_id} crashed: {e}")
+            result = 'error'
+        totals[result] += 1
+        if result == OutboxMessage.STATUS_SENT:
+            sent.append(entry)
+        if self.progress:
+            self.progress(entry, result)
+
+    def run(self, once=False):
+        """
+        Deliver messages as they become due
+
+        Args:
+            once: Return when nothing is due instead of waiting for more
+
+        Returns:
+            Counter of final statuses
+        """
+        totals = Counter()
+        inflight = {}  # future -> OutboxMessage
+        sent = []      # delivered messages waiting for their Sent copy
+        sent_since = 0
+        lease = getattr(settings, 'EMAIL_OUTBOX_LEASE', 600)
+        next_recovery = 0
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='mail-outbox') as executor:
+            while not self._stop.is_set():
+                if time.monotonic() >= next_recovery:
+                    recover_stale(lease)
+                    next_recovery = time.monotonic() + lease / 2
+
+                free = self.workers - len(inflight)
+                if free:
+                    now = time.monotonic()
+                    self._throttled = {key: item for key, item in self._throttled.items() if item[1] > now}
+                    busy = Counter(entry.account.domain_id for entry in inflight.values())
+                    throttled = [bucket for bucket, _ in self._throttled.values()]
+                    for entry in claim(free, self.max_per_domain, busy, throttled):
+                        if self._admit(entry, totals):
+                            inflight[executor.submit(self._deliver, entry)] = entry
+
+                if sent and (not inflight or len(sent) >= SENT_BATCH_SIZE
+                             or time.monotonic() - sent_since >= SENT_BATCH_DELAY):
+                    self._flush_sent(executor, sent)
+
+                if not inflight:
+                    if once:
+                        break
+                    self._stop.wait(self.poll_interval)
+                    continue
+
+                done, _ = wait(inflight, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if not sent:
+                        sent_since = time.monotonic()
+                    self._collect(future, inflight.pop(future), totals, sent)
+
+            # Stopping: finish deliveries already on the wire and file what went out
+            for future in wait(inflight).done:
+                self._collect(future, inflight.pop(future), totals, sent)
+            if sent:
+                self._flush_sent(executor, sent)
+        return totals
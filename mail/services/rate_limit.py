@@ -0,0 +1,161 @@
+"""
+Outbound rate limiting
+Enforces Domain.message_limit (messages per hour) with token buckets: one per domain and
+a smaller one per account, so a single account can't use up its domain's allowance in a
+burst. Buckets are RateLimitBucket rows updated under a row lock, which makes the limits
+hold across every process that sends (web workers, outbox workers, mail merge runners).
+"""
+import math
+from collections import namedtuple
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from mail.models import EmailAccount, RateLimitBucket
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Bucket(namedtuple('Bucket', 'kind object_id capacity rate')):
+    """Limit of one domain or account: holds up to ``capacity`` tokens, refilled at ``rate`` per second"""
+
+    @property
+    def key(self):
+        return f'{self.kind}:{self.object_id}'
+
+    def level(self, row, now):
+        """Tokens in the bucket at ``now`` given its stored row (full when there is none)"""
+        if row is None:
+            return self.capacity
+        return min(self.capacity, row.tokens + max((now - row.updated_at).total_seconds(), 0) * self.rate)
+
+
+def _bucket(kind, object_id, per_hour):
+    burst_seconds = getattr(settings, 'EMAIL_RATE_LIMIT_BURST_SECONDS', 300)
+    rate = per_hour / 3600
+    return Bucket(kind, object_id, max(1.0, rate * burst_seconds), rate)
+
+
+def domain_bucket(domain):
+    """Bucket of a domain, or None when it has no message limit"""
+    if domain.message_limit <= 0:
+        return None
+    return _bucket('domain', domain.pk, domain.message_limit)
+
+
+def account_bucket(email_account, domain=None):
+    """Bucket of one account: EMAIL_RATE_LIMIT_ACCOUNT_PERCENT of its domain's limit"""
+    domain = domain or email_account.domain
+    percent = getattr(settings, 'EMAIL_RATE_LIMIT_ACCOUNT_PERCENT', 50)
+    if domain.message_limit <= 0 or percent >= 100:
+        return None
+    return _bucket('account', email_account.pk, domain.message_limit * percent / 100)
+
+
+def buckets_for(email_account):
+    """Buckets a message sent from the account draws a token from"""
+    return [bucket for bucket in (domain_bucket(email_account.domain), account_bucket(email_account))
+            if bucket is not None]
+
+
+def _locked_rows(buckets, now):
+    """Bucket rows locked for update in key order (one lock order, no deadlocks), created full if missing"""
+    keys = sorted(bucket.key for bucket in buckets)
+    rows = {row.key: row for row in RateLimitBucket.objects.select_for_update().filter(key__in=keys).order_by('key')}
+    missing = [bucket for bucket in buckets if bucket.key not in rows]
+    if missing:
+        RateLimitBucket.objects.bulk_create(
+            [RateLimitBucket(key=bucket.key, tokens=bucket.capacity, updated_at=now) for bucket in missing],
+            ignore_conflicts=True)
+        rows = {row.key: row for row in RateLimitBucket.objects.select_for_update().filter(key__in=keys).order_by('key')}
+    return rows
+
+
+def take(email_account):
+    """
+    Take the token for one message from the account's buckets, if all of them have one
+
+    Tokens are taken from every bucket or from none.
+
+    Returns:
+        tuple: (0, None) when the message may go out now, otherwise (seconds until it
+        may, the Bucket that is empty)
+    """
+    buckets = buckets_for(email_account)
+    if not buckets:
+        return 0, None
+    now = timezone.now()
+    with transaction.atomic():
+        rows = _locked_rows(buckets, now)
+        levels = {bucket.key: bucket.level(rows[bucket.key], now) for bucket in buckets}
+        waits = [((1 - levels[bucket.key]) / bucket.rate, bucket) for bucket in buckets if levels[bucket.key] < 1]
+        wait, limiting = max(waits, key=lambda item: item[0]) if waits else (0, None)
+        for bucket in buckets:
+            row = rows[bucket.key]
+            row.tokens = levels[bucket.key] - (0 if limiting else 1)
+            row.updated_at = now
+            row.save(update_fields=['tokens', 'updated_at'])
+    if limiting:
+        logger.info(f"Rate limit of {limiting.key} reached for {email_account.email}, next token in {wait:.0f}s")
+    return wait, limiting
+
+
+def refund(email_account):
+    """Give back the token take() took for a message that didn't go out (capped at each bucket's capacity)"""
+    buckets = buckets_for(email_account)
+    if not buckets:
+        return
+    now = timezone.now()
+    with transaction.atomic():
+        rows = _locked_rows(buckets, now)
+        for bucket in buckets:
+            row = rows[bucket.key]
+            row.tokens = min(bucket.capacity, bucket.level(row, now) + 1)
+            row.updated_at = now
+            row.save(update_fields=['tokens', 'updated_at'])
+
+
+def limit_error(email_account, wait):
+    """Error message for a send refused by the rate limit"""
+    return (f"Sending limit of {email_account.domain.name} reached "
+            f"({email_account.domain.message_limit} messages per hour), try again in {math.ceil(wait)}s")
+
+
+def levels(domains):
+    """
+    Current bucket levels of some domains, for dashboards
+
+    Accounts are listed only while their bucket is below full (they have been sending).
+
+    Returns:
+        list: [{'domain', 'message_limit', 'capacity', 'available', 'accounts': [{'email', 'capacity', 'available'}]}],
+        capacity and available being None for unlimited domains
+    """
+    domains = list(domains)
+    accounts = list(EmailAccount.objects.filter(domain__in=domains).only('id', 'email', 'domain_id').order_by('email'))
+    domain_buckets = {domain.pk: domain_bucket(domain) for domain in domains}
+    by_domain = {domain.pk: domain for domain in domains}
+    account_buckets = [(account, account_bucket(account, by_domain[account.domain_id])) for account in accounts]
+    keys = [bucket.key for bucket in domain_buckets.values() if bucket]
+    keys += [bucket.key for _, bucket in account_buckets if bucket]
+    rows = {row.key: row for row in RateLimitBucket.objects.filter(key__in=keys)}
+    now = timezone.now()
+
+    result = []
+    for domain in domains:
+        bucket = domain_buckets[domain.pk]
+        entry = {'domain': domain.name, 'message_limit': domain.message_limit,
+                 'capacity': None, 'available': None, 'accounts': []}
+        if bucket:
+            entry['capacity'] = round(bucket.capacity, 1)
+            entry['available'] = round(bucket.level(rows.get(bucket.key), now), 1)
+        result.append(entry)
+    entries = {domain.pk: entry for domain, entry in zip(domains, result)}
+    for account, bucket in account_buckets:
+        if bucket is None:
+            continue
+        available = bucket.level(rows.get(bucket.key), now)
+        if available < bucket.capacity:
+            entries[account.domain_id]['accounts'].append(
+                {'email': account.email, 'capacity': round(bucket.capacity, 1), 'available': round(available, 1)})
+    return result
@@ -0,0 +1,113 @@
+"""
+Raw message store
+Content-addressed copy of the RFC822 bytes fetched by sync, so messages can be
+reparsed or reindexed locally without downloading them from Dovecot again
+"""
+import email
+import hashlib
+import mmap
+import os
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class RawMessageStore:
+    """
+    Write-once store of raw messages keyed by sha256
+
+    Blobs live at <root>/<aa>/<bb>/<sha256> so no directory grows past a few thousand
+    entries. Identical messages (one delivery to several local recipients) are stored
+    once and shared, which is why deleting an EmailMessage never deletes its blob.
+    """
+
+    def __init__(self, root=None):
+        self.root = root if root is not None else getattr(settings, 'EMAIL_RAW_STORE_DIR', '')
+
+    @property
+    def enabled(self):
+        return bool(self.root)
+
+    @staticmethod
+    def digest_of(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def path_for(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest):
+        return os.path.exists(self.path_for(digest))
+
+    def put(self, data):
+        """
+        Store raw message bytes (a no-op when the same content is already stored)
+
+        Returns:
+            str: sha256 hex digest addressing the blob
+        """
+        digest = self.digest_of(data)
+        path = self.path_for(digest)
+        if os.path.exists(path):
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            # Atomic rename: readers see the whole blob or nothing; a concurrent writer of
+            # the same content just replaces it with identical bytes
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        return digest
+
+    @contextmanager
+    def open(self, digest):
+        """
+        Memory-map a stored message read-only
+
+        Yields an mmap (bytes-like: slicing, find(), len()) valid inside the with block.
+        Raises FileNotFoundError for unknown digests.
+        """
+        with open(self.path_for(digest), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # mmap refuses empty files
+                yield b''
+                return
+            view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield view
+            finally:
+                view.close()
+
+    def read(self, digest):
+        """Raw bytes of a stored message"""
+        with self.open(digest) as view:
+            return view[:]
+
+    def parse(self, digest):
+        """Stored message parsed into an email.message.Message"""
+        with self.open(digest) as view:
+            return email.message_from_bytes(view[:])
+
+    def iter_digests(self):
+        """Digests of every stored blob"""
+        if not self.enabled or not os.path.isdir(self.root):
+            return
+        for root, _, names in os.walk(self.root):
+            for name in names:
+                if len(name) == 64 and not name.endswith('.tmp'):
+                    yield name
+
+
+# Process-wide store; disabled unless EMAIL_RAW_STORE_DIR is set
+raw_store = RawMessageStore()
@@ -0,0 +1,277 @@
+"""
+SMTP Session Pool
+Keeps authenticated Postfix submission connections alive between sends so each
+message costs MAIL/RCPT/DATA instead of connect + STARTTLS + AUTH
+"""
+import hashlib
+import smtplib
+import ssl
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from django.conf import settings
+from mail.backends import resolve_smtp_host
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SMTPPoolExhausted(smtplib.SMTPException):
+    """Raised when no connection becomes available within the pool's acquire timeout"""
+
+
+class SMTPSessionPool:
+    """
+    Pool of authenticated SMTP connections keyed by sender credentials
+
+    Same leasing model as IMAPSessionPool: acquire() hands out a connection exclusively,
+    release() resets it with RSET and returns it to the pool, discard() closes it. The same
+    caps apply too: ``max_size`` connections, ``max_per_account`` per sender, with acquire()
+    waiting up to ``acquire_timeout`` seconds for a slot. Idle connections are closed after
+    ``idle_timeout`` seconds (keep it below Postfix's smtpd_timeout) and checked with NOOP
+    when idle longer than ``noop_interval``.
+    """
+
+    def __init__(self, max_size=None, max_per_account=None, idle_timeout=None, noop_interval=None,
+                 acquire_timeout=None, timeout=None):
+        self.max_size = max_size or getattr(settings, 'EMAIL_SMTP_POOL_MAX_SIZE', 20)
+        self.max_per_account = max_per_account or getattr(settings, 'EMAIL_SMTP_POOL_MAX_PER_ACCOUNT', 2)
+        self.idle_timeout = idle_timeout or getattr(settings, 'EMAIL_SMTP_POOL_IDLE_TIMEOUT', 60)
+        self.noop_interval = noop_interval or getattr(settings, 'EMAIL_SMTP_POOL_NOOP_INTERVAL', 15)
+        self.acquire_timeout = acquire_timeout or getattr(settings, 'EMAIL_SMTP_POOL_ACQUIRE_TIMEOUT', 30)
+        self.timeout = timeout or getattr(settings, 'EMAIL_TIMEOUT', None) or 30
+
+        self._lock = threading.Lock()
+        self._freed = threading.Condition(self._lock)  # notified whenever a slot or idle connection frees up
+        self._idle = {}              # key -> deque of (connection, last_used)
+        self._leased = {}            # id(connection) -> key
+        self._open_count = 0         # idle + leased + being opened
+        self._per_account = Counter()  # username -> open connections
+
+    @staticmethod
+    def _make_key(username, password):
+        """Key connections by login and password so a changed password never reuses one"""
+        digest = hashlib.sha256((password or '').encode('utf-8')).hexdigest()
+        return ((username or '').lower(), digest)
+
+    def _connect(self, username, password):
+        """Open a submission connection (implicit TLS or STARTTLS) and authenticate"""
+        host = resolve_smtp_host()
+        port = getattr(settings, 'EMAIL_PORT', 587)
+        # Postfix presents a self-signed certificate in development; same policy as CustomSMTPBackend
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+
+        if getattr(settings, 'EMAIL_USE_SSL', False):
+            conn = smtplib.SMTP_SSL(host, port, timeout=self.timeout, context=context)
+        else:
+            conn = smtplib.SMTP(host, port, timeout=self.timeout)
+        try:
+            if not getattr(settings, 'EMAIL_USE_SSL', False) and getattr(settings, 'EMAIL_USE_TLS', False):
+                conn.starttls(context=context)
+            if username and password:
+                conn.login(username, password)
+        except Exception:
+            self._close(conn)
+            raise
+        return conn
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.quit()
+        except Exception:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    @staticmethod
+    def _is_alive(conn):
+        try:
+            return conn.noop()[0] == 250
+        except Exception:
+            return False
+
+    def _forget_locked(self, key, count=1):
+        """Account for closed connections of ``key`` and wake up waiting acquirers"""
+        self._open_count -= count
+        self._per_account[key[0]] -= count
+        if self._per_account[key[0]] <= 0:
+            del self._per_account[key[0]]
+        self._freed.notify_all()
+
+    def _reap_locked(self, now):
+        """Detach idle connections past their timeout; caller closes them outside the lock"""
+        expired = []
+        for key in list(self._idle):
+            connections = self._idle[key]
+            while connections and now - connections[0][1] > self.idle_timeout:
+                expired.append(connections.popleft()[0])
+                self._forget_locked(key)
+            if not connections:
+                del self._idle[key]
+        return expired
+
+    def _evict_locked(self, username=None):
+        """Detach the least recently used idle connection (of one sender, if given), or None"""
+        keys = [key for key in self._idle if username is None or key[0] == username]
+        if not keys:
+            return None
+        key = min(keys, key=lambda k: self._idle[k][0][1])
+        conn = self._idle[key].popleft()[0]
+        if not self._idle[key]:
+            del self._idle[key]
+        self._forget_locked(key)
+        return conn
+
+    def _checkout(self, key, deadline):
+        """
+        Take an idle connection of ``key`` or reserve a slot for a new one
+
+        Returns:
+            tuple: ((connection, last_used) or None when a slot was reserved, connections to close)
+
+        Raises:
+            SMTPPoolExhausted: no slot freed up before ``deadline``
+        """
+        closing = []
+        with self._freed:
+            while True:
+                closing += self._reap_locked(time.monotonic())
+                connections = self._idle.get(key)
+                if connections:
+                    entry = connections.pop()
+                    if not connections:
+                        del self._idle[key]
+                    return entry, closing
+
+                # Idle connections of other keys (another sender, an old password) give way
+                if self._per_account[key[0]] >= self.max_per_account:
+                    victim = self._evict_locked(key[0])
+                elif self._open_count >= self.max_size:
+                    victim = self._evict_locked()
+                else:
+                    victim = None
+                if victim is not None:
+                    closing.append(victim)
+                if self._open_count < self.max_size and self._per_account[key[0]] < self.max_per_account:
+                    self._open_count += 1
+                    self._per_account[key[0]] += 1
+                    return None, closing
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._freed.wait(remaining)
+        for conn in closing:
+            self._close(conn)
+        raise SMTPPoolExhausted(f"No SMTP connection available for {key[0]} within {self.acquire_timeout}s")
+
+    def acquire(self, username, password):
+        """
+        Borrow an authenticated connection, opening one if none is idle
+
+        Returns:
+            smtplib.SMTP connection (must be passed back to release() or discard())
+
+        Raises:
+            SMTPPoolExhausted: the pool stayed full for ``acquire_timeout`` seconds
+        """
+        key = self._make_key(username, password)
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            entry, closing = self._checkout(key, deadline)
+            for stale in closing:
+                self._close(stale)
+
+            if entry is None:
+                try:
+                    conn = self._connect(username, password)
+                except BaseException:
+                    with self._lock:
+                        self._forget_locked(key)
+                    raise
+                break
+
+            conn, last_used = entry
+            if time.monotonic() - last_used <= self.noop_interval or self._is_alive(conn):
+                break
+
+            logger.info(f"Dropping dead SMTP connection for {username}")
+            self._close(conn)
+            with self._lock:
+                self._forget_locked(key)
+
+        with self._lock:
+            self._leased[id(conn)] = key
+        return conn
+
+    def release(self, conn):
+        """Reset a connection with RSET and return it to the pool (closed if the reset fails)"""
+        try:
+            healthy = conn.rset()[0] == 250
+        except Exception:
+            healthy = False
+        if not healthy:
+            self.discard(conn)
+            return
+        with self._lock:
+            key = self._leased.pop(id(conn), None)
+            if key is None:
+                return
+            self._idle.setdefault(key, deque()).append((conn, time.monotonic()))
+            self._freed.notify_all()
+
+    def discard(self, conn):
+        """Close a connection whose state is unknown instead of pooling it"""
+        with self._lock:
+            key = self._leased.pop(id(conn), None)
+            if key is None:
+                return
+            self._forget_locked(key)
+        self._close(conn)
+
+    @contextmanager
+    def session(self, username, password):
+        """Context manager around acquire()/release(); SMTP or socket errors discard the connection"""
+        conn = self.acquire(username, password)
+        try:
+            yield conn
+        except (smtplib.SMTPServerDisconnected, OSError):
+            self.discard(conn)
+            raise
+        except BaseException:
+            self.release(conn)
+            raise
+        else:
+            self.release(conn)
+
+    def close_account(self, username):
+        """Close every idle connection of a sender (e.g. on password change)"""
+        username = username.lower()
+        with self._lock:
+            closing = []
+            for key in [key for key in self._idle if key[0] == username]:
+                connections = self._idle.pop(key)
+                closing += [conn for conn, _ in connections]
+                self._forget_locked(key, len(connections))
+        for conn in closing:
+            self._close(conn)
+
+    def close_all(self):
+        """Close every idle connection"""
+        with self._lock:
+            closing = []
+            for key, connections in self._idle.items():
+                closing += [conn for conn, _ in connections]
+                self._forget_locked(key, len(connections))
+            self._idle.clear()
+        for conn in closing:
+            self._close(conn)
+
+
+# Process-wide pool shared by every sender
+smtp_pool = SMTPSessionPool()
@@ -0,0 +1,150 @@
+"""
+Multi-account sync engine
+Syncs many accounts in parallel with a bounded worker pool, one IMAP login per
+account for all of its folders and a cap on concurrent sessions per Dovecot host
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from django.conf import settings
+from django.db import connection
+from imapclient.exceptions import LoginError
+from .imap_pool import IMAPConnectionError
+from .ingest_pipeline import hook_runner
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Standard folders synced when no folder is given
+DEFAULT_SYNC_FOLDERS = ['INBOX', 'Sent', 'Drafts', 'Spam', 'Trash', 'Junk']
+
+
+class AccountSyncResult:
+    """Outcome of syncing one account"""
+
+    def __init__(self, email_address):
+        self.email_address = email_address
+        self.folders = {}  # folder -> sync_folders() result dict
+        self.seconds = 0.0
+        self.error = None
+        self.error_is_auth = False  # error was a login/connection failure (IMAPConnectionError, LoginError)
+
+    @property
+    def messages(self):
+        return sum(result.get('count', 0) for result in self.folders.values())
+
+    @property
+    def bytes(self):
+        return sum(result.get('bytes', 0) for result in self.folders.values())
+
+    @property
+    def failures(self):
+        """Folders that failed, excluding folders that simply don't exist on the server"""
+        return {folder: result['error'] for folder, result in self.folders.items()
+                if not result.get('success') and "doesn't exist" not in (result.get('error') or '').lower()}
+
+    @property
+    def auth_failed(self):
+        """Whether the account couldn't log in, judged by exception type rather than error text"""
+        return self.error_is_auth or any(result.get('auth_failed') for result in self.folders.values())
+
+
+class SyncReport:
+    """Aggregated results of one engine run"""
+
+    def __init__(self):
+        self.accounts = []
+        self.started = time.monotonic()
+        self.seconds = 0.0
+
+    @property
+    def messages(self):
+        return sum(account.messages for account in self.accounts)
+
+    @property
+    def bytes(self):
+        return sum(account.bytes for account in self.accounts)
+
+    @property
+    def failed_accounts(self):
+        return [account for account in self.accounts if account.error or account.failures]
+
+    def rate(self, amount):
+        return amount / self.seconds if self.seconds else 0.0
+
+
+class SyncEngine:
+    """
+    Parallel sync of many EmailAccounts
+
+    Args:
+        workers: Accounts synced at the same time
+        max_per_host: Concurrent IMAP sessions allowed against one IMAP host
+        folders: Folders to sync per account
+        limit: Maximum new messages per folder
+        password: Password used for every account (falls back to the service default)
+        progress: Optional callable(AccountSyncResult) called as each account finishes
+    """
+
+    def __init__(self, workers=None, max_per_host=None, folders=None, limit=100, password=None, progress=None):
+        self.workers = workers or getattr(settings, 'EMAIL_SYNC_WORKERS', 8)
+        self.max_per_host = max_per_host or getattr(settings, 'EMAIL_SYNC_MAX_PER_HOST', 4)
+        self.folders = folders or DEFAULT_SYNC_FOLDERS
+        self.limit = limit
+        self.password = password
+        self.progress = progress
+
+        self._lock = threading.Lock()
+        self._host_slots = {}  # host -> BoundedSemaphore
+
+    def host_for(self, email_account):
+        """IMAP host serving the account (all accounts share the configured Dovecot host today)"""
+        return getattr(settings, 'EMAIL_IMAP_HOST', 'localhost')
+
+    def _slot(self, host):
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._host_slots[host]
+
+    def sync_account(self, email_account):
+        """Sync every folder of one account over a single login"""
+        from mail.services import DjangoEmailService
+
+        result = AccountSyncResult(email_account.email)
+        started = time.monotonic()
+        try:
+            with self._slot(self.host_for(email_account)):
+                email_service = DjangoEmailService(email_account)
+                if self.password:
+                    email_service._password = self.password
+                result.folders = email_service.sync_folders(self.folders, limit=self.limit)
+        except Exception as e:
+            logger.error(f"Sync of {email_account.email} failed: {e}")
+            result.error = str(e)
+            result.error_is_auth = isinstance(e, (IMAPConnectionError, LoginError))
+        finally:
+            # Worker threads get their own DB connection; don't leave it open after the account
+            connection.close()
+        result.seconds = time.monotonic() - started
+        return result
+
+    def run(self, email_accounts):
+        """
+        Sync the given accounts
+
+        Returns:
+            SyncReport
+        """
+        report = SyncReport()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='mail-sync') as executor:
+            futures = [executor.submit(self.sync_account, account) for account in email_accounts]
+            for future in as_completed(futures):
+                result = future.result()
+                report.accounts.append(result)
+                if self.progress:
+                    self.progress(result)
+        report.seconds = time.monotonic() - report.started
+        # Post-ingest hooks run in the background; finish them before a one-shot run exits
+        hook_runner.drain()
+        return report
@@ -0,0 +1,195 @@
+"""
+Adaptive sync scheduler
+Resident loop that syncs each account on its own interval: active mailboxes are
+synced often, quiet ones back off towards a ceiling, and failing accounts retry
+with jittered exponential backoff. Each account's interval, backoff and next due
+time are persisted (AccountSyncState), so a restart resumes the schedule instead
+of syncing every account at once.
+"""
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Max
+from django.utils import timezone
+from mail.models import AccountSyncState, EmailAccount, FolderSyncState
+from .ingest_pipeline import hook_runner
+from .sync_engine import AccountSyncResult
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Quiet accounts' interval grows by this factor after each sync without new mail
+INTERVAL_GROWTH = 1.5
+
+# Delays are spread by +/- this fraction so accounts don't sync in lockstep
+JITTER = 0.2
+
+# First retry delay (seconds) after an authentication failure; a wrong password won't fix itself quickly
+AUTH_BACKOFF = 300
+
+
+class AccountSchedule:
+    """Scheduling state of one account"""
+
+    def __init__(self, account, interval, next_run):
+        self.account = account
+        self.interval = interval
+        self.next_run = next_run  # time.monotonic() value
+        self.failures = 0
+        self.running = False
+
+
+class SyncScheduler:
+    """
+    Run SyncEngine.sync_account for every active account, forever, at adaptive intervals
+
+    Args:
+        engine: SyncEngine providing sync_account(), worker count and per-host limits
+        min_interval: Seconds between syncs of an account that keeps receiving mail
+        max_interval: Ceiling for the interval of an idle account
+        max_backoff: Ceiling for the retry delay of a failing account
+        accounts: EmailAccount queryset to schedule (re-read every refresh_interval)
+        refresh_interval: Seconds between checks for added or deactivated accounts
+        progress: Optional callable(AccountSyncResult, AccountSchedule) after each sync
+    """
+
+    def __init__(self, engine, min_interval=None, max_interval=None, max_backoff=None, accounts=None,
+                 refresh_interval=60, progress=None):
+        self.engine = engine
+        self.min_interval = min_interval or getattr(settings, 'EMAIL_SCHEDULER_MIN_INTERVAL', 60)
+        self.max_interval = max_interval or getattr(settings, 'EMAIL_SCHEDULER_MAX_INTERVAL', 1800)
+        self.max_backoff = max_backoff or getattr(settings, 'EMAIL_SCHEDULER_MAX_BACKOFF', 3600)
+        self.accounts = accounts if accounts is not None else EmailAccount.objects.filter(is_active=True)
+        self.refresh_interval = refresh_interval
+        self.progress = progress
+
+        self.schedules = {}  # account pk -> AccountSchedule
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._next_refresh = 0.0
+
+    def stop(self):
+        """Ask run() to return once in-flight syncs finish (safe to call from a signal handler)"""
+        self._stop.set()
+        self._wake.set()
+
+    @staticmethod
+    def _jitter(delay):
+        return delay * random.uniform(1 - JITTER, 1 + JITTER)
+
+    def refresh_accounts(self):
+        """Add new accounts (due according to their persisted schedule) and drop removed ones"""
+        close_old_connections()
+        # .all() re-evaluates the queryset; iterating self.accounts again would reuse its first result
+        accounts = {account.pk: account for account in self.accounts.all()}
+        new = [pk for pk in accounts if pk not in self.schedules]
+        states = {state.account_id: state for state in AccountSyncState.objects.filter(account__in=new)}
+        last_synced = dict(
+            FolderSyncState.objects.filter(folder__account__in=[pk for pk in new if pk not in states])
+            .values('folder__account').annotate(last=Max('last_synced_at'))
+            .values_list('folder__account', 'last')
+        )
+
+        now = time.monotonic()
+        wall_now = timezone.now()
+        for pk, account in accounts.items():
+            if pk in self.schedules:
+                self.schedules[pk].account = account
+                continue
+            state = states.get(pk)
+            if state and state.next_sync_at:
+                interval = min(self.max_interval, max(self.min_interval, state.interval))
+                delay = (state.next_sync_at - wall_now).total_seconds()
+            else:
+                last = last_synced.get(pk)
+                interval = self.min_interval
+                delay = self.min_interval - (wall_now - last).total_seconds() if last else 0.0
+            # Accounts that fell due while the scheduler was down are spread over one interval
+            # instead of all syncing at once
+            if delay <= 0:
+                delay = random.uniform(0, self.min_interval)
+            schedule = AccountSchedule(account, interval, now + delay)
+            if state:
+                schedule.failures = state.failures
+            self.schedules[pk] = schedule
+
+        for pk in [pk for pk, schedule in self.schedules.items() if pk not in accounts and not schedule.running]:
+            del self.schedules[pk]
+        self._next_refresh = now + self.refresh_interval
+
+    def reschedule(self, schedule, result):
+        """Pick the next run of an account from the outcome of its last sync"""
+        schedule.running = False
+        auth_failed = result.auth_failed
+        if result.error or result.failures:
+            schedule.failures += 1
+            base = AUTH_BACKOFF if auth_failed else self.min_interval
+            delay = min(self.max_backoff, base * 2 ** (schedule.failures - 1))
+        else:
+            schedule.failures = 0
+            if result.messages:
+                schedule.interval = self.min_interval
+            else:
+                schedule.interval = min(self.max_interval, schedule.interval * INTERVAL_GROWTH)
+            delay = schedule.interval
+        delay = self._jitter(delay)
+        schedule.next_run = time.monotonic() + delay
+
+        try:
+            AccountSyncState.objects.update_or_create(account=schedule.account, defaults={
+                'interval': round(schedule.interval),
+                'failures': schedule.failures,
+                'auth_failed': bool(schedule.failures and auth_failed),
+                'next_sync_at': timezone.now() + timedelta(seconds=delay),
+            })
+        except Exception as e:
+            # The in-memory schedule still works; only a restart would lose this account's backoff
+            logger.error(f"Failed to save sync schedule of {schedule.account.email}: {e}")
+
+    def run(self):
+        """Schedule syncs until stop() is called; returns after in-flight syncs complete"""
+        running = {}  # future -> AccountSchedule
+        with ThreadPoolExecutor(max_workers=self.engine.workers, thread_name_prefix='mail-sched') as executor:
+            while not self._stop.is_set():
+                now = time.monotonic()
+                if now >= self._next_refresh:
+                    self.refresh_accounts()
+
+                due = sorted((schedule for schedule in self.schedules.values()
+                              if not schedule.running and schedule.next_run <= now),
+                             key=lambda schedule: schedule.next_run)
+                for schedule in due[:max(0, self.engine.workers - len(running))]:
+                    schedule.running = True
+                    future = executor.submit(self.engine.sync_account, schedule.account)
+                    future.add_done_callback(lambda _: self._wake.set())
+                    running[future] = schedule
+
+                # With every worker busy, only a finishing sync (done callback) can start the next one
+                waiting = [schedule.next_run for schedule in self.schedules.values()
+                           if not schedule.running] if len(running) < self.engine.workers else []
+                timeout = min(waiting + [self._next_refresh]) - time.monotonic()
+                self._wake.wait(max(0.05, timeout))
+                self._wake.clear()
+                self._collect(running, block=False)
+
+            logger.info(f"Sync scheduler stopping; waiting for {len(running)} running sync(s)")
+            self._collect(running, block=True)
+        hook_runner.drain(timeout=30)
+
+    def _collect(self, running, block):
+        for future in [future for future in running if block or future.done()]:
+            schedule = running.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                # sync_account reports failures itself; anything escaping it must not kill the loop
+                logger.error(f"Sync of {schedule.account.email} crashed: {e}")
+                result = AccountSyncResult(schedule.account.email)
+                result.error = str(e)
+            self.reschedule(schedule, result)
+            if self.progress:
+                self.progress(result, schedule)
@@ -0,0 +1,610 @@
+"""
+Test helpers shared by the mail and API test suites
+
+In-memory stand-ins for the IMAP and SMTP servers so services can be exercised without a mail server.
+"""
+import imaplib
+import re
+import smtplib
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+from cryptography.fernet import Fernet
+from django.contrib.auth import get_user_model
+from django.test import override_settings
+from imapclient.exceptions import LoginError
+
+from organizations.models import Organization
+from mail.models import Domain, EmailAccount
+
+# Tests that store SMTP passwords (services/credentials.py) need a Fernet key
+with_credential_key = override_settings(EMAIL_CREDENTIAL_KEY=Fernet.generate_key().decode('ascii'))
+
+
+def create_account(email='sender@example.com', message_limit=0):
+    """EmailAccount with its organization, owner and domain"""
+    domain_name = email.split('@')[1]
+    organization = Organization.objects.create(name=domain_name, domain_name=domain_name)
+    domain = Domain.objects.create(name=domain_name, organization=organization, message_limit=message_limit)
+    user = get_user_model().objects.create(username=email.split('@')[0], organization=organization)
+    return EmailAccount.objects.create(user=user, domain=domain, email=email, first_name='Test', last_name='Sender')
+
+
+def make_raw_message(message_id, subject='Hello', sender='Bob <bob@example.org>', to='ada@example.com',
+                     body='Hi there', headers=''):
+    """RFC822 bytes of a plain text message"""
+    return (
+        f'From: {sender}\r\nTo: {to}\r\nSubject: {subject}\r\nMessage-ID: {message_id}\r\n'
+        f'Date: Tue, 14 Oct 2025 10:00:00 +0000\r\n{headers}\r\n{body}\r\n'
+    ).encode()
+
+
+def expand_uids(uid_set, existing):
+    """UIDs of ``existing`` matching an IMAP UID set such as '1:3,7' or '5:*'"""
+    existing = sorted(existing)
+    if not isinstance(uid_set, str):
+        return [uid for uid in existing if uid in set(uid_set)]
+    highest = existing[-1] if existing else 0
+    wanted = set()
+    for chunk in uid_set.split(','):
+        low, _, high = chunk.partition(':')
+        low = highest if low == '*' else int(low)
+        high = low if not high else highest if high == '*' else int(high)
+        wanted.update(range(min(low, high), max(low, high) + 1))
+    return [uid for uid in existing if uid in wanted]
+
+
+class FakeMessage:
+    """Message stored in a FakeFolder; ``parts`` maps MIME part numbers to their encoded bodies"""
+
+    def __init__(self, flags=(), raw=b'', modseq=1, parts=None):
+        self.flags = set(flags)
+        self.raw = raw
+        self.modseq = modseq
+        self.parts = parts or {}
+
+
+class FakeFolder:
+    """
+    Mailbox of a FakeIMAP server
+
+    ``messages`` maps UIDs to FakeMessage; ``attributes`` are the folder's LIST flags.
+    Every change through append(), store() and expunge() raises HIGHESTMODSEQ like a
+    CONDSTORE server does.
+    """
+
+    def __init__(self, messages=None, uidvalidity=7, attributes='\\HasNoChildren', highestmodseq=1):
+        self.messages = messages if messages is not None else {}
+        self.uidvalidity = uidvalidity
+        self.attributes = attributes
+        self.highestmodseq = highestmodseq
+        self.uidnext = max(self.messages, default=0) + 1
+        self.vanished = {}  # expunged UID -> modseq of the expunge
+
+    @classmethod
+    def with_counts(cls, total, unseen=0, **kwargs):
+        """Folder of ``total`` messages (UIDs 1..total), the first ``unseen`` of them unread"""
+        messages = {uid: FakeMessage(() if uid <= unseen else ('\\Seen',)) for uid in range(1, total + 1)}
+        return cls(messages, **kwargs)
+
+    @property
+    def selectable(self):
+        return '\\Noselect' not in self.attributes
+
+    def status(self):
+        return {
+            'MESSAGES': len(self.messages),
+            'UNSEEN': sum(1 for message in self.messages.values() if '\\Seen' not in message.flags),
+            'HIGHESTMODSEQ': self.highestmodseq,
+            'UIDNEXT': self.uidnext,
+            'UIDVALIDITY': self.uidvalidity,
+        }
+
+    def append(self, raw=b'', flags=()):
+        """Deliver a message under the next UID and return the UID"""
+        uid, self.uidnext = self.uidnext, self.uidnext + 1
+        self.highestmodseq += 1
+        self.messages[uid] = FakeMessage(flags, raw, self.highestmodseq)
+        return uid
+
+    def store(self, uid, flags):
+        self.highestmodseq += 1
+        self.messages[uid].flags = set(flags)
+        self.messages[uid].modseq = self.highestmodseq
+
+    def expunge(self, *uids):
+        self.highestmodseq += 1
+        for uid in uids:
+            del self.messages[uid]
+            self.vanished[uid] = self.highestmodseq
+
+
+def _quote(name):
+    return '"' + name.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _unquote(name):
+    if name.startswith('"') and name.endswith('"'):
+        return re.sub(r'\\(.)', r'\1', name[1:-1])
+    return name
+
+
+class FakeIMAP:
+    """
+    imaplib.IMAP4 stand-in for one connection to an in-memory server
+
+    ``folders`` maps folder names to FakeFolder; every command sent is recorded in ``commands``.
+    Set ``alive`` to False to make the next command fail like a dropped connection, or
+    ``fail`` to a UID command name to have the server answer it with NO.
+    """
+
+    error = imaplib.IMAP4.error
+    abort = imaplib.IMAP4.abort
+
+    def __init__(self, host=None, port=None, timeout=None, folders=None, password='secret',
+                 capabilities=('IMAP4REV1', 'LIST-STATUS', 'CONDSTORE')):
+        self.folders = folders if folders is not None else {'INBOX': FakeFolder()}
+        self.password = password
+        self.capabilities = capabilities
+        self.state = 'NONAUTH'
+        self.selected = None
+        self.untagged_responses = {}
+        self.commands = []
+        self.alive = True
+        self.fail = None
+        self.literal = None
+
+    def _command(self, *args):
+        if not self.alive:
+            raise self.abort('socket error: EOF')
+        self.commands.append(args)
+
+    def _list_line(self, name):
+        return b'(%s) "/" %s' % (self.folders[name].attributes.encode(), _quote(name).encode())
+
+    def _status_line(self, name, items):
+        status = self.folders[name].status()
+        values = ' '.join(f'{item} {status[item]}' for item in items.strip('()').split())
+        return b'%s (%s)' % (_quote(name).encode(), values.encode())
+
+    def response(self, code):
+        return 'OK', self.untagged_responses.pop(code, [None])
+
+    def login(self, user, password):
+        self._command('LOGIN', user)
+        if password != self.password:
+            raise self.error(b'[AUTHENTICATIONFAILED] Authentication failed.')
+        self.state = 'AUTH'
+        return 'OK', [b'Logged in']
+
+    def select(self, mailbox='INBOX', readonly=False):
+        self._command('EXAMINE' if readonly else 'SELECT', mailbox)
+        folder = self.folders.get(_unquote(mailbox))
+        if folder is None or not folder.selectable:
+            self.state, self.selected = 'AUTH', None
+            return 'NO', [b'Mailbox does not exist']
+        self.state, self.selected = 'SELECTED', folder
+        exists = str(len(folder.messages)).encode()
+        self.untagged_responses = {'EXISTS': [exists], 'UIDVALIDITY': [str(folder.uidvalidity).encode()]}
+        return 'OK', [exists]
+
+    def noop(self):
+        self._command('NOOP')
+        return 'OK', [b'NOOP completed']
+
+    def list(self, directory='""', pattern='*'):
+        self._command('LIST', directory, pattern)
+        return 'OK', [self._list_line(name) for name in self.folders]
+
+    def status(self, mailbox, items):
+        self._command('STATUS', mailbox, items)
+        name = _unquote(mailbox)
+        if name not in self.folders or not self.folders[name].selectable:
+            return 'NO', [b'Mailbox does not exist']
+        return 'OK', [self._status_line(name, items)]
+
+    def xatom(self, name, *args):
+        """LIST ... RETURN (STATUS (...)) of the LIST-STATUS extension"""
+        self._command(name, *args)
+        items = re.match(r'\(STATUS (\(.*\))\)$', args[-1]).group(1)
+        self.untagged_responses['LIST'] = [self._list_line(name) for name in self.folders]
+        self.untagged_responses['STATUS'] = [self._status_line(name, items) for name, folder in self.folders.items()
+                                             if folder.selectable]
+        return 'OK', [b'LIST completed']
+
+    def uid(self, command, *args):
+        self._command('UID', command, *args)
+        if command == self.fail:
+            return 'NO', [b'Command failed']
+        return getattr(self, f'_uid_{command.lower()}')(*args)
+
+    def _uid_search(self, charset, *criteria):
+        """UID <set>, optionally behind DELETED and NOT"""
+        criteria = list(criteria)
+        found = set(self.selected.messages)
+        negate = False
+        while criteria:
+            key = criteria.pop(0)
+            if key == 'NOT':
+                negate = True
+                continue
+            if key == 'DELETED':
+                matches = {uid for uid, message in self.selected.messages.items() if '\\Deleted' in message.flags}
+            else:
+                matches = set(expand_uids(criteria.pop(0), self.selected.messages))
+            found = found - matches if negate else found & matches
+            negate = False
+        return 'OK', [' '.join(str(uid) for uid in sorted(found)).encode()]
+
+    def _uid_store(self, uid_set, operation, flags):
+        flags = set(flags.strip('()').split())
+        for uid in expand_uids(uid_set, self.selected.messages):
+            current = self.selected.messages[uid].flags
+            self.selected.store(uid, current - flags if operation.startswith('-') else current | flags)
+        return 'OK', [None]
+
+    def _uid_copy(self, uid_set, mailbox):
+        target = self.folders.get(_unquote(mailbox))
+        if target is None:
+            return 'NO', [b'[TRYCREATE] Mailbox does not exist']
+        uids = expand_uids(uid_set, self.selected.messages)
+        copies = [target.append(self.selected.messages[uid].raw, self.selected.messages[uid].flags) for uid in uids]
+        source, copied = (','.join(map(str, found)) for found in (uids, copies))
+        self.untagged_responses['COPYUID'] = [f'{target.uidvalidity} {source} {copied}'.encode()]
+        return 'OK', [None]
+
+    def _uid_move(self, uid_set, mailbox):
+        typ, data = self._uid_copy(uid_set, mailbox)
+        if typ == 'OK':
+            self.selected.expunge(*expand_uids(uid_set, self.selected.messages))
+        return typ, data
+
+    def _uid_expunge(self, uid_set):
+        self.selected.expunge(*[uid for uid in expand_uids(uid_set, self.selected.messages)
+                                if '\\Deleted' in self.selected.messages[uid].flags])
+        return 'OK', [None]
+
+    def expunge(self):
+        self._command('EXPUNGE')
+        self.selected.expunge(*[uid for uid, message in self.selected.messages.items()
+                                if '\\Deleted' in message.flags])
+        return 'OK', [None]
+
+    def _uid_fetch(self, uid, items):
+        """BODY.PEEK[part]<offset.length> slices of one message part"""
+        section, offset, length = re.match(r'\(BODY\.PEEK\[([\d.]+)\]<(\d+)\.(\d+)>\)$', items).groups()
+        message = self.selected.messages.get(int(uid))
+        if message is None:
+            return 'OK', [None]
+        offset, length = int(offset), int(length)
+        chunk = message.parts[section][offset:offset + length]
+        line = b'1 (UID %s BODY[%s]<%d> {%d}' % (uid.encode(), section.encode(), offset, len(chunk))
+        return 'OK', [(line, chunk), b')']
+
+    def _append_to(self, mailbox, flags, messages):
+        """Store messages in a folder, reporting their UIDs in APPENDUID when the server has UIDPLUS"""
+        target = self.folders.get(_unquote(mailbox))
+        if target is None:
+            return 'NO', [b'[TRYCREATE] Mailbox does not exist']
+        flags = tuple(flags.strip('()').split()) if flags else ()
+        uids = [target.append(message, flags) for message in messages]
+        if 'UIDPLUS' in self.capabilities:
+            self.untagged_responses['APPENDUID'] = [f'{target.uidvalidity} {",".join(map(str, uids))}'.encode()]
+        return 'OK', [b'Append completed']
+
+    def append(self, mailbox, flags, date_time, message):
+        self._command('APPEND', mailbox, 1)
+        return self._append_to(mailbox, flags, [message])
+
+    def _simple_command(self, name, mailbox, announcement):
+        """MULTIAPPEND: ``literal`` answers each continuation with a message and the next announcement"""
+        messages = []
+        while announcement:
+            flags, size = re.match(r'(\(.*?\)) \{(\d+)\}$', announcement).groups()
+            data = self.literal(b'')
+            messages.append(data[:int(size)])
+            announcement = data[int(size) + 1:].decode('ascii')
+        self.literal = None
+        self._command(name, mailbox, len(messages))
+        return self._append_to(mailbox, flags, messages)
+
+    def create(self, mailbox):
+        self._command('CREATE', mailbox)
+        self.folders[_unquote(mailbox)] = FakeFolder()
+        return 'OK', [b'Create completed']
+
+    def logout(self):
+        self.commands.append(('LOGOUT',))
+        self.state = 'LOGOUT'
+        return 'BYE', [b'Logging out']
+
+
+class FakeIMAPClient:
+    """
+    imapclient.IMAPClient stand-in over in-memory FakeFolders
+
+    ``idle_responses`` holds the batches of untagged responses idle_check() returns, in order
+    (a callable batch is called first, e.g. to change a folder as the server announces it);
+    once they are used up idle_check() calls ``on_idle_exhausted`` (if set) and returns nothing.
+    """
+
+    def __init__(self, folders=None, password='secret', capabilities=(b'IMAP4REV1', b'IDLE'), idle_responses=()):
+        self.folders = folders if folders is not None else {'INBOX': FakeFolder()}
+        self.password = password
+        self._capabilities = tuple(capabilities)
+        self.idle_responses = list(idle_responses)
+        self.on_idle_exhausted = None
+        self.selected = None
+        self.commands = []
+        self.logged_out = False
+        self._imap = SimpleNamespace(untagged_responses={})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.logout()
+
+    def starttls(self, ssl_context=None):
+        pass
+
+    def login(self, username, password):
+        self.commands.append(('LOGIN', username))
+        if password != self.password:
+            raise LoginError('[AUTHENTICATIONFAILED] Authentication failed.')
+        return b'Logged in'
+
+    def capabilities(self):
+        return self._capabilities
+
+    def has_capability(self, capability):
+        return capability.upper().encode() in self._capabilities
+
+    def enable(self, *capabilities):
+        self.commands.append(('ENABLE',) + capabilities)
+        return [capability.encode() for capability in capabilities]
+
+    def list_folders(self, directory='', pattern='*'):
+        self.commands.append(('LIST',))
+        return [((folder.attributes.encode(),), b'/', name) for name, folder in self.folders.items()]
+
+    def select_folder(self, folder, readonly=False):
+        self.commands.append(('EXAMINE' if readonly else 'SELECT', folder))
+        self.selected = self.folders[folder]
+        status = self.selected.status()
+        return {b'EXISTS': status['MESSAGES'], b'UIDVALIDITY': status['UIDVALIDITY'], b'UIDNEXT': status['UIDNEXT']}
+
+    def folder_status(self, folder, what=None):
+        self.commands.append(('STATUS', folder))
+        status = self.folders[folder].status()
+        items = [item.decode() if isinstance(item, bytes) else item for item in what or ('MESSAGES', 'UNSEEN')]
+        return {item.encode(): status[item] for item in items}
+
+    def search(self, criteria):
+        self.commands.append(('SEARCH',) + tuple(criteria))
+        assert criteria[0] == 'UID', 'only UID <set> searches are supported'
+        return expand_uids(criteria[1], self.selected.messages)
+
+    def fetch(self, messages, data, modifiers=None):
+        """UID FETCH; honours CHANGEDSINCE and leaves VANISHED (EARLIER) untagged like imapclient"""
+        modifiers = list(modifiers or ())
+        self.commands.append(('FETCH', messages, tuple(data), tuple(modifiers)))
+        folder = self.selected
+        uids = expand_uids(messages, folder.messages)
+        changed_since = next((int(m.split()[1]) for m in modifiers if m.startswith('CHANGEDSINCE')), None)
+        if changed_since is not None:
+            uids = [uid for uid in uids if folder.messages[uid].modseq > changed_since]
+            if 'VANISHED' in modifiers:
+                gone = sorted(uid for uid, modseq in folder.vanished.items()
+                              if modseq > changed_since and expand_uids(messages, [uid]))
+                if gone:
+                    line = b'(EARLIER) ' + ','.join(str(uid) for uid in gone).encode()
+                    self._imap.untagged_responses.setdefault('VANISHED', []).append(line)
+        response = {}
+        for seq, uid in enumerate(uids, 1):
+            message = folder.messages[uid]
+            item = {b'SEQ': seq, b'MODSEQ': (message.modseq,)}
+            if 'FLAGS' in data:
+                item[b'FLAGS'] = tuple(flag.encode() for flag in sorted(message.flags))
+            if 'BODY.PEEK[]' in data:
+                item[b'BODY[]'] = message.raw
+            response[uid] = item
+        return response
+
+    def idle(self):
+        self.commands.append(('IDLE',))
+
+    def _next_responses(self):
+        responses = self.idle_responses.pop(0) if self.idle_responses else []
+        return responses() if callable(responses) else responses
+
+    def idle_check(self, timeout=None):
+        if not self.idle_responses and self.on_idle_exhausted:
+            self.on_idle_exhausted()
+        return self._next_responses()
+
+    def idle_done(self):
+        self.commands.append(('DONE',))
+        return b'IDLE terminated', []
+
+    def noop(self):
+        self.commands.append(('NOOP',))
+        return b'NOOP completed', self._next_responses()
+
+    def logout(self):
+        self.logged_out = True
+        return b'Logging out'
+
+    def shutdown(self):
+        self.logged_out = True
+
+
+class FakeSMTP:
+    """
+    smtplib.SMTP stand-in for one submission connection
+
+    Every command sent is recorded in ``commands`` and accepted messages in ``sent``;
+    recipients in ``rejected`` are refused with 550. Raw writes through send() (PIPELINING)
+    are answered like Postfix would, or with the scripted ``replies`` when given.
+    Set ``alive`` to False to make the next command fail like a dropped connection (or
+    ``drop_after`` to drop it once that many messages were accepted), ``rset_code`` to
+    the reply code the server answers RSET with, or ``error`` to an exception sendmail() raises.
+    """
+
+    def __init__(self, host=None, port=None, timeout=None, context=None, password='secret', error=None,
+                 extensions=('pipelining',), rejected=(), replies=None):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.error = error
+        self.extensions = extensions
+        self.rejected = set(rejected)
+        self.scripted = replies is not None
+        self.replies = list(replies or [])
+        self.commands = []
+        self.sent = []
+        self.written = []
+        self.alive = True
+        self.drop_after = None
+        self.rset_code = 250
+        self.closed = False
+        self._buffer = b''
+        self._accepted = 0
+        self._in_data = False
+
+    def _check_alive(self):
+        if self.drop_after is not None and len(self.sent) >= self.drop_after:
+            self.alive = False
+        if not self.alive:
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+
+    def _command(self, *args):
+        self._check_alive()
+        self.commands.append(args)
+
+    def _rcpt_reply(self, recipient):
+        if recipient in self.rejected:
+            return 550, f'5.1.1 <{recipient}>: Recipient address rejected: User unknown'.encode()
+        self._accepted += 1
+        return 250, b'2.1.5 Ok'
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def has_extn(self, name):
+        return name.lower() in self.extensions
+
+    def starttls(self, context=None):
+        self._command('STARTTLS')
+        return 220, b'2.0.0 Ready to start TLS'
+
+    def login(self, user, password):
+        self._command('AUTH', user)
+        if password != self.password:
+            raise smtplib.SMTPAuthenticationError(535, b'5.7.8 Error: authentication failed')
+        return 235, b'2.7.0 Authentication successful'
+
+    def noop(self):
+        self._command('NOOP')
+        return 250, b'2.0.0 Ok'
+
+    def rset(self):
+        self._command('RSET')
+        self._accepted = 0
+        return self.rset_code, b'2.0.0 Ok' if self.rset_code == 250 else b'4.4.2 Error: timeout exceeded'
+
+    def sendmail(self, from_addr, to_addrs, msg, mail_options=(), rcpt_options=()):
+        self._command('SENDMAIL', from_addr, tuple(to_addrs))
+        if self.error:
+            raise self.error
+        refused = {recipient: reply for recipient in to_addrs
+                   for reply in [self._rcpt_reply(recipient)] if reply[0] != 250}
+        self._accepted = 0
+        if len(refused) == len(to_addrs):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        self.sent.append(msg)
+        return refused
+
+    def send(self, data):
+        self._check_alive()
+        self.written.append(data)
+        if not self.scripted:
+            self._buffer += data
+            self._serve()
+
+    def _serve(self):
+        """Answer the complete commands and messages written so far"""
+        while True:
+            if self._in_data:
+                end = self._buffer.find(b'\r\n.\r\n')
+                if end < 0:
+                    return
+                self.sent.append(re.sub(rb'(?m)^\.\.', b'.', self._buffer[:end + 2]))
+                self._buffer = self._buffer[end + 5:]
+                self._in_data = False
+                self.replies.append((250, b'2.0.0 Ok: queued'))
+                continue
+            line, found, self._buffer = self._buffer.partition(b'\r\n')
+            if not found:
+                self._buffer = line
+                return
+            name, _, argument = line.decode('ascii').partition(':')
+            address = argument.strip('<>')
+            self.commands.append((name, address) if argument else (name,))
+            if name == 'MAIL FROM':
+                self._accepted = 0
+                self.replies.append((250, b'2.1.0 Ok'))
+            elif name == 'RCPT TO':
+                self.replies.append(self._rcpt_reply(address))
+            elif self._accepted:
+                self._in_data = True
+                self.replies.append((354, b'End data with <CR><LF>.<CR><LF>'))
+            else:
+                self.replies.append((554, b'5.5.1 Error: no valid recipients'))
+
+    def getreply(self):
+        self._check_alive()
+        return self.replies.pop(0)
+
+    def quit(self):
+        self._command('QUIT')
+        self.closed = True
+        return 221, b'2.0.0 Bye'
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSMTPPool:
+    """
+    smtp_pool stand-in lending a new FakeSMTP per session (or the next one of ``pending``)
+
+    Connections' sendmail() raises ``error`` if set; returned connections are recorded in
+    ``released`` and ``discarded``.
+    """
+
+    def __init__(self, error=None, pending=()):
+        self.error = error
+        self.pending = list(pending)
+        self.passwords = []
+        self.connections = []
+        self.released = []
+        self.discarded = []
+
+    def acquire(self, username, password):
+        self.passwords.append(password)
+        conn = self.pending.pop(0) if self.pending else FakeSMTP(password=password, error=self.error)
+        self.connections.append(conn)
+        return conn
+
+    def release(self, conn):
+        self.released.append(conn)
+
+    def discard(self, conn):
+        self.discarded.append(conn)
+
+    @contextmanager
+    def session(self, username, password):
+        conn = self.acquire(username, password)
+        yield conn
+        self.release(conn)
@@ -1,3 +1,3001 @@
-from django.test import TestCase
+import base64
+import contextlib
+import imaplib
+import io
+import json
+import os
+import quopri
+import re
+import smtplib
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter
+from datetime import timedelta
+from importlib import import_module
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from cryptography.fernet import Fernet
+from django.conf import settings
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.core.cache import cache as django_cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail import EmailMessage as DjangoEmailMessage, get_connection
+from django.core.management import CommandError, call_command
+from django.template import TemplateSyntaxError
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from imapclient.response_parser import parse_fetch_response
+
+from mail.message_parser import parse_message
+from mail.models import (
+    BODY_COMPRESS_MIN, BODY_RAW, BODY_ZLIB, AccountSyncState, Contact, Domain, EmailAccount, EmailFolder, EmailMessage,
+    EmailMessageBody, EmailTemplate, FolderSyncState, MailboxPushState, MailMergeJob, MessageLocation, OutboxMessage,
+    RateLimitBucket, compress_body, decompress_body,
+)
+from mail.services import (
+    DjangoEmailService, IMAPConnectionError, credentials, folder_status, idle_watcher, imap_actions, imap_fetch,
+    imap_pool, ingest_pipeline, mail_merge, outbox, rate_limit, sync_engine, sync_scheduler,
+)
+from mail.services.message_cache import ParsedMessageCache
+from mail.services.message_locations import apply_action_results, locate
+from mail.services.imap_append import append_messages
+from mail.services.imap_pool import IMAPFolderError, IMAPPoolExhausted, IMAPSessionPool, PooledIMAP4_SSL
+from mail.services.imap_stream import PartReader, parse_range_header
+from mail.services.message_search import search_messages, update_search_vectors
+from mail.services.raw_store import RawMessageStore, raw_store
+from mail.services.smtp_pool import SMTPPoolExhausted, SMTPSessionPool
+from mail.services.ingest_hooks import extract_contacts
+from mail.testing import (
+    FakeFolder, FakeIMAP, FakeIMAPClient, FakeMessage, FakeSMTP, FakeSMTPPool, create_account, make_raw_message,
+    with_credential_key,
+)
+
+
+# multipart/mixed: (text/plain + quoted-printable text/html), a PDF attachment and an inline image
+BODYSTRUCTURE = (
+    b'((("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 43 1 NIL NIL NIL NIL)'
+    b'("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "QUOTED-PRINTABLE" 80 2 NIL NIL NIL NIL)'
+    b' "ALTERNATIVE" ("BOUNDARY" "b2") NIL NIL NIL)'
+    b'("APPLICATION" "PDF" ("NAME" "report.pdf") NIL NIL "BASE64" 7800 NIL ("ATTACHMENT" ("FILENAME" "report.pdf")) NIL NIL)'
+    b'("IMAGE" "PNG" NIL "<logo@example.org>" NIL "BASE64" 780 NIL ("INLINE" NIL) NIL NIL)'
+    b' "MIXED" ("BOUNDARY" "b1") NIL NIL NIL)'
+)
+
+ENVELOPE = (
+    b'("Tue, 14 Oct 2025 10:00:00 +0000" "=?utf-8?q?Caf=C3=A9?=" (("Ada Lovelace" NIL "ada" "example.org")) NIL NIL'
+    b' (("Bob" NIL "bob" "example.com")) (("Cy" NIL "cy" "example.com")) NIL NIL "<m1@example.org>")'
+)
+
+# BODY[1] of the message above starts with the nested multipart's boundary and part headers
+PEEK = b'--b2\r\nContent-Type: text/plain; charset=utf-8\r\n\r\nHello   world,\r\nthis is the body.\r\n--b2'
+
+
+def fetch_data(seq, items, literal=None):
+    """Raw imaplib FETCH response for one message; ``items`` ends with the literal's {size} when there is one"""
+    line = b'%d (%s' % (seq, items)
+    if literal is None:
+        return [line + b')']
+    return [(line + b' {%d}' % len(literal), literal), b')']
+
+
+def parse_structure(structure=BODYSTRUCTURE):
+    return parse_fetch_response(fetch_data(1, b'BODYSTRUCTURE ' + structure), uid_is_key=False)[1][b'BODYSTRUCTURE']
+
+
+class IMAPPoolTests(TestCase):
+    """Pooled IMAP sessions: reuse per account and password, expiry and health checks"""
+
+    def setUp(self):
+        self.now = 1000.0
+        self.opened = []
+        patcher = mock.patch('mail.services.imap_pool.PooledIMAP4_SSL', side_effect=self.open_connection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('mail.services.imap_pool.resolve_imap_host', return_value='imap.example.com')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('mail.services.imap_pool.time')
+        patcher.start().monotonic.side_effect = lambda: self.now
+        self.addCleanup(patcher.stop)
+        self.password = 'secret'
+        self.pool = IMAPSessionPool(max_size=4, max_per_account=2, idle_timeout=300, noop_interval=30)
+
+    def open_connection(self, host, port, timeout=None):
+        conn = FakeIMAP(host, port, timeout, folders={'INBOX': FakeFolder(), 'Archive': FakeFolder()},
+                        password=self.password)
+        self.opened.append(conn)
+        return conn
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def test_session_is_reused(self):
+        conn = self.pool.acquire('ada@example.com', 'secret')
+        self.pool.release(conn)
+        self.assertIs(self.pool.acquire('ADA@example.com', 'secret'), conn)
+        self.assertEqual(len(self.opened), 1)
+        self.assertEqual(conn.commands, [('LOGIN', 'ada@example.com')])
+
+    def test_leased_session_is_not_shared(self):
+        first = self.pool.acquire('ada@example.com', 'secret')
+        second = self.pool.acquire('ada@example.com', 'secret')
+        self.assertIsNot(first, second)
+
+    def test_sessions_are_keyed_by_password(self):
+        conn = self.pool.acquire('ada@example.com', 'secret')
+        self.pool.release(conn)
+        with self.assertRaises(IMAPConnectionError):
+            self.pool.acquire('ada@example.com', 'wrong')
+        # The failed session is logged out, the pooled one is kept for the right password
+        self.assertEqual(self.opened[1].commands, [('LOGIN', 'ada@example.com'), ('LOGOUT',)])
+        self.assertIs(self.pool.acquire('ada@example.com', 'secret'), conn)
+
+    def test_acquire_selects_folder(self):
+        conn = self.pool.acquire('ada@example.com', 'secret', folder='Archive')
+        self.assertEqual(conn.commands[-1], ('SELECT', 'Archive'))
+
+    def test_idle_session_expires(self):
+        conn = self.pool.acquire('ada@example.com', 'secret')
+        self.pool.release(conn)
+        self.now += 301
+        self.assertIsNot(self.pool.acquire('ada@example.com', 'secret'), conn)
+        self.assertEqual(conn.commands[-1], ('LOGOUT',))
+
+    def test_long_idle_session_is_checked_with_noop(self):
+        conn = self.pool.acquire('ada@example.com', 'secret')
+        self.pool.release(conn)
+        self.now += 10
+        self.assertIs(self.pool.acquire('ada@example.com', 'secret'), conn)
+        self.assertNotIn(('NOOP',), conn.commands)
+        self.pool.release(conn)
+        self.now += 60
+        self.assertIs(self.pool.acquire('ada@example.com', 'secret'), conn)
+        self.assertEqual(conn.commands[-1], ('NOOP',))
+
+    def test_dead_session_is_replaced(self):
+        conn = self.pool.acquire('ada@example.com', 'secret')
+        self.pool.release(conn)
+        conn.alive = False
+        self.now += 60
+        self.assertIsNot(self.pool.acquire('ada@example.com', 'secret'), conn)
+        self.assertEqual(len(self.opened), 2)
+
+    def test_max_per_account_counts_leased_sessions(self):
+        for _ in range(2):
+            self.pool.acquire('ada@example.com', 'secret')
+        with mock.patch.object(self.pool._freed, 'wait', side_effect=self.advance):
+            with self.assertRaises(IMAPPoolExhausted):
+                self.pool.acquire('ada@example.com', 'secret')
+        self.assertEqual(len(self.opened), 2)
+        self.assertIsNotNone(self.pool.acquire('bob@example.com', 'secret'))
+
+    def test_acquire_waits_for_a_released_session(self):
+        sessions = [self.pool.acquire('ada@example.com', 'secret') for _ in range(2)]
+        acquired = []
+        waiter = threading.Thread(target=lambda: acquired.append(self.pool.acquire('ada@example.com', 'secret')))
+        waiter.start()
+        self.pool.release(sessions[0])
+        waiter.join(5)
+        self.assertEqual(acquired, [sessions[0]])
+        self.assertEqual(len(self.opened), 2)
+
+    def test_full_pool_closes_least_recently_used_idle_session(self):
+        for index in range(4):
+            self.now += 1
+            self.pool.release(self.pool.acquire(f'user{index}@example.com', 'secret'))
+        self.pool.acquire('ada@example.com', 'secret')
+        self.assertEqual(self.opened[0].commands[-1], ('LOGOUT',))
+        self.assertEqual([conn.commands[-1] for conn in self.opened[1:4]], [('LOGIN', f'user{index}@example.com')
+                                                                          for index in range(1, 4)])
+        self.assertEqual(self.pool._open_count, 4)
+
+    def test_idle_session_of_an_old_password_gives_way(self):
+        sessions = [self.pool.acquire('ada@example.com', 'secret') for _ in range(2)]
+        for conn in sessions:
+            self.pool.release(conn)
+        self.password = 'changed'
+        self.pool.acquire('ada@example.com', 'changed')
+        self.assertEqual(sessions[0].commands[-1], ('LOGOUT',))
+        self.assertEqual(self.pool._per_account['ada@example.com'], 2)
+
+    def test_failed_login_frees_its_slot(self):
+        for _ in range(3):
+            with self.assertRaises(IMAPConnectionError):
+                self.pool.acquire('ada@example.com', 'wrong')
+        self.assertEqual((self.pool._open_count, dict(self.pool._per_account)), (0, {}))
+
+    def test_select_error_discards_session(self):
+        with mock.patch.object(FakeIMAP, 'select', side_effect=imaplib.IMAP4.abort('socket error: EOF')):
+            with self.assertRaises(imaplib.IMAP4.abort):
+                self.pool.acquire('ada@example.com', 'secret', folder='Archive')
+        self.assertEqual(self.opened[0].commands[-1], ('LOGOUT',))
+        self.assertEqual(self.pool._open_count, 0)
+
+    def test_missing_folder_returns_session_to_pool(self):
+        with self.assertRaises(IMAPFolderError):
+            self.pool.acquire('ada@example.com', 'secret', folder='Missing')
+        self.assertEqual(self.pool._open_count, 1)
+        conn = self.pool.acquire('ada@example.com', 'secret', folder='Archive')
+        self.assertIs(conn, self.opened[0])
+        self.assertEqual(conn.commands[-1], ('SELECT', 'Archive'))
+
+    def test_session_discards_connection_on_connection_error(self):
+        for error in (imaplib.IMAP4.abort('socket error: EOF'), OSError('Connection reset')):
+            with self.assertRaises(type(error)):
+                with self.pool.session('ada@example.com', 'secret') as conn:
+                    raise error
+            self.assertEqual(conn.commands[-1], ('LOGOUT',))
+            self.assertEqual(self.pool._open_count, 0)
+
+    def test_session_is_released_after_command_error(self):
+        for error in (imaplib.IMAP4.error('UID STORE failed'), ValueError('parse error')):
+            with self.assertRaises(type(error)):
+                with self.pool.session('ada@example.com', 'secret') as conn:
+                    raise error
+            self.assertIs(self.pool.acquire('ada@example.com', 'secret'), conn)
+            self.pool.release(conn)
+        self.assertEqual(len(self.opened), 1)
+
+    def test_close_account(self):
+        mine = self.pool.acquire('ada@example.com', 'secret')
+        theirs = self.pool.acquire('bob@example.com', 'secret')
+        self.pool.release(mine)
+        self.pool.release(theirs)
+        self.pool.close_account('Ada@example.com')
+        self.assertEqual(mine.commands[-1], ('LOGOUT',))
+        self.assertIs(self.pool.acquire('bob@example.com', 'secret'), theirs)
+
+
+class PooledSelectTests(TestCase):
+    """PooledIMAP4_SSL skips SELECT when the folder is already selected"""
+
+    def setUp(self):
+        self.conn = PooledIMAP4_SSL.__new__(PooledIMAP4_SSL)
+        self.conn.debug = 0
+        self.conn.state = 'AUTH'
+        self.conn.untagged_responses = {}
+        patcher = mock.patch.object(imaplib.IMAP4, 'select', autospec=True, side_effect=self.server_select)
+        self.server = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(imaplib.IMAP4, 'noop', autospec=True, return_value=('OK', [b'NOOP completed']))
+        self.noop = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def server_select(conn, mailbox='INBOX', readonly=False):
+        if mailbox == 'Missing':
+            conn.state = 'AUTH'
+            return 'NO', [b'Mailbox does not exist']
+        conn.state = 'SELECTED'
+        conn.untagged_responses = {'EXISTS': [b'3'], 'UIDVALIDITY': [b'7']}
+        return 'OK', [b'3']
+
+    def test_same_folder_is_selected_once(self):
+        self.assertEqual(self.conn.select('INBOX'), ('OK', [b'3']))
+        self.assertEqual(self.conn.select('INBOX'), ('OK', [b'3']))
+        # The NOOP sent instead of SELECT delivers new mail
+        self.noop.side_effect = lambda conn: conn.untagged_responses.update(EXISTS=[b'4']) or ('OK', [None])
+        self.assertEqual(self.conn.select('INBOX'), ('OK', [b'4']))
+        self.assertEqual(self.server.call_count, 1)
+        self.assertEqual(self.noop.call_count, 2)
+
+    def test_expunge_by_another_client_selects_again(self):
+        self.conn.select('INBOX')
+        self.noop.side_effect = lambda conn: conn.untagged_responses.update(EXPUNGE=[b'2']) or ('OK', [None])
+        self.conn.select('INBOX')
+        self.assertEqual(self.server.call_count, 2)
+
+    def test_own_expunge_selects_again(self):
+        self.conn.select('INBOX')
+        with mock.patch.object(imaplib.IMAP4, 'expunge', return_value=('OK', [None])):
+            self.conn.expunge()
+        self.conn.select('INBOX')
+        self.assertEqual(self.server.call_count, 2)
+
+    def test_other_folder_is_selected(self):
+        self.conn.select('INBOX')
+        self.conn.select('Archive')
+        self.conn.select('INBOX')
+        self.assertEqual([call.args[1] for call in self.server.call_args_list], ['INBOX', 'Archive', 'INBOX'])
+
+    def test_uidvalidity_of_selected_folder(self):
+        self.conn.select('INBOX')
+        self.assertEqual(self.conn.uidvalidity, 7)
+        self.conn.select('Missing')
+        self.assertIsNone(self.conn.uidvalidity)
+
+    def test_readonly_select_is_not_remembered(self):
+        self.conn.select('INBOX', readonly=True)
+        self.conn.select('INBOX')
+        self.assertEqual(self.server.call_count, 2)
+
+    def test_failed_select_is_not_remembered(self):
+        self.conn.select('INBOX')
+        self.assertEqual(self.conn.select('Missing')[0], 'NO')
+        self.conn.select('INBOX')
+        self.assertEqual(self.server.call_count, 3)
+
+
+class MessageSummaryTests(TestCase):
+    """Header-only list FETCH: ENVELOPE, BODYSTRUCTURE and BODY[1] peek into list rows"""
+
+    def summarize(self, flags=b'\\Seen', structure=BODYSTRUCTURE, peek=PEEK):
+        items = b'UID 11 FLAGS (%s) ENVELOPE %s RFC822.SIZE 2048 BODYSTRUCTURE %s BODY[1]<0>' % (flags, ENVELOPE, structure)
+        data = parse_fetch_response(fetch_data(1, items, peek), normalise_times=False, uid_is_key=False)[1]
+        return imap_fetch.summarize_message(data)
+
+    def test_envelope_fields(self):
+        summary = self.summarize()
+        self.assertEqual(summary['uid'], 11)
+        self.assertEqual(summary['message_id'], '<m1@example.org>')
+        self.assertEqual(summary['subject'], 'Café')
+        self.assertEqual(summary['sender'], 'ada@example.org')
+        self.assertEqual(summary['from_display'], 'Ada Lovelace <ada@example.org>')
+        self.assertEqual(summary['to_recipients'], ['bob@example.com'])
+        self.assertEqual(summary['cc_recipients'], ['cy@example.com'])
+        self.assertEqual(summary['date_received'], '2025-10-14T10:00:00+00:00')
+        self.assertEqual(summary['size_bytes'], 2048)
+
+    def test_flags(self):
+        summary = self.summarize(flags=b'\\Flagged')
+        self.assertEqual((summary['is_read'], summary['is_starred']), (False, True))
+
+    def test_attachments_from_bodystructure(self):
+        self.assertTrue(self.summarize()['has_attachments'])
+        plain = b'("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 43 1 NIL NIL NIL NIL)'
+        self.assertFalse(self.summarize(structure=plain, peek=b'Hi')['has_attachments'])
+
+    def test_snippet_skips_nested_part_headers(self):
+        self.assertEqual(self.summarize()['snippet'], 'Hello world, this is the body.')
+
+    def test_snippet_of_html_and_base64_parts(self):
+        html = b'("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "7BIT" 90 2 NIL NIL NIL NIL)'
+        peek = b'<html><style>p {color: red}</style><p>Hi <b>there</b></p>'
+        self.assertEqual(self.summarize(structure=html, peek=peek)['snippet'], 'Hi there')
+        base64_text = b'("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "BASE64" 90 2 NIL NIL NIL NIL)'
+        # A peek cut in the middle of a base64 quantum still decodes
+        self.assertEqual(self.summarize(structure=base64_text, peek=b'SGVsbG8gdGhlcmU=\r\nSGk')['snippet'], 'Hello there')
+
+    def test_non_text_first_part_has_no_snippet(self):
+        pdf = b'("APPLICATION" "PDF" NIL NIL NIL "BASE64" 7800 NIL NIL NIL)'
+        self.assertEqual(self.summarize(structure=pdf, peek=b'JVBERi0xLjQK')['snippet'], '')
+
+    def test_fetch_summaries_uses_one_fetch(self):
+        conn = mock.Mock()
+        items = b'UID 11 FLAGS () ENVELOPE %s RFC822.SIZE 2048 BODYSTRUCTURE %s BODY[1]<0>' % (ENVELOPE, BODYSTRUCTURE)
+        conn.fetch.return_value = ('OK', fetch_data(51, items, PEEK) + fetch_data(52, items.replace(b'UID 11', b'UID 12'), PEEK))
+        summaries = imap_fetch.fetch_summaries(conn, '51:52')
+        conn.fetch.assert_called_once_with('51:52', imap_fetch.SUMMARY_FETCH_ITEMS)
+        self.assertEqual({seq: summary['uid'] for seq, summary in summaries.items()}, {51: 11, 52: 12})
+
+
+class MessageRefTests(TestCase):
+    """UIDVALIDITY-tagged message references"""
+
+    def test_make_message_ref(self):
+        self.assertEqual(imap_fetch.make_message_ref(1700000000, 42), '1700000000:42')
+        self.assertEqual(imap_fetch.make_message_ref(None, 42), '42')
+
+    def test_parse_message_ref(self):
+        self.assertEqual(imap_fetch.parse_message_ref('1700000000:42'), (1700000000, 42))
+        self.assertEqual(imap_fetch.parse_message_ref(' 42 '), (None, 42))
+        self.assertEqual(imap_fetch.parse_message_ref(42), (None, 42))
+        for ref in ('', 'abc', '1:x', ':42'):
+            with self.assertRaises(ValueError):
+                imap_fetch.parse_message_ref(ref)
+
+    def test_resolve_uid(self):
+        conn = mock.Mock(uidvalidity=1700000000)
+        self.assertEqual(imap_fetch.resolve_uid(conn, '1700000000:42'), '42')
+        # Bare UIDs (old clients) are taken as they are
+        self.assertEqual(imap_fetch.resolve_uid(conn, '42'), '42')
+
+    def test_resolve_uid_rejects_stale_ref(self):
+        conn = mock.Mock(uidvalidity=1800000000)
+        with self.assertRaises(imap_fetch.StaleMessageRef):
+            imap_fetch.resolve_uid(conn, '1700000000:42')
+
+    def test_resolve_uid_without_known_uidvalidity(self):
+        conn = mock.Mock(uidvalidity=None)
+        self.assertEqual(imap_fetch.resolve_uid(conn, '1700000000:42'), '42')
+
+
+class FolderStatusTests(TestCase):
+    """Folder counters from LIST-STATUS (or LIST + STATUS)"""
+
+    def connect(self, capabilities=('IMAP4REV1', 'LIST-STATUS', 'CONDSTORE')):
+        return FakeIMAP(capabilities=capabilities, folders={
+            'INBOX': FakeFolder.with_counts(10, unseen=2, highestmodseq=77),
+            'Sent Items': FakeFolder.with_counts(4, attributes='\\HasNoChildren \\Sent', highestmodseq=5),
+            'Archive': FakeFolder.with_counts(1, unseen=1, attributes='\\HasChildren', highestmodseq=9),
+            'Entw&APw-rfe': FakeFolder.with_counts(3, unseen=3, highestmodseq=2),
+            '[Gmail]': FakeFolder(attributes='\\Noselect \\HasChildren'),
+        })
+
+    def check_folders(self, folders):
+        names = [folder['name'] for folder in folders]
+        # Defaults first in a fixed order (placeholders when missing), then custom folders by display name
+        self.assertEqual(names, ['INBOX', 'Sent', 'Drafts', 'Trash', 'Spam', 'Archive', 'Entw&APw-rfe', 'Sent Items'])
+        by_name = {folder['name']: folder for folder in folders}
+        self.assertEqual(by_name['INBOX'], {'name': 'INBOX', 'display_name': 'INBOX', 'type': 'inbox',
+                                            'total': 10, 'unseen': 2, 'highestmodseq': 77})
+        self.assertEqual(by_name['Sent']['total'], 0)
+        self.assertEqual(by_name['Sent Items']['type'], 'sent')
+        self.assertEqual(by_name['Entw&APw-rfe']['display_name'], 'Entwürfe')
+        self.assertEqual((by_name['Archive']['type'], by_name['Archive']['unseen']), ('other', 1))
+
+    def test_list_status_in_one_command(self):
+        conn = self.connect()
+        self.check_folders(folder_status.list_folder_status(conn))
+        self.assertEqual(conn.commands, [('LIST', '""', '*', 'RETURN', '(STATUS (MESSAGES UNSEEN HIGHESTMODSEQ))')])
+
+    def test_status_per_folder_without_list_status(self):
+        conn = self.connect(capabilities=('IMAP4REV1', 'CONDSTORE'))
+        self.check_folders(folder_status.list_folder_status(conn))
+        self.assertEqual(conn.commands[0], ('LIST', '""', '*'))
+        self.assertEqual(len(conn.commands), 5)  # \Noselect folders get no STATUS
+        self.assertIn(('STATUS', '"Sent Items"', '(MESSAGES UNSEEN HIGHESTMODSEQ)'), conn.commands)
+
+    def test_get_folder_status(self):
+        conn = self.connect(capabilities=('IMAP4REV1',))
+        folder = folder_status.get_folder_status(conn, 'Sent Items')
+        self.assertEqual((folder['total'], folder['unseen'], folder['type']), (4, 0, 'other'))
+        self.assertEqual(conn.commands, [('STATUS', '"Sent Items"', '(MESSAGES UNSEEN)')])
+        self.assertIsNone(folder_status.get_folder_status(conn, 'Missing'))
+
+    def test_quote_mailbox(self):
+        self.assertEqual(folder_status.quote_mailbox('INBOX'), 'INBOX')
+        self.assertEqual(folder_status.quote_mailbox('Sent Items'), '"Sent Items"')
+        self.assertEqual(folder_status.quote_mailbox('a"b\\c'), '"a\\"b\\\\c"')
+        self.assertEqual(folder_status.quote_mailbox('"Quoted"'), '"Quoted"')
+
+    def test_cached_counters(self):
+        folder_status.invalidate_folder_status('User@Example.com')
+        folder_status.update_cached_folder('user@example.com', {'name': 'INBOX', 'total': 1, 'unseen': 1})
+        self.assertIsNone(folder_status.get_cached_folder_status('user@example.com'))
+
+        folders = folder_status.list_folder_status(self.connect())
+        folder_status.set_cached_folder_status('User@Example.com', folders)
+        folder_status.update_cached_folder('user@example.com', {'name': 'INBOX', 'display_name': 'x', 'total': 11, 'unseen': 3})
+        inbox = folder_status.get_cached_folder_status('user@example.com')[0]
+        self.assertEqual((inbox['display_name'], inbox['total'], inbox['unseen']), ('INBOX', 11, 3))
+        folder_status.invalidate_folder_status('user@example.com')
+        self.assertIsNone(folder_status.get_cached_folder_status('User@Example.com'))
+
+
+class IdleHubTests(TransactionTestCase):
+    """Long-poll side of the push channel: versions, events and the watcher lease shared between processes"""
+
+    def setUp(self):
+        self.hub = idle_watcher.IdleHub(max_watchers=1, linger=120, lease=90)
+        patcher = mock.patch.object(idle_watcher.MailboxWatcher, 'start')
+        self.start = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_subscribe_starts_one_watcher_per_account(self):
+        self.assertTrue(self.hub.subscribe('Ada@example.com', 'secret'))
+        self.assertEqual(self.start.call_count, 1)
+        # Watcher limit reached for another account
+        self.assertFalse(self.hub.subscribe('bob@example.com', 'secret'))
+
+    def test_wait_returns_newer_events(self):
+        self.hub.subscribe('ada@example.com', 'secret')
+        self.hub.publish('ada@example.com', None, 10, 2)
+        first = self.hub.wait_for_events('ada@example.com', timeout=0)
+        self.assertEqual((first['version'], first['total_count'], first['unread_count']), (1, 10, 2))
+        self.assertEqual(first['events'], [])
+
+        self.hub.publish('ada@example.com', 'new_mail', 11, 3, new_count=1)
+        result = self.hub.wait_for_events('ada@example.com', since=first['version'], timeout=0)
+        self.assertEqual(result['version'], 2)
+        self.assertEqual([(event['type'], event['new_count']) for event in result['events']], [('new_mail', 1)])
+
+    def test_wait_times_out_without_events(self):
+        self.hub.subscribe('ada@example.com', 'secret')
+        self.hub.publish('ada@example.com', None, 10, 2)
+        result = self.hub.wait_for_events('ada@example.com', since=1, timeout=0.01)
+        self.assertEqual((result['version'], result['events'], result['error']), (1, [], None))
+
+    def test_publish_wakes_waiting_client(self):
+        self.hub.subscribe('ada@example.com', 'secret')
+        self.hub.poll_interval = 5
+
+        def publish():
+            self.hub.publish('ada@example.com', 'flags', 10, 1)
+            connection.close()
+
+        timer = threading.Timer(0.05, publish)
+        timer.start()
+        started = time.monotonic()
+        result = self.hub.wait_for_events('ada@example.com', since=0, timeout=5)
+        timer.join()
+        self.assertEqual([event['type'] for event in result['events']], ['flags'])
+        self.assertLess(time.monotonic() - started, 4)
+
+    def test_wait_sees_events_published_by_another_process(self):
+        self.hub.subscribe('ada@example.com', 'secret')
+        other = idle_watcher.IdleHub()
+        other.publish('ada@example.com', 'new_mail', 3, 1, new_count=1)
+        result = self.hub.wait_for_events('ada@example.com', since=0, timeout=0)
+        self.assertEqual([event['type'] for event in result['events']], ['new_mail'])
+
+    def test_lease_held_by_another_process(self):
+        MailboxPushState.objects.create(email='ada@example.com', watcher='mx2:42', watcher_heartbeat=timezone.now())
+        self.assertTrue(self.hub.subscribe('ada@example.com', 'secret'))
+        self.start.assert_not_called()
+        state = MailboxPushState.objects.get()
+        self.assertEqual(state.watcher, 'mx2:42')
+        self.assertIsNotNone(state.last_polled)
+
+    def test_stale_lease_is_taken_over(self):
+        MailboxPushState.objects.create(email='ada@example.com', watcher='mx2:42',
+                                        watcher_heartbeat=timezone.now() - timedelta(seconds=91))
+        self.assertTrue(self.hub.subscribe('ada@example.com', 'secret'))
+        self.assertEqual(self.start.call_count, 1)
+        self.assertEqual(MailboxPushState.objects.get().watcher, self.hub.owner)
+
+    def test_refused_password_waits_for_backoff_or_a_new_password(self):
+        self.hub.subscribe('ada@example.com', 'wrong')
+        watcher = self.hub._watchers['ada@example.com']
+        self.hub.fail(watcher, 'Authentication failed')
+        self.hub.detach(watcher)
+
+        # Polls with the refused password get the error instead of another login
+        self.assertTrue(self.hub.subscribe('ada@example.com', 'wrong'))
+        self.assertEqual(self.start.call_count, 1)
+        self.assertEqual(self.hub.wait_for_events('ada@example.com', timeout=0)['error'], 'Authentication failed')
+
+        MailboxPushState.objects.update(failed_at=timezone.now() - timedelta(seconds=301))
+        self.hub.subscribe('ada@example.com', 'wrong')
+        self.assertEqual(self.start.call_count, 2)
+        state = MailboxPushState.objects.get()
+        self.assertEqual((state.error, state.failed_digest, state.failed_at), ('', '', None))
+
+    def test_new_password_is_tried_at_once(self):
+        self.hub.subscribe('ada@example.com', 'wrong')
+        self.hub.fail(self.hub._watchers['ada@example.com'], 'Authentication failed')
+        self.hub.detach(self.hub._watchers['ada@example.com'])
+        self.hub.subscribe('ada@example.com', 'secret')
+        self.assertEqual(self.start.call_count, 2)
+        self.assertIsNone(self.hub.wait_for_events('ada@example.com', timeout=0)['error'])
+
+    def test_watcher_gives_up_a_lost_lease(self):
+        self.hub.subscribe('ada@example.com', 'secret')
+        watcher = self.hub._watchers['ada@example.com']
+        self.assertTrue(self.hub.wanted(watcher))
+        MailboxPushState.objects.update(watcher='mx2:42')
+        self.assertFalse(self.hub.wanted(watcher))
+        self.hub.detach(watcher)
+        self.assertEqual(MailboxPushState.objects.get().watcher, 'mx2:42')
+
+    def test_unknown_account(self):
+        self.assertIsNone(self.hub.wait_for_events('nobody@example.com', timeout=0))
+
+
+class MailboxWatcherTests(TestCase):
+    """IDLE responses turned into push events"""
+
+    def setUp(self):
+        self.hub = idle_watcher.IdleHub(check_interval=0)
+        with mock.patch.object(idle_watcher.MailboxWatcher, 'start'):
+            self.hub.subscribe('ada@example.com', 'secret')
+        self.watcher = self.hub._watchers['ada@example.com']
+        self.inbox = FakeFolder.with_counts(2)
+        self.client = FakeIMAPClient(folders={'INBOX': self.inbox})
+        self.client.on_idle_exhausted = self.watcher.stop
+        # Watchers close their thread's database connection, which here is the test's
+        patcher = mock.patch.object(idle_watcher, 'connection')
+        self.connection = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def watch(self):
+        self.watcher._watch(self.client)
+        return self.hub.wait_for_events('ada@example.com', since=0, timeout=0)
+
+    def test_new_mail_and_flag_changes(self):
+        def deliver():
+            self.inbox.messages[3] = FakeMessage()
+            return [(3, b'EXISTS')]
+
+        self.client.idle_responses = [deliver, [(1, b'FETCH', (b'FLAGS', ()))]]
+        result = self.watch()
+        self.assertEqual([(event['type'], event['total_count'], event['unread_count']) for event in result['events']],
+                         [('new_mail', 3, 1), ('flags', 3, 1)])
+        self.assertEqual(result['events'][0]['new_count'], 1)
+        self.assertEqual(self.client.commands[0], ('EXAMINE', 'INBOX'))
+
+    def test_unrelated_responses_are_ignored(self):
+        self.client.idle_responses = [[(b'OK', b'Still here')]]
+        result = self.watch()
+        self.assertEqual(result['events'], [])
+        self.assertEqual(result['total_count'], 2)
+
+    def test_noop_polling_without_idle(self):
+        self.client = FakeIMAPClient(folders={'INBOX': self.inbox}, capabilities=(b'IMAP4REV1',))
+        self.hub.noop_interval = 0
+
+        def expunge():
+            del self.inbox.messages[1]
+            self.watcher.stop()
+            return [(1, b'EXPUNGE')]
+
+        self.client.idle_responses = [expunge]
+        result = self.watch()
+        self.assertEqual([(event['type'], event['total_count']) for event in result['events']], [('expunge', 1)])
+        self.assertNotIn(('IDLE',), self.client.commands)
+
+    def test_database_connection_closed_after_each_write(self):
+        calls = []
+        wanted = iter([True, True, False])
+        self.connection.close.side_effect = lambda: calls.append('close')
+        self.hub.wanted = mock.Mock(side_effect=lambda watcher: calls.append('wanted') or next(wanted))
+        self.hub.publish = mock.Mock(side_effect=lambda *args, **kwargs: calls.append('publish'))
+        self.client.idle_responses = [[(1, b'FETCH', (b'FLAGS', ()))]]
+        self.watcher._watch(self.client)
+        self.assertEqual(calls, ['publish', 'close', 'wanted', 'close', 'wanted', 'close', 'publish', 'close',
+                                 'wanted', 'close'])
+
+    def test_login_failure_is_reported(self):
+        with mock.patch.object(idle_watcher.MailboxWatcher, '_connect',
+                               side_effect=idle_watcher.LoginError('Authentication failed')):
+            self.watcher.run()
+        self.assertEqual(self.hub.wait_for_events('ada@example.com', since=0, timeout=0)['error'],
+                         'Authentication failed')
+        self.assertNotIn('ada@example.com', self.hub._watchers)
+        with mock.patch.object(idle_watcher.MailboxWatcher, 'start') as start:
+            self.hub.subscribe('ada@example.com', 'secret')
+        start.assert_not_called()
+
+
+class MailboxWatcherThreadTests(TransactionTestCase):
+    """A watcher on its own thread, as in production: it only sees committed rows"""
+
+    def test_events_reach_clients_without_holding_a_database_connection(self):
+        hub = idle_watcher.IdleHub(check_interval=0)
+        inbox = FakeFolder.with_counts(2)
+        client = FakeIMAPClient(folders={'INBOX': inbox})
+        client.on_idle_exhausted = hub.stop_all
+        held = []
+
+        def deliver():
+            held.append(connection.connection is not None)
+            inbox.messages[3] = FakeMessage()
+            return [(3, b'EXISTS')]
+
+        client.idle_responses = [deliver]
+        with mock.patch.object(idle_watcher.MailboxWatcher, '_connect', return_value=client):
+            self.assertTrue(hub.subscribe('ada@example.com', 'secret'))
+            for thread in [thread for thread in threading.enumerate() if thread.name == 'imap-idle-ada@example.com']:
+                thread.join(5)
+
+        result = hub.wait_for_events('ada@example.com', since=0, timeout=0)
+        self.assertEqual([(event['type'], event['total_count']) for event in result['events']], [('new_mail', 3)])
+        # No database connection open while the watcher sat in IDLE
+        self.assertEqual(held, [False])
+        self.assertTrue(client.logged_out)
+        self.assertEqual(MailboxPushState.objects.get().watcher, '')
+
+
+@override_settings(EMAIL_INGEST_PARSE_PROCESSES=0)
+class IngestTestCase(TransactionTestCase):
+    """Tests that sync messages: the ingest pipeline stores them from its own threads, which only see committed rows"""
+
+
+class FolderSyncTests(IngestTestCase):
+    """Incremental folder sync from a STATUS checkpoint, with CONDSTORE/QRESYNC"""
+
+    def setUp(self):
+        self.account = create_account('ada@example.com')
+        self.inbox = FakeFolder(uidvalidity=1700000000)
+        for index in range(1, 4):
+            self.deliver(index, flags=('\\Seen',) if index == 1 else ())
+        self.client = FakeIMAPClient(folders={'INBOX': self.inbox},
+                                     capabilities=(b'IMAP4REV1', b'CONDSTORE', b'QRESYNC'))
+        patcher = mock.patch('imapclient.IMAPClient', return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.service = DjangoEmailService(self.account)
+        self.service._password = 'secret'
+
+    def deliver(self, index, flags=()):
+        return self.inbox.append(make_raw_message(f'<{index}@example.org>', subject=f'Message {index}'), flags)
+
+    def sync(self, limit=50):
+        self.client.commands.clear()
+        result = self.service.receive_emails('INBOX', limit=limit)
+        self.assertTrue(result['success'], result['error'])
+        return result
+
+    def stored(self):
+        return {int(message.uid): message.is_read for message in EmailMessage.objects.exclude(uid=None)}
+
+    def state(self):
+        return FolderSyncState.objects.get(folder__account=self.account, folder__name='INBOX')
+
+    def test_first_sync(self):
+        self.assertEqual(self.sync()['count'], 3)
+        self.assertEqual(self.stored(), {1: True, 2: False, 3: False})
+        state = self.state()
+        self.assertEqual((state.mailbox, state.uidvalidity, state.last_uid, state.highest_modseq),
+                         ('INBOX', 1700000000, 3, self.inbox.highestmodseq))
+        # Bodies are fetched without setting \Seen
+        self.assertIn(('EXAMINE', 'INBOX'), self.client.commands)
+        self.assertIn(('FETCH', [1, 2, 3], ('BODY.PEEK[]', 'FLAGS'), ()), self.client.commands)
+
+    def test_quiet_folder_costs_one_status(self):
+        self.sync()
+        self.assertEqual(self.sync()['count'], 0)
+        self.assertEqual(self.client.commands, [('LOGIN', 'ada@example.com'), ('STATUS', 'INBOX')])
+
+    def test_only_new_uids_are_fetched(self):
+        self.sync()
+        self.deliver(4)
+        self.assertEqual(self.sync()['count'], 1)
+        self.assertIn(('SEARCH', 'UID', '4:*'), self.client.commands)
+        self.assertIn(('FETCH', [4], ('BODY.PEEK[]', 'FLAGS'), ()), self.client.commands)
+        self.assertEqual(self.state().last_uid, 4)
+
+    def test_flag_changes(self):
+        self.sync()
+        modseq = self.state().highest_modseq
+        self.inbox.store(2, ['\\Seen'])
+        self.inbox.store(1, [])
+        result = self.sync()
+        self.assertEqual(result['flags_updated'], 2)
+        self.assertEqual(self.stored(), {1: False, 2: True, 3: False})
+        self.assertIn(('FETCH', '1:3', ('FLAGS',), (f'CHANGEDSINCE {modseq}', 'VANISHED')), self.client.commands)
+
+    def test_vanished_messages_are_deleted(self):
+        self.sync()
+        self.inbox.expunge(2)
+        self.assertEqual(self.sync()['vanished'], 1)
+        self.assertEqual(set(self.stored()), {1, 3})
+        self.assertNotIn('SEARCH', [command[0] for command in self.client.commands])
+
+    def test_expunges_found_by_search_without_qresync(self):
+        self.client._capabilities = (b'IMAP4REV1', b'CONDSTORE')
+        self.sync()
+        self.inbox.expunge(1)
+        self.assertEqual(self.sync()['vanished'], 1)
+        self.assertEqual(set(self.stored()), {2, 3})
+        self.assertIn(('SEARCH', 'UID', '1:3'), self.client.commands)
+
+    def test_uidvalidity_change_resyncs(self):
+        self.sync()
+        renumbered = FakeFolder(uidvalidity=1800000000)
+        for uid in (3, 1, 2):
+            renumbered.append(self.inbox.messages[uid].raw)
+        self.client.folders['INBOX'] = renumbered
+        self.assertEqual(self.sync()['count'], 0)
+        # Same messages, re-linked to their new UIDs by Message-ID
+        self.assertEqual({int(message.uid): message.message_id for message in EmailMessage.objects.all()},
+                         {1: '<3@example.org>', 2: '<1@example.org>', 3: '<2@example.org>'})
+        self.assertEqual((self.state().uidvalidity, self.state().last_uid), (1800000000, 3))
+
+    def test_limited_run_resumes_from_checkpoint(self):
+        self.assertEqual(self.sync(limit=2)['count'], 2)
+        self.assertEqual(self.state().last_uid, 2)
+        self.assertEqual(self.sync(limit=2)['count'], 1)
+        self.assertEqual(set(self.stored()), {1, 2, 3})
+        self.assertEqual(self.state().last_uid, 3)
+
+    def test_expunged_new_mail_advances_checkpoint(self):
+        self.sync()
+        for index in (4, 5):
+            self.deliver(index)
+        self.inbox.expunge(4)
+        self.inbox.expunge(5)
+        self.assertEqual(self.sync()['count'], 0)
+        self.assertEqual(self.state().last_uid, 5)
+        # The gap is not searched again
+        self.sync()
+        self.assertEqual(self.client.commands, [('LOGIN', 'ada@example.com'), ('STATUS', 'INBOX')])
+
+    def test_checkpoint_stops_at_fetched_uids_when_limited(self):
+        self.sync()
+        for index in (4, 5, 6):
+            self.deliver(index)
+        self.inbox.expunge(5)
+        self.assertEqual(self.sync(limit=1)['count'], 1)
+        self.assertEqual(self.state().last_uid, 4)
+        self.assertEqual(self.sync(limit=1)['count'], 1)
+        self.assertEqual(self.state().last_uid, 6)
+
+    def test_vanished_responses_are_consumed(self):
+        self.sync()
+        self.inbox.expunge(3)
+        self.sync()
+        self.assertNotIn('VANISHED', self.client._imap.untagged_responses)
+
+
+class MessageCacheTests(TestCase):
+    """Parsed message details in a byte-budgeted LRU, spilling to disk"""
+
+    def message(self, uid, size=100):
+        return {'id': f'7:{uid}', 'subject': f'Message {uid}', 'body_text': 'x' * size}
+
+    def size(self, uid, size=100):
+        return len(json.dumps(self.message(uid, size)).encode('utf-8'))
+
+    def test_round_trip(self):
+        cache = ParsedMessageCache(max_bytes=10000, disk_dir='')
+        cache.set('Ada@example.com', 'INBOX', 7, 5, self.message(5))
+        self.assertEqual(cache.get('ada@example.com', 'INBOX', '7', '5'), self.message(5))
+        self.assertIsNone(cache.get('ada@example.com', 'INBOX', 8, 5))
+        self.assertIsNone(cache.get('ada@example.com', 'Archive', 7, 5))
+
+    def test_without_uidvalidity_nothing_is_cached(self):
+        cache = ParsedMessageCache(max_bytes=10000, disk_dir='')
+        cache.set('ada@example.com', 'INBOX', None, 5, self.message(5))
+        self.assertIsNone(cache.get('ada@example.com', 'INBOX', None, 5))
+        self.assertEqual(cache._size, 0)
+
+    def test_least_recently_used_is_evicted_first(self):
+        cache = ParsedMessageCache(max_bytes=self.size(1) * 3, disk_dir='')
+        for uid in (1, 2, 3):
+            cache.set('ada@example.com', 'INBOX', 7, uid, self.message(uid))
+        cache.get('ada@example.com', 'INBOX', 7, 1)
+        cache.set('ada@example.com', 'INBOX', 7, 4, self.message(4))
+        self.assertIsNone(cache.get('ada@example.com', 'INBOX', 7, 2))
+        for uid in (1, 3, 4):
+            self.assertIsNotNone(cache.get('ada@example.com', 'INBOX', 7, uid))
+
+    def test_byte_budget(self):
+        cache = ParsedMessageCache(max_bytes=self.size(1) * 2 + 10, disk_dir='')
+        cache.set('ada@example.com', 'INBOX', 7, 1, self.message(1))
+        cache.set('ada@example.com', 'INBOX', 7, 2, self.message(2))
+        # Replacing an entry doesn't count it twice
+        cache.set('ada@example.com', 'INBOX', 7, 2, self.message(2))
+        self.assertEqual(cache._size, self.size(1) * 2)
+        # A message larger than the whole budget is not cached and evicts nothing
+        cache.set('ada@example.com', 'INBOX', 7, 3, self.message(3, size=1000))
+        self.assertIsNone(cache.get('ada@example.com', 'INBOX', 7, 3))
+        self.assertEqual(len(cache._entries), 2)
+        cache.set('ada@example.com', 'INBOX', 7, 4, self.message(4, size=150))
+        self.assertLessEqual(cache._size, cache.max_bytes)
+        self.assertIsNone(cache.get('ada@example.com', 'INBOX', 7, 1))
+
+    def test_invalidate(self):
+        cache = ParsedMessageCache(max_bytes=10000, disk_dir='')
+        for folder, uid in (('INBOX', 1), ('INBOX', 2), ('Archive', 1)):
+            cache.set('ada@example.com', folder, 7, uid, self.message(uid))
+        cache.set('bob@example.com', 'INBOX', 7, 1, self.message(1))
+
+        cache.invalidate('Ada@example.com', 'INBOX', 7, 1)
+        self.assertIsNone(cache.get('ada@example.com', 'INBOX', 7, 1))
+        self.assertIsNotNone(cache.get('ada@example.com', 'INBOX', 7, 2))
+        cache.invalidate('ada@example.com', 'INBOX')
+        self.assertIsNone(cache.get('ada@example.com', 'INBOX', 7, 2))
+        self.assertIsNotNone(cache.get('ada@example.com', 'Archive', 7, 1))
+        cache.invalidate('ada@example.com')
+        self.assertIsNone(cache.get('ada@example.com', 'Archive', 7, 1))
+        self.assertIsNotNone(cache.get('bob@example.com', 'INBOX', 7, 1))
+        self.assertEqual(cache._size, self.size(1))
+
+    def test_disk_tier(self):
+        with tempfile.TemporaryDirectory() as disk_dir:
+            # Files add a header line (generation and time, about 150 bytes) to the message
+            cache = ParsedMessageCache(max_bytes=self.size(1), disk_dir=disk_dir,
+                                       disk_max_bytes=(self.size(1) + 200) * 2)
+            for uid in (1, 2, 3, 4):
+                cache.set('ada@example.com', 'INBOX', 7, uid, self.message(uid))
+            # 4 in memory; 1-3 spilled to disk, trimmed to the two most recent
+            files = [name for _, _, names in os.walk(disk_dir) for name in names]
+            self.assertEqual(sorted(files), ['7-2.json', '7-3.json'])
+            self.assertEqual(cache.get('ada@example.com', 'INBOX', 7, 3), self.message(3))
+            self.assertIsNone(cache.get('ada@example.com', 'INBOX', 7, 1))
+
+            cache.invalidate('ada@example.com', 'INBOX')
+            self.assertIsNone(cache.get('ada@example.com', 'INBOX', 7, 2))
+
+    def test_entries_expire(self):
+        cache = ParsedMessageCache(max_bytes=10000, disk_dir='', ttl=60)
+        cache.set('ada@example.com', 'INBOX', 7, 1, self.message(1))
+        now = time.time()
+        with mock.patch('mail.services.message_cache.time.time', return_value=now + 59):
+            self.assertIsNotNone(cache.get('ada@example.com', 'INBOX', 7, 1))
+        with mock.patch('mail.services.message_cache.time.time', return_value=now + 61):
+            self.assertIsNone(cache.get('ada@example.com', 'INBOX', 7, 1))
+        self.assertEqual((len(cache._entries), cache._size), (0, 0))
+
+    def test_invalidation_reaches_other_processes(self):
+        # Two caches stand in for two processes sharing the Django cache
+        this, other = (ParsedMessageCache(max_bytes=10000, disk_dir='') for _ in range(2))
+        for cache in (this, other):
+            for folder, uid in (('INBOX', 1), ('INBOX', 2), ('Archive', 1)):
+                cache.set('ada@example.com', folder, 7, uid, self.message(uid))
+
+        this.invalidate('ada@example.com', 'INBOX', 7, 1)
+        self.assertIsNone(other.get('ada@example.com', 'INBOX', 7, 1))
+        self.assertIsNotNone(other.get('ada@example.com', 'INBOX', 7, 2))
+        this.invalidate('ada@example.com', 'INBOX')
+        self.assertIsNone(other.get('ada@example.com', 'INBOX', 7, 2))
+        self.assertIsNotNone(other.get('ada@example.com', 'Archive', 7, 1))
+        this.invalidate('Ada@example.com')
+        self.assertIsNone(other.get('ada@example.com', 'Archive', 7, 1))
+        # Stored again after the invalidation, the message is served everywhere
+        other.set('ada@example.com', 'INBOX', 7, 1, self.message(1))
+        self.assertEqual(other.get('ada@example.com', 'INBOX', 7, 1), self.message(1))
+
+    def test_lost_generation_invalidates(self):
+        cache = ParsedMessageCache(max_bytes=10000, disk_dir='')
+        cache.set('ada@example.com', 'INBOX', 7, 1, self.message(1))
+        # Evicted from the shared cache: a new token is drawn, so the entry can't be trusted
+        django_cache.delete_many(cache._generation_keys(cache.make_key('ada@example.com', 'INBOX', 7, 1))[1:2])
+        self.assertIsNone(cache.get('ada@example.com', 'INBOX', 7, 1))
+
+    def test_disk_entries_are_checked_too(self):
+        with tempfile.TemporaryDirectory() as disk_dir:
+            this = ParsedMessageCache(max_bytes=self.size(1), disk_dir=disk_dir)
+            other = ParsedMessageCache(max_bytes=10000, disk_dir='')
+            for uid in (1, 2):
+                this.set('ada@example.com', 'INBOX', 7, uid, self.message(uid))
+            other.invalidate('ada@example.com', 'INBOX')
+            # UID 1 was spilled to disk under the old generation; it doesn't push UID 2 out
+            self.assertIsNone(this.get('ada@example.com', 'INBOX', 7, 1))
+            self.assertEqual([name for _, _, names in os.walk(disk_dir) for name in names], [])
+            self.assertEqual(list(this._entries), [this.make_key('ada@example.com', 'INBOX', 7, 2)])
+
+
+class BodyStructureTests(TestCase):
+    """BODYSTRUCTURE-driven detail fetch: which parts are shown, listed and downloaded"""
+
+    def setUp(self):
+        self.structure = parse_structure()
+
+    def test_part_numbers(self):
+        parts = list(imap_fetch.iter_parts(self.structure))
+        self.assertEqual([(part['part'], part['content_type']) for part in parts],
+                         [('1.1', 'text/plain'), ('1.2', 'text/html'), ('2', 'application/pdf'), ('3', 'image/png')])
+        self.assertEqual(parts[2]['filename'], 'report.pdf')
+        self.assertEqual((parts[3]['disposition'], parts[3]['content_id']), ('inline', 'logo@example.org'))
+
+    def test_single_part_message_is_part_1(self):
+        structure = parse_structure(b'("TEXT" "PLAIN" ("CHARSET" "iso-8859-1") NIL NIL "QUOTED-PRINTABLE" 12 1 NIL NIL NIL NIL)')
+        part = imap_fetch.find_part(structure, '1')
+        self.assertEqual((part['content_type'], part['encoding'], part['params']['charset']),
+                         ('text/plain', 'quoted-printable', 'iso-8859-1'))
+        self.assertIsNone(imap_fetch.find_part(structure, '2'))
+
+    def test_display_parts(self):
+        text, html = imap_fetch.display_parts(self.structure)
+        self.assertEqual((text['part'], html['part']), ('1.1', '1.2'))
+
+    def test_text_attachment_is_not_displayed(self):
+        structure = parse_structure(
+            b'(("TEXT" "HTML" NIL NIL NIL "7BIT" 10 1 NIL NIL NIL NIL)'
+            b'("TEXT" "PLAIN" ("NAME" "notes.txt") NIL NIL "7BIT" 10 1 NIL ("ATTACHMENT" ("FILENAME" "notes.txt")) NIL NIL)'
+            b' "MIXED" ("BOUNDARY" "b") NIL NIL NIL)')
+        text, html = imap_fetch.display_parts(structure)
+        self.assertIsNone(text)
+        self.assertEqual(html['part'], '1')
+        self.assertTrue(imap_fetch.has_attachments(structure))
+
+    def test_attachment_manifest(self):
+        self.assertEqual(imap_fetch.attachment_manifest(self.structure), [
+            {'part': '2', 'filename': 'report.pdf', 'content_type': 'application/pdf', 'size': 5700,
+             'content_id': None, 'inline': False},
+            {'part': '3', 'filename': 'part-3', 'content_type': 'image/png', 'size': 570,
+             'content_id': 'logo@example.org', 'inline': True},
+        ])
+
+    def test_fetch_body_parts_in_one_fetch(self):
+        text, html = imap_fetch.display_parts(self.structure)
+        conn = mock.Mock()
+        items = b'1 (UID 11 BODY[1.1] {5}'
+        conn.uid.return_value = ('OK', [(items, b'Hello'), (b' BODY[1.2] {16}', b'<p>Caf=C3=A9</p>'), b')'])
+        texts = imap_fetch.fetch_body_parts(conn, '11', [text, html], peek=True)
+        conn.uid.assert_called_once_with('FETCH', '11', '(BODY.PEEK[1.1] BODY.PEEK[1.2])')
+        self.assertEqual(texts, {'1.1': 'Hello', '1.2': '<p>Café</p>'})
+
+    def test_fetch_body_parts_nothing_to_fetch(self):
+        conn = mock.Mock()
+        self.assertEqual(imap_fetch.fetch_body_parts(conn, '11', []), {})
+        conn.uid.assert_not_called()
+
+    def test_fetch_message_structure_of_missing_uid(self):
+        conn = mock.Mock()
+        conn.uid.return_value = ('OK', [None])
+        self.assertIsNone(imap_fetch.fetch_message_structure(conn, '99'))
+
+
+class PartStreamTests(TestCase):
+    """Ranged, chunked download of one MIME part"""
+
+    PAYLOAD = bytes(range(256)) * 40 + b'tail'  # 10244 bytes: the last base64 quantum is padded
+
+    def reader(self, encoded, encoding='base64', chunk_size=1000):
+        conn = FakeIMAP(folders={'INBOX': FakeFolder({5: FakeMessage(parts={'2': encoded})})})
+        conn.select('INBOX')
+        part = {'part': '2', 'encoding': encoding, 'size': len(encoded)}
+        return conn, PartReader(conn, '5', part, chunk_size=chunk_size)
+
+    def fetches(self, conn):
+        """(offset, length) of every partial FETCH sent"""
+        return [tuple(map(int, re.search(r'<(\d+)\.(\d+)>', command[3]).groups()))
+                for command in conn.commands if command[:2] == ('UID', 'FETCH')]
+
+    def lines(self, line_length=76):
+        """base64 with CRLF line breaks every ``line_length`` characters, as mail clients write it"""
+        flat = base64.b64encode(self.PAYLOAD)
+        return b''.join(flat[i:i + line_length] + b'\r\n' for i in range(0, len(flat), line_length))
+
+    def test_parse_range_header(self):
+        self.assertEqual(parse_range_header('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(parse_range_header('bytes=500-', 1000), (500, 999))
+        self.assertEqual(parse_range_header('bytes=900-5000', 1000), (900, 999))
+        self.assertEqual(parse_range_header('bytes=-100', 1000), (900, 999))
+        self.assertEqual(parse_range_header('bytes=-5000', 1000), (0, 999))
+        self.assertEqual(parse_range_header('bytes=1000-', 1000), 'invalid')
+        self.assertEqual(parse_range_header('bytes=5-2', 1000), 'invalid')
+        for header in (None, '', 'bytes=-', 'items=0-1', 'bytes=0-1,5-6'):
+            self.assertIsNone(parse_range_header(header, 1000))
+        # Unknown size (quoted-printable): ranges aren't served
+        self.assertIsNone(parse_range_header('bytes=0-99', None))
+
+    def test_base64_lines(self):
+        conn, reader = self.reader(self.lines())
+        self.assertEqual(reader.size, len(self.PAYLOAD))
+        # 57 decoded bytes per 76-character line (78 with CRLF)
+        self.assertEqual(reader._start_position(57 * 3 + 10), (78 * 3, 10))
+        conn.commands.clear()
+        self.assertEqual(b''.join(reader.iter_range(5000, 5999)), self.PAYLOAD[5000:6000])
+        self.assertEqual(self.fetches(conn)[0][0], 5000 // 57 * 78)
+        self.assertEqual(b''.join(reader.iter_range(0)), self.PAYLOAD)
+        self.assertEqual(b''.join(reader.iter_range(10000)), self.PAYLOAD[10000:])
+
+    def test_base64_part_smaller_than_the_probe(self):
+        flat = base64.b64encode(self.PAYLOAD[:100])
+        conn, reader = self.reader(flat[:76] + b'\r\n' + flat[76:] + b'\r\n')
+        self.assertEqual(reader.size, 100)
+        self.assertEqual(b''.join(reader.iter_range(60, 99)), self.PAYLOAD[60:100])
+
+    def test_base64_without_line_breaks(self):
+        conn, reader = self.reader(base64.b64encode(self.PAYLOAD))
+        self.assertEqual(reader.size, len(self.PAYLOAD))
+        self.assertEqual(reader._start_position(1000), (1332, 1))
+        self.assertEqual(b''.join(reader.iter_range(1000, 1099)), self.PAYLOAD[1000:1100])
+
+    def test_base64_irregular_lines(self):
+        flat = base64.b64encode(self.PAYLOAD)
+        conn, reader = self.reader(flat[:60] + b'\r\n' + flat[60:100] + b'\r\n' + flat[100:])
+        self.assertIsNone(reader.size)
+        # Offsets can't be computed: decode from the start and skip
+        self.assertEqual(reader._start_position(1000), (0, 1000))
+        self.assertEqual(b''.join(reader.iter_range(1000, 1099)), self.PAYLOAD[1000:1100])
+
+    def test_quoted_printable(self):
+        text = ('Grüße, ' * 300).encode('utf-8')
+        conn, reader = self.reader(quopri.encodestring(text).replace(b'\n', b'\r\n'), encoding='quoted-printable')
+        self.assertIsNone(reader.size)
+        self.assertEqual(reader._start_position(100), (0, 100))
+        self.assertEqual(b''.join(reader.iter_range(100, 199)), text[100:200])
+
+    def test_unencoded(self):
+        conn, reader = self.reader(self.PAYLOAD, encoding='binary', chunk_size=4096)
+        self.assertEqual(reader.size, len(self.PAYLOAD))
+        self.assertEqual(reader._start_position(7000), (7000, 0))
+        conn.commands.clear()
+        self.assertEqual(b''.join(reader.iter_range(7000, 7009)), self.PAYLOAD[7000:7010])
+        self.assertEqual(self.fetches(conn), [(7000, 3244)])
+
+
+class BulkActionTests(TestCase):
+    """Bulk message actions, one UID set per command"""
+
+    def connect(self, uids, capabilities=('IMAP4REV1', 'MOVE', 'UIDPLUS'), deleted=()):
+        """Session with INBOX holding ``uids`` (``deleted`` already flagged \\Deleted) selected"""
+        inbox = FakeFolder({uid: FakeMessage(('\\Deleted',) if uid in deleted else ()) for uid in uids})
+        archive = FakeFolder(uidvalidity=1700000001)
+        archive.uidnext = 500
+        conn = FakeIMAP(folders={'INBOX': inbox, 'Old Mail': archive, 'Archive': archive},
+                        capabilities=capabilities)
+        conn.select('INBOX')
+        conn.commands.clear()
+        return conn
+
+    def test_build_uid_set(self):
+        self.assertEqual(imap_actions.build_uid_set([9, 1, 3, 2, '10', 7, 3]), '1:3,7,9:10')
+        self.assertEqual(imap_actions.build_uid_set([5]), '5')
+        self.assertEqual(imap_actions.build_uid_set([]), '')
+
+    def test_expand_uid_set(self):
+        self.assertEqual(imap_actions.expand_uid_set('41,43:46'), [41, 43, 44, 45, 46])
+        self.assertEqual(imap_actions.expand_uid_set('46:44'), [44, 45, 46])
+        uids = [1, 2, 3, 7, 9, 10, 100]
+        self.assertEqual(imap_actions.expand_uid_set(imap_actions.build_uid_set(uids)), uids)
+
+    def test_flag_action_is_one_store(self):
+        conn = self.connect(uids=range(1, 50))
+        results = imap_actions.apply_action(conn, 'mark_read', [1, 2, 3, 7, 99])
+        self.assertEqual(conn.commands, [('UID', 'SEARCH', None, 'UID', '1:3,7,99'),
+                                         ('UID', 'STORE', '1:3,7', '+FLAGS.SILENT', '(\\Seen)')])
+        self.assertEqual(results, {1: {'status': 'ok'}, 2: {'status': 'ok'}, 3: {'status': 'ok'},
+                                   7: {'status': 'ok'}, 99: {'status': 'not_found'}})
+        self.assertEqual(conn.selected.status()['UNSEEN'], 45)
+
+    def test_batches(self):
+        conn = self.connect(uids=range(1, 10))
+        with mock.patch.object(imap_actions, 'UID_SET_BATCH', 2):
+            imap_actions.apply_action(conn, 'star', [1, 2, 3])
+        self.assertEqual([command for command in conn.commands if command[1] == 'STORE'],
+                         [('UID', 'STORE', '1:2', '+FLAGS.SILENT', '(\\Flagged)'),
+                          ('UID', 'STORE', '3', '+FLAGS.SILENT', '(\\Flagged)')])
+
+    def test_move_reports_new_references(self):
+        conn = self.connect(uids=[4, 5, 6])
+        results = imap_actions.apply_action(conn, 'move', [4, 6], 'Old Mail')
+        self.assertIn(('UID', 'MOVE', '4,6', '"Old Mail"'), conn.commands)
+        self.assertEqual(results, {4: {'status': 'ok', 'id': '1700000001:500'},
+                                   6: {'status': 'ok', 'id': '1700000001:501'}})
+        self.assertEqual(list(conn.selected.messages), [5])
+
+    def test_move_without_move_extension(self):
+        conn = self.connect(uids=[4, 5], capabilities=('IMAP4REV1', 'UIDPLUS'))
+        results = imap_actions.apply_action(conn, 'move', [4, 5], 'Archive')
+        self.assertEqual([command[1] for command in conn.commands], ['SEARCH', 'COPY', 'STORE', 'EXPUNGE'])
+        self.assertEqual(conn.commands[-1], ('UID', 'EXPUNGE', '4:5'))
+        self.assertEqual(results, {4: {'status': 'ok', 'id': '1700000001:500'},
+                                   5: {'status': 'ok', 'id': '1700000001:501'}})
+        self.assertEqual((len(conn.selected.messages), len(conn.folders['Archive'].messages)), (0, 2))
+
+    def test_delete_without_uidplus_spares_other_deleted_messages(self):
+        conn = self.connect(uids=[1, 2, 3, 8], capabilities=('IMAP4REV1',), deleted=[8])
+        imap_actions.apply_action(conn, 'delete', [1, 2])
+        self.assertEqual(conn.commands[1:], [
+            ('UID', 'STORE', '1:2', '+FLAGS.SILENT', '(\\Deleted)'),
+            ('UID', 'SEARCH', None, 'DELETED', 'NOT', 'UID', '1:2'),
+            ('UID', 'STORE', '8', '-FLAGS.SILENT', '(\\Deleted)'),
+            ('EXPUNGE',),
+            ('UID', 'STORE', '8', '+FLAGS.SILENT', '(\\Deleted)'),
+        ])
+        self.assertEqual(sorted(conn.selected.messages), [3, 8])
+
+    def test_failed_command(self):
+        conn = self.connect(uids=[1, 2])
+        conn.fail = 'STORE'
+        results = imap_actions.apply_action(conn, 'mark_unread', [1, 2, 3])
+        self.assertEqual({uid: result['status'] for uid, result in results.items()},
+                         {1: 'failed', 2: 'failed', 3: 'not_found'})
+
+    def test_invalid_action(self):
+        conn = self.connect(uids=[1])
+        with self.assertRaises(ValueError):
+            imap_actions.apply_action(conn, 'explode', [1])
+        with self.assertRaises(ValueError):
+            imap_actions.apply_action(conn, 'move', [1])
+        self.assertEqual(conn.commands, [])
+
+
+class SyncEngineTests(IngestTestCase):
+    """All folders of an account over one login, many accounts in parallel"""
+
+    def setUp(self):
+        self.account = create_account('ada@example.com')
+        self.folders = {'INBOX': FakeFolder(), 'Sent': FakeFolder()}
+        for name, folder in self.folders.items():
+            for index in range(1, 3):
+                folder.append(make_raw_message(f'<{name}-{index}@example.org>'))
+        self.client = FakeIMAPClient(folders=self.folders, capabilities=(b'IMAP4REV1', b'CONDSTORE', b'QRESYNC'))
+        patcher = mock.patch('imapclient.IMAPClient', return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.service = DjangoEmailService(self.account)
+        self.service._password = 'secret'
+
+    def test_one_login_for_all_folders(self):
+        results = self.service.sync_folders(['INBOX', 'Sent', 'Missing'])
+        self.assertEqual({name: result['count'] for name, result in results.items()},
+                         {'INBOX': 2, 'Sent': 2, 'Missing': 0})
+        self.assertEqual(results['Missing']['error'], "Folder 'Missing' doesn't exist")
+        self.assertGreater(results['INBOX']['bytes'], 0)
+        commands = [command[0] for command in self.client.commands]
+        self.assertEqual((commands.count('LOGIN'), commands.count('LIST'), commands.count('ENABLE')), (1, 1, 1))
+        self.assertTrue(self.client.logged_out)
+
+    def test_connection_loss_fails_the_remaining_folders(self):
+        folder_status = self.client.folder_status
+
+        def drop_on_sent(folder, what=None):
+            if folder == 'Sent':
+                raise OSError('Connection reset by peer')
+            return folder_status(folder, what)
+
+        self.client.folder_status = drop_on_sent
+        results = self.service.sync_folders(['INBOX', 'Sent', 'Trash'])
+        self.assertTrue(results['INBOX']['success'])
+        self.assertEqual([results[name]['error'] for name in ('Sent', 'Trash')], ['Connection reset by peer'] * 2)
+        self.assertFalse(results['Sent']['auth_failed'])
+
+    def test_wrong_password_fails_every_folder(self):
+        self.service._password = 'wrong'
+        results = self.service.sync_folders(['INBOX', 'Sent'])
+        self.assertEqual([result['error'] for result in results.values()],
+                         ['[AUTHENTICATIONFAILED] Authentication failed.'] * 2)
+        self.assertTrue(all(result['auth_failed'] for result in results.values()))
+        self.assertTrue(self.client.logged_out)
+
+    def test_engine_caps_sessions_per_host(self):
+        accounts = [self.account] + [create_account(f'user{index}@example{index}.com') for index in range(3)]
+        active, peak = [0], [0]
+        lock = threading.Lock()
+
+        def sync_folders(service, folders, limit):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            threading.Event().wait(0.02)
+            with lock:
+                active[0] -= 1
+            if service.email_account.email == 'user0@example0.com':
+                raise OSError('Connection refused')
+            return {folder: {'success': True, 'count': 1, 'bytes': 10, 'error': None} for folder in folders}
+
+        finished = []
+        engine = sync_engine.SyncEngine(workers=4, max_per_host=2, folders=['INBOX', 'Sent'],
+                                        password='secret', progress=finished.append)
+        with mock.patch.object(DjangoEmailService, 'sync_folders', autospec=True, side_effect=sync_folders):
+            report = engine.run(accounts)
+        self.assertEqual(peak[0], 2)
+        self.assertEqual(len(finished), 4)
+        self.assertEqual((report.messages, report.bytes), (6, 60))
+        self.assertEqual([account.email_address for account in report.failed_accounts], ['user0@example0.com'])
+
+    def test_missing_folders_are_not_failures(self):
+        result = sync_engine.AccountSyncResult('ada@example.com')
+        result.folders = {
+            'INBOX': {'success': True, 'count': 3, 'bytes': 30, 'error': None},
+            'Junk': {'success': False, 'count': 0, 'bytes': 0, 'error': "Folder 'Junk' doesn't exist"},
+            'Sent': {'success': False, 'count': 0, 'bytes': 0, 'error': 'timed out'},
+        }
+        self.assertEqual(result.failures, {'Sent': 'timed out'})
+
+
+class BulkIngestTests(IngestTestCase):
+    """New messages are stored per fetch batch with a fixed number of queries"""
+
+    def setUp(self):
+        self.account = create_account('ada@example.com')
+        self.inbox = FakeFolder()
+        self.client = FakeIMAPClient(folders={'INBOX': self.inbox})
+        patcher = mock.patch('imapclient.IMAPClient', return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.service = DjangoEmailService(self.account)
+        self.service._password = 'secret'
+
+    def deliver(self, count, flags=()):
+        for _ in range(count):
+            uid = self.inbox.uidnext
+            self.inbox.append(make_raw_message(f'<{uid}@example.org>', subject=f'Message {uid}'), flags)
+
+    def sync(self):
+        self.client.commands.clear()
+        result = self.service.receive_emails('INBOX', limit=100)
+        self.assertTrue(result['success'], result['error'])
+        return result
+
+    def test_fetched_in_batches(self):
+        self.deliver(5)
+        with override_settings(EMAIL_SYNC_BATCH_SIZE=2):
+            self.assertEqual(self.sync()['count'], 5)
+        self.assertEqual([command[1] for command in self.client.commands if command[0] == 'FETCH'],
+                         [[1, 2], [3, 4], [5]])
+
+    def test_queries_do_not_grow_with_the_batch(self):
+        folder = self.service._get_or_create_folder('INBOX', 'inbox')
+        counts = []
+        for first, size in ((1, 2), (3, 20)):
+            parsed = []
+            for uid in range(first, first + size):
+                raw = make_raw_message(f'<{uid}@example.org>')
+                parsed.append((uid, parse_message(raw)[0], [], raw))
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.service._persist_messages(folder, parsed)[0], size)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_known_and_repeated_message_ids_are_stored_once(self):
+        self.deliver(2)
+        self.sync()
+        self.inbox.append(make_raw_message('<1@example.org>'))
+        self.inbox.append(make_raw_message('<new@example.org>'))
+        self.inbox.append(make_raw_message('<new@example.org>'))
+        self.assertEqual(self.sync()['count'], 1)
+        self.assertEqual(sorted(EmailMessage.objects.values_list('message_id', flat=True)),
+                         ['<1@example.org>', '<2@example.org>', '<new@example.org>'])
+
+    def test_folder_counts(self):
+        self.deliver(2, flags=('\\Seen',))
+        self.deliver(3)
+        self.sync()
+        folder = self.account.folders.get(name='INBOX')
+        self.assertEqual((folder.total_count, folder.unread_count), (5, 3))
+
+
+class FolderCountTests(IngestTestCase):
+    """Folder counters: F() deltas on hot paths, reconcile_counts() for drift"""
+
+    def setUp(self):
+        self.account = create_account()
+        self.inbox = EmailFolder.objects.create(account=self.account, name='INBOX', display_name='Inbox')
+        self.sent = EmailFolder.objects.create(account=self.account, name='Sent', display_name='Sent')
+
+    def add_messages(self, folder, read, unread):
+        now = timezone.now()
+        for index in range(read + unread):
+            EmailMessage.objects.create(
+                folder=folder, message_id=f'<{folder.name}-{index}@example.com>', uid=str(index + 1),
+                subject='Hi', sender='bob@example.com', to_recipients=['sender@example.com'],
+                date_sent=now, date_received=now, is_read=index < read)
+
+    def counts(self, folder):
+        folder.refresh_from_db()
+        return folder.total_count, folder.unread_count
+
+    def test_adjust_counts(self):
+        self.inbox.adjust_counts(total=3, unread=2)
+        self.inbox.adjust_counts(unread=-1)
+        EmailFolder.adjust_folder_counts(self.inbox.pk, total=-1)
+        self.assertEqual(self.counts(self.inbox), (2, 1))
+        self.assertEqual(self.counts(self.sent), (0, 0))
+
+    def test_zero_delta_skips_the_update(self):
+        with self.assertNumQueries(0):
+            self.inbox.adjust_counts()
+
+    def test_reconcile_counts(self):
+        self.add_messages(self.inbox, read=2, unread=3)
+        self.add_messages(self.sent, read=1, unread=0)
+        self.sent.adjust_counts(total=1)
+        self.assertEqual(EmailFolder.reconcile_counts(), 1)
+        self.assertEqual(self.counts(self.inbox), (5, 3))
+        self.assertEqual(self.counts(self.sent), (1, 0))
+        self.assertEqual(EmailFolder.reconcile_counts(), 0)
+
+    def test_reconcile_counts_of_some_folders(self):
+        self.inbox.adjust_counts(total=4, unread=4)
+        self.sent.adjust_counts(total=4)
+        self.assertEqual(EmailFolder.reconcile_counts(EmailFolder.objects.filter(name='Sent')), 1)
+        self.assertEqual(self.counts(self.inbox), (4, 4))
+        self.assertEqual(self.counts(self.sent), (0, 0))
+
+    def test_reconcile_command(self):
+        self.add_messages(self.inbox, read=0, unread=2)
+        out = io.StringIO()
+        call_command('reconcile_folder_counts', email='sender@example.com', stdout=out)
+        self.assertIn('Corrected counters of 1 folder(s)', out.getvalue())
+        self.assertEqual(self.counts(self.inbox), (2, 2))
+
+    def test_sync_applies_deltas(self):
+        server_inbox = FakeFolder()
+        for index in range(4):
+            server_inbox.append(make_raw_message(f'<{index}@example.org>'), ('\\Seen',) if index == 0 else ())
+        client = FakeIMAPClient(folders={'INBOX': server_inbox}, capabilities=(b'IMAP4REV1', b'CONDSTORE', b'QRESYNC'))
+        service = DjangoEmailService(self.account)
+        service._password = 'secret'
+        with mock.patch('imapclient.IMAPClient', return_value=client):
+            service.receive_emails('INBOX')
+            self.assertEqual(self.counts(self.inbox), (4, 3))
+            server_inbox.store(2, ['\\Seen'])
+            server_inbox.store(1, ['\\Seen', '\\Flagged'])
+            service.receive_emails('INBOX')
+            self.assertEqual(self.counts(self.inbox), (4, 2))
+            server_inbox.expunge(3, 4)
+            service.receive_emails('INBOX')
+            self.assertEqual(self.counts(self.inbox), (2, 0))
+
+
+@skipUnless(connection.vendor == 'postgresql', 'full-text search needs PostgreSQL')
+class MessageSearchTests(IngestTestCase):
+    """Weighted tsvector search over stored messages"""
+
+    def setUp(self):
+        self.account = create_account('ada@example.com')
+        self.inbox = EmailFolder.objects.create(account=self.account, name='INBOX', display_name='Inbox')
+        self.archive = EmailFolder.objects.create(account=self.account, name='Archive', display_name='Archive')
+        FolderSyncState.objects.create(folder=self.inbox, mailbox='INBOX', uidvalidity=7)
+
+    def add(self, folder, uid, subject, body='', sender='bob@example.org'):
+        now = timezone.now()
+        message = EmailMessage.objects.create(
+            folder=folder, message_id=f'<{folder.name}-{uid}@example.org>', uid=str(uid), subject=subject,
+            sender=sender, sender_name='Bob', to_recipients=['ada@example.com'], body_text=body,
+            date_sent=now, date_received=now)
+        update_search_vectors({message.pk: body})
+        return message
+
+    def test_subject_ranks_above_body(self):
+        self.add(self.inbox, 1, 'Lunch', body='The invoices are attached.')
+        self.add(self.inbox, 2, 'Invoice for October', body='See attached.')
+        hits = search_messages(self.account, 'invoice')
+        self.assertEqual([hit['uid'] for hit in hits], [2, 1])
+        self.assertEqual((hits[0]['id'], hits[0]['folder']), ('7:2', 'INBOX'))
+
+    def test_folder_filter_and_paging(self):
+        self.add(self.inbox, 1, 'Report one')
+        self.add(self.archive, 1, 'Report two')
+        self.assertEqual([hit['folder'] for hit in search_messages(self.account, 'report', folder='Archive')],
+                         ['Archive'])
+        self.assertEqual(len(search_messages(self.account, 'report', limit=1, offset=1)), 1)
+        # No sync checkpoint: the reference is the bare UID
+        self.assertEqual(search_messages(self.account, 'two')[0]['id'], '1')
+
+    def test_websearch_syntax(self):
+        self.add(self.inbox, 1, 'Budget draft')
+        self.add(self.inbox, 2, 'Budget final')
+        self.assertEqual([hit['uid'] for hit in search_messages(self.account, 'budget -draft')], [2])
+        self.assertEqual([hit['uid'] for hit in search_messages(self.account, '"final budget"')], [])
+
+    def test_snippet_is_escaped(self):
+        self.add(self.inbox, 1, 'Hi', body='Use <script>alert(1)</script> for the quarterly numbers')
+        snippet = search_messages(self.account, 'quarterly')[0]['snippet']
+        self.assertIn('<mark>quarterly</mark>', snippet)
+        self.assertIn('&lt;/script&gt;', snippet)
+        self.assertNotIn('<script>', snippet)
+
+    def test_other_accounts_are_not_searched(self):
+        other = EmailFolder.objects.create(account=create_account('eve@example.net'), name='INBOX', display_name='Inbox')
+        self.add(other, 1, 'Secret plans')
+        self.assertEqual(search_messages(self.account, 'secret'), [])
+
+    def test_synced_messages_are_indexed(self):
+        server_inbox = FakeFolder()
+        server_inbox.append(make_raw_message('<1@example.org>', subject='Quarterly forecast'))
+        service = DjangoEmailService(self.account)
+        service._password = 'secret'
+        with mock.patch('imapclient.IMAPClient', return_value=FakeIMAPClient(folders={'INBOX': server_inbox})):
+            service.receive_emails('INBOX')
+        self.assertEqual([hit['subject'] for hit in search_messages(self.account, 'forecast')], ['Quarterly forecast'])
+
+
+class SearchMigrationTests(SimpleTestCase):
+    """Migration 0010 backfills and indexes search vectors on PostgreSQL only"""
+
+    def setUp(self):
+        self.migration = import_module('mail.migrations.0010_emailmessage_search_vector')
+        self.schema_editor = mock.Mock()
+
+    def test_backfill_skipped_off_postgres(self):
+        self.schema_editor.connection.vendor = 'sqlite'
+        apps = mock.Mock()
+        self.migration.backfill_search_vectors(apps, self.schema_editor)
+        apps.get_model.assert_not_called()
+
+    def test_index_built_concurrently_on_postgres_only(self):
+        index = self.migration.Migration.operations[-1]
+        for vendor, built in (('sqlite', False), ('mysql', False), ('postgresql', True)):
+            self.schema_editor.connection.vendor = vendor
+            with mock.patch.object(AddIndexConcurrently, 'database_forwards') as forwards, \
+                    mock.patch.object(AddIndexConcurrently, 'database_backwards') as backwards:
+                index.database_forwards('mail', self.schema_editor, None, None)
+                index.database_backwards('mail', self.schema_editor, None, None)
+            self.assertEqual((forwards.called, backwards.called), (built, built), vendor)
+
+    def test_vectors_not_updated_off_postgres(self):
+        with mock.patch('mail.services.message_search.connection') as db:
+            db.vendor = 'sqlite'
+            self.assertEqual(update_search_vectors({1: 'Body'}), 0)
+        db.cursor.assert_not_called()
+
+
+class BodyCompressionTests(IngestTestCase):
+    """Message bodies stored as <version byte><payload> in EmailMessageBody"""
+
+    def test_short_body_stays_raw(self):
+        text = 'Caf\u00e9 ' * 10
+        data = compress_body(text)
+        self.assertLess(len(text.encode('utf-8')), BODY_COMPRESS_MIN)
+        self.assertEqual(data, bytes([BODY_RAW]) + text.encode('utf-8'))
+        self.assertEqual(decompress_body(data), text)
+
+    def test_long_body_is_compressed(self):
+        text = 'Quarterly report, see attached. ' * 100
+        data = compress_body(text)
+        self.assertEqual(data[0], BODY_ZLIB)
+        self.assertLess(len(data), len(text) // 10)
+        self.assertEqual(decompress_body(data), text)
+
+    def test_incompressible_body_stays_raw(self):
+        text = 'a' * BODY_COMPRESS_MIN
+        with mock.patch('mail.models.zlib.compress', return_value=b'x' * len(text)):
+            self.assertEqual(compress_body(text), bytes([BODY_RAW]) + text.encode())
+
+    def test_empty_and_missing(self):
+        self.assertIsNone(compress_body(None))
+        self.assertIsNone(decompress_body(None))
+        self.assertEqual(decompress_body(compress_body('')), '')
+        self.assertEqual(decompress_body(b''), '')
+        self.assertEqual(decompress_body(memoryview(bytes([BODY_RAW]) + b'hi')), 'hi')
+
+    def test_unknown_version(self):
+        with self.assertRaises(ValueError):
+            decompress_body(bytes([7]) + zlib.compress(b'hello'))
+
+    def test_message_body_round_trip(self):
+        folder = EmailFolder.objects.create(account=create_account(), name='INBOX', display_name='Inbox')
+        now = timezone.now()
+        html = '<p>' + 'Hello there. ' * 50 + '</p>'
+        message = EmailMessage.objects.create(
+            folder=folder, message_id='<body@example.com>', subject='Hi', sender='bob@example.com',
+            to_recipients=['sender@example.com'], date_sent=now, date_received=now, body_text='Hello', body_html=html)
+        body = EmailMessageBody.objects.get(pk=message.pk)
+        self.assertEqual(bytes(body.text_data)[0], BODY_RAW)
+        self.assertEqual(bytes(body.html_data)[0], BODY_ZLIB)
+        message = EmailMessage.objects.with_body().get(pk=message.pk)
+        self.assertEqual((message.body_text, message.body_html), ('Hello', html))
+
+    def test_synced_bodies_are_stored_compressed(self):
+        account = create_account('ada@example.com')
+        server_inbox = FakeFolder()
+        server_inbox.append(make_raw_message('<1@example.org>', body='Long enough to compress. ' * 40))
+        service = DjangoEmailService(account)
+        service._password = 'secret'
+        with mock.patch('imapclient.IMAPClient', return_value=FakeIMAPClient(folders={'INBOX': server_inbox})):
+            service.receive_emails('INBOX')
+        message = EmailMessage.objects.with_body().get()
+        self.assertEqual(bytes(message.body.text_data)[0], BODY_ZLIB)
+        self.assertIn('Long enough to compress.', message.body_text)
+
+
+class RawStoreTests(IngestTestCase):
+    """Content-addressed raw RFC822 copies and local reparsing"""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = tmp.name
+        self.store = RawMessageStore(self.root)
+
+    def test_put_and_read(self):
+        raw = make_raw_message('<1@example.org>')
+        digest = self.store.put(raw)
+        self.assertEqual(self.store.path_for(digest), os.path.join(self.root, digest[:2], digest[2:4], digest))
+        self.assertTrue(self.store.exists(digest))
+        self.assertEqual(self.store.read(digest), raw)
+        self.assertEqual(self.store.parse(digest)['Message-ID'], '<1@example.org>')
+        with self.store.open(digest) as view:
+            self.assertEqual(view[:4], b'From')
+
+    def test_identical_content_is_stored_once(self):
+        raw = make_raw_message('<1@example.org>')
+        self.assertEqual(self.store.put(raw), self.store.put(raw))
+        self.assertEqual(list(self.store.iter_digests()), [RawMessageStore.digest_of(raw)])
+
+    def test_empty_blob_and_unknown_digest(self):
+        self.assertEqual(self.store.read(self.store.put(b'')), b'')
+        with self.assertRaises(FileNotFoundError):
+            self.store.read('0' * 64)
+
+    def test_disabled_without_a_root(self):
+        self.assertFalse(RawMessageStore('').enabled)
+        self.assertEqual(list(RawMessageStore('').iter_digests()), [])
+
+    def sync(self, *messages):
+        account = create_account('ada@example.com')
+        server_inbox = FakeFolder()
+        for raw in messages:
+            server_inbox.append(raw)
+        service = DjangoEmailService(account)
+        service._password = 'secret'
+        with mock.patch('imapclient.IMAPClient', return_value=FakeIMAPClient(folders={'INBOX': server_inbox})):
+            return service.receive_emails('INBOX')
+
+    def test_sync_keeps_raw_copies(self):
+        raw = make_raw_message('<1@example.org>', subject='Original')
+        with mock.patch.object(raw_store, 'root', self.root):
+            self.sync(raw)
+        message = EmailMessage.objects.get()
+        self.assertEqual(message.raw_digest, RawMessageStore.digest_of(raw))
+        self.assertEqual(self.store.read(message.raw_digest), raw)
+
+    def test_failed_write_does_not_stop_the_sync(self):
+        with mock.patch.object(raw_store, 'root', self.root), \
+                mock.patch.object(raw_store, 'put', side_effect=OSError('No space left on device')):
+            result = self.sync(make_raw_message('<1@example.org>'))
+        self.assertEqual(result['count'], 1)
+        self.assertIsNone(EmailMessage.objects.get().raw_digest)
+
+    def test_reparse_messages(self):
+        with mock.patch.object(raw_store, 'root', self.root):
+            self.sync(make_raw_message('<1@example.org>', subject='Original', body='First body'),
+                      make_raw_message('<2@example.org>', subject='Second'))
+            EmailMessage.objects.update(subject='Mangled')
+            lost = EmailMessage.objects.get(message_id='<2@example.org>')
+            os.remove(self.store.path_for(lost.raw_digest))
+            out = io.StringIO()
+            call_command('reparse_messages', stdout=out)
+        self.assertIn('1 message(s) had no raw copy', out.getvalue())
+        self.assertIn('Reparsed 1 message(s)', out.getvalue())
+        message = EmailMessage.objects.with_body().get(message_id='<1@example.org>')
+        self.assertEqual((message.subject, message.body_text.strip()), ('Original', 'First body'))
+        self.assertEqual(EmailMessage.objects.get(pk=lost.pk).subject, 'Mangled')
+
+    def test_reparse_needs_the_store(self):
+        with mock.patch.object(raw_store, 'root', ''):
+            with self.assertRaises(CommandError):
+                call_command('reparse_messages', stdout=io.StringIO())
+
+
+class SyncSchedulerTests(TestCase):
+    """Adaptive per-account sync intervals"""
+
+    def setUp(self):
+        self.account = create_account('ada@example.com')
+        self.engine = mock.Mock(workers=2)
+        self.scheduler = sync_scheduler.SyncScheduler(self.engine, min_interval=60, max_interval=600, max_backoff=3600)
+        # No jitter: delays are exact and overdue accounts are spread to half an interval
+        patcher = mock.patch.object(sync_scheduler.random, 'uniform', side_effect=lambda low, high: (low + high) / 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Would close the test transaction's connection
+        patcher = mock.patch.object(sync_scheduler, 'close_old_connections')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def result(self, messages=0, error=None, failures=None, auth_failed=False):
+        result = sync_engine.AccountSyncResult(self.account.email)
+        result.folders = {'INBOX': {'success': True, 'count': messages, 'bytes': 0, 'error': None}}
+        for folder, folder_error in (failures or {}).items():
+            result.folders[folder] = {'success': False, 'count': 0, 'bytes': 0, 'error': folder_error}
+        result.error = error
+        result.error_is_auth = auth_failed
+        return result
+
+    def delay(self, schedule):
+        return round(schedule.next_run - time.monotonic())
+
+    def test_first_run_follows_the_last_persisted_sync(self):
+        folder = EmailFolder.objects.create(account=self.account, name='INBOX', display_name='Inbox')
+        FolderSyncState.objects.create(folder=folder, mailbox='INBOX', last_synced_at=timezone.now() - timedelta(seconds=20))
+        never_synced = create_account('bob@example.org')
+        self.scheduler.refresh_accounts()
+        self.assertEqual(self.delay(self.scheduler.schedules[self.account.pk]), 40)
+        self.assertEqual(self.delay(self.scheduler.schedules[never_synced.pk]), 30)
+
+    def test_restart_resumes_the_persisted_schedule(self):
+        self.scheduler.refresh_accounts()
+        schedule = self.scheduler.schedules[self.account.pk]
+        for messages in (0, 0):
+            self.scheduler.reschedule(schedule, self.result(messages))
+        self.scheduler.reschedule(schedule, self.result(failures={'Sent': 'timed out'}))
+        state = AccountSyncState.objects.get(account=self.account)
+        self.assertEqual((state.interval, state.failures, state.auth_failed), (135, 1, False))
+
+        restarted = sync_scheduler.SyncScheduler(self.engine, min_interval=60, max_interval=600, max_backoff=3600)
+        restarted.refresh_accounts()
+        resumed = restarted.schedules[self.account.pk]
+        self.assertEqual((resumed.interval, resumed.failures, self.delay(resumed)), (135, 1, 60))
+        restarted.reschedule(resumed, self.result(failures={'Sent': 'timed out'}))
+        self.assertEqual(self.delay(resumed), 120)
+
+    def test_overdue_accounts_are_spread_after_a_restart(self):
+        AccountSyncState.objects.create(account=self.account, interval=300,
+                                        next_sync_at=timezone.now() - timedelta(hours=1))
+        self.scheduler.refresh_accounts()
+        schedule = self.scheduler.schedules[self.account.pk]
+        self.assertEqual((schedule.interval, self.delay(schedule)), (300, 30))
+
+    def test_refresh_sees_added_and_deactivated_accounts(self):
+        self.scheduler.refresh_accounts()
+        self.assertEqual(set(self.scheduler.schedules), {self.account.pk})
+        added = create_account('bob@example.org')
+        self.scheduler.refresh_accounts()
+        self.assertEqual(set(self.scheduler.schedules), {self.account.pk, added.pk})
+        EmailAccount.objects.filter(pk=self.account.pk).update(is_active=False)
+        self.scheduler.refresh_accounts()
+        self.assertEqual(set(self.scheduler.schedules), {added.pk})
+
+    def test_interval_adapts_to_new_mail(self):
+        self.scheduler.refresh_accounts()
+        schedule = self.scheduler.schedules[self.account.pk]
+        intervals = []
+        for messages in (0, 0, 0, 0, 0, 0, 3):
+            self.scheduler.reschedule(schedule, self.result(messages))
+            intervals.append(self.delay(schedule))
+        self.assertEqual(intervals, [90, 135, 202, 304, 456, 600, 60])
+
+    def test_failures_back_off(self):
+        self.scheduler.refresh_accounts()
+        schedule = self.scheduler.schedules[self.account.pk]
+        delays = []
+        for _ in range(8):
+            self.scheduler.reschedule(schedule, self.result(failures={'Sent': 'timed out'}))
+            delays.append(self.delay(schedule))
+        self.assertEqual(delays, [60, 120, 240, 480, 960, 1920, 3600, 3600])
+        self.scheduler.reschedule(schedule, self.result(1))
+        self.assertEqual((schedule.failures, self.delay(schedule)), (0, 60))
+
+    def test_auth_failures_start_later(self):
+        self.scheduler.refresh_accounts()
+        schedule = self.scheduler.schedules[self.account.pk]
+        self.scheduler.reschedule(schedule, self.result(error='[AUTHENTICATIONFAILED] Nope', auth_failed=True))
+        self.assertEqual(self.delay(schedule), 300)
+        self.scheduler.reschedule(schedule, self.result(error='[AUTHENTICATIONFAILED] Nope', auth_failed=True))
+        self.assertEqual(self.delay(schedule), 600)
+        self.assertTrue(AccountSyncState.objects.get(account=self.account).auth_failed)
+
+    def test_auth_failures_are_judged_by_exception_type(self):
+        self.scheduler.refresh_accounts()
+        schedule = self.scheduler.schedules[self.account.pk]
+        # Error text mentioning a login is not enough
+        self.scheduler.reschedule(schedule, self.result(failures={'INBOX': 'login shell quota exceeded'}))
+        self.assertEqual(self.delay(schedule), 60)
+        # Folder results flagged by DjangoEmailService from a LoginError
+        result = self.result()
+        result.folders['INBOX'].update(success=False, error='Invalid credentials', auth_failed=True)
+        schedule.failures = 0
+        self.scheduler.reschedule(schedule, result)
+        self.assertEqual(self.delay(schedule), 300)
+
+    def test_missing_folders_are_not_failures(self):
+        self.scheduler.refresh_accounts()
+        schedule = self.scheduler.schedules[self.account.pk]
+        self.scheduler.reschedule(schedule, self.result(failures={'Junk': "Folder 'Junk' doesn't exist"}))
+        self.assertEqual((schedule.failures, self.delay(schedule)), (0, 90))
+
+    def test_run_until_stopped(self):
+        other = create_account('bob@example.org')
+        scheduler = sync_scheduler.SyncScheduler(self.engine, min_interval=0.01, max_interval=0.02, max_backoff=1)
+        synced = []
+
+        def sync_account(account):
+            synced.append(account.email)
+            if account == other:
+                raise RuntimeError('boom')
+            return self.result(1)
+
+        def progress(result, schedule):
+            if len(synced) >= 6:
+                scheduler.stop()
+
+        self.engine.sync_account.side_effect = sync_account
+        scheduler.progress = progress
+        timer = threading.Timer(5, scheduler.stop)
+        timer.start()
+        scheduler.run()
+        timer.cancel()
+        self.assertGreaterEqual(len(synced), 6)
+        self.assertEqual(set(synced), {'ada@example.com', 'bob@example.org'})
+        # A crashing sync is reported as a failure and retried, not fatal to the loop
+        self.assertGreater(scheduler.schedules[other.pk].failures, 0)
+        self.assertFalse(any(schedule.running for schedule in scheduler.schedules.values()))
+
+
+class SyncCheckpointTests(IngestTestCase):
+    """Per-batch checkpoints and folder error tracking"""
+
+    def setUp(self):
+        self.account = create_account('ada@example.com')
+        self.inbox = FakeFolder()
+        for index in range(1, 6):
+            self.inbox.append(make_raw_message(f'<{index}@example.org>'))
+        self.client = FakeIMAPClient(folders={'INBOX': self.inbox}, capabilities=(b'IMAP4REV1', b'CONDSTORE'))
+        patcher = mock.patch('imapclient.IMAPClient', return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.service = DjangoEmailService(self.account)
+        self.service._password = 'secret'
+
+    def state(self):
+        return FolderSyncState.objects.get(folder__account=self.account, folder__name='INBOX')
+
+    def fetches(self):
+        return [command[1] for command in self.client.commands if command[0] == 'FETCH']
+
+    @override_settings(EMAIL_SYNC_BATCH_SIZE=2)
+    def test_interrupted_sync_resumes_after_the_last_batch(self):
+        fetch = self.client.fetch
+
+        def drop_on_third_batch(messages, data, modifiers=None):
+            if len(self.fetches()) == 2:  # two batches stored
+                raise OSError('Connection reset by peer')
+            return fetch(messages, data, modifiers)
+
+        self.client.fetch = drop_on_third_batch
+        result = self.service.receive_emails('INBOX')
+        self.assertFalse(result['success'])
+        state = self.state()
+        self.assertEqual((state.last_uid, state.highest_modseq), (4, None))
+        self.assertEqual(EmailMessage.objects.count(), 4)
+
+        self.client.fetch = fetch
+        self.client.commands.clear()
+        self.assertEqual(self.service.receive_emails('INBOX')['count'], 1)
+        self.assertEqual(self.fetches(), [[5]])
+        self.assertEqual(self.state().highest_modseq, self.inbox.highestmodseq)
+
+    def test_error_counters(self):
+        self.service.receive_emails('INBOX')
+        with mock.patch.object(self.client, 'folder_status', side_effect=RuntimeError('STATUS failed')):
+            self.service.receive_emails('INBOX')
+            self.service.receive_emails('INBOX')
+        state = self.state()
+        self.assertEqual((state.error_count, state.last_error), (2, 'STATUS failed'))
+        self.assertIsNotNone(state.last_error_at)
+        self.service.receive_emails('INBOX')
+        state = self.state()
+        self.assertEqual((state.error_count, state.last_error), (0, ''))
+
+    def test_full_scan_is_stamped(self):
+        self.client._capabilities = (b'IMAP4REV1',)
+        self.service.receive_emails('INBOX')
+        self.assertIsNone(self.state().last_full_scan)
+        self.inbox.expunge(2)
+        self.service.receive_emails('INBOX')
+        self.assertIsNotNone(self.state().last_full_scan)
+        self.assertEqual(EmailMessage.objects.count(), 4)
+
+    def test_message_without_message_id_is_not_duplicated(self):
+        raw = b'From: bob@example.org\r\nSubject: No id\r\n\r\nHi\r\n'
+        self.inbox.append(raw)
+        self.service.receive_emails('INBOX')
+        self.assertEqual(EmailMessage.objects.get(subject='No id').message_id,
+                         f'<{RawMessageStore.digest_of(raw)}@no-message-id>')
+        # New UIDVALIDITY: every message is fetched again but matched to its row
+        self.inbox.uidvalidity += 1
+        self.service.receive_emails('INBOX')
+        self.assertEqual(EmailMessage.objects.count(), 6)
+        self.assertFalse(EmailMessage.objects.filter(uid=None).exists())
+
+
+class IngestPipelineTests(IngestTestCase):
+    """fetch -> parse -> classify -> persist -> hooks"""
+
+    def setUp(self):
+        self.account = create_account('ada@example.com')
+        self.inbox = FakeFolder()
+        for index in range(1, 6):
+            self.inbox.append(make_raw_message(f'<{index}@example.org>', sender=f'Bob Stone <bob{index % 2}@example.org>'))
+        self.client = FakeIMAPClient(folders={'INBOX': self.inbox})
+        patcher = mock.patch('imapclient.IMAPClient', return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.service = DjangoEmailService(self.account)
+        self.service._password = 'secret'
+
+    def test_broken_message_does_not_fail_its_batch(self):
+        def parse(raw):
+            return (None, 'unparseable') if b'<2@example.org>' in raw else parse_message(raw)
+
+        with mock.patch.object(ingest_pipeline, 'parse_message', side_effect=parse):
+            result = self.service.receive_emails('INBOX')
+        self.assertEqual(result['count'], 4)
+        self.assertEqual(FolderSyncState.objects.get().last_uid, 5)
+
+    @override_settings(EMAIL_SYNC_BATCH_SIZE=2)
+    def test_stage_error_stops_after_committed_batches(self):
+        persist = self.service._persist_messages
+        calls = []
+
+        def fail_second_batch(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 2:
+                raise RuntimeError('disk full')
+            return persist(*args, **kwargs)
+
+        with mock.patch.object(self.service, '_persist_messages', side_effect=fail_second_batch):
+            result = self.service.receive_emails('INBOX')
+        self.assertEqual((result['success'], result['error']), (False, 'disk full'))
+        self.assertEqual(EmailMessage.objects.count(), 2)
+        self.assertEqual(FolderSyncState.objects.get().last_uid, 2)
+
+    def test_classify_runs_on_the_persist_thread(self):
+        threads = []
+        classify = self.service._classify
+
+        def record(email_data):
+            threads.append(threading.current_thread().name)
+            return classify(email_data)
+
+        pipeline = ingest_pipeline.IngestPipeline(self.service, None, None)
+        self.assertEqual([stage.name for stage in pipeline._stages], ['mail-ingest-parse', 'mail-ingest-persist'])
+        with mock.patch.object(self.service, '_classify', side_effect=record):
+            self.assertEqual(self.service.receive_emails('INBOX')['count'], 5)
+        self.assertEqual(len(threads), 5)
+        self.assertEqual(set(threads), {'mail-ingest-persist'})
+
+    def test_hooks_run_after_commit(self):
+        seen = []
+        hook = ingest_pipeline.register_hook(lambda account, messages: seen.append((account.email, messages.count())))
+        self.addCleanup(ingest_pipeline._registered_hooks.remove, hook)
+        self.service.receive_emails('INBOX')
+        self.assertTrue(ingest_pipeline.hook_runner.drain(timeout=5))
+        self.assertEqual(seen, [('ada@example.com', 5)])
+
+    def test_extract_contacts(self):
+        Contact.objects.create(user=self.account.user, email='bob1@example.org', first_name='Bob', last_name='')
+        self.service.receive_emails('INBOX')
+        self.inbox.append(make_raw_message('<own@example.org>', sender='Ada <ada@example.com>'))
+        self.service.receive_emails('INBOX')
+        extract_contacts(self.account, EmailMessage.objects.all())
+        contacts = {contact.email: contact for contact in Contact.objects.all()}
+        self.assertEqual(set(contacts), {'bob0@example.org', 'bob1@example.org'})
+        self.assertEqual((contacts['bob0@example.org'].first_name, contacts['bob0@example.org'].last_name,
+                          contacts['bob0@example.org'].source), ('Bob', 'Stone', 'email'))
+        self.assertIsNotNone(contacts['bob1@example.org'].last_contacted)
+
+    @override_settings(EMAIL_INGEST_PARSE_PROCESSES=1)
+    def test_parse_in_worker_process(self):
+        self.addCleanup(ingest_pipeline._reset_parse_pool)
+        raws = [make_raw_message(f'<{index}@example.org>', subject=f'Message {index}') for index in range(3)]
+        parsed = ingest_pipeline.parse_raw_messages(raws)
+        self.assertEqual([email_data['subject'] for email_data, _ in parsed], ['Message 0', 'Message 1', 'Message 2'])
+        self.assertEqual(parsed, [parse_message(raw) for raw in raws])
+
+
+class MessageLocationTests(IngestTestCase):
+    """Message-ID / (uidvalidity, uid) -> folder index"""
+
+    def setUp(self):
+        self.account = create_account('ada@example.com')
+        self.server = {'INBOX': FakeFolder(uidvalidity=7), 'Archive': FakeFolder(uidvalidity=9)}
+        for index in range(1, 4):
+            self.server['INBOX'].append(make_raw_message(f'<{index}@example.org>'))
+        self.server['Archive'].append(make_raw_message('<1@example.org>'))
+        patcher = mock.patch('imapclient.IMAPClient', return_value=FakeIMAPClient(
+            folders=self.server, capabilities=(b'IMAP4REV1', b'CONDSTORE', b'QRESYNC')))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.service = DjangoEmailService(self.account)
+        self.service._password = 'secret'
+        self.service.sync_folders(['INBOX', 'Archive'])
+
+    def locations(self, mailbox):
+        return sorted(MessageLocation.objects.filter(folder__name=mailbox).values_list('uidvalidity', 'uid', 'message_id'))
+
+    def test_sync_records_every_fetched_uid(self):
+        self.assertEqual(self.locations('INBOX'), [(7, 1, '<1@example.org>'), (7, 2, '<2@example.org>'),
+                                                   (7, 3, '<3@example.org>')])
+        # Stored once as an EmailMessage, but located in both folders
+        self.assertEqual(self.locations('Archive'), [(9, 1, '<1@example.org>')])
+
+    def test_vanished_and_reset_locations_are_dropped(self):
+        self.server['INBOX'].expunge(2)
+        self.server['Archive'].uidvalidity = 10
+        self.service.sync_folders(['INBOX', 'Archive'])
+        self.assertEqual([uid for _, uid, _ in self.locations('INBOX')], [1, 3])
+        self.assertEqual(self.locations('Archive'), [(10, 1, '<1@example.org>')])
+
+    def test_locate(self):
+        location = locate(self.account, ref='9:1')
+        self.assertEqual((location.mailbox, location.ref, location.message_id), ('Archive', '9:1', '<1@example.org>'))
+        self.assertEqual(locate(self.account, message_id='<2@example.org>').ref, '7:2')
+        self.assertEqual(locate(self.account, ref='5:1', message_id='<3@example.org>').ref, '7:3')
+        self.assertIsNone(locate(self.account, ref='2'))
+        self.assertIsNone(locate(create_account('eve@example.net'), ref='9:1'))
+
+    def test_delete_drops_locations(self):
+        apply_action_results(self.account, 'INBOX', 7, 'delete', {1: {'status': 'ok'}, 2: {'status': 'failed'}})
+        self.assertEqual([uid for _, uid, _ in self.locations('INBOX')], [2, 3])
+
+    def test_move_follows_copyuid(self):
+        apply_action_results(self.account, 'INBOX', 7, 'move',
+                             {2: {'status': 'ok', 'id': '9:40'}, 3: {'status': 'ok'}}, 'Archive')
+        self.assertEqual([uid for _, uid, _ in self.locations('INBOX')], [1])
+        # UID 3 came without COPYUID: the next sync of Archive records it
+        self.assertEqual(self.locations('Archive'), [(9, 1, '<1@example.org>'), (9, 40, '<2@example.org>')])
+
+    def test_flag_actions_leave_the_index_alone(self):
+        apply_action_results(self.account, 'INBOX', 7, 'mark_read', {1: {'status': 'ok'}})
+        self.assertEqual(len(self.locations('INBOX')), 3)
+
+
+class ActionResultsTests(TestCase):
+    """apply_action_results() keeps stored messages and folder counters in step with the actions"""
+
+    def setUp(self):
+        self.account = create_account('ada@example.com')
+        self.inbox = EmailFolder.objects.create(account=self.account, name='INBOX', display_name='Inbox')
+        self.archive = EmailFolder.objects.create(account=self.account, name='Archive', display_name='Archive')
+        now = timezone.now()
+        for uid in range(1, 5):
+            EmailMessage.objects.create(folder=self.inbox, message_id=f'<{uid}@example.org>', uid=str(uid),
+                                        subject='Hi', sender='bob@example.org', to_recipients=['ada@example.com'],
+                                        date_sent=now, date_received=now, is_read=uid == 1)
+        EmailFolder.reconcile_counts()
+
+    def apply(self, action, results, target_folder=None):
+        apply_action_results(self.account, 'INBOX', 7, action, results, target_folder)
+
+    def counts(self, folder):
+        folder.refresh_from_db()
+        return folder.total_count, folder.unread_count
+
+    def stored(self, folder):
+        return dict(folder.messages.values_list('message_id', 'uid'))
+
+    def test_read_state(self):
+        self.apply('mark_read', {1: {'status': 'ok'}, 2: {'status': 'ok'}, 3: {'status': 'not_found'}})
+        self.assertEqual(set(EmailMessage.objects.filter(is_read=True).values_list('uid', flat=True)), {'1', '2'})
+        # Only UID 2 flipped
+        self.assertEqual(self.counts(self.inbox), (4, 2))
+        self.apply('mark_unread', {1: {'status': 'ok'}, 4: {'status': 'failed', 'error': 'NO'}})
+        self.assertEqual(self.counts(self.inbox), (4, 3))
+        self.assertEqual(EmailFolder.reconcile_counts(), 0)
+
+    def test_star(self):
+        self.apply('star', {2: {'status': 'ok'}})
+        self.assertEqual(list(EmailMessage.objects.filter(is_starred=True).values_list('uid', flat=True)), ['2'])
+        self.assertEqual(self.counts(self.inbox), (4, 3))
+
+    def test_delete(self):
+        self.apply('delete', {1: {'status': 'ok'}, 2: {'status': 'not_found'}, 3: {'status': 'failed'}})
+        self.assertEqual(sorted(self.stored(self.inbox).values()), ['3', '4'])
+        self.assertEqual(self.counts(self.inbox), (2, 2))
+
+    def test_move(self):
+        self.apply('move', {1: {'status': 'ok', 'id': '9:40'}, 2: {'status': 'ok'}, 3: {'status': 'not_found'},
+                            4: {'status': 'failed'}}, 'Archive')
+        self.assertEqual(self.stored(self.inbox), {'<4@example.org>': '4'})
+        # Without COPYUID the next sync of Archive re-links the UID
+        self.assertEqual(self.stored(self.archive), {'<1@example.org>': '40', '<2@example.org>': None})
+        self.assertEqual(self.counts(self.inbox), (1, 1))
+        self.assertEqual(self.counts(self.archive), (2, 1))
+        self.assertEqual(EmailFolder.reconcile_counts(), 0)
+
+    def test_move_to_unsynced_folder(self):
+        self.apply('move', {2: {'status': 'ok'}}, 'Projects')
+        self.assertNotIn('<2@example.org>', self.stored(self.inbox))
+        self.assertEqual(self.counts(self.inbox), (3, 2))
+
+    def test_unknown_mailbox(self):
+        apply_action_results(self.account, 'Projects', 7, 'mark_read', {1: {'status': 'ok'}})
+        self.assertEqual(self.counts(self.inbox), (4, 3))
+
+
+class MessageActionViewTests(TestCase):
+    """mark-read, mark-unread, delete and move views update stored messages and counters"""
+
+    def setUp(self):
+        self.account = create_account('ada@example.com')
+        self.client.force_login(self.account.user)
+        session = self.client.session
+        session['email_password'] = 'secret'
+        session.save()
+
+        self.server = {'INBOX': FakeFolder(uidvalidity=7), 'Archive': FakeFolder(uidvalidity=9),
+                       'Trash': FakeFolder(uidvalidity=11)}
+        self.folders = {name: EmailFolder.objects.create(account=self.account, name=name, display_name=name)
+                        for name in self.server}
+        now = timezone.now()
+        for index in range(1, 4):
+            flags = ('\\Seen',) if index == 1 else ()
+            uid = self.server['INBOX'].append(make_raw_message(f'<{index}@example.org>'), flags)
+            EmailMessage.objects.create(folder=self.folders['INBOX'], message_id=f'<{index}@example.org>',
+                                        uid=str(uid), subject='Hi', sender='bob@example.org',
+                                        to_recipients=['ada@example.com'], date_sent=now, date_received=now,
+                                        is_read=index == 1)
+        EmailFolder.reconcile_counts()
+
+        self.conn = FakeIMAP(folders=self.server, capabilities=('IMAP4REV1', 'MOVE', 'UIDPLUS'))
+        self.conn.select('INBOX')
+        self.conn.uidvalidity = 7
+        patcher = mock.patch('mail.views.imap_pool')
+        patcher.start().session.return_value = contextlib.nullcontext(self.conn)
+        self.addCleanup(patcher.stop)
+
+    def post(self, name, ref, query='', **data):
+        response = self.client.post(reverse(f'mail:{name}', args=[ref]) + query, data)
+        self.assertEqual(response.json(), {'success': True})
+
+    def counts(self, name):
+        folder = self.folders[name]
+        folder.refresh_from_db()
+        return folder.total_count, folder.unread_count
+
+    def unread(self):
+        return set(EmailMessage.objects.filter(is_read=False).values_list('message_id', flat=True))
+
+    def test_mark_as_read(self):
+        self.post('mark_read', '7:2')
+        self.assertIn('\\Seen', self.server['INBOX'].messages[2].flags)
+        self.assertEqual(self.unread(), {'<3@example.org>'})
+        self.assertEqual(self.counts('INBOX'), (3, 1))
+
+    def test_mark_as_unread(self):
+        self.post('mark_unread', '7:1')
+        self.assertEqual(len(self.unread()), 3)
+        self.assertEqual(self.counts('INBOX'), (3, 3))
+
+    def test_delete_moves_to_trash(self):
+        self.post('delete_message', '7:2')
+        message = EmailMessage.objects.get(message_id='<2@example.org>')
+        self.assertEqual((message.folder.name, message.uid), ('Trash', '1'))
+        self.assertEqual(self.counts('INBOX'), (2, 1))
+        self.assertEqual(self.counts('Trash'), (1, 1))
+
+    def test_permanent_delete(self):
+        self.post('delete_message', '7:3', query='?permanent=true')
+        self.assertFalse(EmailMessage.objects.filter(message_id='<3@example.org>').exists())
+        self.assertEqual(self.counts('INBOX'), (2, 1))
+        self.assertEqual(self.counts('Trash'), (0, 0))
+
+    def test_move(self):
+        self.post('move_message', '7:1', folder_id='Archive', current_folder='INBOX')
+        self.assertEqual(EmailMessage.objects.get(message_id='<1@example.org>').folder.name, 'Archive')
+        self.assertEqual(self.counts('INBOX'), (2, 2))
+        self.assertEqual(self.counts('Archive'), (1, 0))
+
+
+class SMTPPoolTests(TestCase):
+    """Pooled SMTP connections: reuse per sender and password, RSET on release, expiry and health checks"""
+
+    def setUp(self):
+        self.now = 1000.0
+        self.opened = []
+        patcher = mock.patch('mail.services.smtp_pool.smtplib.SMTP', side_effect=self.open_connection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('mail.services.smtp_pool.resolve_smtp_host', return_value='smtp.example.com')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('mail.services.smtp_pool.time')
+        patcher.start().monotonic.side_effect = lambda: self.now
+        self.addCleanup(patcher.stop)
+        self.password = 'secret'
+        self.pool = SMTPSessionPool(max_size=4, max_per_account=2, idle_timeout=60, noop_interval=15)
+
+    def open_connection(self, host, port, timeout=None):
+        conn = FakeSMTP(host, port, timeout, password=self.password)
+        self.opened.append(conn)
+        return conn
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def test_connection_is_reused_and_reset(self):
+        conn = self.pool.acquire('ada@example.com', 'secret')
+        self.pool.release(conn)
+        self.assertIs(self.pool.acquire('ADA@example.com', 'secret'), conn)
+        self.assertEqual(len(self.opened), 1)
+        self.assertEqual(conn.commands, [('STARTTLS',), ('AUTH', 'ada@example.com'), ('RSET',)])
+
+    def test_connections_are_keyed_by_password(self):
+        conn = self.pool.acquire('ada@example.com', 'secret')
+        self.pool.release(conn)
+        with self.assertRaises(smtplib.SMTPAuthenticationError):
+            self.pool.acquire('ada@example.com', 'wrong')
+        self.assertTrue(self.opened[1].closed)
+        self.assertIs(self.pool.acquire('ada@example.com', 'secret'), conn)
+
+    def test_failed_rset_discards_connection(self):
+        conn = self.pool.acquire('ada@example.com', 'secret')
+        conn.rset_code = 421
+        self.pool.release(conn)
+        self.assertEqual(conn.commands[-1], ('QUIT',))
+        self.assertEqual(self.pool._open_count, 0)
+        self.assertIsNot(self.pool.acquire('ada@example.com', 'secret'), conn)
+
+    def test_idle_connection_expires(self):
+        conn = self.pool.acquire('ada@example.com', 'secret')
+        self.pool.release(conn)
+        self.now += 61
+        self.assertIsNot(self.pool.acquire('ada@example.com', 'secret'), conn)
+        self.assertEqual(conn.commands[-1], ('QUIT',))
+
+    def test_long_idle_connection_is_checked_with_noop(self):
+        conn = self.pool.acquire('ada@example.com', 'secret')
+        self.pool.release(conn)
+        self.now += 10
+        self.assertIs(self.pool.acquire('ada@example.com', 'secret'), conn)
+        self.assertNotIn(('NOOP',), conn.commands)
+        self.pool.release(conn)
+        self.now += 30
+        self.assertIs(self.pool.acquire('ada@example.com', 'secret'), conn)
+        self.assertEqual(conn.commands[-1], ('NOOP',))
+
+    def test_dead_connection_is_replaced(self):
+        conn = self.pool.acquire('ada@example.com', 'secret')
+        self.pool.release(conn)
+        conn.alive = False
+        self.now += 30
+        self.assertIsNot(self.pool.acquire('ada@example.com', 'secret'), conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(len(self.opened), 2)
+
+    def test_max_per_account_counts_leased_connections(self):
+        for _ in range(2):
+            self.pool.acquire('ada@example.com', 'secret')
+        with mock.patch.object(self.pool._freed, 'wait', side_effect=self.advance):
+            with self.assertRaises(SMTPPoolExhausted):
+                self.pool.acquire('ada@example.com', 'secret')
+        self.assertEqual(len(self.opened), 2)
+        self.assertIsNotNone(self.pool.acquire('bob@example.com', 'secret'))
+
+    def test_acquire_waits_for_a_released_connection(self):
+        connections = [self.pool.acquire('ada@example.com', 'secret') for _ in range(2)]
+        acquired = []
+        waiter = threading.Thread(target=lambda: acquired.append(self.pool.acquire('ada@example.com', 'secret')))
+        waiter.start()
+        self.pool.release(connections[0])
+        waiter.join(5)
+        self.assertEqual(acquired, [connections[0]])
+        self.assertEqual(connections[0].commands[-1], ('RSET',))
+
+    def test_full_pool_closes_least_recently_used_idle_connection(self):
+        for index in range(4):
+            self.now += 1
+            self.pool.release(self.pool.acquire(f'user{index}@example.com', 'secret'))
+        self.pool.acquire('ada@example.com', 'secret')
+        self.assertEqual(self.opened[0].commands[-1], ('QUIT',))
+        self.assertEqual([conn.closed for conn in self.opened], [True, False, False, False, False])
+        self.assertEqual(self.pool._open_count, 4)
+
+    def test_idle_connection_of_an_old_password_gives_way(self):
+        connections = [self.pool.acquire('ada@example.com', 'secret') for _ in range(2)]
+        for conn in connections:
+            self.pool.release(conn)
+        self.password = 'changed'
+        self.pool.acquire('ada@example.com', 'changed')
+        self.assertEqual(connections[0].commands[-1], ('QUIT',))
+        self.assertEqual(self.pool._per_account['ada@example.com'], 2)
+
+    def test_failed_login_frees_its_slot(self):
+        for _ in range(3):
+            with self.assertRaises(smtplib.SMTPAuthenticationError):
+                self.pool.acquire('ada@example.com', 'wrong')
+        self.assertEqual((self.pool._open_count, dict(self.pool._per_account)), (0, {}))
+
+    def test_session_discards_connection_on_smtp_error(self):
+        for error in (smtplib.SMTPServerDisconnected('Connection unexpectedly closed'), OSError('Connection reset'),
+                      smtplib.SMTPDataError(451, b'4.3.0 Error: queue file write error')):
+            with self.assertRaises(type(error)):
+                with self.pool.session('ada@example.com', 'secret') as conn:
+                    raise error
+            self.assertTrue(conn.closed)
+            self.assertEqual(self.pool._open_count, 0)
+
+    def test_session_is_released_after_command_error(self):
+        with self.assertRaises(ValueError):
+            with self.pool.session('ada@example.com', 'secret') as conn:
+                raise ValueError('bad address')
+        self.assertEqual(conn.commands[-1], ('RSET',))
+        self.assertIs(self.pool.acquire('ada@example.com', 'secret'), conn)
+
+    def test_close_account(self):
+        mine = self.pool.acquire('ada@example.com', 'secret')
+        theirs = self.pool.acquire('bob@example.com', 'secret')
+        self.pool.release(mine)
+        self.pool.release(theirs)
+        self.pool.close_account('Ada@example.com')
+        self.assertEqual(mine.commands[-1], ('QUIT',))
+        self.assertIs(self.pool.acquire('bob@example.com', 'secret'), theirs)
+
+    def test_backend_borrows_pooled_connection(self):
+        with mock.patch('mail.services.smtp_pool.smtp_pool', self.pool):
+            for _ in range(2):
+                backend = get_connection('mail.backends.PooledSMTPBackend',
+                                         username='ada@example.com', password='secret')
+                sent = backend.send_messages([
+                    DjangoEmailMessage('Hi', 'Body', 'ada@example.com', ['bob@example.org']),
+                ])
+                self.assertEqual(sent, 1)
+        self.assertEqual(len(self.opened), 1)
+        self.assertEqual(len(self.opened[0].sent), 2)
+        self.assertEqual(self.opened[0].commands[-1], ('RSET',))
+
+    def test_send_email_uses_account_credentials(self):
+        account = create_account('ada@example.com')
+        service = DjangoEmailService(account)
+        service._password = 'secret'
+        with mock.patch('mail.services.smtp_pool.smtp_pool', self.pool), \
+                mock.patch.object(DjangoEmailService, '_save_sent_to_imap', return_value=[None]), \
+                override_settings(EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD=''):
+            result = service.send_email(['bob@example.org'], 'Hi', 'Body')
+            self.assertEqual(settings.EMAIL_HOST_USER, '')
+        self.assertTrue(result['success'], result['error'])
+        conn = self.opened[0]
+        self.assertIn(('AUTH', 'ada@example.com'), conn.commands)
+        self.assertIn(f'Message-ID: {result["message_id"]}'.encode(), conn.sent[0])
+        self.assertTrue(EmailMessage.objects.filter(folder__name='Sent', subject='Hi').exists())
+
+
+@with_credential_key
+class CredentialsTests(TestCase):
+    """Sealing stored SMTP passwords"""
+
+    def test_seal_round_trip(self):
+        sealed = credentials.seal('s3cret:pässword')
+        self.assertNotIn('s3cret', sealed)
+        self.assertEqual(credentials.unseal(sealed), 's3cret:pässword')
+
+    def test_same_password_seals_differently(self):
+        self.assertNotEqual(credentials.seal('secret'), credentials.seal('secret'))
+
+    def test_empty_password(self):
+        self.assertEqual(credentials.seal(''), '')
+        self.assertEqual(credentials.seal(None), '')
+        self.assertIsNone(credentials.unseal(''))
+
+    def test_expired_password_is_refused(self):
+        sealed = credentials.seal('secret')
+        with mock.patch('cryptography.fernet.time.time', return_value=time.time() + 120):
+            self.assertIsNone(credentials.unseal(sealed, max_age=60))
+            self.assertEqual(credentials.unseal(sealed, max_age=600), 'secret')
+
+    def test_tampered_or_foreign_key_is_refused(self):
+        sealed = credentials.seal('secret')
+        self.assertIsNone(credentials.unseal(sealed[:-4] + 'AAAA'))
+        with override_settings(EMAIL_CREDENTIAL_KEY=Fernet.generate_key().decode('ascii')):
+            self.assertIsNone(credentials.unseal(sealed))
+
+    def test_plaintext_is_not_a_password(self):
+        self.assertIsNone(credentials.unseal('secret'))
+        self.assertIsNone(credentials.unseal('pässword'))
+
+    def test_key_is_required(self):
+        for key in ('', 'not-a-fernet-key'):
+            with override_settings(EMAIL_CREDENTIAL_KEY=key):
+                with self.assertRaises(ImproperlyConfigured):
+                    credentials.seal('secret')
+        # SECRET_KEY is not a fallback
+        with override_settings(EMAIL_CREDENTIAL_KEY='', SECRET_KEY=Fernet.generate_key().decode('ascii')):
+            with self.assertRaises(ImproperlyConfigured):
+                credentials.seal('secret')
+
+
+@with_credential_key
+class OutboxQueueTests(TestCase):
+    """Claiming due messages and deciding what happens to failed ones"""
+
+    def setUp(self):
+        self.account = create_account('ada@example.com')
+        self.other = create_account('bob@example.org')
+
+    def enqueue(self, account, delay=0):
+        entry = outbox.enqueue(account, ['rcpt@example.net'], 'Subject', 'Body', password='secret')
+        OutboxMessage.objects.filter(pk=entry.pk).update(next_attempt_at=timezone.now() + timedelta(seconds=delay))
+        return entry.pk
+
+    def test_enqueue_renders_message(self):
+        entry = outbox.enqueue(self.account, ['rcpt@example.net'], 'Hi', 'Body', '<p>Body</p>',
+                               bcc_emails=['hidden@example.net'], password='secret')
+        raw = bytes(entry.raw)
+        self.assertIn(f'Message-ID: {entry.message_id}'.encode(), raw)
+        self.assertNotIn(b'hidden@example.net', raw)
+        self.assertEqual(entry.recipients, ['rcpt@example.net', 'hidden@example.net'])
+        self.assertEqual((entry.status, entry.attempts), (OutboxMessage.STATUS_QUEUED, 0))
+        # Only the sealed password is stored
+        self.assertNotIn('secret', entry.smtp_password)
+        self.assertEqual(credentials.unseal(entry.smtp_password), 'secret')
+
+    def test_claim_due_messages_in_order(self):
+        later = self.enqueue(self.account, delay=-10)
+        first = self.enqueue(self.account, delay=-60)
+        self.enqueue(self.account, delay=60)
+        claimed = outbox.claim(5)
+        self.assertEqual([entry.pk for entry in claimed], [first, later])
+        for entry in claimed:
+            self.assertEqual((entry.status, entry.attempts), (OutboxMessage.STATUS_SENDING, 1))
+            self.assertIsNotNone(entry.locked_at)
+        self.assertEqual(outbox.claim(5), [])
+
+    def test_claim_limit(self):
+        pks = [self.enqueue(self.account, delay=-index) for index in range(3)]
+        self.assertEqual([entry.pk for entry in outbox.claim(2)], [pks[2], pks[1]])
+        self.assertEqual(OutboxMessage.objects.filter(status=OutboxMessage.STATUS_QUEUED).count(), 1)
+
+    def test_claim_caps_messages_per_domain(self):
+        mine = [self.enqueue(self.account, delay=-60 + index) for index in range(3)]
+        theirs = self.enqueue(self.other, delay=-1)
+        claimed = outbox.claim(4, max_per_domain=2)
+        self.assertEqual([entry.pk for entry in claimed], mine[:2] + [theirs])
+
+        busy = {self.account.domain_id: 2}
+        self.assertEqual(outbox.claim(4, max_per_domain=2, busy=busy), [])
+        self.assertEqual([entry.pk for entry in outbox.claim(4, max_per_domain=2, busy={})], mine[2:])
+
+    def test_claim_skips_throttled_buckets(self):
+        mine = self.enqueue(self.account, delay=-2)
+        theirs = self.enqueue(self.other, delay=-1)
+        domain = rate_limit.Bucket('domain', self.account.domain_id, 10, 1.0)
+        self.assertEqual([entry.pk for entry in outbox.claim(5, throttled=[domain])], [theirs])
+        account = rate_limit.Bucket('account', self.other.pk, 10, 1.0)
+        OutboxMessage.objects.filter(pk=theirs).update(status=OutboxMessage.STATUS_QUEUED)
+        self.assertEqual([entry.pk for entry in outbox.claim(5, throttled=[account])], [mine])
+
+    def test_defer_does_not_count_an_attempt(self):
+        self.enqueue(self.account, delay=-1)
+        entry = outbox.claim(1)[0]
+        outbox.defer(entry, 30)
+        entry.refresh_from_db()
+        self.assertEqual((entry.status, entry.attempts, entry.locked_at), (OutboxMessage.STATUS_QUEUED, 0, None))
+        self.assertGreater(entry.next_attempt_at, timezone.now() + timedelta(seconds=25))
+
+    def test_recover_stale(self):
+        self.enqueue(self.account, delay=-1)
+        entry = outbox.claim(1)[0]
+        self.assertEqual(outbox.recover_stale(lease=600), 0)
+        OutboxMessage.objects.filter(pk=entry.pk).update(locked_at=timezone.now() - timedelta(seconds=700))
+        self.assertEqual(outbox.recover_stale(lease=600), 1)
+        self.assertEqual([claimed.pk for claimed in outbox.claim(1)], [entry.pk])
+
+    def test_is_permanent(self):
+        self.assertTrue(outbox.is_permanent(smtplib.SMTPDataError(554, b'Rejected')))
+        self.assertTrue(outbox.is_permanent(smtplib.SMTPSenderRefused(553, b'Nope', 'ada@example.com')))
+        self.assertFalse(outbox.is_permanent(smtplib.SMTPDataError(451, b'Later')))
+        self.assertFalse(outbox.is_permanent(smtplib.SMTPAuthenticationError(535, b'Bad credentials')))
+        self.assertFalse(outbox.is_permanent(smtplib.SMTPServerDisconnected('gone')))
+        self.assertFalse(outbox.is_permanent(OSError('Connection refused')))
+        refused = {'a@example.net': (550, b'No such user'), 'b@example.net': (552, b'Mailbox full')}
+        self.assertTrue(outbox.is_permanent(smtplib.SMTPRecipientsRefused(refused)))
+        refused['c@example.net'] = (450, b'Greylisted')
+        self.assertFalse(outbox.is_permanent(smtplib.SMTPRecipientsRefused(refused)))
+
+    def test_retry_delay_doubles_up_to_the_ceiling(self):
+        with mock.patch.object(outbox.random, 'uniform', side_effect=lambda low, high: 1.0):
+            self.assertEqual([outbox.retry_delay(attempts) for attempts in (0, 1, 2, 3, 7, 20)],
+                             [60, 60, 120, 240, 3600, 3600])
+
+    def test_retry_delay_jitter(self):
+        delays = {outbox.retry_delay(2) for _ in range(50)}
+        self.assertGreater(len(delays), 1)
+        self.assertTrue(all(120 * 0.8 <= delay <= 120 * 1.2 for delay in delays))
+
+
+@with_credential_key
+class OutboxDeliveryTests(TestCase):
+    """deliver(): one claimed message over SMTP, then the Sent copy, or a recorded failure"""
+
+    def setUp(self):
+        self.account = create_account('ada@example.com')
+        self.pool = FakeSMTPPool()
+        patcher = mock.patch('mail.services.outbox.smtp_pool', self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(DjangoEmailService, '_save_sent_to_imap')
+        self.save_sent = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def claim(self, password='secret'):
+        outbox.enqueue(self.account, ['rcpt@example.net'], 'Report', 'Body', bcc_emails=['hidden@example.net'],
+                       password=password)
+        return outbox.claim(1)[0]
+
+    def test_sent(self):
+        entry = self.claim()
+        self.assertEqual(outbox.deliver(entry), OutboxMessage.STATUS_SENT)
+        conn = self.pool.connections[0]
+        self.assertEqual(conn.commands, [('SENDMAIL', 'ada@example.com', ('rcpt@example.net', 'hidden@example.net'))])
+        self.assertEqual(conn.sent, [bytes(entry.raw)])
+
+        # The password stays for file_sent_copies()
+        entry.refresh_from_db()
+        self.assertEqual((entry.status, credentials.unseal(entry.smtp_password), entry.locked_at),
+                         (OutboxMessage.STATUS_SENT, 'secret', None))
+        self.assertIsNotNone(entry.sent_at)
+
+    def test_file_sent_copies(self):
+        entries = [self.claim(), self.claim(password=None)]
+        for entry in entries:
+            outbox.deliver(entry)
+        self.save_sent.return_value = ['9:1', None]
+        outbox.file_sent_copies(self.account, entries)
+        self.assertEqual(self.save_sent.call_args.args, tuple(bytes(entry.raw) for entry in entries))
+
+        stored = EmailMessage.objects.filter(folder__name='Sent').order_by('pk')
+        self.assertEqual([(message.message_id, message.uid) for message in stored],
+                         [(entries[0].message_id, '1'), (entries[1].message_id, None)])
+        self.assertEqual(locate(self.account, ref='9:1').message_id, entries[0].message_id)
+        self.assertFalse(OutboxMessage.objects.exclude(smtp_password='').exists())
+
+    def test_failed_sent_copy_still_stores_message(self):
+        self.save_sent.side_effect = OSError('IMAP down')
+        entry = self.claim()
+        outbox.deliver(entry)
+        outbox.file_sent_copies(self.account, [entry])
+        self.assertEqual(EmailMessage.objects.get(folder__name='Sent').message_id, entry.message_id)
+        entry.refresh_from_db()
+        self.assertEqual(entry.smtp_password, '')
+
+    def test_recover_stale_clears_passwords_of_sent_messages(self):
+        entry = self.claim()
+        outbox.deliver(entry)
+        OutboxMessage.objects.filter(pk=entry.pk).update(sent_at=timezone.now() - timedelta(seconds=700))
+        outbox.recover_stale(lease=600)
+        entry.refresh_from_db()
+        self.assertEqual((entry.status, entry.smtp_password), (OutboxMessage.STATUS_SENT, ''))
+
+    def test_temporary_failure_is_retried(self):
+        self.pool.error = smtplib.SMTPDataError(451, b'4.3.0 Try again later')
+        entry = self.claim()
+        self.assertEqual(outbox.deliver(entry), OutboxMessage.STATUS_QUEUED)
+        entry.refresh_from_db()
+        self.assertEqual((entry.status, credentials.unseal(entry.smtp_password), entry.locked_at),
+                         (OutboxMessage.STATUS_QUEUED, 'secret', None))
+        self.assertIn('Try again later', entry.last_error)
+        self.assertGreater(entry.next_attempt_at, timezone.now() + timedelta(seconds=30))
+        self.assertFalse(EmailMessage.objects.filter(folder__name='Sent').exists())
+
+    def test_permanent_failure(self):
+        self.pool.error = smtplib.SMTPDataError(554, b'5.7.1 Rejected as spam')
+        entry = self.claim()
+        self.assertEqual(outbox.deliver(entry), OutboxMessage.STATUS_FAILED)
+        entry.refresh_from_db()
+        self.assertEqual((entry.status, entry.smtp_password), (OutboxMessage.STATUS_FAILED, ''))
+
+    @override_settings(EMAIL_OUTBOX_MAX_ATTEMPTS=2)
+    def test_gives_up_after_max_attempts(self):
+        self.pool.error = OSError('Connection refused')
+        entry = self.claim()
+        self.assertEqual(outbox.deliver(entry), OutboxMessage.STATUS_QUEUED)
+        OutboxMessage.objects.filter(pk=entry.pk).update(next_attempt_at=timezone.now())
+        self.assertEqual(outbox.deliver(outbox.claim(1)[0]), OutboxMessage.STATUS_FAILED)
+        entry.refresh_from_db()
+        self.assertEqual(entry.smtp_password, '')
+        self.assertEqual(self.pool.passwords, ['secret', 'secret'])
+
+    def test_fallback_password(self):
+        outbox.deliver(self.claim(password=None), password='fallback')
+        outbox.deliver(self.claim(), password='fallback')
+        self.assertEqual(self.pool.passwords, ['fallback', 'secret'])
+
+
+@with_credential_key
+class OutboxWorkerTests(TransactionTestCase):
+    """run_outbox_worker delivers from worker threads, which only see committed rows"""
+
+    def setUp(self):
+        self.account = create_account('ada@example.com')
+        self.pool = FakeSMTPPool()
+        patcher = mock.patch('mail.services.outbox.smtp_pool', self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(DjangoEmailService, '_save_sent_to_imap', side_effect=lambda *raw: [None] * len(raw))
+        self.save_sent = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_run_once(self):
+        for index in range(3):
+            outbox.enqueue(self.account, ['rcpt@example.net'], f'Message {index}', 'Body', password='secret')
+        outbox.enqueue(self.account, ['rcpt@example.net'], 'Later', 'Body', password='secret')
+        OutboxMessage.objects.filter(subject='Later').update(next_attempt_at=timezone.now() + timedelta(hours=1))
+        out = io.StringIO()
+        call_command('run_outbox_worker', '--once', '--workers', '2', stdout=out)
+        self.assertIn('3 sent, 0 to retry, 0 failed', out.getvalue())
+        self.assertEqual(sum(len(conn.sent) for conn in self.pool.connections), 3)
+        self.assertEqual(OutboxMessage.objects.filter(status=OutboxMessage.STATUS_SENT).count(), 3)
+        self.assertEqual(OutboxMessage.objects.get(subject='Later').status, OutboxMessage.STATUS_QUEUED)
+        # Sent copies of one account are filed together
+        self.assertEqual(EmailMessage.objects.filter(folder__name='Sent').count(), 3)
+        self.assertEqual(sum(len(call.args) for call in self.save_sent.call_args_list), 3)
+        self.assertFalse(OutboxMessage.objects.filter(status=OutboxMessage.STATUS_SENT).exclude(smtp_password='').exists())
+
+
+class IMAPAppendTests(TestCase):
+    """Sent copies appended with MULTIAPPEND where possible, their UIDs read from APPENDUID"""
+
+    def setUp(self):
+        self.sent = FakeFolder(uidvalidity=9)
+        self.conn = FakeIMAP(folders={'INBOX': FakeFolder(), 'Sent': self.sent},
+                             capabilities=('IMAP4REV1', 'UIDPLUS', 'MULTIAPPEND'))
+        self.messages = [make_raw_message(f'<{index}@example.com>').replace(b'\r\n', b'\n') for index in range(3)]
+
+    def test_multiappend(self):
+        self.assertEqual(append_messages(self.conn, 'Sent', self.messages), ['9:1', '9:2', '9:3'])
+        self.assertEqual(self.conn.commands, [('APPEND', 'Sent', 3)])
+        self.assertEqual([message.raw for message in self.sent.messages.values()],
+                         [message.replace(b'\n', b'\r\n') for message in self.messages])
+        self.assertEqual(set(self.sent.messages[1].flags), {'\\Seen'})
+
+    def test_multiappend_in_batches(self):
+        with mock.patch('mail.services.imap_append.MULTIAPPEND_BATCH', 2):
+            self.assertEqual(append_messages(self.conn, 'Sent', self.messages), ['9:1', '9:2', '9:3'])
+        self.assertEqual(self.conn.commands, [('APPEND', 'Sent', 2), ('APPEND', 'Sent', 1)])
+
+    def test_one_append_per_message_without_multiappend(self):
+        self.conn.capabilities = ('IMAP4REV1', 'UIDPLUS')
+        self.assertEqual(append_messages(self.conn, 'Sent', self.messages[:2]), ['9:1', '9:2'])
+        self.assertEqual(self.conn.commands, [('APPEND', 'Sent', 1), ('APPEND', 'Sent', 1)])
+
+    def test_no_uids_without_uidplus(self):
+        self.conn.capabilities = ('IMAP4REV1', 'MULTIAPPEND')
+        self.assertEqual(append_messages(self.conn, 'Sent', self.messages[:2]), [None, None])
+        self.assertEqual(len(self.sent.messages), 2)
+
+    def test_mailbox_created_on_trycreate(self):
+        del self.conn.folders['Sent']
+        self.assertEqual(append_messages(self.conn, 'Sent', self.messages[:1]), ['7:1'])
+        self.assertEqual(self.conn.commands, [('APPEND', 'Sent', 1), ('CREATE', 'Sent'), ('APPEND', 'Sent', 1)])
+
+    def test_send_email_stores_sent_copy_location(self):
+        account = create_account('ada@example.com')
+        service = DjangoEmailService(account)
+        service._password = 'secret'
+        with mock.patch('mail.services.smtp_pool.smtp_pool', FakeSMTPPool()), \
+                mock.patch.object(imap_pool, 'session', return_value=contextlib.nullcontext(self.conn)):
+            result = service.send_email(['bob@example.org'], 'Hi', 'Body')
+        self.assertTrue(result['success'], result['error'])
+        stored = EmailMessage.objects.get(folder__name='Sent')
+        self.assertEqual((stored.message_id, stored.uid), (result['message_id'], '1'))
+        self.assertEqual(locate(account, ref='9:1').message_id, result['message_id'])
+        self.assertIn(result['message_id'].encode(), self.sent.messages[1].raw)
+
+    def test_sent_copy_already_synced_is_not_stored_twice(self):
+        account = create_account('ada@example.com')
+        service = DjangoEmailService(account)
+        folder = service._get_or_create_folder('Sent', 'sent')
+        for _ in range(2):
+            service._store_sent_email(folder, ['bob@example.org'], None, None, 'Hi', 'Body', None,
+                                      message_id='<1@example.com>', ref='9:1')
+        self.assertEqual(EmailMessage.objects.filter(message_id='<1@example.com>').count(), 1)
+
+
+class SMTPPipelineTests(TestCase):
+    """Replies of pipelined MAIL/RCPT/DATA matched to the right message"""
+
+    def test_end_of_data_reply_read_with_next_message(self):
+        conn = FakeSMTP(rejected=['c@example.org'])
+        pipeline = mail_merge.SMTPPipeline(conn)
+        self.assertEqual(pipeline.send('me@example.com', ['a@example.org'], b'First\r\n', 'a'), [])
+        self.assertEqual(pipeline.send('me@example.com', ['b@example.org'], b'Second', 'b'), [('a', None)])
+        self.assertEqual(pipeline.send('me@example.com', ['c@example.org'], b'Third', 'c'),
+                         [('b', None), ('c', '550 5.1.1 <c@example.org>: Recipient address rejected: User unknown')])
+        self.assertEqual(pipeline.flush(), [])
+        self.assertEqual(conn.written[:3], [
+            b'MAIL FROM:<me@example.com>\r\nRCPT TO:<a@example.org>\r\nDATA\r\n',
+            b'First\r\n.\r\nMAIL FROM:<me@example.com>\r\nRCPT TO:<b@example.org>\r\nDATA\r\n',
+            b'Second\r\n.\r\nMAIL FROM:<me@example.com>\r\nRCPT TO:<c@example.org>\r\nDATA\r\n',
+        ])
+        self.assertEqual(conn.sent, [b'First\r\n', b'Second\r\n'])
+        self.assertEqual(conn.commands[-1], ('RSET',))
+        self.assertEqual(conn.replies, [])
+
+    def test_dot_stuffing(self):
+        conn = FakeSMTP()
+        pipeline = mail_merge.SMTPPipeline(conn)
+        pipeline.send('me@example.com', ['a@example.org'], b'.Hi\r\n.\r\nbye', 'a')
+        self.assertEqual(pipeline.flush(), [('a', None)])
+        self.assertEqual(conn.written[-1], b'..Hi\r\n..\r\nbye\r\n.\r\n')
+        self.assertEqual(conn.sent, [b'.Hi\r\n.\r\nbye\r\n'])
+
+    def test_one_accepted_recipient_is_enough(self):
+        conn = FakeSMTP(rejected=['x@example.org'])
+        pipeline = mail_merge.SMTPPipeline(conn)
+        self.assertEqual(pipeline.send('me@example.com', ['x@example.org', 'a@example.org'], b'Hi', 'a'), [])
+        self.assertEqual(pipeline.flush(), [('a', None)])
+
+    def test_rejected_message(self):
+        conn = FakeSMTP(replies=[(250, b'OK'), (250, b'OK'), (354, b'Go'),
+                                 (250, b'Queued'), (250, b'OK'), (250, b'OK'), (354, b'Go'),
+                                 (550, b'Spam')])
+        pipeline = mail_merge.SMTPPipeline(conn)
+        pipeline.send('me@example.com', ['a@example.org'], b'First', 'a')
+        self.assertEqual(pipeline.send('me@example.com', ['b@example.org'], b'Second', 'b'), [('a', None)])
+        self.assertEqual(pipeline.flush(), [('b', '550 Spam')])
+
+    def test_sender_rejected(self):
+        conn = FakeSMTP(replies=[(250, b'OK'), (250, b'OK'), (354, b'Go'),
+                                 (250, b'Queued'), (553, b'Not yours'), (503, b'Need MAIL'), (503, b'Need RCPT')])
+        pipeline = mail_merge.SMTPPipeline(conn)
+        pipeline.send('me@example.com', ['a@example.org'], b'Hi', 'a')
+        outcomes = pipeline.send('someone@example.com', ['b@example.org'], b'Hi', 'b')
+        self.assertEqual(outcomes, [('a', None), ('b', '553 Not yours')])
+        self.assertEqual(conn.commands, [('RSET',)])
+        self.assertEqual(pipeline.flush(), [])
+
+    def test_every_recipient_rejected_but_data_accepted(self):
+        conn = FakeSMTP(replies=[(250, b'OK'), (550, b'No such user'), (354, b'Go'), (554, b'No valid recipients')])
+        pipeline = mail_merge.SMTPPipeline(conn)
+        outcomes = pipeline.send('me@example.com', ['x@example.org'], b'Hi', 'x')
+        self.assertEqual(outcomes, [('x', '550 No such user')])
+        self.assertEqual(conn.written[-1], b'.\r\n')
+        self.assertEqual(conn.commands, [('RSET',)])
+        self.assertEqual(conn.replies, [])
+
+    def test_without_pipelining(self):
+        conn = FakeSMTP(extensions=(), rejected=['x@example.org', 'y@example.org'])
+        pipeline = mail_merge.SMTPPipeline(conn)
+        self.assertEqual(pipeline.send('me@example.com', ['a@example.org'], b'Hi', 'a'), [('a', None)])
+        self.assertEqual(pipeline.send('me@example.com', ['x@example.org'], b'Hi', 'x'),
+                         [('x', '550 5.1.1 <x@example.org>: Recipient address rejected: User unknown')])
+        self.assertEqual(pipeline.send('me@example.com', ['y@example.org', 'b@example.org'], b'Hi', 'b'), [('b', None)])
+        conn.error = smtplib.SMTPDataError(554, b'Spam')
+        self.assertEqual(pipeline.send('me@example.com', ['c@example.org'], b'Hi', 'c'), [('c', '554 Spam')])
+        self.assertEqual(pipeline.flush(), [])
+        self.assertEqual(conn.written, [])
+        self.assertEqual(conn.sent, [b'Hi', b'Hi'])
+
+    def test_pipelining_turned_off(self):
+        conn = FakeSMTP()
+        pipeline = mail_merge.SMTPPipeline(conn, pipelining=False)
+        self.assertEqual(pipeline.send('me@example.com', ['a@example.org'], b'Hi', 'a'), [('a', None)])
+        self.assertEqual(conn.commands, [('SENDMAIL', 'me@example.com', ('a@example.org',))])
+
+
+@with_credential_key
+class MailMergeTests(TestCase):
+    """Merge jobs: per-contact rendering, checkpointed progress and resuming"""
+
+    def setUp(self):
+        self.account = create_account('ada@example.com')
+        self.user = self.account.user
+        self.contacts = [
+            Contact.objects.create(user=self.user, first_name=name, last_name='Doe', email=f'{name.lower()}@example.org',
+                                   tags=['customer'] if index % 2 == 0 else [])
+            for index, name in enumerate(['Ann', 'Ben', 'Cat', 'Dan', 'Eve'])
+        ]
+        Contact.objects.create(user=self.user, first_name='Old', last_name='Doe', email='old@example.org',
+                               is_active=False)
+        self.template = EmailTemplate.objects.create(
+            user=self.user, name='Offer', subject_template='Hello   {{ first_name }}\n',
+            body_template='Dear {{ full_name }}, {{ offer }} for {{ company|default:"you" }}.',
+            variables={'offer': '10% off'},
+        )
+        self.pool = FakeSMTPPool()
+        patcher = mock.patch('mail.services.mail_merge.smtp_pool', self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_job(self, job, **kwargs):
+        self.assertTrue(mail_merge.claim_job(job))
+        return mail_merge.run_job(job, **kwargs)
+
+    def test_render(self):
+        compiled = mail_merge.CompiledTemplate(self.template, {'offer': '20% off'})
+        self.assertEqual(compiled.render(self.contacts[0]), ('Hello Ann', 'Dear Ann Doe, 20% off for you.', None))
+
+    def test_html_body_is_escaped_with_text_alternative(self):
+        self.template.body_template = '<p>Dear {{ first_name }}</p>'
+        self.contacts[0].first_name = '<b>Ann</b>'
+        subject, body_text, body_html = mail_merge.CompiledTemplate(self.template).render(self.contacts[0])
+        self.assertEqual(body_html, '<p>Dear &lt;b&gt;Ann&lt;/b&gt;</p>')
+        self.assertEqual(body_text, 'Dear &lt;b&gt;Ann&lt;/b&gt;')
+
+    def test_create_job_stores_sealed_password(self):
+        job = mail_merge.create_job(self.account, self.template, password='secret')
+        self.assertNotIn('secret', job.smtp_password)
+        self.assertEqual(credentials.unseal(job.smtp_password), 'secret')
+
+    def test_refused_login_is_not_retried_as_a_reconnect(self):
+        job = mail_merge.create_job(self.account, self.template, password='wrong')
+        error = smtplib.SMTPAuthenticationError(535, b'5.7.8 Authentication failed')
+        with mock.patch.object(self.pool, 'acquire', side_effect=error) as acquire:
+            job = self.run_job(job)
+        self.assertEqual(acquire.call_count, 1)
+        self.assertEqual((job.status, job.smtp_password), (MailMergeJob.STATUS_FAILED, ''))
+        self.assertIn('Authentication failed', job.last_error)
+
+    def test_create_job_counts_recipients(self):
+        self.assertEqual(mail_merge.create_job(self.account, self.template).total, 5)
+        self.assertEqual(mail_merge.create_job(self.account, self.template, tag='customer').total, 3)
+        self.template.body_template = '{% if %}'
+        with self.assertRaises(TemplateSyntaxError):
+            mail_merge.create_job(self.account, self.template)
+
+    def test_run_job(self):
+        job = mail_merge.create_job(self.account, self.template, tag='customer', password='secret')
+        job = self.run_job(job)
+        self.assertEqual((job.status, job.sent_count, job.failed_count, job.smtp_password),
+                         (MailMergeJob.STATUS_COMPLETED, 3, 0, ''))
+        conn = self.pool.connections[0]
+        self.assertEqual(self.pool.released, [conn])
+        self.assertEqual([command[1] for command in conn.commands if command[0] == 'RCPT TO'],
+                         ['ann@example.org', 'cat@example.org', 'eve@example.org'])
+        self.assertIn(b'Subject: Hello Cat', conn.sent[1])
+        self.assertEqual(Contact.objects.filter(last_contacted__isnull=False).count(), 3)
+
+    def test_rejected_recipients_are_recorded(self):
+        self.pool.pending = [FakeSMTP(rejected=['ben@example.org'])]
+        job = self.run_job(mail_merge.create_job(self.account, self.template, password='secret'))
+        self.assertEqual((job.status, job.sent_count, job.failed_count), (MailMergeJob.STATUS_COMPLETED, 4, 1))
+        self.assertEqual(job.failures[0]['email'], 'ben@example.org')
+        self.assertIn('550', job.failures[0]['error'])
+
+    def test_reconnects_and_resumes_from_checkpoint(self):
+        dropping = FakeSMTP()
+        dropping.drop_after = 2
+        self.pool.pending = [dropping]
+        job = self.run_job(mail_merge.create_job(self.account, self.template, password='secret'),
+                           checkpoint_every=1)
+        self.assertEqual((job.status, job.sent_count), (MailMergeJob.STATUS_COMPLETED, 5))
+        self.assertEqual(self.pool.discarded, [dropping])
+        resent = [command[1] for command in self.pool.connections[1].commands if command[0] == 'RCPT TO']
+        # Ben's message went out but its reply was lost with the connection, so it is sent again
+        self.assertEqual(resent, ['ben@example.org', 'cat@example.org', 'dan@example.org', 'eve@example.org'])
+
+    def test_failed_job_resumes(self):
+        dropping = FakeSMTP()
+        dropping.drop_after = 2
+        dead = [FakeSMTP() for _ in range(mail_merge.MAX_RECONNECTS)]
+        for conn in dead:
+            conn.alive = False
+        self.pool.pending = [dropping, *dead]
+        job = self.run_job(mail_merge.create_job(self.account, self.template, password='secret'),
+                           checkpoint_every=1)
+        self.assertEqual((job.status, job.sent_count, job.smtp_password), (MailMergeJob.STATUS_FAILED, 1, ''))
+        self.assertIn('Connection unexpectedly closed', job.last_error)
+
+        # A failed job doesn't keep the password; resuming takes it again
+        job = self.run_job(MailMergeJob.objects.get(pk=job.pk), password='secret')
+        self.assertEqual((job.status, job.sent_count, job.last_error), (MailMergeJob.STATUS_COMPLETED, 5, ''))
+        self.assertEqual(self.pool.passwords[-1], 'secret')
+        resent = [command[1] for command in self.pool.connections[-1].commands if command[0] == 'RCPT TO']
+        self.assertEqual(resent, ['ben@example.org', 'cat@example.org', 'dan@example.org', 'eve@example.org'])
+
+    def test_claimable_jobs(self):
+        pending = mail_merge.create_job(self.account, self.template)
+        running = mail_merge.create_job(self.account, self.template)
+        MailMergeJob.objects.filter(pk=running.pk).update(status=MailMergeJob.STATUS_RUNNING)
+        self.assertEqual(list(mail_merge.claimable_jobs()), [pending])
+        MailMergeJob.objects.filter(pk=running.pk).update(updated_at=timezone.now() - timedelta(seconds=700))
+        self.assertEqual(list(mail_merge.claimable_jobs()), [pending, running])
+
+        stale = MailMergeJob.objects.get(pk=pending.pk)
+        self.assertTrue(mail_merge.claim_job(pending))
+        self.assertFalse(mail_merge.claim_job(stale))
+
+    def test_command(self):
+        job = mail_merge.create_job(self.account, self.template, password='secret')
+        out = io.StringIO()
+        call_command('run_mail_merge', '--no-pipelining', stdout=out)
+        self.assertIn(f'✓ Job {job.pk}: 5 sent, 0 rejected', out.getvalue())
+        self.assertEqual(self.pool.connections[0].written, [])
+        call_command('run_mail_merge', '--job', str(job.pk), stdout=out)
+        self.assertIn(f'Job {job.pk} is already completed', out.getvalue())
+        with self.assertRaises(CommandError):
+            call_command('run_mail_merge', '--job', '999999', stdout=out)
+
+
+@with_credential_key
+class RateLimitTests(TestCase):
+    """360 messages/hour: the domain bucket holds 30 tokens, each account's 15, refilled at 0.1 and 0.05/s"""
+
+    def setUp(self):
+        self.account = create_account(message_limit=360)
+        self.domain_bucket = rate_limit.domain_bucket(self.account.domain)
+        self.account_bucket = rate_limit.account_bucket(self.account)
+
+    def level(self, bucket, now=None):
+        return bucket.level(RateLimitBucket.objects.filter(key=bucket.key).first(), now or timezone.now())
+
+    def drain(self, bucket):
+        RateLimitBucket.objects.update_or_create(key=bucket.key, defaults={'tokens': 0, 'updated_at': timezone.now()})
+
+    def test_buckets(self):
+        self.assertEqual((self.domain_bucket.capacity, self.domain_bucket.rate), (30, 0.1))
+        self.assertEqual((self.account_bucket.capacity, self.account_bucket.rate), (15, 0.05))
+        with override_settings(EMAIL_RATE_LIMIT_ACCOUNT_PERCENT=100):
+            self.assertEqual(rate_limit.buckets_for(self.account), [self.domain_bucket])
+
+    def test_unlimited_domain(self):
+        Domain.objects.filter(pk=self.account.domain_id).update(message_limit=0)
+        self.account.domain.refresh_from_db()
+        self.assertEqual(rate_limit.take(self.account), (0, None))
+        self.assertFalse(RateLimitBucket.objects.exists())
+
+    def test_account_bucket_runs_out_first(self):
+        for _ in range(15):
+            self.assertEqual(rate_limit.take(self.account)[1], None)
+        wait, limiting = rate_limit.take(self.account)
+        self.assertEqual(limiting, self.account_bucket)
+        self.assertAlmostEqual(wait, 20, delta=0.5)
+        self.assertAlmostEqual(self.level(self.domain_bucket), 15, delta=0.1)
+
+    def test_refill(self):
+        start = timezone.now()
+        with mock.patch('mail.services.rate_limit.timezone.now', return_value=start):
+            for _ in range(15):
+                rate_limit.take(self.account)
+            self.assertIsNotNone(rate_limit.take(self.account)[1])
+        # 20 seconds later the account bucket has one token again
+        with mock.patch('mail.services.rate_limit.timezone.now', return_value=start + timedelta(seconds=20)):
+            self.assertEqual(rate_limit.take(self.account), (0, None))
+            self.assertIsNotNone(rate_limit.take(self.account)[1])
+        # Never above capacity, however long the bucket was idle
+        self.assertEqual(self.level(self.account_bucket, start + timedelta(days=1)), 15)
+
+    def test_all_or_nothing(self):
+        rate_limit.take(self.account)
+        RateLimitBucket.objects.filter(key=self.domain_bucket.key).update(tokens=0.5, updated_at=timezone.now())
+        wait, limiting = rate_limit.take(self.account)
+        self.assertEqual(limiting, self.domain_bucket)
+        self.assertAlmostEqual(wait, 5, delta=0.5)
+        # The account bucket had a token but gave none
+        self.assertAlmostEqual(self.level(self.account_bucket), 14, delta=0.1)
+
+    def test_refund(self):
+        rate_limit.take(self.account)
+        rate_limit.take(self.account)
+        rate_limit.refund(self.account)
+        self.assertAlmostEqual(self.level(self.account_bucket), 14, delta=0.1)
+        self.assertAlmostEqual(self.level(self.domain_bucket), 29, delta=0.1)
+        rate_limit.refund(self.account)
+        rate_limit.refund(self.account)
+        self.assertAlmostEqual(self.level(self.account_bucket), 15, delta=0.01)
+
+    def test_failed_outbox_delivery_gives_token_back(self):
+        outbox.enqueue(self.account, ['rcpt@example.org'], 'Subject', 'Body', password='secret')
+        entry = outbox.claim(1)[0]
+        self.assertTrue(outbox.OutboxWorker()._admit(entry, Counter()))
+        self.assertAlmostEqual(self.level(self.account_bucket), 14, delta=0.1)
+        with mock.patch.object(outbox, 'smtp_pool', FakeSMTPPool(smtplib.SMTPDataError(451, b'Later'))):
+            self.assertEqual(outbox.deliver(entry), OutboxMessage.STATUS_QUEUED)
+        self.assertAlmostEqual(self.level(self.account_bucket), 15, delta=0.1)
+
+    def test_failed_direct_send_gives_token_back(self):
+        service = DjangoEmailService(self.account)
+        service._password = 'secret'
+        pool = FakeSMTPPool(smtplib.SMTPDataError(554, b'Rejected'))
+        with mock.patch('mail.services.smtp_pool.smtp_pool', pool):
+            result = service.send_email(['rcpt@example.org'], 'Subject', 'Body')
+        self.assertFalse(result['success'])
+        self.assertEqual(len(pool.connections), 1)
+        self.assertAlmostEqual(self.level(self.account_bucket), 15, delta=0.1)
+
+    def test_levels(self):
+        EmailAccount.objects.create(user=self.account.user, domain=self.account.domain, email='idle@example.com',
+                                    first_name='Idle', last_name='Account')
+        rate_limit.take(self.account)
+        [entry] = rate_limit.levels([self.account.domain])
+        self.assertEqual((entry['domain'], entry['message_limit'], entry['capacity']), ('example.com', 360, 30))
+        self.assertAlmostEqual(entry['available'], 29, delta=0.1)
+        # Only accounts that have been sending are listed
+        self.assertEqual([account['email'] for account in entry['accounts']], [self.account.email])
+
+    def test_direct_send_is_refused_over_the_limit(self):
+        self.drain(self.account_bucket)
+        service = DjangoEmailService(self.account)
+        service._password = 'secret'
+        pool = FakeSMTPPool()
+        with mock.patch('mail.services.smtp_pool.smtp_pool', pool):
+            result = service.send_email(['rcpt@example.org'], 'Subject', 'Body')
+        self.assertFalse(result['success'])
+        self.assertIn('Sending limit of example.com reached (360 messages per hour), try again in 20s', result['error'])
+        self.assertEqual(pool.connections, [])
+
+    def test_outbox_holds_back_throttled_messages(self):
+        outbox.enqueue(self.account, ['rcpt@example.org'], 'Subject', 'Body', password='secret')
+        self.drain(self.domain_bucket)
+        entry = outbox.claim(1)[0]
+        worker = outbox.OutboxWorker()
+        totals = Counter()
+        self.assertFalse(worker._admit(entry, totals))
+        self.assertEqual(totals, Counter({outbox.THROTTLED: 1}))
+        entry.refresh_from_db()
+        self.assertEqual((entry.status, entry.attempts), (OutboxMessage.STATUS_QUEUED, 0))
+        self.assertGreater(entry.next_attempt_at, timezone.now() + timedelta(seconds=5))
+        self.assertEqual([bucket for bucket, _ in worker._throttled.values()], [self.domain_bucket])
+
+    def test_merge_job_waits_for_tokens(self):
+        Contact.objects.create(user=self.account.user, first_name='Ann', last_name='Doe', email='ann@example.org')
+        Contact.objects.create(user=self.account.user, first_name='Ben', last_name='Doe', email='ben@example.org')
+        template = EmailTemplate.objects.create(user=self.account.user, name='News', subject_template='News',
+                                                body_template='Hi {{ first_name }}')
+        job = mail_merge.create_job(self.account, template, password='secret')
+        mail_merge.claim_job(job)
+        RateLimitBucket.objects.create(key=self.account_bucket.key, tokens=1, updated_at=timezone.now())
+
+        def wait(job, seconds):
+            waits.append(round(seconds))
+            RateLimitBucket.objects.filter(key=self.account_bucket.key).update(tokens=1)
+
+        waits = []
+        pool = FakeSMTPPool()
+        with mock.patch('mail.services.mail_merge.smtp_pool', pool), \
+                mock.patch('mail.services.mail_merge._wait_for_token', side_effect=wait):
+            job = mail_merge.run_job(job)
+        self.assertEqual((job.status, job.sent_count), (MailMergeJob.STATUS_COMPLETED, 2))
+        self.assertEqual(waits, [20])
+        # The connection is given back while waiting
+        self.assertEqual(len(pool.released), 2)
+        self.assertEqual(sum(len(conn.sent) for conn in pool.connections), 2)
+
+    def test_rejected_merge_recipient_gives_token_back(self):
+        Contact.objects.create(user=self.account.user, first_name='Ann', last_name='Doe', email='ann@example.org')
+        Contact.objects.create(user=self.account.user, first_name='Ben', last_name='Doe', email='ben@example.org')
+        template = EmailTemplate.objects.create(user=self.account.user, name='News', subject_template='News',
+                                                body_template='Hi {{ first_name }}')
+        job = mail_merge.create_job(self.account, template, password='secret')
+        mail_merge.claim_job(job)
+        pool = FakeSMTPPool(pending=[FakeSMTP(rejected=['ben@example.org'])])
+        with mock.patch('mail.services.mail_merge.smtp_pool', pool):
+            job = mail_merge.run_job(job)
+        self.assertEqual((job.sent_count, job.failed_count), (1, 1))
+        self.assertAlmostEqual(self.level(self.account_bucket), 14, delta=0.1)
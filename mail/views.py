@@ -7,12 +7,40 @@ from django.views.decorators.http import require_POST, require_GET
 from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
 from .forms import ComposeEmailForm
-from .models import Draft, EmailAccount
+from .models import Draft, EmailAccount, EmailFolder
+from .services import imap_pool
+from .services.imap_fetch import resolve_uid
+from .services.imap_actions import apply_action
+from .services.message_locations import apply_action_results
+from .services.folder_status import invalidate_folder_status
+from .services.message_cache import message_cache
 import json
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Folders shown in the sidebar before the client loads the live IMAP list
+SIDEBAR_FOLDERS = [
+    {'name': 'INBOX', 'display_name': 'Inbox', 'folder_type': 'inbox', 'unread_count': 0, 'total_count': 0},
+    {'name': 'Sent', 'display_name': 'Sent', 'folder_type': 'sent', 'unread_count': 0, 'total_count': 0},
+    {'name': 'Drafts', 'display_name': 'Drafts', 'folder_type': 'drafts', 'unread_count': 0, 'total_count': 0},
+    {'name': 'Trash', 'display_name': 'Trash', 'folder_type': 'trash', 'unread_count': 0, 'total_count': 0},
+    {'name': 'Spam', 'display_name': 'Spam', 'folder_type': 'spam', 'unread_count': 0, 'total_count': 0},
+]
+
+
+def sidebar_folders(user):
+    """Sidebar folders with the stored EmailFolder counters (one query, no EmailMessage scans)"""
+    counters = {
+        name: (unread, total)
+        for name, unread, total in EmailFolder.objects.filter(account__user=user, account__is_active=True)
+        .values_list('name', 'unread_count', 'total_count')
+    }
+    return [
+        {**folder, 'unread_count': counters.get(folder['name'], (0, 0))[0], 'total_count': counters.get(folder['name'], (0, 0))[1]}
+        for folder in SIDEBAR_FOLDERS
+    ]
+
 def get_or_create_api_token(request):
     """Get existing API token or create new one for the user"""
     # Check session first
@@ -31,13 +59,7 @@ def inbox(request):
         current_folder = request.GET.get('folder', 'INBOX')
 
         # Create default folders for the user
-        default_folders = [
-            {'name': 'INBOX', 'display_name': 'Inbox', 'folder_type': 'inbox', 'unread_count': 0, 'total_count': 0},
-            {'name': 'Sent', 'display_name': 'Sent', 'folder_type': 'sent', 'unread_count': 0, 'total_count': 0},
-            {'name': 'Drafts', 'display_name': 'Drafts', 'folder_type': 'drafts', 'unread_count': 0, 'total_count': 0},
-            {'name': 'Trash', 'display_name': 'Trash', 'folder_type': 'trash', 'unread_count': 0, 'total_count': 0},
-            {'name': 'Spam', 'display_name': 'Spam', 'folder_type': 'spam', 'unread_count': 0, 'total_count': 0},
-        ]
+        default_folders = sidebar_folders(request.user)
 
         # All emails (including drafts) are now loaded client-side via JavaScript API calls
         # Don't try to load them server-side to avoid authentication issues and conflicts
@@ -56,13 +78,7 @@ def inbox(request):
     except Exception as e:
         logger.error(f"Inbox view error: {e}")
         messages_list = []
-        default_folders = [
-            {'name': 'INBOX', 'display_name': 'Inbox', 'folder_type': 'inbox', 'unread_count': 0, 'total_count': 0},
-            {'name': 'Sent', 'display_name': 'Sent', 'folder_type': 'sent', 'unread_count': 0, 'total_count': 0},
-            {'name': 'Drafts', 'display_name': 'Drafts', 'folder_type': 'drafts', 'unread_count': 0, 'total_count': 0},
-            {'name': 'Trash', 'display_name': 'Trash', 'folder_type': 'trash', 'unread_count': 0, 'total_count': 0},
-            {'name': 'Spam', 'display_name': 'Spam', 'folder_type': 'spam', 'unread_count': 0, 'total_count': 0},
-        ]
+        default_folders = [dict(folder) for folder in SIDEBAR_FOLDERS]
         current_folder = request.GET.get('folder', 'INBOX')
         search_query = request.GET.get('q', '').strip()
 
@@ -92,13 +108,7 @@ def folder_view(request, folder_name):
     messages_list = []
 
     # Use default folder structure for display
-    default_folders = [
-        {'name': 'INBOX', 'display_name': 'Inbox', 'folder_type': 'inbox', 'unread_count': 0, 'total_count': 0},
-        {'name': 'Sent', 'display_name': 'Sent', 'folder_type': 'sent', 'unread_count': 0, 'total_count': 0},
-        {'name': 'Drafts', 'display_name': 'Drafts', 'folder_type': 'drafts', 'unread_count': 0, 'total_count': 0},
-        {'name': 'Trash', 'display_name': 'Trash', 'folder_type': 'trash', 'unread_count': 0, 'total_count': 0},
-        {'name': 'Spam', 'display_name': 'Spam', 'folder_type': 'spam', 'unread_count': 0, 'total_count': 0},
-    ]
+    default_folders = sidebar_folders(request.user)
 
     context = {
         'messages': messages_list,
@@ -223,11 +233,12 @@ def email_detail(request, message_id):
                 else:
                     self.date_received = None
 
-                # Mock attachments manager for template compatibility
-                class MockAttachments:
+                # Attachments manager for template compatibility (manifest from the API, inline parts excluded)
+                manifest = [attachment for attachment in data.get('attachments', []) if not attachment.get('inline')]
+                class ManifestAttachments:
                     def all(self):
-                        return []
-                self.attachments = MockAttachments()
+                        return manifest
+                self.attachments = ManifestAttachments()
 
         message = MessageObject(message_data)
 
@@ -413,20 +424,20 @@ def store_reply_data(request):
 def get_folders(request):
     """Get email folders for the current user"""
     try:
-        # For now, return standard folders plus drafts
-        # In a full implementation, this would sync with the email server
+        # Counters are maintained on EmailFolder by the sync, so no message rows are counted here
+        counters = {folder['name']: folder for folder in sidebar_folders(request.user)}
         folders = [
             {
                 'id': 'INBOX',
                 'name': 'Inbox',
-                'unread_count': 0,  # Would be calculated from EmailMessage model
-                'total_count': 0,
+                'unread_count': counters['INBOX']['unread_count'],
+                'total_count': counters['INBOX']['total_count'],
             },
             {
                 'id': 'SENT',
                 'name': 'Sent',
-                'unread_count': 0,
-                'total_count': 0,
+                'unread_count': counters['Sent']['unread_count'],
+                'total_count': counters['Sent']['total_count'],
             },
             {
                 'id': 'DRAFT',
@@ -437,8 +448,8 @@ def get_folders(request):
             {
                 'id': 'TRASH',
                 'name': 'Trash',
-                'unread_count': 0,
-                'total_count': 0,
+                'unread_count': counters['Trash']['unread_count'],
+                'total_count': counters['Trash']['total_count'],
             },
         ]
 
@@ -454,7 +465,7 @@ def get_folders(request):
 
 def _send_email_from_form(request, form):
     """Helper function to send email from compose form - DRY"""
-    from mail.services import DjangoEmailService
+    from mail.services.outbox import enqueue as enqueue_message
     
     # Get user's email account
     try:
@@ -505,22 +516,22 @@ def _send_email_from_form(request, form):
         for attachment in form.cleaned_data['attachments']:
             attachments.append((attachment.name, attachment.read(), attachment.content_type))
     
-    # Send email
+    # Queue for the outbox worker (SMTP delivery happens off the request)
     try:
-        email_service = DjangoEmailService(email_account)
-        email_service._password = password
-        result = email_service.send_email(
+        entry = enqueue_message(
+            email_account,
             to_emails=to_emails,
             subject=subject,
             body_text=body_text,
             body_html=body_html,
             cc_emails=cc_emails if cc_emails else None,
             bcc_emails=bcc_emails if bcc_emails else None,
-            attachments=attachments if attachments else None
+            attachments=attachments if attachments else None,
+            password=password,
         )
-        return result
+        return {'success': True, 'message_id': entry.message_id, 'outbox_id': entry.pk, 'error': None}
     except Exception as e:
-        logger.error(f"Failed to send email: {e}")
+        logger.error(f"Failed to queue email: {e}")
         return {'success': False, 'error': f'Failed to send email: {str(e)}'}
 
 @login_required
@@ -711,33 +722,20 @@ def mark_as_read(request, message_id):
         # Get folder from query params
         folder_name = request.GET.get('folder', 'INBOX')
         
-        # Connect to IMAP
-        import imaplib
-        import socket
-        import os
-        from django.conf import settings
-        
-        if os.path.exists('/.dockerenv'):
-            IMAP_HOST = getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
-        else:
-            IMAP_HOST = getattr(settings, 'EMAIL_IMAP_HOST', 'mail.fayvad.com')
-            try:
-                socket.gethostbyname(IMAP_HOST)
-            except socket.gaierror:
-                IMAP_HOST = getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
-        
-        mail = imaplib.IMAP4_SSL(IMAP_HOST, 993, timeout=10)
-        mail.login(email_account.email, password)
-        
         # Select folder
         folder_map = {'INBOX': 'INBOX', 'Sent': 'Sent', 'Drafts': 'Drafts', 'Trash': 'Trash', 'Spam': 'Spam'}
         imap_folder = folder_map.get(folder_name, folder_name)
-        mail.select(imap_folder)
         
-        # Mark as read (add \Seen flag)
-        mail.store(str(message_id), '+FLAGS', '\\Seen')
-        mail.logout()
+        with imap_pool.session(email_account.email, password, folder=imap_folder) as mail:
+            uid = resolve_uid(mail, message_id)
+            message_cache.invalidate(email_account.email, imap_folder, mail.uidvalidity, uid)
+            # Mark as read (add \Seen flag)
+            result = apply_action(mail, 'mark_read', [uid])
+            if result[int(uid)]['status'] == 'failed':
+                return JsonResponse({'success': False, 'error': result[int(uid)]['error']})
+            apply_action_results(email_account, imap_folder, mail.uidvalidity, 'mark_read', result)
         
+        invalidate_folder_status(email_account.email)
         return JsonResponse({'success': True})
     except Exception as e:
         logger.error(f"Failed to mark email as read: {e}")
@@ -762,33 +760,20 @@ def mark_as_unread(request, message_id):
         # Get folder from query params
         folder_name = request.GET.get('folder', 'INBOX')
         
-        # Connect to IMAP
-        import imaplib
-        import socket
-        import os
-        from django.conf import settings
-        
-        if os.path.exists('/.dockerenv'):
-            IMAP_HOST = getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
-        else:
-            IMAP_HOST = getattr(settings, 'EMAIL_IMAP_HOST', 'mail.fayvad.com')
-            try:
-                socket.gethostbyname(IMAP_HOST)
-            except socket.gaierror:
-                IMAP_HOST = getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
-        
-        mail = imaplib.IMAP4_SSL(IMAP_HOST, 993, timeout=10)
-        mail.login(email_account.email, password)
-        
         # Select folder
         folder_map = {'INBOX': 'INBOX', 'Sent': 'Sent', 'Drafts': 'Drafts', 'Trash': 'Trash', 'Spam': 'Spam'}
         imap_folder = folder_map.get(folder_name, folder_name)
-        mail.select(imap_folder)
         
-        # Mark as unread (remove \Seen flag)
-        mail.store(str(message_id), '-FLAGS', '\\Seen')
-        mail.logout()
+        with imap_pool.session(email_account.email, password, folder=imap_folder) as mail:
+            uid = resolve_uid(mail, message_id)
+            message_cache.invalidate(email_account.email, imap_folder, mail.uidvalidity, uid)
+            # Mark as unread (remove \Seen flag)
+            result = apply_action(mail, 'mark_unread', [uid])
+            if result[int(uid)]['status'] == 'failed':
+                return JsonResponse({'success': False, 'error': result[int(uid)]['error']})
+            apply_action_results(email_account, imap_folder, mail.uidvalidity, 'mark_unread', result)
         
+        invalidate_folder_status(email_account.email)
         return JsonResponse({'success': True})
     except Exception as e:
         logger.error(f"Failed to mark email as unread: {e}")
@@ -814,51 +799,28 @@ def delete_message(request, message_id):
         folder_name = request.GET.get('folder', 'INBOX')
         permanent = request.GET.get('permanent', 'false').lower() == 'true'
         
-        # Connect to IMAP
-        import imaplib
-        import socket
-        import os
-        from django.conf import settings
-        
-        if os.path.exists('/.dockerenv'):
-            IMAP_HOST = getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
-        else:
-            IMAP_HOST = getattr(settings, 'EMAIL_IMAP_HOST', 'mail.fayvad.com')
-            try:
-                socket.gethostbyname(IMAP_HOST)
-            except socket.gaierror:
-                IMAP_HOST = getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
-        
-        mail = imaplib.IMAP4_SSL(IMAP_HOST, 993, timeout=10)
-        mail.login(email_account.email, password)
-        
         # Select folder
         folder_map = {'INBOX': 'INBOX', 'Sent': 'Sent', 'Drafts': 'Drafts', 'Trash': 'Trash', 'Spam': 'Spam'}
         imap_folder = folder_map.get(folder_name, folder_name)
-        mail.select(imap_folder)
         
-        if permanent or folder_name == 'Trash':
-            # Permanently delete
-            mail.store(str(message_id), '+FLAGS', '\\Deleted')
-            mail.expunge()
-        else:
-            # Move to Trash
-            try:
-                mail.select('Trash')
-            except:
-                mail.create('Trash')
-                mail.select('Trash')
-            
-            # Copy message to Trash
-            mail.select(imap_folder)
-            result = mail.copy(str(message_id), 'Trash')
-            if result[0] == 'OK':
-                # Mark original as deleted
-                mail.store(str(message_id), '+FLAGS', '\\Deleted')
-                mail.expunge()
-        
-        mail.logout()
+        with imap_pool.session(email_account.email, password, folder=imap_folder) as mail:
+            uid = resolve_uid(mail, message_id)
+            message_cache.invalidate(email_account.email, imap_folder, mail.uidvalidity, uid)
+            if permanent or folder_name == 'Trash':
+                # Permanently delete (expunges only this message)
+                result = apply_action(mail, 'delete', [uid])
+            else:
+                # Move to Trash (create it if missing)
+                result = apply_action(mail, 'move', [uid], 'Trash')
+                if result[int(uid)]['status'] == 'failed':
+                    mail.create('Trash')
+                    result = apply_action(mail, 'move', [uid], 'Trash')
+            if result[int(uid)]['status'] == 'failed':
+                return JsonResponse({'success': False, 'error': result[int(uid)]['error']})
+            apply_action_results(email_account, imap_folder, mail.uidvalidity,
+                                 'delete' if permanent or folder_name == 'Trash' else 'move', result, 'Trash')
         
+        invalidate_folder_status(email_account.email)
         return JsonResponse({'success': True})
     except Exception as e:
         logger.error(f"Failed to delete email: {e}")
@@ -888,39 +850,17 @@ def move_message(request, message_id):
         # Get current folder from query params
         current_folder = request.POST.get('current_folder', 'INBOX')
 
-        # Connect to IMAP
-        import imaplib
-        import socket
-        import os
-        from django.conf import settings
-
-        if os.path.exists('/.dockerenv'):
-            IMAP_HOST = getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
-        else:
-            IMAP_HOST = getattr(settings, 'EMAIL_IMAP_HOST', 'mail.fayvad.com')
-            try:
-                socket.gethostbyname(IMAP_HOST)
-            except socket.gaierror:
-                IMAP_HOST = getattr(settings, 'MAIL_SERVER_IP', '167.86.95.242')
-
-        IMAP_PORT = 993
-        IMAP_USE_SSL = True
-
-        if IMAP_USE_SSL:
-            mail = imaplib.IMAP4_SSL(IMAP_HOST, IMAP_PORT, timeout=10)
-        else:
-            mail = imaplib.IMAP4(IMAP_HOST, IMAP_PORT, timeout=10)
-
-        mail.login(email_account.email, password)
-        mail.select(current_folder)
-
-        # Copy message to target folder
-        mail.copy(str(message_id), folder_name)
-        # Mark original as deleted
-        mail.store(str(message_id), '+FLAGS', '\\Deleted')
-        mail.expunge()
-        mail.logout()
-
+        with imap_pool.session(email_account.email, password, folder=current_folder) as mail:
+            uid = resolve_uid(mail, message_id)
+            message_cache.invalidate(email_account.email, current_folder, mail.uidvalidity, uid)
+            # MOVE (or COPY + UID EXPUNGE) to the target folder
+            results = apply_action(mail, 'move', [uid], folder_name)
+            result = results[int(uid)]
+            if result['status'] == 'failed':
+                return JsonResponse({'success': False, 'error': result['error']})
+            apply_action_results(email_account, current_folder, mail.uidvalidity, 'move', results, folder_name)
+
+        invalidate_folder_status(email_account.email)
         return JsonResponse({'success': True})
     except Exception as e:
         logger.error(f"Failed to move email: {e}")
@@ -6,6 +6,8 @@ import requests
 
 from .models import Organization
 from accounts.models import User
+from mail.models import Domain
+from mail.services import rate_limit
 
 def is_org_admin(user):
     """Check if user is organization admin"""
@@ -84,6 +86,9 @@ def dashboard(request):
             'domains': [],
         }
 
+    # Outbound rate limit levels come from the local database
+    context['rate_limits'] = rate_limit.levels(Domain.objects.filter(organization=organization).order_by('name'))
+
     return render(request, 'organizations/dashboard.html', context)
 
 @login_required